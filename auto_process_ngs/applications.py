@@ -46,12 +46,21 @@ __version__ = "0.0.8"
 #######################################################################
 
 import sys
+import os
 import re
+import pipes
 import subprocess
 import logging
 import tempfile
 from bcftbx.utils import find_program
 
+#######################################################################
+# Constants
+#######################################################################
+
+# Tag for resource usage line written by wrapper scripts
+RESOURCE_USAGE_TAG = "#### RESOURCES"
+
 #######################################################################
 # Classes
 #######################################################################
@@ -237,12 +246,20 @@ class Command:
         return (status,output)
 
     def make_wrapper_script(self,shell=None,filen=None,fp=None,
-                            prologue=None,epilogue=None):
+                            prologue=None,epilogue=None,
+                            resource_usage=False):
         """Wrap the command in a script
 
         Returns a string which can be injected into a file and
         run as a script.
 
+        If 'resource_usage' is set then the script will also
+        record the wall time, CPU time and peak memory (RSS)
+        used by the command, and write them to stdout on a line
+        starting with RESOURCE_USAGE_TAG after the command
+        completes (see 'resource_usage_wrapper'). These can be
+        recovered from the output using 'parse_resource_usage'.
+
         Arguments:
           shell (str): optional, if set then will be written
             to the wrapper script shebang (#!)
@@ -255,6 +272,9 @@ class Command:
             into the script before the command
           epilogue (str): optional, if set then will be written
             into the script after the command
+          resource_usage (bool): optional, if True then also
+            record the resources used by the command (default:
+            False)
 
         Returns:
           String: the wrapper script contents.
@@ -264,7 +284,10 @@ class Command:
             script.append("#!%s" % shell)
         if prologue is not None:
             script.append("%s" % prologue)
-        script.append(str(self))
+        if resource_usage:
+            script.append(resource_usage_wrapper(str(self)))
+        else:
+            script.append(str(self))
         if epilogue is not None:
             script.append("%s" % epilogue)
         script = '\n'.join(script)
@@ -570,3 +593,119 @@ class general:
         """
         scp_command = Command('scp',source,'%s@%s:%s' % (user,server,target))
         return scp_command
+
+#######################################################################
+# Functions
+#######################################################################
+
+def resource_usage_wrapper(cmd):
+    """Wrap a command line to record the resources it uses
+
+    Returns shell code which runs the command and then writes
+    a line of the form
+
+    #### RESOURCES wall=WALL user=USER sys=SYS maxrss=MAXRSS
+
+    to stdout, where WALL, USER and SYS are the elapsed,
+    user CPU and system CPU times (in seconds) and MAXRSS
+    is the peak resident set size (in Kb).
+
+    If GNU '/usr/bin/time' is available then this is used
+    to get the values; otherwise the shell's 'times' builtin
+    is used instead (in which case 'maxrss' is not available
+    and the times are reported in the form '0m1.234s'). NB
+    'times' must run in the wrapper's own shell (not in a
+    pipeline or subshell) to report the times for the
+    command.
+
+    The exit status of the shell code is the exit status of
+    the command.
+
+    Arguments:
+      cmd (str): command line to wrap
+
+    Returns:
+      String: shell code to run the command.
+    """
+    return '\n'.join(
+        ["_rusage_start=$(date +%s)",
+         "if /usr/bin/time -f \"\" true >/dev/null 2>&1 ; then",
+         "  _rusage_file=$(mktemp)",
+         "  /usr/bin/time -f \"wall=%%e user=%%U sys=%%S maxrss=%%M\" "
+         "-o $_rusage_file /bin/bash -c %s" % pipes.quote(cmd),
+         "  _rusage_exit_code=$?",
+         "  echo \"%s $(tail -n 1 $_rusage_file)\"" % RESOURCE_USAGE_TAG,
+         "  rm -f $_rusage_file",
+         "else",
+         "  %s" % cmd,
+         "  _rusage_exit_code=$?",
+         "  _rusage_times_file=$(mktemp)",
+         "  times >$_rusage_times_file",
+         "  set -- $(sed -n 2p $_rusage_times_file)",
+         "  rm -f $_rusage_times_file",
+         "  echo \"%s wall=$(($(date +%%s)-_rusage_start)) "
+         "user=$1 sys=$2\"" % RESOURCE_USAGE_TAG,
+         "fi",
+         "(exit $_rusage_exit_code)"])
+
+def parse_resource_usage(log_file):
+    """Extract resource usage recorded by a wrapper script
+
+    Looks for the last line starting with RESOURCE_USAGE_TAG
+    in the output from a wrapper script generated with
+    'resource_usage' turned on, and extracts the values.
+
+    Arguments:
+      log_file (str): path to the file with the output from
+        the wrapper script
+
+    Returns:
+      Dictionary: dictionary with keys 'wall_time', 'user_time',
+        'sys_time' and 'cpu_time' (all in seconds) and
+        'peak_rss' (in Kb, or None if not available); or None
+        if the log file doesn't exist or doesn't contain a
+        resource usage line.
+    """
+    if log_file is None or not os.path.isfile(log_file):
+        return None
+    usage_line = None
+    with open(log_file,'r') as fp:
+        for line in fp:
+            if line.startswith(RESOURCE_USAGE_TAG):
+                usage_line = line
+    if usage_line is None:
+        return None
+    values = {}
+    for item in usage_line[len(RESOURCE_USAGE_TAG):].split():
+        try:
+            key,value = item.split('=',1)
+        except ValueError:
+            continue
+        values[key] = value
+    try:
+        usage = { 'wall_time': _parse_seconds(values['wall']),
+                  'user_time': _parse_seconds(values['user']),
+                  'sys_time': _parse_seconds(values['sys']),
+                  'peak_rss': None }
+    except (KeyError,ValueError),ex:
+        logging.debug("Unable to parse resource usage from %s: %s" %
+                      (log_file,ex))
+        return None
+    usage['cpu_time'] = usage['user_time'] + usage['sys_time']
+    try:
+        usage['peak_rss'] = int(values['maxrss'])
+    except (KeyError,ValueError):
+        pass
+    return usage
+
+def _parse_seconds(s):
+    """Internal: convert time string to seconds
+
+    Handles times which are either plain numbers of seconds
+    (e.g. '1.23') or in the format output by the shell
+    'times' builtin (e.g. '1m2.345s').
+    """
+    m = re.match(r'^(\d+)m([\d.]+)s$',s)
+    if m:
+        return int(m.group(1))*60.0 + float(m.group(2))
+    return float(s)
@@ -18,10 +18,13 @@ import os
 import subprocess
 import logging
 import shutil
+import tempfile
 import time
 import ast
+import glob
 import gzip
 import string
+from collections import OrderedDict
 import bcftbx.IlluminaData as IlluminaData
 import bcftbx.platforms as platforms
 import bcftbx.TabFile as TabFile
@@ -32,6 +35,7 @@ import config
 import applications
 import fileops
 import utils
+import checksums
 import simple_scheduler
 import bcl2fastq_utils
 import samplesheet_utils
@@ -39,9 +43,18 @@ import icell8_utils
 import tenx_genomics_utils
 import settings
 from .qc.processing import report_processing_qc
+from .qc.metrics import QCMetrics
 from .exceptions import MissingParameterFileException
 from auto_process_ngs import get_version
 
+#######################################################################
+# Constants
+#######################################################################
+
+# Name of the file in the log directory that scheduler
+# events are written to
+SCHEDULER_EVENT_LOG = 'scheduler_events.ndjson'
+
 #######################################################################
 # Classes
 #######################################################################
@@ -149,6 +162,9 @@ class AutoProcess:
         """
         Save parameters to file
 
+        The file is only rewritten if the parameters have been
+        modified since they were loaded or last saved.
+
         Arguments:
           alt_parameter_file (str): optional, path to an
             'alternative' parameter file; otherwise
@@ -190,6 +206,9 @@ class AutoProcess:
         """
         Save metadata to file
 
+        The file is only rewritten if the metadata have been
+        modified since they were loaded or last saved.
+
         Arguments:
           alt_metadata_file (str): optional, path to an
             'alternative' metadata file; otherwise
@@ -549,6 +568,25 @@ class AutoProcess:
         return utils.get_numbered_subdir(name,
                                          parent_dir=self.log_dir)
 
+    def scheduler_reporter(self):
+        """
+        Return a SchedulerReporter for the current log directory
+
+        If the 'scheduler_event_log' setting is turned on then
+        the reporter will also write a structured event stream
+        to SCHEDULER_EVENT_LOG in the current log directory,
+        which can be followed using the 'monitor' method.
+
+        Returns:
+          SchedulerReporter: reporter instance to pass to a
+            SimpleScheduler.
+        """
+        event_log = None
+        if self.settings.general.scheduler_event_log:
+            event_log = self.log_path(SCHEDULER_EVENT_LOG)
+        return simple_scheduler.default_scheduler_reporter(
+            event_log=event_log)
+
     def __del__(self):
         """
         Implement __del__ method
@@ -1880,7 +1918,9 @@ class AutoProcess:
         # Schedule the jobs needed to do counting
         sched = simple_scheduler.SimpleScheduler(
             runner=runner,
-            max_concurrent=self.settings.general.max_concurrent_jobs)
+            reporter=self.scheduler_reporter(),
+            max_concurrent=self.settings.general.max_concurrent_jobs,
+            resource_usage=True)
         sched.start()
         # Do counting
         print "Getting counts from fastq files"
@@ -2154,16 +2194,18 @@ class AutoProcess:
             raise Exception("Data directories not consistent with primary "
                             "dir '%s'" % primary_unaligned_dir)
         # Collect the projects from the extra directories
-        projects = []
+        # NB projects and undetermined samples are keyed by
+        # name to detect collisions
+        projects = OrderedDict()
         undetermined = []
+        undetermined_names = set()
         for unaligned_dir in unaligned_dirs:
             print "Examining projects in %s:" % unaligned_dir
             illumina_data = unaligned_dirs[unaligned_dir]
             for project in illumina_data.projects:
-                if not filter(lambda p: p.name == project.name,
-                              projects):
+                if project.name not in projects:
                     print "- %s: will be merged in" % project.name
-                    projects.append(project)
+                    projects[project.name] = project
                 else:
                     logging.error("collision: %s already exists" %
                                   project.name)
@@ -2178,10 +2220,10 @@ class AutoProcess:
                         undetermined.append(sample)
                 else:
                     for sample in illumina_data.undetermined.samples:
-                        if not filter(lambda s: s.name == sample.name,
-                                      undetermined):
+                        if sample.name not in undetermined_names:
                             print "- %s: will be merged in" % sample.name
                             undetermined.append(sample)
+                            undetermined_names.add(sample.name)
                         else:
                             logging.error("collision: %s already exists" %
                                           sample.name)
@@ -2193,10 +2235,9 @@ class AutoProcess:
         print "Examining projects in primary dir %s:" \
             % primary_unaligned_dir
         for project in primary_illumina_data.projects:
-            if not filter(lambda p: p.name == project.name,
-                          projects):
+            if project.name not in projects:
                 print "- %s: will be merged in" % project.name
-                projects.append(project)
+                projects[project.name] = project
             else:
                 print "- %s: already exists, will be discarded" \
                     % project.name
@@ -2209,10 +2250,10 @@ class AutoProcess:
                 undetermined.insert(0,sample)
         else:
             for sample in primary_illumina_data.undetermined.samples:
-                if not filter(lambda s: s.name == sample.name,
-                              undetermined):
+                if sample.name not in undetermined_names:
                     print "- %s: will be merged in" % sample.name
                     undetermined.insert(0,sample)
+                    undetermined_names.add(sample.name)
                 else:
                     print "- %s: already exists, will be discarded" \
                         % sample.name
@@ -2224,28 +2265,23 @@ class AutoProcess:
                                                   undetermined_dir)
         else:
              merge_undetermined_dir = os.path.join(merge_dir)
-        if not dry_run:
-            print "Making temporary merge directory %s" % merge_dir
-            bcf_utils.mkdir(merge_dir)
+        # Plan the operations to populate the merge directory
+        # NB these are independent so can be run in parallel
+        merge_jobs = []
         # Copy the projects
         print "Importing projects:"
-        for project in projects:
+        for project in projects.values():
             print "- %s" % project.name
             project_dir = os.path.join(merge_dir,
                                        os.path.basename(project.dirn))
-            if not dry_run:
-                shutil.copytree(project.dirn,project_dir)
+            merge_jobs.append(("merge_project.%s" % project.name,
+                               applications.Command('cp','-R','-L','-p',
+                                                    project.dirn,
+                                                    project_dir)))
         # Handle the undetermined reads
         print "Dealing with undetermined reads:"
         if no_lane_splitting:
             # No lane info: merge undetermined fastqs
-            if not dry_run:
-                self.set_log_dir(self.get_log_subdir('merge_fastq_dirs'))
-                runner = self.settings.general.default_runner
-                runner.set_log_dir(self.log_dir)
-                sched = simple_scheduler.SimpleScheduler(runner=runner)
-                sched.start()
-                jobs = []
             for read in (1,2):
                 if read == 2 and not paired_end:
                     break
@@ -2257,39 +2293,65 @@ class AutoProcess:
                 cmd.add_args(os.path.join(
                     merge_undetermined_dir,
                     "Undetermined_S0_R%s_001.fastq.gz" % read))
-                print "- Running %s" % cmd
-                if not dry_run:
-                    job = sched.submit(cmd,
-                                       name="merge_undetermined.R%s" % read,
-                                       wd=merge_dir)
-                    print "Job: %s" % job
-                    jobs.append(job)
-            if not dry_run:
-                # Wait for scheduler jobs to complete
-                sched.wait()
-                sched.stop()
-                # Check job exit status
-                if filter(lambda j: j.exit_status != 0,jobs):
-                    logging.critical("One or more jobs failed (non-zero "
-                                     "exit status)")
-                    return
+                merge_jobs.append(("merge_undetermined.R%s" % read,cmd))
         else:
             for sample in undetermined:
                 print "- %s" % sample.name
                 if fmt == "bcl2fastq2":
                     # Need to copy fastqs directly
                     sample_dir = merge_undetermined_dir
-                    if not dry_run:
-                        for fq in sample.fastq:
-                            src_fq = os.path.join(sample.dirn,fq)
-                            dst_fq = os.path.join(sample_dir,fq)
-                            shutil.copyfile(src_fq,dst_fq)
+                    for fq in sample.fastq:
+                        src_fq = os.path.join(sample.dirn,fq)
+                        dst_fq = os.path.join(sample_dir,fq)
+                        merge_jobs.append(("merge_undetermined.%s" % fq,
+                                           applications.Command('cp','-L',
+                                                                src_fq,
+                                                                dst_fq)))
                 else:
                     # Just copy directory tree wholesale
                     sample_dir = os.path.join(merge_undetermined_dir,
                                               os.path.basename(sample.dirn))
-                    if not dry_run:
-                        shutil.copytree(sample.dirn,sample_dir)
+                    merge_jobs.append(("merge_undetermined.%s" % sample.name,
+                                       applications.Command('cp','-R','-L',
+                                                            '-p',
+                                                            sample.dirn,
+                                                            sample_dir)))
+        # Run the operations
+        if dry_run:
+            for name,cmd in merge_jobs:
+                print "- Running %s" % cmd
+        else:
+            print "Making temporary merge directory %s" % merge_dir
+            bcf_utils.mkdir(merge_dir)
+            if not os.path.exists(merge_undetermined_dir):
+                bcf_utils.mkdir(merge_undetermined_dir)
+            self.set_log_dir(self.get_log_subdir('merge_fastq_dirs'))
+            runner = self.settings.general.default_runner
+            runner.set_log_dir(self.log_dir)
+            sched = simple_scheduler.SimpleScheduler(
+                runner=runner,
+                reporter=self.scheduler_reporter(),
+                max_concurrent=self.settings.general.max_concurrent_jobs,
+                resource_usage=True)
+            sched.start()
+            jobs = []
+            for name,cmd in merge_jobs:
+                print "- Running %s" % cmd
+                job = sched.submit(cmd,name=name,wd=merge_dir)
+                print "Job: %s" % job
+                jobs.append(job)
+            # Wait for scheduler jobs to complete
+            sched.wait()
+            sched.stop()
+            # Check job exit status
+            failed_jobs = [j for j in jobs if j.exit_status != 0]
+            if failed_jobs:
+                for job in failed_jobs:
+                    logging.critical("%s: failed (exit status %s)" %
+                                     (job.name,job.exit_status))
+                logging.critical("One or more jobs failed (non-zero "
+                                 "exit status)")
+                return
         # Make expected subdirs for bcl2fastq2
         if not dry_run and fmt == "bcl2fastq2":
             for dirn in ('Reports','Stats'):
@@ -2333,7 +2395,8 @@ class AutoProcess:
                             short_fastq_names=False,
                             link_to_fastqs=False,
                             projects=None,
-                            undetermined_project=None):
+                            undetermined_project=None,
+                            nthreads=1,dry_run=False):
         """
         Construct and populate project analysis directories
 
@@ -2359,6 +2422,10 @@ class AutoProcess:
           undetermined_project (str): optional, specify name for
             project directory to create with 'undetermined' Fastqs
             (defaults to 'undetermined')
+          nthreads (int): optional, number of threads to use when
+            making links to Fastqs (default: 1)
+          dry_run (bool): if True then report the projects and
+            links that would be made, without creating anything
         """
         # Source location for fastq files
         if unaligned_dir is None:
@@ -2429,18 +2496,23 @@ class AutoProcess:
                 logging.warning("Project '%s' already exists, skipping" %
                                 project.name)
                 continue
-            print "Creating project: '%s'" % project_name
+            if not dry_run:
+                print "Creating project: '%s'" % project_name
             try:
                 project.create_directory(
                     illumina_data.get_project(project_name),
                     short_fastq_names=short_fastq_names,
-                    link_to_fastqs=link_to_fastqs)
+                    link_to_fastqs=link_to_fastqs,
+                    nthreads=nthreads,
+                    dry_run=dry_run)
                 n_projects += 1
             except IlluminaData.IlluminaDataError as ex:
                 logging.warning("Failed to create project '%s': %s" %
                                 (project_name,ex))
         # Tell us how many were made
-        print "Created %d project%s" % (n_projects,'s' if n_projects != 1 else '')
+        print "%s %d project%s" % ('Would create' if dry_run else 'Created',
+                                   n_projects,
+                                   's' if n_projects != 1 else '')
         # Also set up analysis directory for undetermined reads
         if undetermined_project is None:
             undetermined_project = 'undetermined'
@@ -2455,13 +2527,19 @@ class AutoProcess:
                                                  "with undetermined indices",
                                                  platform=self.metadata.platform)
             if not undetermined.exists:
-                print "Creating directory '%s' for analysing reads " \
-                    "with undetermined indices" % undetermined.name
+                if not dry_run:
+                    print "Creating directory '%s' for analysing reads " \
+                        "with undetermined indices" % undetermined.name
                 undetermined.create_directory(illumina_data.undetermined,
-                                              link_to_fastqs=link_to_fastqs)
+                                              link_to_fastqs=link_to_fastqs,
+                                              nthreads=nthreads,
+                                              dry_run=dry_run)
             else:
                 logging.warning("'%s' directory already exists, skipping" %
                                 undetermined.name)
+        # Record checksums for the Fastqs
+        if not dry_run:
+            self.update_checksum_manifest(unaligned_dir=unaligned_dir)
 
     def run_qc(self,projects=None,max_jobs=4,ungzip_fastqs=False,
                fastq_screen_subset=100000,nthreads=1,
@@ -2491,7 +2569,10 @@ class AutoProcess:
                     don't decompress the input files)
           fastq_screen_subset: subset of reads to use in fastq_screen
                     (default is 100000, set to zero or None to use
-                    all reads)
+                    all reads). If the QC script supports it then
+                    the subset is sampled once for each Fastq and
+                    shared between all the screens (and removed once
+                    the QC for the sample has completed)
           nthreads: (optional) specify number of threads to run the
                     QC pipeline with (default is 1)
           runner:   (optional) specify a non-default job runner to
@@ -2523,6 +2604,21 @@ class AutoProcess:
             logging.error("QC script version is %s, needs %s" %
                           (version,'/'.join(compatible_versions)))
             return 1
+        # Check whether the screens can be run on a single shared
+        # subset of reads for each Fastq (rather than each screen
+        # sampling the Fastq independently)
+        if fastq_screen_subset is None:
+            fastq_screen_subset = 0
+        use_shared_subset = False
+        if fastq_screen_subset:
+            status,qc_script_help = applications.Command(
+                'illumina_qc.sh','--help').subprocess_check_output()
+            if '--no-screens' in qc_script_help and \
+               bcf_utils.find_program('fastq_screen.sh') and \
+               bcf_utils.find_program('sample_fastq.py'):
+                print "Using shared subset of %s reads for screens" % \
+                    fastq_screen_subset
+                use_shared_subset = True
         # Process project pattern matching
         if projects is None:
             project_pattern = '*'
@@ -2544,9 +2640,15 @@ class AutoProcess:
             qc_runner = fetch_runner(runner)
         else:
             qc_runner = self.settings.runners.qc
+        # Record projects where QC couldn't be verified or reported
+        failed_project_names = set()
         # Set up a simple scheduler
-        sched = simple_scheduler.SimpleScheduler(runner=qc_runner,
-                                                 max_concurrent=max_jobs)
+        self.set_log_dir(self.get_log_subdir('run_qc'))
+        sched = simple_scheduler.SimpleScheduler(
+            runner=qc_runner,
+            reporter=self.scheduler_reporter(),
+            max_concurrent=max_jobs,
+            resource_usage=True)
         sched.start()
         # Look for samples with no/invalid QC outputs and populate
         # pipeline with the associated fastq.gz files
@@ -2572,8 +2674,10 @@ class AutoProcess:
                 logging.warning("No samples found for QC analysis in project '%s'" %
                                 project.name)
             groups = []
+            subset_dir = os.path.join(project_qc_dir,'subsets')
             for sample in samples:
                 group = None
+                subset_fastqs = []
                 print "Examining files in sample %s" % sample.name
                 for fq in sample.fastq:
                     if utils.AnalysisFastq(fq).is_index_read:
@@ -2587,28 +2691,70 @@ class AutoProcess:
                         print "\t%s: setting up QC run" % os.path.basename(fq)
                         # Create a group if none exists for this sample
                         if group is None:
+                            # Remove shared subsets when group completes
+                            def remove_subsets(name,jobs,sched,
+                                               subset_fastqs=subset_fastqs):
+                                for subset_fastq in subset_fastqs:
+                                    if os.path.exists(subset_fastq):
+                                        os.remove(subset_fastq)
                             group = sched.group("%s.%s" % (project.name,sample.name),
-                                                log_dir=log_dir)
+                                                log_dir=log_dir,
+                                                callbacks=(remove_subsets,))
                         # Create and submit a QC job
                         fastq = os.path.join(project.dirn,'fastqs',fq)
+                        fastq_name = str(utils.AnalysisFastq(fq))
                         label = "illumina_qc.%s.%s" % \
-                                (project.name,str(utils.AnalysisFastq(fq)))
+                                (project.name,fastq_name)
                         qc_cmd = applications.Command('illumina_qc.sh',fastq)
                         if ungzip_fastqs:
                             qc_cmd.add_args('--ungzip-fastqs')
-                        if fastq_screen_subset is None:
-                            fastq_screen_subset = 0
+                        if use_shared_subset:
+                            qc_cmd.add_args('--no-screens')
+                        else:
+                            qc_cmd.add_args('--subset',fastq_screen_subset)
                         qc_cmd.add_args(
                             '--threads',nthreads,
-                            '--subset',fastq_screen_subset,
                             '--qc_dir',project_qc_dir)
                         job = group.add(qc_cmd,name=label,wd=project.dirn)
                         print "Job: %s" %  job
+                        if use_shared_subset:
+                            # Sample the subset of reads once, and
+                            # run all the screens on that subset
+                            if not os.path.exists(subset_dir):
+                                bcf_utils.mkdir(subset_dir,mode=0775)
+                            subset_fastq = os.path.join(
+                                subset_dir,
+                                "%s.fastq" % utils.strip_ngs_extensions(
+                                    os.path.basename(fq)))
+                            subset_fastqs.append(subset_fastq)
+                            subset_label = "sample_fastq.%s.%s" % \
+                                           (project.name,fastq_name)
+                            subset_cmd = applications.Command(
+                                'sample_fastq.py',
+                                '--subset',fastq_screen_subset,
+                                fastq,subset_fastq)
+                            job = group.add(subset_cmd,name=subset_label,
+                                            wd=project.dirn)
+                            print "Job: %s" %  job
+                            screen_cmd = applications.Command(
+                                'fastq_screen.sh',
+                                '--subset',0,
+                                '--threads',nthreads,
+                                '--qc_dir',project_qc_dir,
+                                subset_fastq)
+                            job = group.add(screen_cmd,
+                                            name="fastq_screen.%s.%s" %
+                                            (project.name,fastq_name),
+                                            wd=project.dirn,
+                                            wait_for=(subset_label,))
+                            print "Job: %s" %  job
                 # Indicate no more jobs to add
                 if group:
                     group.close()
                     groups.append(group.name)
             # Add MultiQC job (if requested)
+            multiqc_out = None
+            wait_for = list(groups)
             if run_multiqc:
                 multiqc_out = "multi%s_report.html" % \
                               os.path.basename(project_qc_dir)
@@ -2626,39 +2772,51 @@ class AutoProcess:
                                        wd=project.dirn,
                                        log_dir=log_dir,
                                        wait_for=groups)
+                    wait_for.append(job.name)
                 else:
                     print "MultiQC report '%s': already exists" % multiqc_out
+            # Verify the outputs and generate the QC report for
+            # the project as soon as its QC jobs have finished
+            # (this can overlap with QC still running for other
+            # projects)
+            if report_html is None:
+                out_file = '%s_report.html' % \
+                           os.path.basename(project_qc_dir)
+            else:
+                out_file = report_html
+            title = "%s/%s" % (self.run_name,project.name)
+            if fastq_dir is not None:
+                title = "%s (%s)" % (title,fastq_dir)
+            title = "%s: QC report" % title
+            report_cmd = applications.Command(
+                'reportqc.py',
+                '--qc_dir',project_qc_dir,
+                '--filename',out_file,
+                '--title',title)
+            if fastq_dir is not None:
+                report_cmd.add_args('--fastq_dir',fastq_dir)
+            if multiqc_out is not None:
+                report_cmd.add_args('--multiqc',multiqc_out)
+            report_cmd.add_args(project.dirn)
+            print "Running %s" % report_cmd
+            # Flag the project as failed if reporting fails
+            def check_report(name,jobs,sched,project_name=project.name):
+                for job in jobs:
+                    if job.exit_code != 0:
+                        failed_project_names.add(project_name)
+            job = sched.submit(report_cmd,
+                               name="reportqc.%s" % project.name,
+                               wd=project.dirn,
+                               log_dir=log_dir,
+                               wait_for=wait_for,
+                               callbacks=(check_report,))
+            print "Job: %s" % job
         # Wait for the scheduler to run all jobs
         sched.wait()
         sched.stop()
-        # Verify the outputs and generate QC reports
-        failed_projects = []
-        for project in projects:
-            if not project.verify_qc(qc_dir=qc_dir):
-                failed_projects.append(project)
-            else:
-                qc_base = os.path.basename(qc_dir)
-                if report_html is None:
-                    out_file = '%s_report.html' % qc_base
-                else:
-                    out_file = report_html
-                if not os.path.isabs(out_file):
-                    out_file = os.path.join(project.dirn,out_file)
-                title = "%s/%s" % (self.run_name,
-                                   project.name)
-                if fastq_dir is not None:
-                    title = "%s (%s)" % (title,fastq_dir)
-                title = "%s: QC report" % title
-                print "QC okay, generating report for %s" % project.name
-                project.qc_report(qc_dir=qc_dir,
-                                  title=title,
-                                  report_html=out_file)
-            if run_multiqc:
-                multiqc_report = os.path.join(project.dirn,multiqc_out)
-                if not os.path.exists(multiqc_report):
-                    logging.warning("Missing MultiQC report for %s" %
-                                    project.name)
-                    failed_projects.append(project)
+        # Put failed projects into the original order
+        failed_projects = [p for p in projects
+                           if p.name in failed_project_names]
         # Report failed projects
         if failed_projects:
             logging.error("QC failed for one or more samples in following projects:")
@@ -2668,6 +2826,173 @@ class AutoProcess:
         # Finish
         return 0
 
+    def qc_metrics(self,projects=None,qc_dir=None,out_file=None,
+                   nprocessors=1):
+        """Export QC metrics for all projects into a single table
+
+        Collects the key QC metrics (number of reads, %GC,
+        FastQC module statuses and fastq_screen mapping
+        percentages) for each Fastq in each project, and
+        writes them to a single tab-delimited file.
+
+        Arguments:
+          projects: specify a pattern to match one or more projects to
+                    collect the metrics for (default is to collect
+                    metrics for all projects)
+          qc_dir:   (optional) specify a non-standard directory to
+                    read the QC outputs from; will be used for all
+                    projects (default is the default QC directory
+                    for each project)
+          out_file: (optional) specify the name of the output file
+                    (default is 'qc_metrics.tsv' in the top-level
+                    analysis directory)
+          nprocessors: (optional) number of processors to use when
+                    collecting the metrics (default is 1)
+
+        Returns:
+          UNIX-style integer returncode: 0 = successful termination,
+          non-zero indicates an error occurred.
+
+        """
+        # Get project dir data
+        projects = self.get_analysis_projects(projects)
+        # Check we have projects
+        if len(projects) == 0:
+            logging.warning("No projects found for QC metrics")
+            return 1
+        # Collect the metrics
+        print "Collecting QC metrics for %d projects" % len(projects)
+        metrics = QCMetrics(projects,
+                            qc_dir=qc_dir,
+                            n_processors=nprocessors)
+        # Write to file
+        if out_file is None:
+            out_file = 'qc_metrics.tsv'
+        if not os.path.isabs(out_file):
+            out_file = os.path.join(self.analysis_dir,out_file)
+        print "Writing QC metrics for %d Fastqs to %s" % (len(metrics.raw),
+                                                          out_file)
+        metrics.write(out_file=out_file)
+        return 0
+
+    def find_scheduler_event_log(self):
+        """Locate the most recently updated scheduler event log
+
+        Looks for scheduler event log files in the top-level log
+        directory and in each of its subdirectories.
+
+        Returns:
+          String: path to the most recently modified event log,
+          or None if no event logs were found.
+
+        """
+        event_logs = glob.glob(os.path.join(self.log_dir,
+                                            SCHEDULER_EVENT_LOG))
+        event_logs.extend(glob.glob(os.path.join(self.log_dir,'*',
+                                                 SCHEDULER_EVENT_LOG)))
+        if not event_logs:
+            return None
+        return max(event_logs,key=lambda f: os.path.getmtime(f))
+
+    def monitor(self,event_log=None,poll_interval=5,once=False):
+        """Follow a scheduler event log and report progress
+
+        Reads the events written to a scheduler event log and
+        periodically reports the number of running, waiting and
+        finished jobs, along with the job throughput and the
+        estimated time to complete the jobs scheduled so far.
+
+        Monitoring continues until interrupted (e.g. by Ctrl-C),
+        unless 'once' is set.
+
+        Arguments:
+          event_log: (optional) path to the event log to follow
+                     (default is the most recently updated event
+                     log under the log directory)
+          poll_interval: (optional) number of seconds to wait
+                     between checking for new events (default is
+                     5 seconds)
+          once:      (optional) if True then report the current
+                     status and stop (default is False)
+
+        Returns:
+          UNIX-style integer returncode: 0 = successful termination,
+          non-zero indicates an error occurred.
+
+        """
+        if event_log is None:
+            event_log = self.find_scheduler_event_log()
+            if event_log is None:
+                logging.error("No scheduler event logs found under %s" %
+                              self.log_dir)
+                return 1
+        print "Monitoring %s" % event_log
+        summary = simple_scheduler.SchedulerEventSummary()
+        offset = 0
+        try:
+            while True:
+                events,offset = simple_scheduler.read_scheduler_events(
+                    event_log,offset=offset)
+                for event in events:
+                    summary.update(event)
+                print "%s: %s" % (simple_scheduler.date_and_time(),
+                                  summary.report(now=time.time()))
+                if once:
+                    break
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            print "Stopped monitoring"
+        except IOError as ex:
+            logging.error("Failed to read %s: %s" % (event_log,ex))
+            return 1
+        return 0
+
+    def update_checksum_manifest(self,unaligned_dir=None,nthreads=None):
+        """
+        Create or update the checksum manifest for the run
+
+        The manifest records MD5 checksums for the Fastqs in
+        the bcl2fastq output directory and in the project
+        directories (see the ChecksumManifest class); only
+        files which are new or whose size or timestamp have
+        changed are checksummed. Entries for files which no
+        longer exist are removed.
+
+        Arguments:
+          unaligned_dir (str): optional, name of 'unaligned'
+            subdirectory (defaults to value stored in parameters)
+          nthreads (int): optional, number of threads to use
+            for computing checksums (defaults to the value from
+            the settings.ini file)
+
+        Returns:
+          ChecksumManifest: the updated manifest.
+        """
+        if unaligned_dir is None:
+            unaligned_dir = self.params.unaligned_dir
+        if nthreads is None:
+            nthreads = self.settings.general.checksum_threads
+        # Collect the files
+        files = []
+        if unaligned_dir is not None:
+            unaligned_dir = os.path.join(self.analysis_dir,unaligned_dir)
+            for dirpath,dirnames,filenames in os.walk(unaligned_dir):
+                for filen in filenames:
+                    if filen.endswith(('.fastq','.fastq.gz')):
+                        files.append(os.path.join(dirpath,filen))
+        for project in self.get_analysis_projects_from_dirs():
+            files.extend(project.fastqs)
+        # Update the manifest
+        manifest = checksums.ChecksumManifest(self.analysis_dir)
+        npruned = manifest.prune()
+        nupdated = manifest.update(files,nthreads=nthreads)
+        if manifest.modified:
+            manifest.save()
+        print "Updated checksum manifest %s: %d files (%d checksums " \
+            "computed, %d removed)" % (manifest.manifest_file,
+                                       len(manifest),nupdated,npruned)
+        return manifest
+
     def copy_to_archive(self,archive_dir=None,platform=None,year=None,dry_run=False,
                         chmod=None,group=None,include_bcl2fastq=False,
                         read_only_fastqs=True,force=False,runner=None):
@@ -2693,6 +3018,10 @@ class AutoProcess:
 
         'rsync' is used to perform the transfer.
 
+        The checksum manifest for the run is updated before the
+        transfer and is copied along with the data, so that the
+        archived copy can be verified against it.
+
         Arguments:
           archive_dir: top level archive directory, of the form
             '[[user@]host:]dir'; if not set then use the value from
@@ -2775,6 +3104,9 @@ class AutoProcess:
         excludes.append('--exclude=*.mro')
         excludes.append('--exclude="%s*"' %
                         tenx_genomics_utils.flow_cell_id(self.run_name))
+        # Update the checksum manifest
+        if not dry_run:
+            self.update_checksum_manifest()
         # Log dir
         self.set_log_dir(self.get_log_subdir('archive'))
         # Set up runner
@@ -2786,7 +3118,9 @@ class AutoProcess:
         # Setup a scheduler for multiple rsync jobs
         sched = simple_scheduler.SimpleScheduler(
             runner=runner,
-            max_concurrent=self.settings.general.max_concurrent_jobs)
+            reporter=self.scheduler_reporter(),
+            max_concurrent=self.settings.general.max_concurrent_jobs,
+            resource_usage=True)
         sched.start()
         # If making fastqs read-only then transfer them separately
         if read_only_fastqs:
@@ -2979,271 +3313,283 @@ class AutoProcess:
                     os.path.join(barcode_analysis_dir,filen)):
                 barcode_analysis_dir = None
                 break
-        # Make a directory for the QC reports
-        fileops.mkdir(dirn)
-        # Start building an index page
-        title = "QC reports for %s" % os.path.basename(self.analysis_dir)
-        index_page = htmlpagewriter.HTMLPageWriter(title)
-        # Add CSS rules
-        index_page.addCSSRule("h1 { background-color: #42AEC2;\n"
-                              "     color: white;\n"
-                              "     padding: 5px 10px; }")
-        index_page.addCSSRule("table { margin: 10 10;\n"
-                              "        border: solid 1px grey;\n"
-                              "        background-color: white; }")
-        index_page.addCSSRule("th    { background-color: grey;\n"
-                              "        color: white;\n"
-                              "        padding: 2px 5px; }")
-        index_page.addCSSRule("td    { text-align: left;\n"
-                              "        vertical-align: top;\n"
-                              "        padding: 2px 5px;\n"
-                              "        border-bottom: solid 1px lightgray; }")
-        index_page.addCSSRule("td.param { background-color: grey;\n"
-                              "           color: white;\n"
-                              "           padding: 2px 5px;\n"
-                              "           font-weight: bold; }")
-        index_page.addCSSRule("p.footer { font-style: italic;\n"
-                              "           font-size: 70%; }")
-        # Build the page
-        index_page.add("<h1>%s</h1>" % title)
-        # General info
-        index_page.add("<h2>General information</h2>")
-        index_page.add("<table>")
-        index_page.add("<tr><td class='param'>Run name</td><td>%s</td></tr>" %
-                       os.path.basename(self.analysis_dir))
-        index_page.add("<tr><td class='param'>Run number</td><td>%s</td></tr>" %
-                       self.metadata.run_number)
-        index_page.add("<tr><td class='param'>Platform</td><td>%s</td></tr>" %
-                       self.metadata.platform)
-        index_page.add("<tr><td class='param'>Endedness</td><td>%s</td></tr>" %
-                       ('Paired end' if analysis_dir.paired_end else 'Single end'))
+        # Make a local staging directory for the QC reports, so
+        # that they can be published in a single transfer at
+        # the end
+        stage_root = tempfile.mkdtemp(prefix='publish_qc.',
+                                      dir=self.tmp_dir)
         try:
-            bcl2fastq_software = ast.literal_eval(
-                self.metadata.bcl2fastq_software)
-        except ValueError:
-            bcl2fastq_software = None
-        index_page.add("<tr><td class='param'>Bcl2fastq</td><td>%s</td></tr>" %
-                       ('unspecified' if not bcl2fastq_software else
-                       "%s %s" % (bcl2fastq_software[1],
-                                  bcl2fastq_software[2])))
-        index_page.add("<tr><td class='param'>Reference</td><td>%s</td></tr>" %
-                       self.run_reference_id)
-        index_page.add("</table>")
-        # Add link to processing statistics
-        processing_qc_html = "processing_qc.html"
-        if os.path.exists(processing_qc_html):
-            index_page.add("<h2>Processing Statistics</h2>")
-            index_page.add("<a href='%s'>Processing QC report</a>" %
-                           processing_qc_html)
-        else:
-            processing_qc_html = None
-        # Add to link to 10xGenomics cellranger QC summaries
-        cellranger_qc_html = filter(lambda f: os.path.isfile(f)
-                                    and f.startswith("cellranger_qc_summary")
-                                    and f.endswith(".html"),
-                                    os.listdir(self.analysis_dir))
-        if cellranger_qc_html:
-            index_page.add("<h2>QC summary: cellranger mkfastq</h2>")
-            for qc_html in cellranger_qc_html:
-                # Check for lane list at tail of QC summary
-                # e.g. cellranger_qc_summary_45.html
-                # This might not be present
-                lanes = qc_html.split('.')[0].split('_')[-1]
-                if all(c in string.digits for c in lanes):
-                    lanes = ','.join(lanes)
-                else:
-                    lanes = None
-                index_page.add("<a href='%s'>QC summary for %s</a>" %
-                               (qc_html,
-                                ("all lanes" if lanes is None
-                                 else "lanes %s" % lanes)))
-        # Barcode analysis
-        if barcode_analysis_dir:
-            # Create section
-            index_page.add("<h2>Barcode analysis</h2>")
-            index_page.add("<p>Plain text report: "
-                           "<a href='barcodes/barcodes.report'>barcodes.report</a> "
-                           " | XLS: "
-                           "<a href='barcodes/barcodes.xls'>barcodes.xls</a>"
-                           " | HTML: "
-                           "<a href='barcodes/barcodes.html'>barcodes.html</a>"
-                           "</p>")
-            # Create subdir and copy files
-            barcodes_dirn = os.path.join(dirn,'barcodes')
-            fileops.mkdir(barcodes_dirn)
-            for filen in barcodes_files:
-                fileops.copy(os.path.join(barcode_analysis_dir,filen),
-                             barcodes_dirn)
-        if projects:
-            # Table of projects
-            index_page.add("<h2>QC Reports</h2>")
+            stage_dirn = os.path.join(stage_root,
+                                      os.path.basename(self.analysis_dir))
+            fileops.mkdir(stage_dirn)
+            # Start building an index page
+            title = "QC reports for %s" % os.path.basename(self.analysis_dir)
+            index_page = htmlpagewriter.HTMLPageWriter(title)
+            # Add CSS rules
+            index_page.addCSSRule("h1 { background-color: #42AEC2;\n"
+                                  "     color: white;\n"
+                                  "     padding: 5px 10px; }")
+            index_page.addCSSRule("table { margin: 10 10;\n"
+                                  "        border: solid 1px grey;\n"
+                                  "        background-color: white; }")
+            index_page.addCSSRule("th    { background-color: grey;\n"
+                                  "        color: white;\n"
+                                  "        padding: 2px 5px; }")
+            index_page.addCSSRule("td    { text-align: left;\n"
+                                  "        vertical-align: top;\n"
+                                  "        padding: 2px 5px;\n"
+                                  "        border-bottom: solid 1px lightgray; }")
+            index_page.addCSSRule("td.param { background-color: grey;\n"
+                                  "           color: white;\n"
+                                  "           padding: 2px 5px;\n"
+                                  "           font-weight: bold; }")
+            index_page.addCSSRule("p.footer { font-style: italic;\n"
+                                  "           font-size: 70%; }")
+            # Build the page
+            index_page.add("<h1>%s</h1>" % title)
+            # General info
+            index_page.add("<h2>General information</h2>")
             index_page.add("<table>")
-            index_page.add("<tr><th>Project</th><th>User</th><th>Library</th><th>Organism</th><th>PI</th><th>Samples</th><th>#Samples</th><th>Reports</th></tr>")
-            # Set the string to represent "null" table entries
-            null_str = '&nbsp;'
-            # Deal with QC for each project
-            for project in projects:
-                # Reset source Fastqs dir
-                project.use_fastq_dir()
-                # Get local versions of project information
-                info = project.info
-                project_user = null_str if info.user is None else info.user
-                library_type = null_str if info.library_type is None else info.library_type
-                organism = null_str if info.organism is None else info.organism
-                PI = null_str if info.PI is None else info.PI
-                # Generate line in the table of projects
-                index_page.add("<tr>")
-                index_page.add("<td>%s</td>" % project.name)
-                index_page.add("<td>%s</td>" % project_user)
-                index_page.add("<td>%s</td>" % library_type)
-                index_page.add("<td>%s</td>" % organism)
-                index_page.add("<td>%s</td>" % PI)
-                index_page.add("<td>%s</td>" % project.prettyPrintSamples())
-                index_page.add("<td>%d</td>" % len(project.samples))
-                # Locate and copy QC reports
-                report_html = []
-                for qc_dir in project_qc[project.name]:
-                    qc_zip = os.path.join(project.dirn,
-                                          "%s_report.%s.%s.zip" %
-                                          (qc_dir,
-                                           project.name,
-                                           os.path.basename(self.analysis_dir)))
-                    print qc_zip
-                    assert(os.path.isfile(qc_zip))
-                    qc_report_copied = True
-                    try:
-                        fileops.copy(qc_zip,dirn)
-                        fileops.unzip(os.path.join(
-                            dirn,
-                            os.path.basename(qc_zip)),
-                                      fileops.Location(dirn).path)
-                    except Exception, ex:
-                        print "Failed to copy QC report: %s" % ex
-                        qc_report_copied = False
-                    # Append info to the index page
-                    if qc_report_copied:
-                        qc_base = "%s_report" % qc_dir
-                        fastq_dir = project.qc_info(qc_dir).fastq_dir
-                        if fastq_dir != project.info.primary_fastq_dir:
-                            fastq_set = fastq_dir
-                        else:
-                            fastq_set = None
-                        # Index
-                        report_html.append(
-                            "<a href='%s.%s.%s/%s.html'>[Report%s]</a>"
-                            % (qc_base,
-                               project.name,
-                               os.path.basename(self.analysis_dir),
-                               qc_base,
-                               (" (%s)" % fastq_set
-                                if fastq_set is not None else "")))
-                        # Zip file
-                        report_html.append(
-                            "<a href='%s'>[Zip%s]</a>"
-                            % (os.path.basename(qc_zip),
-                               (" (%s)" % fastq_dir
-                                if fastq_set is not None else "")))
-                    # MultiQC
-                    multiqc_report = os.path.join(project.dirn,
-                                                  "multi%s.html" % qc_base)
-                    if os.path.exists(multiqc_report):
-                        print "Found MultiQC report: %s" % multiqc_report
-                        final_multiqc = "multi%s.%s.html" % (qc_base,project.name)
+            index_page.add("<tr><td class='param'>Run name</td><td>%s</td></tr>" %
+                           os.path.basename(self.analysis_dir))
+            index_page.add("<tr><td class='param'>Run number</td><td>%s</td></tr>" %
+                           self.metadata.run_number)
+            index_page.add("<tr><td class='param'>Platform</td><td>%s</td></tr>" %
+                           self.metadata.platform)
+            index_page.add("<tr><td class='param'>Endedness</td><td>%s</td></tr>" %
+                           ('Paired end' if analysis_dir.paired_end else 'Single end'))
+            try:
+                bcl2fastq_software = ast.literal_eval(
+                    self.metadata.bcl2fastq_software)
+            except ValueError:
+                bcl2fastq_software = None
+            index_page.add("<tr><td class='param'>Bcl2fastq</td><td>%s</td></tr>" %
+                           ('unspecified' if not bcl2fastq_software else
+                           "%s %s" % (bcl2fastq_software[1],
+                                      bcl2fastq_software[2])))
+            index_page.add("<tr><td class='param'>Reference</td><td>%s</td></tr>" %
+                           self.run_reference_id)
+            index_page.add("</table>")
+            # Add link to processing statistics
+            processing_qc_html = "processing_qc.html"
+            if os.path.exists(processing_qc_html):
+                index_page.add("<h2>Processing Statistics</h2>")
+                index_page.add("<a href='%s'>Processing QC report</a>" %
+                               processing_qc_html)
+            else:
+                processing_qc_html = None
+            # Add to link to 10xGenomics cellranger QC summaries
+            cellranger_qc_html = filter(lambda f: os.path.isfile(f)
+                                        and f.startswith("cellranger_qc_summary")
+                                        and f.endswith(".html"),
+                                        os.listdir(self.analysis_dir))
+            if cellranger_qc_html:
+                index_page.add("<h2>QC summary: cellranger mkfastq</h2>")
+                for qc_html in cellranger_qc_html:
+                    # Check for lane list at tail of QC summary
+                    # e.g. cellranger_qc_summary_45.html
+                    # This might not be present
+                    lanes = qc_html.split('.')[0].split('_')[-1]
+                    if all(c in string.digits for c in lanes):
+                        lanes = ','.join(lanes)
+                    else:
+                        lanes = None
+                    index_page.add("<a href='%s'>QC summary for %s</a>" %
+                                   (qc_html,
+                                    ("all lanes" if lanes is None
+                                     else "lanes %s" % lanes)))
+            # Barcode analysis
+            if barcode_analysis_dir:
+                # Create section
+                index_page.add("<h2>Barcode analysis</h2>")
+                index_page.add("<p>Plain text report: "
+                               "<a href='barcodes/barcodes.report'>barcodes.report</a> "
+                               " | XLS: "
+                               "<a href='barcodes/barcodes.xls'>barcodes.xls</a>"
+                               " | HTML: "
+                               "<a href='barcodes/barcodes.html'>barcodes.html</a>"
+                               "</p>")
+                # Create subdir and copy files
+                barcodes_dirn = os.path.join(stage_dirn,'barcodes')
+                fileops.mkdir(barcodes_dirn)
+                for filen in barcodes_files:
+                    fileops.copy(os.path.join(barcode_analysis_dir,filen),
+                                 barcodes_dirn)
+            if projects:
+                # Table of projects
+                index_page.add("<h2>QC Reports</h2>")
+                index_page.add("<table>")
+                index_page.add("<tr><th>Project</th><th>User</th><th>Library</th><th>Organism</th><th>PI</th><th>Samples</th><th>#Samples</th><th>Reports</th></tr>")
+                # Set the string to represent "null" table entries
+                null_str = '&nbsp;'
+                # Deal with QC for each project
+                for project in projects:
+                    # Reset source Fastqs dir
+                    project.use_fastq_dir()
+                    # Get local versions of project information
+                    info = project.info
+                    project_user = null_str if info.user is None else info.user
+                    library_type = null_str if info.library_type is None else info.library_type
+                    organism = null_str if info.organism is None else info.organism
+                    PI = null_str if info.PI is None else info.PI
+                    # Generate line in the table of projects
+                    index_page.add("<tr>")
+                    index_page.add("<td>%s</td>" % project.name)
+                    index_page.add("<td>%s</td>" % project_user)
+                    index_page.add("<td>%s</td>" % library_type)
+                    index_page.add("<td>%s</td>" % organism)
+                    index_page.add("<td>%s</td>" % PI)
+                    index_page.add("<td>%s</td>" % project.prettyPrintSamples())
+                    index_page.add("<td>%d</td>" % len(project.samples))
+                    # Locate and copy QC reports
+                    report_html = []
+                    for qc_dir in project_qc[project.name]:
+                        qc_zip = os.path.join(project.dirn,
+                                              "%s_report.%s.%s.zip" %
+                                              (qc_dir,
+                                               project.name,
+                                               os.path.basename(self.analysis_dir)))
+                        print qc_zip
+                        assert(os.path.isfile(qc_zip))
+                        qc_report_copied = True
                         try:
-                            fileops.copy(multiqc_report,
-                                         os.path.join(dirn,final_multiqc))
+                            fileops.copy(qc_zip,stage_dirn)
+                            fileops.unzip(os.path.join(
+                                stage_dirn,
+                                os.path.basename(qc_zip)),
+                                          stage_dirn)
                         except Exception, ex:
-                            print "Failed to copy MultiQC report: %s" % ex
+                            print "Failed to copy QC report: %s" % ex
+                            qc_report_copied = False
+                        # Append info to the index page
+                        if qc_report_copied:
+                            qc_base = "%s_report" % qc_dir
+                            fastq_dir = project.qc_info(qc_dir).fastq_dir
+                            if fastq_dir != project.info.primary_fastq_dir:
+                                fastq_set = fastq_dir
+                            else:
+                                fastq_set = None
+                            # Index
+                            report_html.append(
+                                "<a href='%s.%s.%s/%s.html'>[Report%s]</a>"
+                                % (qc_base,
+                                   project.name,
+                                   os.path.basename(self.analysis_dir),
+                                   qc_base,
+                                   (" (%s)" % fastq_set
+                                    if fastq_set is not None else "")))
+                            # Zip file
+                            report_html.append(
+                                "<a href='%s'>[Zip%s]</a>"
+                                % (os.path.basename(qc_zip),
+                                   (" (%s)" % fastq_dir
+                                    if fastq_set is not None else "")))
+                        # MultiQC
+                        multiqc_report = os.path.join(project.dirn,
+                                                      "multi%s.html" % qc_base)
+                        if os.path.exists(multiqc_report):
+                            print "Found MultiQC report: %s" % multiqc_report
+                            final_multiqc = "multi%s.%s.html" % (qc_base,project.name)
+                            try:
+                                fileops.copy(multiqc_report,
+                                             os.path.join(stage_dirn,
+                                                          final_multiqc))
+                            except Exception, ex:
+                                print "Failed to copy MultiQC report: %s" % ex
+                                multiqc_report = None
+                        else:
+                            print "No MultiQC report found for %s" % \
+                                os.path.basename(qc_dir)
                             multiqc_report = None
-                    else:
-                        print "No MultiQC report found for %s" % \
-                            os.path.basename(qc_dir)
-                        multiqc_report = None
-                    if multiqc_report:
-                        report_html.append("<a href='%s'>[MultiQC%s]</a>"
-                                           % (final_multiqc,
-                                              (" (%s)" % fastq_dir
-                                               if fastq_dir != 'fastqs' else "")))
-                # Check there is something to add
-                if not report_html:
-                    report_html.append("QC reports not available")
-                # Locate and copy ICell8 processing reports
-                icell8_processing_zip = os.path.join(
-                    project.dirn,
-                    "icell8_processing.%s.%s.zip" %
-                    (project.name,
-                     os.path.basename(self.analysis_dir)))
-                if os.path.isfile(icell8_processing_zip):
-                    print icell8_processing_zip
-                    icell8_report_copied = True
-                    try:
-                        fileops.copy(icell8_processing_zip,dirn)
-                        fileops.unzip(os.path.join(
-                            dirn,
-                            os.path.basename(icell8_processing_zip)),
-                                      fileops.Location(dirn).path)
-                    except Exception as ex:
-                        print "Failed to copy ICell8 report: %s" % ex
-                        icell8_report_copied = False
-                else:
-                    # No ICell8 processing report to copy
-                    icell8_report_copied = False
-                # Append info to the index page
-                if icell8_report_copied:
-                    report_html.append(
-                        "<a href='icell8_processing.%s.%s/" \
-                        "icell8_processing.html'>" \
-                        "[Icell8 processing]</a>" % \
+                        if multiqc_report:
+                            report_html.append("<a href='%s'>[MultiQC%s]</a>"
+                                               % (final_multiqc,
+                                                  (" (%s)" % fastq_dir
+                                                   if fastq_dir != 'fastqs' else "")))
+                    # Check there is something to add
+                    if not report_html:
+                        report_html.append("QC reports not available")
+                    # Locate and copy ICell8 processing reports
+                    icell8_processing_zip = os.path.join(
+                        project.dirn,
+                        "icell8_processing.%s.%s.zip" %
                         (project.name,
                          os.path.basename(self.analysis_dir)))
-                    report_html.append("<a href='%s'>[Zip]</a>" % \
-                                       os.path.basename(icell8_processing_zip))
-                # Locate and copy cellranger count reports
-                cellranger_zip = os.path.join(project.dirn,
-                                      "cellranger_count_report.%s.%s.zip" %
-                                      (project.name,
-                                       os.path.basename(self.analysis_dir)))
-                if os.path.isfile(cellranger_zip):
-                    print cellranger_zip
-                    cellranger_report_copied = True
-                    try:
-                        fileops.copy(cellranger_zip,dirn)
-                        fileops.unzip(os.path.join(
-                            dirn,
-                            os.path.basename(cellranger_zip)),
-                                      fileops.Location(dirn).path)
-                    except Exception as ex:
-                        print "Failed to copy cellranger report: %s" % ex
+                    if os.path.isfile(icell8_processing_zip):
+                        print icell8_processing_zip
+                        icell8_report_copied = True
+                        try:
+                            fileops.copy(icell8_processing_zip,stage_dirn)
+                            fileops.unzip(os.path.join(
+                                stage_dirn,
+                                os.path.basename(icell8_processing_zip)),
+                                          stage_dirn)
+                        except Exception as ex:
+                            print "Failed to copy ICell8 report: %s" % ex
+                            icell8_report_copied = False
+                    else:
+                        # No ICell8 processing report to copy
+                        icell8_report_copied = False
+                    # Append info to the index page
+                    if icell8_report_copied:
+                        report_html.append(
+                            "<a href='icell8_processing.%s.%s/" \
+                            "icell8_processing.html'>" \
+                            "[Icell8 processing]</a>" % \
+                            (project.name,
+                             os.path.basename(self.analysis_dir)))
+                        report_html.append("<a href='%s'>[Zip]</a>" % \
+                                           os.path.basename(icell8_processing_zip))
+                    # Locate and copy cellranger count reports
+                    cellranger_zip = os.path.join(project.dirn,
+                                          "cellranger_count_report.%s.%s.zip" %
+                                          (project.name,
+                                           os.path.basename(self.analysis_dir)))
+                    if os.path.isfile(cellranger_zip):
+                        print cellranger_zip
+                        cellranger_report_copied = True
+                        try:
+                            fileops.copy(cellranger_zip,stage_dirn)
+                            fileops.unzip(os.path.join(
+                                stage_dirn,
+                                os.path.basename(cellranger_zip)),
+                                          stage_dirn)
+                        except Exception as ex:
+                            print "Failed to copy cellranger report: %s" % ex
+                            cellranger_report_copied = False
+                    else:
+                        # No cellranger count data to copy
                         cellranger_report_copied = False
-                else:
-                    # No cellranger count data to copy
-                    cellranger_report_copied = False
-                # Append info to the index page
-                if cellranger_report_copied:
-                    report_html.append(
-                        "<a href='cellranger_count_report.%s.%s/" \
-                        "cellranger_count_report.html'>" \
-                        "[Cellranger count]</a>" % \
-                        (project.name,
-                         os.path.basename(self.analysis_dir)))
-                    report_html.append("<a href='%s'>[Zip]</a>" % \
-                                       os.path.basename(cellranger_zip))
-                # Add to the index
-                index_page.add("<td>%s</td>"
-                               % null_str.join(report_html))
-                index_page.add("</tr>")
-            index_page.add("</table>")
-        # Finish index page
-        index_page.add("<p class='footer'>Generated by auto_process.py %s on %s</p>" % \
-                       (get_version(),time.asctime()))
-        # Copy to server
-        index_html = os.path.join(self.tmp_dir,'index.html')
-        index_page.write(index_html)
-        fileops.copy(index_html,dirn)
-        if processing_qc_html:
-            fileops.copy(processing_qc_html,dirn)
-        for qc_html in cellranger_qc_html:
-            fileops.copy(qc_html,dirn)
+                    # Append info to the index page
+                    if cellranger_report_copied:
+                        report_html.append(
+                            "<a href='cellranger_count_report.%s.%s/" \
+                            "cellranger_count_report.html'>" \
+                            "[Cellranger count]</a>" % \
+                            (project.name,
+                             os.path.basename(self.analysis_dir)))
+                        report_html.append("<a href='%s'>[Zip]</a>" % \
+                                           os.path.basename(cellranger_zip))
+                    # Add to the index
+                    index_page.add("<td>%s</td>"
+                                   % null_str.join(report_html))
+                    index_page.add("</tr>")
+                index_page.add("</table>")
+            # Finish index page
+            index_page.add("<p class='footer'>Generated by auto_process.py %s on %s</p>" % \
+                           (get_version(),time.asctime()))
+            # Write index page
+            index_page.write(os.path.join(stage_dirn,'index.html'))
+            if processing_qc_html:
+                fileops.copy(processing_qc_html,stage_dirn)
+            for qc_html in cellranger_qc_html:
+                fileops.copy(qc_html,stage_dirn)
+            # Copy new and updated files to the server
+            print "Publishing QC reports to %s" % dirn
+            fileops.sync_dir(stage_dirn,dirn)
+        finally:
+            # Remove the staging directory
+            shutil.rmtree(stage_root)
         # Print the URL if given
         if self.settings.qc_web_server.url is not None:
             print "QC published to %s" % self.settings.qc_web_server.url
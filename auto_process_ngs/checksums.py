@@ -0,0 +1,748 @@
+#!/usr/bin/env python
+#
+#     checksums.py: utilities for computing and verifying checksums
+#     Copyright (C) University of Manchester 2017 Peter Briggs
+#
+########################################################################
+#
+# checksums.py
+#
+#########################################################################
+
+"""
+checksums.py
+
+Utility classes and functions for computing and verifying checksums
+of files:
+
+- ChecksumManifest: persistent store of checksums for a set of files
+- ChecksumReader: compute the MD5 checksum of data as it is read
+- md5sum: compute the MD5 checksum of a file
+- copy_with_md5sum: copy a file and compute its MD5 checksum
+- sampled_checksum: compute a checksum from sampled blocks of a file
+- read_md5sum_file: read checksums from an 'md5sum'-format file
+- compare_files: compare pairs of files using multiple threads
+- load_reference_checksums: read checksums from a manifest or
+  'md5sum'-format file
+
+"""
+
+#######################################################################
+# Imports
+#######################################################################
+
+import os
+import time
+import shutil
+import hashlib
+import logging
+from multiprocessing.pool import ThreadPool
+
+# Module specific logger
+logger = logging.getLogger(__name__)
+
+#######################################################################
+# Constants
+#######################################################################
+
+# Size of blocks read when computing checksums
+CHECKSUM_BLOCK_SIZE = 4*1024*1024
+
+# Number and size of blocks used for sampled checksums
+SAMPLE_NBLOCKS = 16
+SAMPLE_BLOCK_SIZE = 64*1024
+
+# Outcomes from comparing files
+CHECKSUM_OK = 'ok'
+CHECKSUM_FAILED = 'failed'
+UNREADABLE_REFERENCE = 'unreadable_ref'
+
+# Default name for checksum manifest files
+CHECKSUM_MANIFEST = 'checksums.manifest'
+
+# Header line for checksum manifest files
+CHECKSUM_MANIFEST_HEADER = "#path\tsize\tmtime\tmd5"
+
+#######################################################################
+# Classes
+#######################################################################
+
+class ChecksumManifest(object):
+    """
+    Persistent store of MD5 checksums for files under a directory
+
+    The manifest is a tab-delimited file with one line per
+    file, recording the path (relative to the base directory),
+    size, modification time (in whole seconds) and MD5
+    checksum:
+
+    #path  size  mtime  md5
+    bcl2fastq/AB/AB1_S1_R1_001.fastq.gz  10485760  1504262401  ...
+
+    An entry is only trusted while the size and modification
+    time of the file still match those recorded (its 'stat
+    signature'); otherwise the checksum is recomputed when
+    it is next requested. This means that the checksums only
+    need to be computed once, and can then be updated
+    incrementally as files are added or changed.
+
+    Example usage:
+
+    >>> manifest = ChecksumManifest('/data/170901_M00879_0087')
+    >>> manifest.update(fastqs,nthreads=4)
+    >>> manifest.save()
+    >>> chksum = manifest.md5sum(fastqs[0])
+
+    The manifest isn't written to disk until 'save' is
+    invoked.
+    """
+    def __init__(self,base_dir,manifest_file=None):
+        """
+        Create a new ChecksumManifest instance
+
+        Arguments:
+          base_dir (str): path to the directory that paths
+            in the manifest are relative to
+          manifest_file (str): optional, path to the manifest
+            file (defaults to CHECKSUM_MANIFEST in 'base_dir');
+            existing entries are loaded if the file exists
+        """
+        self._base_dir = os.path.abspath(base_dir)
+        if manifest_file is None:
+            manifest_file = os.path.join(self._base_dir,CHECKSUM_MANIFEST)
+        self._manifest_file = os.path.abspath(manifest_file)
+        self._entries = dict()
+        self._modified = False
+        if os.path.exists(self._manifest_file):
+            self.load()
+
+    @property
+    def manifest_file(self):
+        """
+        Path to the manifest file
+        """
+        return self._manifest_file
+
+    @property
+    def modified(self):
+        """
+        True if the manifest has changed since last loaded or saved
+        """
+        return self._modified
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self,path):
+        return self.relpath(path) in self._entries
+
+    def paths(self):
+        """
+        Return sorted list of relative paths in the manifest
+        """
+        return sorted(self._entries.keys())
+
+    def relpath(self,path):
+        """
+        Return the path of a file relative to the base directory
+
+        Relative paths are assumed to already be relative to
+        the base directory.
+
+        Arguments:
+          path (str): path to the file
+
+        Returns:
+          String: normalised relative path.
+        """
+        if os.path.isabs(path):
+            path = os.path.relpath(path,self._base_dir)
+        return os.path.normpath(path)
+
+    def abspath(self,path):
+        """
+        Return the absolute path for a file in the manifest
+
+        Arguments:
+          path (str): path to the file (relative paths are
+            taken to be relative to the base directory)
+
+        Returns:
+          String: absolute path.
+        """
+        return os.path.normpath(os.path.join(self._base_dir,path))
+
+    def load(self):
+        """
+        Load the entries from the manifest file
+
+        Lines which can't be parsed are ignored (so the
+        affected checksums will be recomputed).
+        """
+        self._entries = dict()
+        with open(self._manifest_file,'r') as fp:
+            for line in fp:
+                line = line.rstrip('\n')
+                if not line or line.startswith('#'):
+                    continue
+                try:
+                    path,size,mtime,chksum = line.split('\t')
+                    self._entries[os.path.normpath(path)] = \
+                        (int(size),int(mtime),chksum)
+                except ValueError:
+                    logger.warning("%s: bad line '%s' (ignored)" %
+                                   (self._manifest_file,line))
+        self._modified = False
+
+    def save(self):
+        """
+        Write the entries to the manifest file
+
+        The data are written to a temporary file which then
+        replaces the manifest, so an existing manifest is
+        never left partially written.
+        """
+        tmp_file = "%s.tmp.%d" % (self._manifest_file,os.getpid())
+        try:
+            with open(tmp_file,'w') as fp:
+                fp.write("%s\n" % CHECKSUM_MANIFEST_HEADER)
+                for path in self.paths():
+                    size,mtime,chksum = self._entries[path]
+                    fp.write("%s\t%d\t%d\t%s\n" % (path,size,mtime,chksum))
+            os.rename(tmp_file,self._manifest_file)
+        except Exception:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+        self._modified = False
+
+    def lookup(self,path):
+        """
+        Return the stored checksum for a file, if it can be trusted
+
+        Arguments:
+          path (str): path to the file
+
+        Returns:
+          String: the stored MD5 checksum if the size and
+            modification time of the file match those in the
+            manifest, otherwise None.
+        """
+        try:
+            size,mtime,chksum = self._entries[self.relpath(path)]
+        except KeyError:
+            return None
+        try:
+            st = os.stat(self.abspath(self.relpath(path)))
+        except OSError:
+            return None
+        if st.st_size == size and int(st.st_mtime) == mtime:
+            return chksum
+        return None
+
+    def md5sum(self,path):
+        """
+        Return the MD5 checksum for a file
+
+        Returns the stored checksum if it can be trusted,
+        otherwise the checksum is computed (and recorded in
+        the manifest if the file is under the base directory).
+
+        Arguments:
+          path (str): path to the file
+
+        Returns:
+          String: MD5 checksum as a hex digest.
+        """
+        chksum = self.lookup(path)
+        if chksum is None:
+            chksum = self._record(self._checksum_file(self.abspath(
+                self.relpath(path))))
+        return chksum
+
+    def update(self,paths,nthreads=1):
+        """
+        Add or refresh the entries for a set of files
+
+        Checksums are only computed for files which are not
+        already in the manifest or whose stat signature has
+        changed. Files which share an inode with a file which
+        has already been checksummed (e.g. hard links) are not
+        read again.
+
+        Files which don't exist are ignored.
+
+        Arguments:
+          paths (list): list of paths to files
+          nthreads (int): number of threads to use when
+            computing checksums (default: 1)
+
+        Returns:
+          Integer: number of checksums that were computed.
+        """
+        # Identify files needing checksums
+        pending = []
+        seen = set()
+        for path in paths:
+            relpath = self.relpath(path)
+            if relpath in seen or self.lookup(relpath) is not None:
+                continue
+            seen.add(relpath)
+            filen = self.abspath(relpath)
+            if not os.path.isfile(filen):
+                logger.warning("%s: not found (ignored)" % filen)
+                continue
+            pending.append((relpath,filen))
+        if not pending:
+            return 0
+        # Reuse checksums for linked files
+        known = dict()
+        for relpath in self._entries:
+            chksum = self.lookup(relpath)
+            if chksum is not None:
+                known[self._inode(self.abspath(relpath))] = chksum
+        to_compute = []
+        for relpath,filen in pending:
+            chksum = known.get(self._inode(filen))
+            if chksum is not None:
+                st = os.stat(filen)
+                self._entries[relpath] = (st.st_size,int(st.st_mtime),
+                                          chksum)
+                self._modified = True
+            else:
+                to_compute.append(filen)
+        # Compute the remaining checksums
+        if not to_compute:
+            return 0
+        start_time = time.time()
+        if nthreads > 1:
+            pool = ThreadPool(nthreads)
+            try:
+                for result in pool.imap_unordered(self._checksum_file,
+                                                  to_compute):
+                    self._record(result)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for filen in to_compute:
+                self._record(self._checksum_file(filen))
+        logger.debug("%s: computed %d checksums in %.2fs" %
+                     (self._manifest_file,len(to_compute),
+                      time.time()-start_time))
+        return len(to_compute)
+
+    def prune(self):
+        """
+        Remove entries for files which no longer exist
+
+        Returns:
+          Integer: number of entries that were removed.
+        """
+        missing = [path for path in self._entries
+                   if not os.path.isfile(self.abspath(path))]
+        for path in missing:
+            del(self._entries[path])
+        if missing:
+            self._modified = True
+        return len(missing)
+
+    def checksums(self,trusted_only=True):
+        """
+        Return the checksums from the manifest
+
+        Arguments:
+          trusted_only (bool): if True (the default) then
+            only return checksums for files whose stat
+            signatures match those in the manifest
+
+        Returns:
+          Dictionary: mapping relative paths to MD5 checksums.
+        """
+        checksums = dict()
+        for path in self._entries:
+            if trusted_only:
+                chksum = self.lookup(path)
+            else:
+                chksum = self._entries[path][2]
+            if chksum is not None:
+                checksums[path] = chksum
+        return checksums
+
+    def write_md5sum_file(self,md5sum_file,paths=None):
+        """
+        Write checksums as an 'md5sum'-format file
+
+        Arguments:
+          md5sum_file (str): path to the output file
+          paths (list): optional, list of paths to write
+            checksums for (defaults to all paths in the
+            manifest); untrusted or missing checksums are
+            computed
+        """
+        if paths is None:
+            paths = self.paths()
+        with open(md5sum_file,'w') as fp:
+            for path in paths:
+                fp.write("%s  %s\n" % (self.md5sum(path),
+                                       self.relpath(path)))
+
+    def _checksum_file(self,filen):
+        """
+        Internal: compute the stat signature and checksum for a file
+
+        The file is stat'ed before and after reading, and
+        the signature is discarded if the file changed while
+        being read (so the checksum won't be trusted later).
+
+        Returns:
+          Tuple: (filen,size,mtime,md5) where 'size' and
+            'mtime' are None if the file changed.
+        """
+        st = os.stat(filen)
+        chksum = md5sum(filen)
+        st_after = os.stat(filen)
+        if (st.st_size,int(st.st_mtime)) != \
+           (st_after.st_size,int(st_after.st_mtime)):
+            logger.warning("%s: changed while computing checksum" % filen)
+            return (filen,None,None,chksum)
+        return (filen,st.st_size,int(st.st_mtime),chksum)
+
+    def _record(self,result):
+        """
+        Internal: store the result from '_checksum_file'
+
+        Only files under the base directory with a valid
+        stat signature are stored.
+
+        Returns:
+          String: the MD5 checksum.
+        """
+        filen,size,mtime,chksum = result
+        relpath = self.relpath(filen)
+        if size is not None and not relpath.startswith(os.pardir):
+            self._entries[relpath] = (size,mtime,chksum)
+            self._modified = True
+        return chksum
+
+    def _inode(self,filen):
+        """
+        Internal: return (device,inode) tuple for a file
+        """
+        st = os.stat(filen)
+        return (st.st_dev,st.st_ino)
+
+class ChecksumReader(object):
+    """
+    Wrapper for a file-like object which computes the MD5 checksum
+
+    The checksum is updated with the data returned by each
+    'read' call, so that it can be computed while the data
+    is being copied elsewhere (e.g. into a tar stream):
+
+    >>> with open(filen,'rb') as fp:
+    ...     reader = ChecksumReader(fp)
+    ...     tar.addfile(tarinfo,reader)
+    >>> chksum = reader.hexdigest()
+    """
+    def __init__(self,fp):
+        """
+        Create a new ChecksumReader instance
+
+        Arguments:
+          fp (File): file-like object open for reading
+        """
+        self._fp = fp
+        self._chksum = hashlib.md5()
+
+    def read(self,size=-1):
+        """
+        Read data and update the checksum
+
+        Arguments:
+          size (int): maximum number of bytes to read
+            (reads to the end of the file if negative)
+        """
+        data = self._fp.read(size)
+        self._chksum.update(data)
+        return data
+
+    def hexdigest(self):
+        """
+        Return the MD5 checksum of the data read so far
+        """
+        return self._chksum.hexdigest()
+
+#######################################################################
+# Functions
+#######################################################################
+
+def md5sum(filen,block_size=CHECKSUM_BLOCK_SIZE):
+    """
+    Compute the MD5 checksum of a file
+
+    Arguments:
+      filen (str): path to the file
+      block_size (int): size of blocks to read the
+        file in (default: CHECKSUM_BLOCK_SIZE)
+
+    Returns:
+      String: MD5 checksum as a hex digest.
+    """
+    chksum = hashlib.md5()
+    with open(filen,'rb') as fp:
+        while True:
+            buf = fp.read(block_size)
+            if not buf:
+                break
+            chksum.update(buf)
+    return chksum.hexdigest()
+
+def copy_with_md5sum(src,dest,block_size=CHECKSUM_BLOCK_SIZE):
+    """
+    Copy a file and compute the MD5 checksum of the data copied
+
+    The checksum is computed as the data are copied, so the
+    source file is only read once. The permission bits are
+    also copied (as for 'shutil.copy').
+
+    Arguments:
+      src (str): path to the file to copy
+      dest (str): path to the destination file or
+        directory
+      block_size (int): size of blocks to copy the
+        file in (default: CHECKSUM_BLOCK_SIZE)
+
+    Returns:
+      String: MD5 checksum of the data as a hex digest.
+    """
+    if os.path.isdir(dest):
+        dest = os.path.join(dest,os.path.basename(src))
+    with open(src,'rb') as fp:
+        reader = ChecksumReader(fp)
+        with open(dest,'wb') as fpout:
+            while True:
+                buf = reader.read(block_size)
+                if not buf:
+                    break
+                fpout.write(buf)
+    shutil.copymode(src,dest)
+    return reader.hexdigest()
+
+def sampled_checksum(filen,nblocks=SAMPLE_NBLOCKS,
+                     block_size=SAMPLE_BLOCK_SIZE):
+    """
+    Compute an MD5 checksum from sampled blocks of a file
+
+    Reads 'nblocks' blocks spaced evenly through the file
+    (always including the first and last blocks) and
+    returns the checksum of the file size plus these blocks.
+    Files smaller than the total size of the samples are
+    read in full.
+
+    This is much faster than a full checksum for large
+    files, but will not detect all differences.
+
+    Arguments:
+      filen (str): path to the file
+      nblocks (int): number of blocks to sample
+      block_size (int): size of each sampled block
+
+    Returns:
+      String: checksum as a hex digest.
+    """
+    size = os.path.getsize(filen)
+    chksum = hashlib.md5(str(size))
+    with open(filen,'rb') as fp:
+        if size <= nblocks*block_size or nblocks < 2:
+            chksum.update(fp.read())
+        else:
+            step = (size - block_size)/(nblocks - 1)
+            for i in xrange(nblocks):
+                fp.seek(i*step)
+                chksum.update(fp.read(block_size))
+    return chksum.hexdigest()
+
+def read_md5sum_file(md5sum_file):
+    """
+    Read checksums from an 'md5sum'-format file
+
+    Lines in the file should be of the form
+    '<CHECKSUM>  <PATH>' (i.e. as output by the 'md5sum'
+    program).
+
+    Arguments:
+      md5sum_file (str): path to the file
+
+    Returns:
+      Dictionary: mapping paths to checksums.
+    """
+    checksums = dict()
+    with open(md5sum_file,'r') as fp:
+        for line in fp:
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+            try:
+                chksum,path = line.split(None,1)
+            except ValueError:
+                logger.warning("%s: bad line '%s' (ignored)" %
+                               (md5sum_file,line))
+                continue
+            # Strip the 'binary mode' indicator
+            if path.startswith('*'):
+                path = path[1:]
+            checksums[os.path.normpath(path)] = chksum
+    return checksums
+
+def compare_files(file_pairs,nthreads=1,quick=False,
+                  reference_checksums=None,
+                  block_size=CHECKSUM_BLOCK_SIZE):
+    """
+    Compare pairs of reference and copy files
+
+    For each pair, files are first compared by size (and
+    are reported as different if the sizes don't match
+    without reading either file). Otherwise the MD5 checksums
+    are compared; the reference and copy are read together
+    block-by-block, so both are checksummed in a single pass.
+
+    If 'reference_checksums' contains a checksum for the
+    reference then this is used and the reference isn't
+    read.
+
+    In 'quick' mode files whose sizes and modification times
+    match are compared using checksums of sampled blocks
+    (see 'sampled_checksum') rather than full checksums;
+    files with different modification times are still
+    compared in full.
+
+    Pairs are processed concurrently using 'nthreads'
+    threads, and the results are returned in the same order
+    as the input pairs.
+
+    Arguments:
+      file_pairs (list): list of tuples of the form
+        (name,reference,copy), where 'name' is an arbitrary
+        identifier and 'reference' and 'copy' are paths to
+        the files to compare
+      nthreads (int): number of threads to use (default: 1)
+      quick (bool): if True then use sampled checksums for
+        files with matching sizes and timestamps
+      reference_checksums (dict): optional, mapping of
+        names to pre-computed MD5 checksums for the
+        reference files
+      block_size (int): size of blocks to read files in
+
+    Returns:
+      Iterator: yields tuples of the form (name,outcome)
+        where 'outcome' is one of CHECKSUM_OK, CHECKSUM_FAILED
+        or UNREADABLE_REFERENCE.
+    """
+    tasks = [(name,ref,cpy,quick,
+              (reference_checksums.get(name)
+               if reference_checksums else None),
+              block_size)
+             for name,ref,cpy in file_pairs]
+    if nthreads > 1:
+        pool = ThreadPool(nthreads)
+        try:
+            for result in pool.imap(_compare_file_pair,tasks):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            yield _compare_file_pair(task)
+
+def _compare_file_pair(task):
+    """
+    Internal: compare a reference file with its copy
+
+    Arguments:
+      task (tuple): tuple of the form (name,reference,copy,
+        quick,reference_md5,block_size) (see 'compare_files')
+
+    Returns:
+      Tuple: (name,outcome).
+    """
+    name,ref,cpy,quick,ref_md5,block_size = task
+    try:
+        ref_stat = os.stat(ref)
+        if ref_md5 is None:
+            with open(ref,'rb'):
+                pass
+    except (IOError,OSError) as ex:
+        logger.debug("%s: unreadable reference: %s" % (name,ex))
+        return (name,UNREADABLE_REFERENCE)
+    try:
+        cpy_stat = os.stat(cpy)
+        if cpy_stat.st_size != ref_stat.st_size:
+            return (name,CHECKSUM_FAILED)
+        if quick and int(cpy_stat.st_mtime) == int(ref_stat.st_mtime):
+            if sampled_checksum(ref) == sampled_checksum(cpy):
+                return (name,CHECKSUM_OK)
+            return (name,CHECKSUM_FAILED)
+        if ref_md5 is not None:
+            cpy_md5 = md5sum(cpy,block_size=block_size)
+        else:
+            ref_md5,cpy_md5 = _md5sum_pair(ref,cpy,block_size)
+    except (IOError,OSError) as ex:
+        logger.debug("%s: failed to checksum copy: %s" % (name,ex))
+        return (name,CHECKSUM_FAILED)
+    if ref_md5 == cpy_md5:
+        return (name,CHECKSUM_OK)
+    return (name,CHECKSUM_FAILED)
+
+def _md5sum_pair(filen1,filen2,block_size=CHECKSUM_BLOCK_SIZE):
+    """
+    Internal: compute MD5 checksums of two files in a single pass
+
+    Arguments:
+      filen1 (str): path to first file
+      filen2 (str): path to second file
+      block_size (int): size of blocks to read files in
+
+    Returns:
+      Tuple: pair of MD5 hex digests.
+    """
+    chksum1 = hashlib.md5()
+    chksum2 = hashlib.md5()
+    with open(filen1,'rb') as fp1:
+        with open(filen2,'rb') as fp2:
+            while True:
+                buf1 = fp1.read(block_size)
+                buf2 = fp2.read(block_size)
+                if not buf1 and not buf2:
+                    break
+                chksum1.update(buf1)
+                chksum2.update(buf2)
+    return (chksum1.hexdigest(),chksum2.hexdigest())
+
+def load_reference_checksums(checksum_file,base_dir=None):
+    """
+    Read reference checksums from a manifest or 'md5sum' file
+
+    If the file is a checksum manifest (see the
+    ChecksumManifest class) then only the checksums for
+    files whose stat signatures still match are returned;
+    otherwise the file is read as 'md5sum'-format output
+    (see 'read_md5sum_file').
+
+    Arguments:
+      checksum_file (str): path to the file
+      base_dir (str): directory that paths in a manifest
+        are relative to (defaults to the directory holding
+        the manifest)
+
+    Returns:
+      Dictionary: mapping relative paths to checksums.
+    """
+    with open(checksum_file,'r') as fp:
+        header = fp.readline().rstrip('\n')
+    if header == CHECKSUM_MANIFEST_HEADER:
+        if base_dir is None:
+            base_dir = os.path.dirname(os.path.abspath(checksum_file))
+        return ChecksumManifest(base_dir,checksum_file).checksums()
+    return read_md5sum_file(checksum_file)
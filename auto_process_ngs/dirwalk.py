@@ -0,0 +1,620 @@
+#!/usr/bin/env python
+#
+#     dirwalk.py: utilities for walking directory trees
+#     Copyright (C) University of Manchester 2017 Peter Briggs
+#
+########################################################################
+#
+# dirwalk.py
+#
+#########################################################################
+
+"""
+dirwalk.py
+
+Utility classes and functions for walking directory trees and
+collecting disk usage:
+
+- DiskUsage: accumulate apparent sizes and block counts
+- UsageIndex: persistent index of per-directory disk usage
+- scan_dir: list directory entries with their 'lstat' results
+- walk_tree: walk a directory tree using multiple threads
+- walk_usage: walk a directory tree collecting per-directory usage
+- get_disk_usage: get the disk usage for a file or directory
+- get_user_name: look up the user name for a UID
+
+The 'scandir' module is used to list directories if it is
+available (each entry is stat'ed once and the result reused);
+otherwise the walker falls back to 'os.listdir' and 'os.lstat'.
+
+"""
+
+#######################################################################
+# Imports
+#######################################################################
+
+import os
+import pwd
+import stat
+import json
+import sqlite3
+import logging
+from collections import deque
+from multiprocessing.pool import ThreadPool
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+# Module specific logger
+logger = logging.getLogger(__name__)
+
+#######################################################################
+# Constants
+#######################################################################
+
+# Size of the blocks reported by 'st_blocks'
+STAT_BLOCK_SIZE = 512
+
+#######################################################################
+# Classes
+#######################################################################
+
+class DiskUsage(object):
+    """
+    Accumulate the disk usage for a set of files and directories
+
+    Records the apparent size (i.e. the sum of the 'st_size'
+    values, as reported by 'du --apparent-size'), the number
+    of 512-byte blocks allocated (the sum of 'st_blocks'), the
+    numbers of files and directories, and the UIDs of their
+    owners.
+
+    Apparent sizes can also be accumulated for arbitrary
+    named categories (e.g. file types), which are stored in
+    the 'categories' dictionary.
+
+    Example usage:
+
+    >>> usage = DiskUsage()
+    >>> usage.add(os.lstat('README'))
+    >>> usage.apparent_size
+    1024
+    """
+    def __init__(self):
+        """
+        Create a new DiskUsage instance
+        """
+        self.apparent_size = 0
+        self.blocks = 0
+        self.nfiles = 0
+        self.ndirs = 0
+        self.uids = set()
+        self.categories = dict()
+
+    @property
+    def size(self):
+        """
+        Size in bytes of the allocated blocks
+        """
+        return self.blocks*STAT_BLOCK_SIZE
+
+    @property
+    def users(self):
+        """
+        Sorted list of the user names of the owners
+        """
+        return sorted(set([get_user_name(uid) for uid in self.uids]))
+
+    def add(self,st,categories=None):
+        """
+        Add a file or directory to the totals
+
+        Arguments:
+          st (stat_result): 'lstat' result for the file
+            or directory
+          categories (list): optional, list of category
+            names to also add the apparent size to
+        """
+        self.apparent_size += st.st_size
+        self.blocks += st.st_blocks
+        if stat.S_ISDIR(st.st_mode):
+            self.ndirs += 1
+        else:
+            self.nfiles += 1
+        self.uids.add(st.st_uid)
+        if categories:
+            for category in categories:
+                self.categories[category] = \
+                    self.categories.get(category,0) + st.st_size
+
+    def merge(self,usage):
+        """
+        Add the totals from another DiskUsage instance
+
+        Arguments:
+          usage (DiskUsage): instance to add the totals
+            from
+        """
+        self.apparent_size += usage.apparent_size
+        self.blocks += usage.blocks
+        self.nfiles += usage.nfiles
+        self.ndirs += usage.ndirs
+        self.uids.update(usage.uids)
+        for category in usage.categories:
+            self.categories[category] = self.categories.get(category,0) + \
+                                        usage.categories[category]
+
+class UsageIndex(object):
+    """
+    Persistent index of per-directory disk usage
+
+    Stores the usage for the entries directly within each
+    directory (see 'walk_usage') in an SQLite database,
+    along with the modification time and inode of the
+    directory and the names of its subdirectories.
+
+    A stored entry is reused for as long as the
+    modification time and inode of the directory are
+    unchanged, which means that unchanged directories only
+    need to be stat'ed rather than listed when re-auditing.
+    Note that changes to the size of files which don't
+    also update the modification time of the parent
+    directory (e.g. appending to an existing file) won't
+    be detected; use 'refresh' (see 'walk_usage') to
+    force a full rescan.
+
+    The index is loaded into memory when the UsageIndex is
+    created, and changes are only written back when 'save'
+    is invoked.
+
+    Example usage:
+
+    >>> index = UsageIndex('usage.db',scheme='audit_data')
+    >>> usage = get_disk_usage('/data/2017/miseq',index=index)
+    >>> index.save()
+
+    """
+    def __init__(self,index_file,scheme=None):
+        """
+        Create a new UsageIndex instance
+
+        Arguments:
+          index_file (str): path to the SQLite database
+            file (created if it doesn't exist)
+          scheme (str): optional, identifier for the
+            categories used when collecting the usage;
+            stored entries are discarded if the scheme
+            doesn't match the one used to create them
+        """
+        self._index_file = os.path.abspath(index_file)
+        self._scheme = str(scheme)
+        self._entries = dict()
+        self._updated = dict()
+        self._removed = set()
+        self._load()
+
+    @property
+    def index_file(self):
+        """
+        Path to the index file
+        """
+        return self._index_file
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self,dirn,st):
+        """
+        Return the stored usage for a directory, if it is current
+
+        Arguments:
+          dirn (str): path to the directory
+          st (stat_result): 'lstat' result for the directory
+
+        Returns:
+          Tuple: (usage,subdirs) where 'usage' is a DiskUsage
+            instance and 'subdirs' is a list of names of the
+            subdirectories, or None if there is no stored
+            entry or if the directory has changed.
+        """
+        try:
+            mtime,inode,usage,subdirs = self._entries[dirn]
+        except KeyError:
+            return None
+        if mtime != st.st_mtime or inode != st.st_ino:
+            return None
+        return (usage,subdirs)
+
+    def update(self,dirn,st,usage,subdirs):
+        """
+        Store the usage for a directory
+
+        Arguments:
+          dirn (str): path to the directory
+          st (stat_result): 'lstat' result for the directory
+          usage (DiskUsage): usage for the entries directly
+            within the directory
+          subdirs (list): list of names of the
+            subdirectories
+        """
+        entry = (st.st_mtime,st.st_ino,usage,list(subdirs))
+        self._entries[dirn] = entry
+        self._updated[dirn] = entry
+        self._removed.discard(dirn)
+
+    def prune(self,dirn,keep):
+        """
+        Remove entries for directories which have gone
+
+        Removes the entries for all directories under
+        'dirn' which aren't in 'keep'.
+
+        Arguments:
+          dirn (str): path to the top-level directory
+          keep (set): paths for the directories to keep
+
+        Returns:
+          Integer: number of entries removed.
+        """
+        prefix = os.path.join(dirn,'')
+        removed = [d for d in self._entries
+                   if (d == dirn or d.startswith(prefix)) and d not in keep]
+        for d in removed:
+            del(self._entries[d])
+            self._updated.pop(d,None)
+            self._removed.add(d)
+        return len(removed)
+
+    def save(self):
+        """
+        Write the changes to the index file
+        """
+        if not self._updated and not self._removed:
+            return
+        db = sqlite3.connect(self._index_file)
+        db.text_factory = str
+        try:
+            with db:
+                self._create_tables(db)
+                db.executemany("DELETE FROM usage WHERE path=?",
+                               [(d,) for d in self._removed])
+                db.executemany("INSERT OR REPLACE INTO usage VALUES "
+                               "(?,?,?,?,?,?,?,?,?,?)",
+                               [self._to_row(d,self._updated[d])
+                                for d in self._updated])
+        finally:
+            db.close()
+        self._updated = dict()
+        self._removed = set()
+
+    def _load(self):
+        """
+        Internal: load the entries from the index file
+        """
+        if not os.path.exists(self._index_file):
+            return
+        db = sqlite3.connect(self._index_file)
+        db.text_factory = str
+        try:
+            with db:
+                self._create_tables(db)
+                scheme = db.execute("SELECT value FROM metadata "
+                                    "WHERE key='scheme'").fetchone()
+                if scheme is None or scheme[0] != self._scheme:
+                    # Discard entries created with another scheme
+                    logger.warning("%s: resetting usage index" %
+                                   self._index_file)
+                    db.execute("DELETE FROM usage")
+                    db.execute("INSERT OR REPLACE INTO metadata "
+                               "VALUES ('scheme',?)",(self._scheme,))
+                    return
+                for row in db.execute("SELECT * FROM usage"):
+                    self._from_row(row)
+        finally:
+            db.close()
+
+    def _create_tables(self,db):
+        """
+        Internal: create the database tables if necessary
+        """
+        db.execute("CREATE TABLE IF NOT EXISTS metadata "
+                   "(key TEXT PRIMARY KEY,value TEXT)")
+        db.execute("CREATE TABLE IF NOT EXISTS usage "
+                   "(path TEXT PRIMARY KEY,mtime REAL,inode INTEGER,"
+                   "apparent_size INTEGER,blocks INTEGER,"
+                   "nfiles INTEGER,ndirs INTEGER,uids TEXT,"
+                   "categories TEXT,subdirs TEXT)")
+        db.execute("INSERT OR IGNORE INTO metadata VALUES ('scheme',?)",
+                   (self._scheme,))
+
+    def _to_row(self,dirn,entry):
+        """
+        Internal: convert an entry to a database row
+        """
+        mtime,inode,usage,subdirs = entry
+        return (dirn,mtime,inode,
+                usage.apparent_size,usage.blocks,
+                usage.nfiles,usage.ndirs,
+                json.dumps(sorted(usage.uids)),
+                json.dumps(usage.categories),
+                json.dumps(subdirs))
+
+    def _from_row(self,row):
+        """
+        Internal: store an entry from a database row
+        """
+        dirn,mtime,inode,apparent_size,blocks,nfiles,ndirs,\
+            uids,categories,subdirs = row
+        usage = DiskUsage()
+        usage.apparent_size = apparent_size
+        usage.blocks = blocks
+        usage.nfiles = nfiles
+        usage.ndirs = ndirs
+        usage.uids = set(json.loads(uids))
+        usage.categories = dict([(str(c),n) for c,n in
+                                 json.loads(categories).items()])
+        self._entries[dirn] = (mtime,inode,usage,
+                               [d.encode('utf-8')
+                                for d in json.loads(subdirs)])
+
+#######################################################################
+# Functions
+#######################################################################
+
+def scan_dir(dirn):
+    """
+    Return the entries in a directory with their 'lstat' results
+
+    Errors when reading the directory are reported as
+    warnings and the directory is treated as empty (as
+    for 'os.walk').
+
+    Arguments:
+      dirn (str): path to the directory
+
+    Returns:
+      List: list of tuples of the form (name,path,stat).
+    """
+    try:
+        if scandir is not None:
+            return [(entry.name,entry.path,entry.stat(follow_symlinks=False))
+                    for entry in scandir(dirn)]
+        entries = []
+        for name in os.listdir(dirn):
+            path = os.path.join(dirn,name)
+            entries.append((name,path,os.lstat(path)))
+        return entries
+    except OSError as ex:
+        logger.warning("%s: %s" % (dirn,ex))
+        return []
+
+def walk_tree(dirn,nthreads=1):
+    """
+    Walk a directory tree, scanning subdirectories concurrently
+
+    For each directory in the tree (starting with 'dirn'
+    itself), yields a tuple of the form (dirpath,entries)
+    where 'entries' is the list of (name,path,stat) tuples
+    returned by 'scan_dir' for that directory.
+
+    Symbolic links to directories are not followed.
+
+    If 'nthreads' is greater than one then the directories
+    are scanned using a pool of threads, in which case the
+    order that directories are yielded is not defined (other
+    than that a directory is always yielded before any of
+    its subdirectories). The results are always yielded in
+    the calling thread, so consumers don't need to do any
+    locking.
+
+    Arguments:
+      dirn (str): path to the top-level directory
+      nthreads (int): number of threads to use (default: 1)
+
+    Returns:
+      Iterator: yields (dirpath,entries) tuples.
+    """
+    for result in _walk(dirn,_scan_dir_task,nthreads):
+        yield result
+
+def walk_usage(dirn,nthreads=1,classify=None,index=None,refresh=False):
+    """
+    Walk a directory tree collecting the usage for each directory
+
+    For each directory in the tree (starting with 'dirn'
+    itself), yields a tuple of the form (dirpath,stat,usage)
+    where 'stat' is the 'lstat' result for the directory and
+    'usage' is a DiskUsage instance with the totals for the
+    entries directly within that directory (i.e. including
+    its subdirectories but not their contents).
+
+    If a UsageIndex is supplied then stored totals are used
+    for directories which haven't changed (so they only need
+    to be stat'ed, not listed), and the index is updated for
+    all other directories (the index is not saved). Entries
+    in the index for directories which no longer exist are
+    removed at the end of the walk.
+
+    Directories are scanned concurrently if 'nthreads' is
+    greater than one (see 'walk_tree').
+
+    Arguments:
+      dirn (str): path to the top-level directory
+      nthreads (int): number of threads to use (default: 1)
+      classify (function): optional, function which takes
+        the name of a file or directory and returns a list
+        of categories to add its size to
+      index (UsageIndex): optional, index to get stored
+        totals from and store new totals in
+      refresh (bool): if True then ignore stored totals in
+        the index and rescan every directory (default: False)
+
+    Returns:
+      Iterator: yields (dirpath,stat,usage) tuples.
+    """
+    dirn = os.path.abspath(dirn)
+    lookup = (index if not refresh else None)
+    task = lambda d: _dir_usage_task(d,classify,lookup)
+    visited = set()
+    for dirpath,st,usage,subdirs,cached in _walk(dirn,task,nthreads):
+        if index is not None:
+            visited.add(dirpath)
+            if not cached:
+                index.update(dirpath,st,usage,subdirs)
+        yield (dirpath,st,usage)
+    if index is not None:
+        index.prune(dirn,visited)
+
+def get_disk_usage(path,nthreads=1,include_top=True,classify=None,
+                   index=None,refresh=False):
+    """
+    Get the disk usage for a file or directory
+
+    The usage for a directory is the total for all the
+    files and directories under it, collected in a single
+    walk of the tree (see 'walk_usage').
+
+    If 'path' is a symbolic link to a directory then the
+    usage is collected for the target directory (links
+    within the tree are not followed).
+
+    Arguments:
+      path (str): path to the file or directory
+      nthreads (int): number of threads to use when
+        walking a directory (default: 1)
+      include_top (bool): if True (the default) then
+        include the top-level directory itself in the
+        totals
+      classify (function): optional, function which takes
+        the name of a file or directory and returns a list
+        of categories to add its size to
+      index (UsageIndex): optional, index of stored totals
+        for unchanged directories (see 'walk_usage')
+      refresh (bool): if True then ignore stored totals
+        in the index (default: False)
+
+    Returns:
+      DiskUsage: the usage for the file or directory.
+    """
+    usage = DiskUsage()
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode) and os.path.isdir(path):
+        # Follow a link to a directory at the top level (but
+        # not any links below it)
+        path = os.path.realpath(path)
+        st = os.lstat(path)
+    if include_top or not stat.S_ISDIR(st.st_mode):
+        usage.add(st,_classify(classify,os.path.basename(path)))
+    if stat.S_ISDIR(st.st_mode):
+        for dirpath,st,dir_usage in walk_usage(path,nthreads=nthreads,
+                                               classify=classify,
+                                               index=index,
+                                               refresh=refresh):
+            usage.merge(dir_usage)
+    return usage
+
+def get_user_name(uid):
+    """
+    Return the user name for a UID
+
+    Names are cached after the first lookup.
+
+    Arguments:
+      uid (int): the UID to look up
+
+    Returns:
+      String: the user name, or the UID as a string if
+        there is no matching user.
+    """
+    try:
+        return _user_names[uid]
+    except KeyError:
+        try:
+            name = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            name = str(uid)
+        _user_names[uid] = name
+        return name
+
+# Cache of user names for 'get_user_name'
+_user_names = dict()
+
+def _walk(dirn,task,nthreads=1):
+    """
+    Internal: apply a function to each directory in a tree
+
+    'task' is called with the path of each directory and
+    should return a tuple (result,subdirs), where 'subdirs'
+    is a list of paths to the subdirectories to visit next;
+    the results are yielded (with None results skipped).
+
+    If 'nthreads' is greater than one then the tasks are run
+    concurrently using a pool of threads.
+    """
+    if nthreads > 1:
+        pool = ThreadPool(nthreads)
+        try:
+            pending = deque([pool.apply_async(task,(dirn,))])
+            while pending:
+                result,subdirs = pending.popleft().get()
+                for d in subdirs:
+                    pending.append(pool.apply_async(task,(d,)))
+                if result is not None:
+                    yield result
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        stack = [dirn]
+        while stack:
+            result,subdirs = task(stack.pop())
+            stack.extend(subdirs)
+            if result is not None:
+                yield result
+
+def _scan_dir_task(dirn):
+    """
+    Internal: scan a directory for '_walk'
+
+    Returns ((dirn,entries),subdirs).
+    """
+    entries = scan_dir(dirn)
+    subdirs = [path for name,path,st in entries
+               if stat.S_ISDIR(st.st_mode)]
+    return ((dirn,entries),subdirs)
+
+def _dir_usage_task(dirn,classify=None,index=None):
+    """
+    Internal: get the usage for a directory for '_walk'
+
+    Returns ((dirn,stat,usage,subdirs,cached),subdirs), or
+    (None,[]) if the directory can't be stat'ed.
+    """
+    try:
+        st = os.lstat(dirn)
+    except OSError as ex:
+        logger.warning("%s: %s" % (dirn,ex))
+        return (None,[])
+    if index is not None:
+        cached = index.lookup(dirn,st)
+        if cached is not None:
+            usage,subdirs = cached
+            return ((dirn,st,usage,subdirs,True),
+                    [os.path.join(dirn,d) for d in subdirs])
+    usage = DiskUsage()
+    subdirs = []
+    for name,path,entry_st in scan_dir(dirn):
+        usage.add(entry_st,_classify(classify,name))
+        if stat.S_ISDIR(entry_st.st_mode):
+            subdirs.append(name)
+    return ((dirn,st,usage,subdirs,False),
+            [os.path.join(dirn,d) for d in subdirs])
+
+def _classify(classify,name):
+    """
+    Internal: return the categories for a name (or None)
+    """
+    if classify is None:
+        return None
+    return classify(name)
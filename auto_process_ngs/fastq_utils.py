@@ -15,8 +15,12 @@ fastq_utils.py
 Utility functions for operating on Fastq files:
 
 - assign_barcodes_single_end: extract and assign inline barcodes
+- check_gzip_member: quick sanity checks on a gzipped file
+- concat_fastqs: concatenate multiple Fastq files
+- fastq_header_key: extract pairing key and read number from header
 - get_read_number: get the read number (1 or 2) from a Fastq file
 - pair_fastqs: automagically pair up FASTQ files
+- sample_fastq: randomly sample a subset of reads from a Fastq file
 
 """
 
@@ -25,15 +29,95 @@ Utility functions for operating on Fastq files:
 #######################################################################
 
 import os
+import io
+import re
 import gzip
+import random
+import shutil
 import logging
+import subprocess
+from multiprocessing.pool import ThreadPool
 from bcftbx.FASTQFile import FastqIterator
+from bcftbx.utils import find_program
+
+# Module specific logger
+logger = logging.getLogger(__name__)
+
+#######################################################################
+# Constants
+#######################################################################
+
+# Gzip magic number and compression method (deflate)
+GZIP_MAGIC = '\x1f\x8b\x08'
+
+# Minimum size of a gzip member (10 byte header, 8 byte trailer)
+GZIP_MIN_SIZE = 18
+
+# Size of chunks used when copying data
+CONCAT_CHUNK_SIZE = 1024*1024
+
+# Compression level used when compressing uncompressed data
+# (same as the default for the 'gzip' program; the gzip
+# module's default of 9 is much slower for little gain)
+CONCAT_COMPRESS_LEVEL = 6
+
+# Number of files above which pair_fastqs reads headers
+# in parallel, and number of threads to use
+PAIR_FASTQS_PARALLEL_MIN = 64
+PAIR_FASTQS_NTHREADS = 8
+
+# Number of reads to buffer before writing output in
+# assign_barcodes_single_end
+ASSIGN_BARCODES_BUFFER_READS = 10000
+
+# Patterns for locating the index sequence in read headers
+# (Illumina 1.8+ and earlier formats)
+_ILLUMINA18_INDEX_PATTERN = re.compile(r'^(@\S+\s+[^:\s]*:[^:\s]*:[^:\s]*:)'
+                                       r'([^\s]*)(.*)$')
+_ILLUMINA_INDEX_PATTERN = re.compile(r'^(@\S+#)([^/\s]*)(.*)$')
+
+#######################################################################
+# Classes
+#######################################################################
+
+class _PigzWriter(object):
+    """
+    Internal: file-like object which compresses data using 'pigz'
+
+    Data written to the object are piped to a 'pigz'
+    subprocess, which writes the compressed data to the
+    output file.
+    """
+    def __init__(self,filen,pigz,nthreads):
+        """
+        Create a new _PigzWriter instance
+
+        Arguments:
+          filen (str): path to the output file
+          pigz (str): path to the 'pigz' executable
+          nthreads (int): number of threads for 'pigz'
+            to use
+        """
+        self._filen = filen
+        self._fp = open(filen,'wb')
+        self._proc = subprocess.Popen([pigz,'-c','-p',str(nthreads)],
+                                      stdin=subprocess.PIPE,
+                                      stdout=self._fp)
+    def write(self,data):
+        self._proc.stdin.write(data)
+    def close(self):
+        self._proc.stdin.close()
+        status = self._proc.wait()
+        self._fp.close()
+        if status != 0:
+            raise IOError("%s: 'pigz' failed (exit status %d)" %
+                          (self._filen,status))
 
 #######################################################################
 # Functions
 #######################################################################
 
-def assign_barcodes_single_end(fastq_in,fastq_out,n=5):
+def assign_barcodes_single_end(fastq_in,fastq_out,n=5,nthreads=1):
     """
     Extract inline barcodes and assign to Fastq read headers
 
@@ -41,8 +125,17 @@ def assign_barcodes_single_end(fastq_in,fastq_out,n=5):
     FASTQ file and assigns it to the index sequence for that
     read in the output file.
 
+    The reads are processed line-by-line: the index sequence
+    in each header is replaced using precompiled regular
+    expressions (see '_assign_index_sequence'), and the
+    sequence and quality lines are trimmed by slicing. Output
+    is written in blocks of ASSIGN_BARCODES_BUFFER_READS
+    reads.
+
     If the supplied output file name ends with '.gz' then it
-    will be gzipped.
+    will be gzipped; if 'nthreads' is greater than 1 and
+    'pigz' is available then this is used to perform the
+    compression using multiple threads.
 
     Arguments:
       fastq_in (str): input FASTQ file (can be gzipped)
@@ -50,29 +143,44 @@ def assign_barcodes_single_end(fastq_in,fastq_out,n=5):
         ending with '.gz')
       n (integer): number of bases to extract and assign as
         index sequence (default: 5)
+      nthreads (integer): number of threads to use for
+        compressing the output (default: 1)
 
     Returns:
       Integer: number of reads processed.
 
     """
-    if fastq_out.endswith('.gz'):
-        fp = gzip.GzipFile(filename=fastq_out,mode='wb')
-    else:
-        fp = open(fastq_out,'w')
+    fp = _open_fastq_out(fastq_out,nthreads=nthreads)
+    fp_in = _open_fastq_in(fastq_in)
     print "Processing reads from %s" % fastq_in
     nread = 0
-    for read in FastqIterator(fastq_in):
-        # Extract new barcode sequence
-        barcode = read.sequence[:n]
-        # Truncate sequence and quality accordingly
-        sequence = read.sequence[n:]
-        quality = read.quality[n:]
-        # Assign new values and write to output
-        read.seqid.index_sequence = barcode
-        read.sequence = sequence
-        read.quality = quality
-        fp.write("%s\n" % read)
-        nread += 1
+    buf = []
+    try:
+        while True:
+            header = fp_in.readline()
+            if not header:
+                break
+            sequence = fp_in.readline().rstrip('\n')
+            optid = fp_in.readline()
+            quality = fp_in.readline().rstrip('\n')
+            # Assign the barcode and truncate sequence and
+            # quality accordingly
+            buf.append(_assign_index_sequence(header.rstrip('\n'),
+                                              sequence[:n]))
+            buf.append(sequence[n:])
+            buf.append(optid.rstrip('\n'))
+            buf.append(quality[n:])
+            nread += 1
+            if nread % ASSIGN_BARCODES_BUFFER_READS == 0:
+                buf.append('')
+                fp.write('\n'.join(buf))
+                buf = []
+        if buf:
+            buf.append('')
+            fp.write('\n'.join(buf))
+    finally:
+        fp_in.close()
+        fp.close()
     print "Finished (%d reads processed)" % nread
     return nread
 
@@ -91,7 +199,7 @@ def get_read_number(fastq):
         break
     return int(seq_id.pair_id)
 
-def pair_fastqs(fastqs):
+def pair_fastqs(fastqs,nthreads=None):
     """
     Automagically pair up FASTQ files
 
@@ -99,9 +207,18 @@ def pair_fastqs(fastqs):
     pairs by examining the header for the first read in
     each file.
 
+    Files are matched using a key extracted from the
+    header (see 'fastq_header_key'), so each file only
+    needs to be examined once. For long lists of files the
+    headers are read using multiple threads.
+
     Arguments:
       fastqs (list): list of paths to FASTQ files which
         will be paired.
+      nthreads (int): optional, number of threads to use
+        when reading the headers (defaults to
+        PAIR_FASTQS_NTHREADS if there are more than
+        PAIR_FASTQS_PARALLEL_MIN files, otherwise 1)
 
     Returns:
       Tuple: pair of lists of the form (paired,unpaired),
@@ -109,39 +226,395 @@ def pair_fastqs(fastqs):
         FASTQ R1/R2 pairs and `unpaired` is a list of
         FASTQs which couldn't be paired.
     """
+    fastqs = [os.path.abspath(fq) for fq in fastqs]
+    if nthreads is None:
+        if len(fastqs) > PAIR_FASTQS_PARALLEL_MIN:
+            nthreads = PAIR_FASTQS_NTHREADS
+        else:
+            nthreads = 1
+    # Get header from first read of each file
+    if nthreads > 1:
+        pool = ThreadPool(nthreads)
+        try:
+            headers = pool.map(_read_first_line,fastqs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        headers = map(_read_first_line,fastqs)
+    # Match up files using the header keys
     fq_pairs = []
-    seq_ids = {}
+    unpaired_by_key = {}
     bad_files = []
-    for fq in [os.path.abspath(fq) for fq in fastqs]:
-        # Get header from first read
-        seq_id = None
-        for r in FastqIterator(fq):
-            seq_id = r.seqid
-            break
-        if seq_id is None:
-            logging.debug("'Bad' file: %s" % fq)
+    for fq,header in zip(fastqs,headers):
+        key = fastq_header_key(header)
+        if key is None:
+            logger.debug("'Bad' file: %s" % fq)
             bad_files.append(fq)
             continue
+        key,pair_id = key
+        candidates = unpaired_by_key.setdefault(key,[])
         fq_pair = None
-        for fq1 in seq_ids:
-            if seq_id.is_pair_of(seq_ids[fq1]):
+        for i,(fq1,pair_id1) in enumerate(candidates):
+            if set((pair_id,pair_id1)) == set(('1','2')):
                 # Found a pair
-                if seq_id.pair_id == '1':
+                if pair_id == '1':
                     fq_pair = (fq,fq1)
                 else:
                     fq_pair = (fq1,fq)
                 fq_pairs.append(fq_pair)
-                logging.debug("*** Paired: %s\n"
-                              "          : %s" % fq_pair)
+                logger.debug("*** Paired: %s\n"
+                             "          : %s" % fq_pair)
                 # Remove paired fastq
-                del(seq_ids[fq1])
+                del(candidates[i])
                 break
         if fq_pair is None:
             # Unable to pair, store for now
-            logging.debug("Unpaired: %s" % fq)
-            seq_ids[fq] = seq_id
+            logger.debug("Unpaired: %s" % fq)
+            candidates.append((fq,pair_id))
     # Sort pairs into order
     fq_pairs = sorted(fq_pairs,lambda x,y: cmp(x[0],y[0]))
-    unpaired = sorted(seq_ids.keys() + bad_files)
+    unpaired = [fq for key in unpaired_by_key
+                for fq,pair_id in unpaired_by_key[key]]
+    unpaired = sorted(unpaired + bad_files)
     # Return paired and upaired fastqs
     return (fq_pairs,unpaired)
+
+def fastq_header_key(header):
+    """
+    Extract the pairing key and read number from a read header
+
+    Handles headers in both the Illumina 1.8+ format e.g.
+
+    @EAS139:136:FC706VJ:2:2104:15343:197393 1:Y:18:ATCACG
+
+    (where the key is 'instrument:run:flowcell:lane:tile:x:y'
+    and the read number follows the space), and the earlier
+    Illumina format e.g.
+
+    @HWUSI-EAS100R:6:73:941:1973#0/1
+
+    (where the key is everything before the trailing '/'
+    and the read number follows it).
+
+    Arguments:
+      header (str): read header line (with or without the
+        leading '@')
+
+    Returns:
+      Tuple: tuple of the form (key,read_number) where both
+        elements are strings, or None if the header couldn't
+        be parsed.
+    """
+    if not header:
+        return None
+    header = header.strip()
+    if header.startswith('@'):
+        header = header[1:]
+    fields = header.split()
+    if not fields:
+        return None
+    if len(fields) > 1:
+        # Illumina 1.8+
+        key = fields[0].split(':')
+        if len(key) < 7:
+            return None
+        return (':'.join(key[:7]),fields[1].split(':')[0])
+    # Earlier Illumina format
+    key,sep,pair_id = fields[0].rpartition('/')
+    if not sep:
+        return None
+    return (key,pair_id)
+
+def _read_first_line(fastq):
+    """
+    Internal: return the first line of a (possibly gzipped) file
+
+    Only decompresses as much data as is needed to get
+    the first line from gzipped files.
+
+    Arguments:
+      fastq (str): path to the file
+
+    Returns:
+      String: the first line of the file (including any
+        trailing newline), or None if the file couldn't
+        be read.
+    """
+    try:
+        if fastq.endswith('.gz'):
+            fp = gzip.GzipFile(filename=fastq,mode='rb')
+        else:
+            fp = open(fastq,'rb')
+        try:
+            return fp.readline()
+        finally:
+            fp.close()
+    except IOError as ex:
+        logger.warning("%s: unable to read header: %s" % (fastq,ex))
+        return None
+
+def sample_fastq(fastq_in,fastq_out,n,seed=None):
+    """
+    Randomly sample a subset of reads from a Fastq file
+
+    Uses reservoir sampling to select ``n`` reads from the
+    input FASTQ file in a single pass, without needing to
+    know the total number of reads in advance. The sampled
+    reads are written to the output file in the same order
+    that they appear in the input.
+
+    If the input file has ``n`` reads or fewer then all the
+    reads are written to the output.
+
+    If the supplied output file name ends with '.gz' then it
+    will be gzipped.
+
+    Arguments:
+      fastq_in (str): input FASTQ file (can be gzipped)
+      fastq_out (str): output FASTQ file (will be gzipped if
+        ending with '.gz')
+      n (integer): number of reads to sample
+      seed (integer): optional, seed for the random number
+        generator (to make the sampling reproducible)
+
+    Returns:
+      Integer: number of reads written to the output file.
+
+    """
+    rng = random.Random(seed)
+    reservoir = []
+    nread = 0
+    if fastq_in.endswith('.gz'):
+        fp = gzip.GzipFile(filename=fastq_in,mode='rb')
+    else:
+        fp = open(fastq_in,'rb')
+    try:
+        while True:
+            # Read the four lines of the next record
+            header = fp.readline()
+            if not header:
+                break
+            record = header + fp.readline() + fp.readline() + fp.readline()
+            if nread < n:
+                reservoir.append((nread,record))
+            else:
+                i = rng.randint(0,nread)
+                if i < n:
+                    reservoir[i] = (nread,record)
+            nread += 1
+    finally:
+        fp.close()
+    # Restore original read order and write out
+    reservoir.sort()
+    if fastq_out.endswith('.gz'):
+        fp = gzip.GzipFile(filename=fastq_out,mode='wb')
+    else:
+        fp = open(fastq_out,'wb')
+    try:
+        for i,record in reservoir:
+            fp.write(record)
+    finally:
+        fp.close()
+    return len(reservoir)
+
+def concat_fastqs(fastqs,fastq_out,verbose=False):
+    """
+    Concatenate multiple Fastq files into a single file
+
+    The inputs are streamed into the output one at a time:
+
+    - gzipped inputs written to a gzipped output are copied
+      byte-for-byte, so that each input becomes a separate
+      gzip 'member' of the output (which is still a valid
+      gzip file). This avoids decompressing and then
+      recompressing the data; only quick sanity checks
+      are performed on each input (see
+      'check_gzip_member').
+    - uncompressed inputs written to a gzipped output are
+      compressed as a new gzip member (using compression
+      level CONCAT_COMPRESS_LEVEL).
+    - gzipped inputs written to an uncompressed output are
+      decompressed.
+    - uncompressed inputs written to an uncompressed output
+      are copied byte-for-byte.
+
+    The data are written to a temporary file which is only
+    moved to the final output name on success.
+
+    Raises an OSError if the output file already exists,
+    or an IOError if a gzipped input fails the checks.
+
+    Arguments:
+      fastqs (list): list of input Fastq files (will be
+        concatenated in the order supplied)
+      fastq_out (str): output Fastq file (will be gzipped
+        if the name ends with '.gz')
+      verbose (bool): if True then report progress
+    """
+    if os.path.exists(fastq_out):
+        raise OSError("Target file '%s' already exists" % fastq_out)
+    compress = fastq_out.endswith('.gz')
+    tmp_fastq_out = "%s.part" % fastq_out
+    try:
+        with open(tmp_fastq_out,'wb') as fp_out:
+            for fq in fastqs:
+                if verbose:
+                    print "Adding %s" % fq
+                gzipped = fq.endswith('.gz')
+                if gzipped:
+                    check_gzip_member(fq)
+                if gzipped == compress:
+                    # Same compression: copy the bytes directly
+                    logger.debug("Copying data from %s" % fq)
+                    with open(fq,'rb') as fp_in:
+                        _copy_file_data(fp_in,fp_out)
+                elif compress:
+                    # Compress into a new gzip member
+                    logger.debug("Compressing data from %s" % fq)
+                    gz_out = gzip.GzipFile(filename=fq,mode='wb',
+                                           compresslevel=
+                                           CONCAT_COMPRESS_LEVEL,
+                                           fileobj=fp_out)
+                    with open(fq,'rb') as fp_in:
+                        shutil.copyfileobj(fp_in,gz_out,CONCAT_CHUNK_SIZE)
+                    gz_out.close()
+                else:
+                    # Decompress the data
+                    logger.debug("Decompressing data from %s" % fq)
+                    fp_in = gzip.GzipFile(filename=fq,mode='rb')
+                    try:
+                        shutil.copyfileobj(fp_in,fp_out,CONCAT_CHUNK_SIZE)
+                    finally:
+                        fp_in.close()
+    except Exception:
+        if os.path.exists(tmp_fastq_out):
+            os.remove(tmp_fastq_out)
+        raise
+    os.rename(tmp_fastq_out,fastq_out)
+
+def check_gzip_member(filen):
+    """
+    Perform quick sanity checks on a gzipped file
+
+    Checks the gzip header (magic number and compression
+    method) at the start of the file, and that the file is
+    at least large enough to hold a gzip header and trailer,
+    without decompressing any data.
+
+    Note that this doesn't validate the trailer or the
+    compressed data, so it won't detect corruption or
+    truncation part way through the data; it is intended
+    to catch files which are not gzipped, or which are
+    empty or obviously truncated.
+
+    Arguments:
+      filen (str): path to the gzipped file
+
+    Raises:
+      IOError: if the file fails the checks.
+    """
+    with open(filen,'rb') as fp:
+        header = fp.read(3)
+        if header != GZIP_MAGIC:
+            raise IOError("%s: not a gzipped file" % filen)
+        fp.seek(0,os.SEEK_END)
+        if fp.tell() < GZIP_MIN_SIZE:
+            raise IOError("%s: gzipped file is truncated" % filen)
+
+def _copy_file_data(fp_in,fp_out):
+    """
+    Internal: copy all data from one open file to another
+
+    Uses 'os.sendfile' to perform the copy within the kernel
+    where it is available, and otherwise falls back to
+    copying the data through a buffer.
+
+    Arguments:
+      fp_in (File): file object open for reading
+      fp_out (File): file object open for writing
+    """
+    if hasattr(os,'sendfile'):
+        fp_out.flush()
+        size = os.fstat(fp_in.fileno()).st_size
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(fp_out.fileno(),fp_in.fileno(),
+                               offset,size-offset)
+            if sent == 0:
+                break
+            offset += sent
+        if offset == size:
+            return
+        fp_in.seek(offset)
+    shutil.copyfileobj(fp_in,fp_out,CONCAT_CHUNK_SIZE)
+
+def _assign_index_sequence(header,index_sequence):
+    """
+    Internal: replace the index sequence in a read header
+
+    Handles headers in the Illumina 1.8+ format (where the
+    index sequence is the final field after the space) and
+    the earlier Illumina format (where the index sequence
+    follows the '#'). Headers in other formats are returned
+    unchanged.
+
+    Arguments:
+      header (str): read header line (without trailing
+        newline)
+      index_sequence (str): new index sequence
+
+    Returns:
+      String: the updated header.
+    """
+    for pattern in (_ILLUMINA18_INDEX_PATTERN,
+                    _ILLUMINA_INDEX_PATTERN):
+        m = pattern.match(header)
+        if m:
+            return "%s%s%s" % (m.group(1),index_sequence,m.group(3))
+    return header
+
+def _open_fastq_in(fastq):
+    """
+    Internal: open a (possibly gzipped) Fastq file for reading
+
+    Gzipped files are wrapped in a buffered reader, which
+    is substantially faster for line-by-line reading than
+    using GzipFile directly.
+
+    Arguments:
+      fastq (str): path to the Fastq file
+
+    Returns:
+      File: file-like object open for reading.
+    """
+    if fastq.endswith('.gz'):
+        return io.BufferedReader(gzip.GzipFile(filename=fastq,mode='rb'),
+                                 buffer_size=CONCAT_CHUNK_SIZE)
+    return open(fastq,'rb')
+
+def _open_fastq_out(fastq,nthreads=1):
+    """
+    Internal: open a Fastq file for writing
+
+    If the file name ends with '.gz' then the output will be
+    gzipped; if 'nthreads' is greater than 1 and 'pigz' is
+    available then the compression is performed by a 'pigz'
+    subprocess using that number of threads.
+
+    Arguments:
+      fastq (str): path to the output Fastq file
+      nthreads (int): number of threads to use for
+        compression (default: 1)
+
+    Returns:
+      File: file-like object open for writing.
+    """
+    if not fastq.endswith('.gz'):
+        return open(fastq,'wb')
+    if nthreads > 1:
+        pigz = find_program('pigz')
+        if pigz:
+            return _PigzWriter(fastq,pigz,nthreads)
+        logger.debug("'pigz' not found, compressing using a single thread")
+    return gzip.GzipFile(filename=fastq,mode='wb')
@@ -19,6 +19,8 @@ files etc) trasparently on either a local or a remote system.
 Classes:
 
 - Location: extracts information from a location specifier
+- FileOpsSession: queue operations and run them over a single
+  connection
 
 Functions:
 
@@ -26,6 +28,7 @@ Functions:
 - copy: copy a file
 - set_group: set the group on a file or directory
 - unzip: unpack a ZIP archive
+- sync_dir: copy new and changed files from a local directory
 """
 
 ########################################################################
@@ -35,13 +38,25 @@ Functions:
 import os
 import shutil
 import logging
+import tempfile
+import subprocess
+import tarfile
+import pipes
 import bcftbx.utils as bcftbx_utils
 import applications
+import checksums
 from utils import split_user_host_dir
 
 # Module specific logger
 logger = logging.getLogger(__name__)
 
+########################################################################
+# Constants
+#########################################################################
+
+# Name of checksum file written by 'sync_dir'
+SYNC_CHECKSUMS = 'checksums.md5'
+
 ########################################################################
 # Classes
 #########################################################################
@@ -107,6 +122,364 @@ class Location(object):
     def __repr__(self):
         return self._location
 
+class FileOpsSession(object):
+    """
+    Class for queueing file operations on a local or remote system
+
+    Operations (making directories, copying files, setting
+    groups, unpacking ZIP archives and checking MD5 sums) are
+    queued using the 'mkdir', 'copy', 'set_group', 'unzip' and
+    'check_md5sums' methods, and are then all performed when
+    the 'run' method is invoked:
+
+    >>> session = FileOpsSession('user@server:/data')
+    >>> session.mkdir('/data/qc')
+    >>> session.copy('report.zip','/data/qc')
+    >>> session.unzip('/data/qc/report.zip','/data/qc')
+    >>> session.run()
+    >>> session.close()
+
+    Queued operations are run in three stages: first all the
+    directories are made; then all the files are copied, as a
+    single 'tar' stream; finally the remaining operations are
+    performed in the order that they were queued, as a single
+    shell script.
+
+    The MD5 checksums of the copied files are computed as
+    they are sent (see the 'md5sums' property), and can be
+    checked on the target system using 'check_md5sums'.
+
+    For a remote system the stages are run using 'ssh' with
+    connection multiplexing (i.e. OpenSSH's 'ControlMaster'
+    option), so that a single connection is made for the
+    lifetime of the session; 'close' should be called to shut
+    down the connection at the end (alternatively the session
+    can be used as a context manager, in which case queued
+    operations are run and the session closed automatically).
+
+    For a local system the same shell commands are executed
+    locally, so the session can also be used as a stand-in for
+    a remote system (e.g. for testing).
+
+    Paths supplied to the operations can either be plain paths
+    on the session's system, or location specifiers of the form
+    '[[USER@]HOST:]PATH' (which must refer to the same system).
+    """
+    def __init__(self,location,persist=60):
+        """
+        Create a new FileOpsSession instance
+
+        Arguments:
+          location (str): location specifier of the form
+            '[[USER@]HOST:]PATH' identifying the system to
+            perform the operations on (the PATH component
+            is ignored)
+          persist (int): number of seconds the shared
+            connection to a remote system remains open
+            after the last command (default: 60)
+        """
+        self._location = Location(location)
+        self._persist = persist
+        self._control_dir = None
+        self._ops = []
+        self._md5sums = dict()
+
+    @property
+    def is_remote(self):
+        """
+        Check if the session operates on a remote system
+        """
+        return self._location.is_remote
+
+    @property
+    def md5sums(self):
+        """
+        Return the MD5 checksums of the files copied so far
+
+        The checksums are computed from the data as they
+        are sent, and are returned as a dictionary where the
+        keys are the (absolute) paths of the local source
+        files.
+        """
+        return dict(self._md5sums)
+
+    @property
+    def pending(self):
+        """
+        Return the number of queued operations
+        """
+        return len(self._ops)
+
+    def mkdir(self,newdir):
+        """
+        Queue making a directory
+
+        Missing parent directories are also created,
+        and it is not an error if the directory already
+        exists.
+
+        Arguments:
+          newdir (str): path of the new directory
+        """
+        self._ops.append(('mkdir',(self._path(newdir),)))
+
+    def copy(self,src,dest):
+        """
+        Queue copying a local file
+
+        Arguments:
+          src (str): local file to copy
+          dest (str): destination (file or directory)
+            on the session's system
+        """
+        if not os.path.isfile(src):
+            raise Exception("Can't copy %s: not a file" % src)
+        self._ops.append(('copy',(os.path.abspath(src),self._path(dest))))
+
+    def set_group(self,group,path):
+        """
+        Queue setting the group for a file or directory
+
+        If 'path' is a directory then the group will also
+        be changed for all its subdirectories and files.
+
+        Arguments:
+          group (str): name of the new group
+          path (str): path to the file or directory
+        """
+        self._ops.append(('chgrp',(group,self._path(path))))
+
+    def unzip(self,zip_file,dest):
+        """
+        Queue unpacking a ZIP archive
+
+        Arguments:
+          zip_file (str): path to the ZIP archive file
+            (can be a file queued for copying)
+          dest (str): path to extract the archive
+            contents to
+        """
+        self._ops.append(('unzip',(self._path(zip_file),self._path(dest))))
+
+    def check_md5sums(self,md5sum_file):
+        """
+        Queue verifying files using an 'md5sum'-format file
+
+        The check is performed by running 'md5sum -c' in
+        the directory holding the checksum file, so paths
+        in the file should be relative to that directory.
+
+        Arguments:
+          md5sum_file (str): path to the checksum file
+            (can be a file queued for copying)
+        """
+        self._ops.append(('md5sum',(self._path(md5sum_file),)))
+
+    def fetch(self,path,local_file):
+        """
+        Fetch a copy of a file from the session's system
+
+        Unlike the other operations this is performed
+        immediately (rather than being queued).
+
+        Arguments:
+          path (str): path to the file to fetch
+          local_file (str): local file to write the
+            copy to
+
+        Returns:
+          Boolean: True if the file was fetched, False
+            if it doesn't exist.
+        """
+        path = pipes.quote(self._path(path))
+        contents = self._execute("if [ -f %s ] ; then echo ; cat %s ; fi" %
+                                 (path,path))
+        if not contents:
+            return False
+        with open(local_file,'w') as fp:
+            fp.write(contents[1:])
+        return True
+
+    def run(self):
+        """
+        Perform all the queued operations
+
+        Raises an exception if any of the operations
+        fail. The queue is emptied regardless.
+        """
+        ops = self._ops
+        self._ops = []
+        if not ops:
+            return
+        # Make directories and find which copy targets are
+        # directories
+        script = []
+        for op,args in ops:
+            if op == 'mkdir':
+                script.append("mkdir -p %s" % pipes.quote(args[0]))
+        copies = [args for op,args in ops if op == 'copy']
+        for dest in set([dest for src,dest in copies]):
+            script.append("if [ -d %s ] ; then echo %s ; fi" %
+                          (pipes.quote(dest),pipes.quote(dest)))
+        dest_dirs = []
+        if script:
+            dest_dirs = self._execute('\n'.join(['set -e'] + script))
+            dest_dirs = dest_dirs.split('\n')
+        # Copy the files
+        copies = [(src,(os.path.join(dest,os.path.basename(src))
+                        if dest in dest_dirs else dest))
+                  for src,dest in copies]
+        for absolute in (True,False):
+            files = [(src,dest) for src,dest in copies
+                     if os.path.isabs(dest) == absolute]
+            if files:
+                self._send_files(files,'/' if absolute else '.')
+        # Run the remaining operations
+        script = ['set -e']
+        for op,args in ops:
+            if op == 'chgrp':
+                script.append("chgrp -R %s %s" % tuple([pipes.quote(x)
+                                                        for x in args]))
+            elif op == 'unzip':
+                script.append("unzip -q -o -d %s %s" %
+                              (pipes.quote(args[1]),pipes.quote(args[0])))
+            elif op == 'md5sum':
+                script.append("(cd %s && md5sum -c --quiet %s)" %
+                              (pipes.quote(os.path.dirname(args[0]) or '.'),
+                               pipes.quote(os.path.basename(args[0]))))
+        if len(script) > 1:
+            self._execute('\n'.join(script))
+
+    def close(self):
+        """
+        Close the session
+
+        Shuts down the shared connection to a remote
+        system (if one was opened); queued operations
+        which haven't been run are discarded.
+        """
+        self._ops = []
+        if self._control_dir is None:
+            return
+        try:
+            subprocess.call(['ssh','-O','exit'] + self._ssh_options() +
+                            [self._host()],
+                            stdout=open(os.devnull,'w'),
+                            stderr=subprocess.STDOUT)
+        finally:
+            shutil.rmtree(self._control_dir,ignore_errors=True)
+            self._control_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        try:
+            if exc_type is None:
+                self.run()
+        finally:
+            self.close()
+
+    def _path(self,path):
+        """
+        Internal: return path on the session's system
+        """
+        location = Location(path)
+        if location.is_remote and \
+           (location.server != self._location.server or
+            (location.user is not None and
+             location.user != self._location.user)):
+            raise Exception("%s: not on the same system as %s" %
+                            (location,self._location))
+        return location.path
+
+    def _host(self):
+        """
+        Internal: return '[USER@]HOST' for remote system
+        """
+        if self._location.user is None:
+            return self._location.server
+        return "%s@%s" % (self._location.user,self._location.server)
+
+    def _ssh_options(self):
+        """
+        Internal: return ssh options for connection sharing
+        """
+        if self._control_dir is None:
+            self._control_dir = tempfile.mkdtemp(prefix='fileops.')
+        return ['-o','ControlMaster=auto',
+                '-o','ControlPath=%s' % os.path.join(self._control_dir,
+                                                     '%r@%h:%p'),
+                '-o','ControlPersist=%d' % self._persist]
+
+    def _command(self,script):
+        """
+        Internal: return Command to run shell script
+        """
+        if not self.is_remote:
+            return applications.Command('/bin/sh','-c',script)
+        ssh_cmd = applications.Command('ssh',*self._ssh_options())
+        ssh_cmd.add_args(self._host(),"sh -c %s" % pipes.quote(script))
+        return ssh_cmd
+
+    def _execute(self,script,stdin=None):
+        """
+        Internal: run shell script and return the stdout
+        """
+        cmd = self._command(script)
+        logger.debug("Running %s" % cmd)
+        p = subprocess.Popen(cmd.command_line,
+                             stdin=stdin,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        stdout,stderr = p.communicate()
+        if p.returncode != 0:
+            raise Exception("Command failed with exit code %s: %s: %s" %
+                            (p.returncode,cmd,stderr.strip()))
+        return stdout
+
+    def _send_files(self,files,base_dir):
+        """
+        Internal: send files in a single 'tar' stream
+
+        Arguments:
+          files (list): list of (src,dest) tuples where 'src'
+            is a local file and 'dest' is the target path
+          base_dir (str): directory that the 'dest' paths
+            are relative to on the session's system
+        """
+        cmd = self._command("tar -x -f - -C %s" % pipes.quote(base_dir))
+        print "Copying %d file%s using %s" % (len(files),
+                                             's' if len(files) != 1 else '',
+                                             cmd)
+        stderr = tempfile.TemporaryFile()
+        p = subprocess.Popen(cmd.command_line,
+                             stdin=subprocess.PIPE,
+                             stderr=stderr)
+        try:
+            tar = tarfile.open(fileobj=p.stdin,mode='w|',dereference=True)
+            for src,dest in files:
+                logger.debug("Adding %s as %s" % (src,dest))
+                # Checksum the data as they are added
+                tarinfo = tar.gettarinfo(src,arcname=dest)
+                with open(src,'rb') as fp:
+                    reader = checksums.ChecksumReader(fp)
+                    tar.addfile(tarinfo,reader)
+                self._md5sums[src] = reader.hexdigest()
+            tar.close()
+        except IOError as ex:
+            # Broken pipe etc: report error from tar below
+            logger.debug("Error writing tar stream: %s" % ex)
+        finally:
+            try:
+                p.stdin.close()
+            except IOError:
+                pass
+        if p.wait() != 0:
+            stderr.seek(0)
+            raise Exception("Failed to copy files using %s: %s" %
+                            (cmd,stderr.read().strip()))
+
 ########################################################################
 # Functions
 #########################################################################
@@ -242,3 +615,78 @@ def unzip(zip_file,dest):
     except Exception as ex:
         raise Exception("Failed to unzip %s: %s" %
                         (zip_file,ex))
+
+def sync_dir(src_dir,dest,checksum_file=SYNC_CHECKSUMS,session=None):
+    """
+    Copy new and changed files from a local directory
+
+    Copies the contents of 'src_dir' into the 'dest'
+    directory on a local or remote system, skipping files
+    whose MD5 checksums match those recorded in the
+    checksum file in 'dest' by the previous sync (i.e. so
+    that only new and changed files are copied). Files in
+    'dest' which are no longer in 'src_dir' are left in
+    place.
+
+    The files are sent in a single transfer, together with
+    an updated 'md5sum'-format checksum file (which is also
+    written to 'src_dir').
+
+    Arguments:
+      src_dir (str): local directory to copy from
+      dest (str): destination directory, identified by a
+        specifier of the form '[[USER@]HOST:]DEST'
+      checksum_file (str): name of the checksum file
+        (default: SYNC_CHECKSUMS)
+      session (FileOpsSession): optional, session to use
+        for the operations (by default a new session is
+        opened and closed)
+
+    Returns:
+      List: relative paths of the copied files (excluding
+        the checksum file).
+    """
+    src_dir = os.path.abspath(src_dir)
+    dest_dirn = Location(dest).path
+    md5file = os.path.join(src_dir,checksum_file)
+    if session is None:
+        sync_session = FileOpsSession(dest)
+    else:
+        sync_session = session
+    try:
+        # Checksums from the previous sync
+        published = dict()
+        if sync_session.fetch(os.path.join(dest_dirn,checksum_file),md5file):
+            published = checksums.read_md5sum_file(md5file)
+        # Checksums for the source files
+        current = dict()
+        for dirpath,dirnames,filenames in os.walk(src_dir):
+            for f in filenames:
+                f = os.path.join(dirpath,f)
+                if f != md5file:
+                    current[os.path.relpath(f,src_dir)] = checksums.md5sum(f)
+        changed = sorted([f for f in current
+                          if published.get(f) != current[f]])
+        print "%d file%s unchanged, %d to copy" % \
+            (len(current)-len(changed),
+             's' if len(current)-len(changed) != 1 else '',
+             len(changed))
+        # Updated checksum file
+        published.update(current)
+        with open(md5file,'w') as fp:
+            for f in sorted(published.keys()):
+                fp.write("%s  %s\n" % (published[f],f))
+        # Queue and perform the copies
+        sync_session.mkdir(dest_dirn)
+        for dirn in sorted(set([os.path.dirname(f) for f in changed])):
+            if dirn:
+                sync_session.mkdir(os.path.join(dest_dirn,dirn))
+        for f in changed:
+            sync_session.copy(os.path.join(src_dir,f),
+                              os.path.join(dest_dirn,f))
+        sync_session.copy(md5file,os.path.join(dest_dirn,checksum_file))
+        sync_session.run()
+    finally:
+        if session is None:
+            sync_session.close()
+    return changed
@@ -1049,6 +1049,10 @@ class PipelineCommand(object):
         """
         Generate a uniquely-named wrapper script to run the command
 
+        The script also records the resources used by the
+        command (see the 'resource_usage' option of
+        'Command.make_wrapper_script').
+
         Arguments:
           scripts_dir (str): path of directory to write
             the wrapper scripts to
@@ -1073,7 +1077,8 @@ class PipelineCommand(object):
         self.cmd().make_wrapper_script(filen=script_file,
                                        shell=shell,
                                        prologue='\n'.join(prologue),
-                                       epilogue='\n'.join(epilogue))
+                                       epilogue='\n'.join(epilogue),
+                                       resource_usage=True)
         return script_file
 
     def init(self):
@@ -2,6 +2,9 @@
 #
 # fastqc library
 import os
+import zipfile
+from collections import OrderedDict
+from cStringIO import StringIO
 from bcftbx.TabFile import TabFile
 from bcftbx.htmlpagewriter import PNGBase64Encoder
 from ..docwriter import Table
@@ -261,6 +264,16 @@ class FastqcData:
 
     >>> nreads = fqc.basic_statistics('Total Sequences')
 
+    On creation only the locations of the modules within
+    the file are recorded; the data for each module is
+    only read and parsed the first time it is accessed.
+
+    If the ``fastqc_data.txt`` file doesn't exist (for
+    example because the FastQC output directory has been
+    removed) then the data are read directly from the
+    corresponding ``_fastqc.zip`` archive instead (without
+    extracting it), if this is present.
+
     """
     def __init__(self,data_file):
         """
@@ -273,22 +286,100 @@ class FastqcData:
         """
         self._data_file = os.path.abspath(data_file)
         self._fastqc_version = None
+        self._zip = None
+        self._zip_data = None
+        # Module index: name -> (status,start,end)
+        self._index = OrderedDict()
+        # Cached data for modules which have been accessed
         self._modules = {}
+        self._columns = {}
+        self._basic_statistics = None
         if data_file:
-            fastqc_module = None
-            with open(data_file,'r') as fp:
-                for line in fp:
-                    line = line.strip()
-                    if fastqc_module is None:
-                        if line.startswith('##FastQC'):
-                            self._fastqc_version = line.split()[-1]
-                        elif line.startswith('>>'):
-                            fastqc_module = line.split('\t')[0][2:]
-                            self._modules[fastqc_module] = []
-                    elif line.startswith('>>END_MODULE'):
-                        fastqc_module = None
-                    else:
-                        self._modules[fastqc_module].append(line)
+            if os.path.exists(self._data_file):
+                with open(self._data_file,'rb') as fp:
+                    self._index_modules(fp)
+            else:
+                self._zip = self._locate_zip()
+                if self._zip is None:
+                    raise IOError("%s: not found" % self._data_file)
+                self._zip_data = self._read_from_zip()
+                self._index_modules(StringIO(self._zip_data))
+
+    def _locate_zip(self):
+        """
+        Internal: return path to FastQC zip file, or None
+
+        The zip file is expected to be alongside the
+        FastQC output directory that would contain the
+        ``fastqc_data.txt`` file.
+        """
+        fastqc_dir = os.path.dirname(self._data_file)
+        zip_file = fastqc_dir + '.zip'
+        if os.path.isfile(zip_file) and zipfile.is_zipfile(zip_file):
+            return zip_file
+        return None
+
+    def _read_from_zip(self):
+        """
+        Internal: return contents of the data file from the zip
+        """
+        member = "%s/%s" % (os.path.basename(os.path.dirname(self._data_file)),
+                            os.path.basename(self._data_file))
+        with zipfile.ZipFile(self._zip) as z:
+            if member not in z.namelist():
+                raise IOError("%s: not found in %s" % (member,self._zip))
+            return z.read(member)
+
+    def _index_modules(self,fp):
+        """
+        Internal: record the start and end offsets of modules
+
+        Performs a single pass through the data, storing
+        the byte offsets of the lines belonging to each
+        module (excluding the '>>' start and end markers)
+        along with the module status.
+
+        Arguments:
+          fp (File): file-like object opened for reading
+            in binary mode
+        """
+        offset = 0
+        fastqc_module = None
+        status = None
+        start = None
+        while True:
+            line = fp.readline()
+            if not line:
+                break
+            next_offset = offset + len(line)
+            if fastqc_module is None:
+                if line.startswith('##FastQC'):
+                    self._fastqc_version = line.strip().split()[-1]
+                elif line.startswith('>>'):
+                    fields = line.strip().split('\t')
+                    fastqc_module = fields[0][2:]
+                    status = fields[1] if len(fields) > 1 else None
+                    start = next_offset
+            elif line.startswith('>>END_MODULE'):
+                self._index[fastqc_module] = (status,start,offset)
+                fastqc_module = None
+            offset = next_offset
+        if fastqc_module is not None:
+            # Truncated final module
+            self._index[fastqc_module] = (status,start,offset)
+
+    def _read_module(self,module):
+        """
+        Internal: read and return the lines for a module
+        """
+        status,start,end = self._index[module]
+        if self._zip_data is not None:
+            data = self._zip_data[start:end]
+        else:
+            with open(self._data_file,'rb') as fp:
+                fp.seek(start)
+                data = fp.read(end-start)
+        return [line.strip() for line in data.split('\n') if line.strip()]
 
     @property
     def version(self):
@@ -305,14 +396,101 @@ class FastqcData:
         """
         return self._data_file
 
+    @property
+    def zip(self):
+        """
+        Path to the zip file that data are read from (or None)
+
+        """
+        return self._zip
+
+    @property
+    def modules(self):
+        """
+        List of the modules found in the data file
+
+        """
+        return self._index.keys()
+
+    def module_status(self,module):
+        """
+        Return the status reported for a module
+
+        Arguments:
+          module (str): name of the module (e.g.
+            'Basic Statistics')
+
+        Returns:
+          String: status of the module (e.g. 'pass',
+            'warn' or 'fail'), or None if the module is
+            not present.
+
+        """
+        try:
+            return self._index[module][0]
+        except KeyError:
+            return None
+
     def data(self,module):
         """
+        Return the raw data lines for a module
+
+        Arguments:
+          module (str): name of the module (e.g.
+            'Basic Statistics')
+
+        Returns:
+          List: list of the lines of data (including
+            the '#' header lines) for the module, or
+            None if the module is not present.
+
         """
-        if module in self._modules:
-            return self._modules[module]
-        return None
+        if module not in self._index:
+            return None
+        if module not in self._modules:
+            self._modules[module] = self._read_module(module)
+        return self._modules[module]
+
+    def columns(self,module):
+        """
+        Return the data for a module as typed columns
+
+        The column names are taken from the last '#'
+        header line in the module; values are converted
+        to integers or floats where possible, otherwise
+        they are left as strings.
+
+        Arguments:
+          module (str): name of the module (e.g.
+            'Per base sequence quality')
+
+        Returns:
+          OrderedDict: mapping of column names to lists
+            of values, or None if the module is not
+            present.
 
-    def basic_statistics(self,measure):
+        """
+        if module not in self._index:
+            return None
+        if module not in self._columns:
+            header = None
+            rows = []
+            for line in self.data(module):
+                if line.startswith('#'):
+                    if not rows:
+                        header = line[1:].split('\t')
+                    continue
+                rows.append([_convert_value(x) for x in line.split('\t')])
+            if header is None:
+                header = ["%d" % i for i in range(len(rows[0]))] \
+                         if rows else []
+            columns = OrderedDict()
+            for i,name in enumerate(header):
+                columns[name] = [r[i] if i < len(r) else None for r in rows]
+            self._columns[module] = columns
+        return self._columns[module]
+
+    def basic_statistics(self,measure=None):
         """
         Access a data item in the ``Basic Statistics`` section
 
@@ -328,17 +506,39 @@ class FastqcData:
 
         Arguments:
           measure (str): key corresponding to a 'measure'
-            in the ``Basic Statistics`` section.
+            in the ``Basic Statistics`` section. If not
+            supplied then all the measures are returned.
 
         Returns:
-          String: value of the requested 'measure'
+          String: value of the requested 'measure' (or a
+            dictionary of all measures and values, if no
+            'measure' was specified).
 
         Raises:
           KeyError: if measure is not found.
 
         """
-        for line in self.data('Basic Statistics'):
-            key,value = line.split('\t')
-            if key == measure:
-                return value
-        raise KeyError("No key '%s'" % key)
+        if self._basic_statistics is None:
+            self._basic_statistics = dict()
+            for line in self.data('Basic Statistics') or []:
+                if line.startswith('#'):
+                    continue
+                key,value = line.split('\t',1)
+                self._basic_statistics[key] = value
+        if measure is None:
+            return dict(self._basic_statistics)
+        try:
+            return self._basic_statistics[measure]
+        except KeyError:
+            raise KeyError("No key '%s'" % measure)
+
+def _convert_value(value):
+    """
+    Internal: convert a string value to int or float if possible
+    """
+    for convert in (int,float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+#
+# QC metrics library
+"""
+Collect QC metrics for FASTQs across multiple projects
+
+Gathers the key metrics from the FastQC and fastq_screen outputs
+for each FASTQ in a set of projects and consolidates them into a
+single tab-delimited table, with one line per FASTQ.
+
+Example usage:
+
+>>> metrics = QCMetrics(projects,n_processors=4)
+>>> metrics.write('qc_metrics.tsv')
+
+"""
+
+#######################################################################
+# Imports
+#######################################################################
+
+import sys
+import os
+import time
+import logging
+from multiprocessing import Pool
+from collections import OrderedDict
+from bcftbx.TabFile import TabFile
+from .fastqc import FastqcData
+from .fastq_screen import Fastqscreen
+from .illumina_qc import FASTQ_SCREENS
+from .illumina_qc import fastqc_output
+from .illumina_qc import fastq_screen_output
+
+# Module specific logger
+logger = logging.getLogger(__name__)
+
+#######################################################################
+# Classes
+#######################################################################
+
+class QCMetrics:
+    """
+    Class for collecting and reporting QC metrics for projects
+
+    Given a list of AnalysisProject instances, collects
+    the following metrics for each (non-index read) FASTQ
+    from the associated QC outputs:
+
+    - Reads: total number of reads (from FastQC)
+    - %GC: GC content (from FastQC)
+    - Sequence_length: read length(s) (from FastQC)
+    - the status of each FastQC module (e.g. 'PASS')
+    - the percentage of reads which mapped to each library
+      in each of the fastq_screens, along with the
+      percentage of reads with no hits in that screen
+
+    FastQC data are read directly from the ``_fastqc.zip``
+    file if the FastQC output directory is not present.
+
+    Missing metrics are reported as empty values.
+    """
+    def __init__(self,projects,qc_dir=None,n_processors=1):
+        """
+        Create a new QCMetrics instance
+
+        Arguments:
+          projects (list): list of AnalysisProject instances
+            to collect the QC metrics from
+          qc_dir (str): optional, name of the QC output
+            directory to use for all projects (defaults to
+            the default QC directory for each project)
+          n_processors (int): number of processors to use
+            (if >1 then uses the multiprocessing library
+            to collect the metrics using multiple cores)
+        """
+        self._projects = projects
+        self._qc_dir = qc_dir
+        self._n_processors = n_processors
+        self._metrics = None
+        self._get_data()
+
+    def _get_data(self):
+        """
+        Internal: collect metrics for FASTQs from all projects
+        """
+        # Collect FASTQ files
+        fqmetrics = []
+        for project in self._projects:
+            qc_dir = self._qc_dir
+            if qc_dir is None:
+                qc_dir = project.qc_dir
+            elif not os.path.isabs(qc_dir):
+                qc_dir = os.path.join(project.dirn,qc_dir)
+            fastq_dir = project.qc_info(qc_dir).fastq_dir
+            if fastq_dir is not None and fastq_dir in project.fastq_dirs:
+                project.use_fastq_dir(fastq_dir)
+            for sample in project.samples:
+                for fastq in sample.fastq:
+                    if sample.fastq_attrs(fastq).is_index_read:
+                        continue
+                    fqmetrics.append(FastqQCMetrics(fastq,
+                                                    qc_dir,
+                                                    project.name,
+                                                    sample.name))
+        # Collect the data for each file
+        if self._n_processors > 1:
+            # Multiple cores
+            pool = Pool(self._n_processors)
+            results = pool.map(collect_fastq_qc_metrics,fqmetrics)
+            pool.close()
+            pool.join()
+        else:
+            # Single core
+            results = map(collect_fastq_qc_metrics,fqmetrics)
+        # Determine the columns: FastQC modules and screen
+        # libraries can vary between FASTQs so take the union
+        # (preserving the order they were first encountered)
+        fastqc_modules = []
+        screen_columns = []
+        for fqm in results:
+            for module in fqm.fastqc:
+                if module not in fastqc_modules:
+                    fastqc_modules.append(module)
+            for name in fqm.screens:
+                for library in fqm.screens[name]:
+                    column = "%s:%s" % (name,library)
+                    if column not in screen_columns:
+                        screen_columns.append(column)
+        # Set up the table to hold all collected data
+        self._metrics = TabFile(column_names=('Project',
+                                              'Sample',
+                                              'Fastq',
+                                              'Reads',
+                                              '%GC',
+                                              'Sequence_length'))
+        for column in fastqc_modules:
+            self._metrics.appendColumn(column)
+        for column in screen_columns:
+            self._metrics.appendColumn(column)
+        # Write the data into the table
+        for fqm in results:
+            data = [fqm.project,
+                    fqm.sample,
+                    fqm.name,
+                    fqm.nreads,
+                    fqm.gc,
+                    fqm.sequence_length]
+            for module in fastqc_modules:
+                data.append(fqm.fastqc.get(module,''))
+            for column in screen_columns:
+                name,library = column.split(':',1)
+                try:
+                    data.append(fqm.screens[name][library])
+                except KeyError:
+                    data.append('')
+            self._metrics.append(data=[('' if x is None else x)
+                                       for x in data])
+
+    @property
+    def raw(self):
+        """
+        Return the 'raw' metrics TabFile instance
+        """
+        return self._metrics
+
+    def write(self,out_file=None,fp=None):
+        """
+        Write the QC metrics as a tab-delimited table
+
+        Arguments:
+          out_file (str): name of file to write table
+            to (used if 'fp' is not supplied)
+          fp (File): File-like object open for writing
+            (defaults to stdout if 'out_file' also not
+            supplied)
+        """
+        # Determine output stream
+        if fp is None:
+            if out_file is None:
+                fpp = sys.stdout
+            else:
+                fpp = open(out_file,'w')
+        else:
+            fpp = fp
+        # Report
+        self._metrics.write(fp=fpp,include_header=True)
+        # Close file
+        if fp is None and out_file is not None:
+            fpp.close()
+
+class FastqQCMetrics:
+    """
+    Container for storing QC metrics for a FASTQ file
+
+    This is a convenience wrapper for holding together
+    QC data for a FASTQ file (full path, associated
+    QC directory, project and sample names, and the
+    metrics extracted from the QC outputs).
+    """
+    def __init__(self,fastq,qc_dir,project,sample):
+        """
+        Create a new FastqQCMetrics instance
+
+        Arguments:
+          fastq (str): full path to FASTQ file
+          qc_dir (str): full path to the QC directory
+            with the outputs for the FASTQ
+          project (str): project name associated
+            with FASTQ file
+          sample (str): sample name associated
+            with FASTQ file
+        """
+        self.fastq = fastq
+        self.qc_dir = qc_dir
+        self.project = project
+        self.sample = sample
+        self.nreads = None
+        self.gc = None
+        self.sequence_length = None
+        self.fastqc = OrderedDict()
+        self.screens = OrderedDict()
+    @property
+    def name(self):
+        """
+        FASTQ file name without leading directory
+        """
+        return os.path.basename(self.fastq)
+
+#######################################################################
+# Functions
+#######################################################################
+
+def collect_fastq_qc_metrics(fqmetrics):
+    """
+    Collect QC metrics for FASTQ file in a FastqQCMetrics instance
+
+    Given a FastqQCMetrics instance, collects and sets the
+    following properties from the QC outputs for the
+    corresponding FASTQ file:
+
+    - nreads: total number of reads
+    - gc: %GC content
+    - sequence_length: sequence length (or range)
+    - fastqc: dictionary where keys are FastQC module
+      names and values are the status (e.g. 'PASS')
+    - screens: dictionary where keys are screen names
+      and values are dictionaries mapping library names
+      to the percentage of reads mapped to that library
+      (with 'no_hits' giving the percentage of reads
+      which didn't map to any library)
+
+    Metrics which can't be found are left unset.
+
+    Arguments:
+      fqmetrics (FastqQCMetrics): FastqQCMetrics instance
+
+    Returns:
+      FastqQCMetrics: input FastqQCMetrics instance with
+        the appropriate properties updated.
+    """
+    fqm = fqmetrics
+    start_time = time.time()
+    # FastQC metrics
+    try:
+        fastqc_data = FastqcData(os.path.join(fqm.qc_dir,
+                                              fastqc_output(fqm.fastq)[0],
+                                              'fastqc_data.txt'))
+        fqm.nreads = fastqc_data.basic_statistics('Total Sequences')
+        fqm.gc = fastqc_data.basic_statistics('%GC')
+        fqm.sequence_length = fastqc_data.basic_statistics(
+            'Sequence length')
+        for module in fastqc_data.modules:
+            status = fastqc_data.module_status(module)
+            if status is not None:
+                fqm.fastqc[module] = status.upper()
+    except Exception as ex:
+        logger.warning("%s: unable to get FastQC metrics: %s" %
+                       (fqm.name,ex))
+    # Fastq_screen metrics
+    for name in FASTQ_SCREENS:
+        screen_txt = os.path.join(fqm.qc_dir,
+                                  fastq_screen_output(fqm.fastq,name)[1])
+        try:
+            screen = Fastqscreen(screen_txt)
+            mapped = OrderedDict()
+            for line in screen:
+                mapped[line['Library']] = "%.2f" % \
+                                          (100.0 - float(line['%Unmapped']))
+            if screen.no_hits is not None:
+                mapped['no_hits'] = "%.2f" % screen.no_hits
+            fqm.screens[name] = mapped
+        except Exception as ex:
+            logger.warning("%s: unable to get metrics for screen '%s': "
+                           "%s" % (fqm.name,name,ex))
+    logger.debug("%s: collected QC metrics in %.2fs" %
+                 (fqm.name,time.time()-start_time))
+    return fqm
@@ -108,6 +108,10 @@ class Settings(object):
                                                           'SimpleJobRunner')
         self.general['max_concurrent_jobs'] = config.getint('general',
                                                             'max_concurrent_jobs',12)
+        self.general['scheduler_event_log'] = config.getboolean(
+            'general','scheduler_event_log',True)
+        self.general['checksum_threads'] = config.getint(
+            'general','checksum_threads',4)
         # modulefiles
         self.add_section('modulefiles')
         self.modulefiles['make_fastqs'] = config.get('modulefiles','make_fastqs')
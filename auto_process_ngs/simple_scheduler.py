@@ -27,13 +27,18 @@ __version__ = "0.0.15"
 
 import bcftbx.JobRunner as JobRunner
 from bcftbx.Pipeline import Job
+from applications import Command
+from applications import parse_resource_usage
 import time
 import os
 import sys
 import re
 import threading
 import Queue
+import json
 import logging
+import pipes
+import uuid
 
 #######################################################################
 # Classes
@@ -69,7 +74,8 @@ class SimpleScheduler(threading.Thread):
                  max_concurrent=None,
                  poll_interval=5,
                  job_interval=0.1,
-                 max_restarts=1):
+                 max_restarts=1,
+                 resource_usage=False):
         """Create a new SimpleScheduler instance
 
         Arguments:
@@ -87,6 +93,9 @@ class SimpleScheduler(threading.Thread):
             jobs that are in an error state up to this many times. Set to
             zero to turn off restarting jobs in error states (they will
             be terminated instead). (default: 1)
+          resource_usage: optional, if True then run each job
+            via a wrapper script which also records the resources
+            used by the job (see 'SchedulerJob'). (default: False)
 
         """
 
@@ -104,6 +113,10 @@ class SimpleScheduler(threading.Thread):
         self.__job_interval = job_interval
         # Number of attempts to restart errored jobs
         self.__max_restarts = max_restarts
+        # Whether to record resource usage for jobs
+        self.__resource_usage = resource_usage
+        # Maximum number of concurrent jobs for specific runners
+        self.__runner_limits = dict()
         # Internal job id counter
         self.__job_count = 0
         # Queue to add jobs
@@ -120,8 +133,10 @@ class SimpleScheduler(threading.Thread):
         # Handle groups
         self.__active_groups = []
         self.__groups = dict()
-        # Handle callbacks
+        # Handle callbacks (the lock guards the list, which is
+        # updated from both the scheduler and the calling threads)
         self.__callbacks = []
+        self.__callback_lock = threading.Lock()
         # Flag controlling whether scheduler is active
         self.__active = False
         # Default reporter
@@ -135,6 +150,27 @@ class SimpleScheduler(threading.Thread):
         """
         self.__active = False
 
+    def set_runner_limit(self,runner,max_concurrent):
+        """Limit the number of concurrent jobs for a runner
+
+        Sets the maximum number of jobs using the specified
+        runner that the scheduler will run at one time (in
+        addition to the overall limit set by 'max_concurrent'
+        for the scheduler). Jobs for other runners are not
+        held back by jobs waiting on this limit.
+
+        Arguments:
+          runner: JobRunner instance to limit
+          max_concurrent: maximum number of concurrent jobs
+            for the runner (None removes the limit)
+
+        """
+        if max_concurrent is None:
+            if runner in self.__runner_limits:
+                del(self.__runner_limits[runner])
+        else:
+            self.__runner_limits[runner] = max_concurrent
+
     @property
     def n_waiting(self):
         """Return number of jobs waiting to run
@@ -156,6 +192,28 @@ class SimpleScheduler(threading.Thread):
         """
         return len(self.__jobs) - self.n_waiting - self.n_running
 
+    @property
+    def n_pending_callbacks(self):
+        """Return number of callbacks ready to be invoked
+
+        Counts the callbacks where all the jobs and groups
+        they are waiting for have finished, but which have
+        not yet been invoked (or are still being invoked).
+
+        """
+        with self.__callback_lock:
+            callbacks = list(self.__callbacks)
+        n_pending = 0
+        for callback in callbacks:
+            ready = True
+            for name in callback.waiting_for:
+                if name not in self.__finished_names:
+                    ready = False
+                    break
+            if ready:
+                n_pending += 1
+        return n_pending
+
     @property
     def job_number(self):
         """Internal: increment and return job count
@@ -184,10 +242,14 @@ class SimpleScheduler(threading.Thread):
         """Test if the scheduler has any jobs remaining
 
         Returns False if there are jobs running and/or waiting,
-        True otherwise.
+        or callbacks which are ready to be invoked, True
+        otherwise.
 
         """
-        return not (self.n_waiting or self.n_running or not self.__submitted.empty())
+        return not (self.n_waiting or
+                    self.n_running or
+                    self.n_pending_callbacks or
+                    not self.__submitted.empty())
 
     def lookup(self,name):
         """Look up and return SchedulerJob or SchedulerGroup instance
@@ -322,7 +384,8 @@ class SimpleScheduler(threading.Thread):
         # Schedule the job
         job = SchedulerJob(runner,args,job_number=job_number,
                            name=name,working_dir=wd,log_dir=log_dir,
-                           wait_for=wait_for)
+                           wait_for=wait_for,
+                           resource_usage=self.__resource_usage)
         self.__submitted.put(job)
         self.__jobs[job.job_name] = job
         # Deal with callbacks
@@ -406,7 +469,8 @@ class SimpleScheduler(threading.Thread):
         if self.has_name(name):
             raise Exception,"Name '%s' already assigned" % name
         new_callback = SchedulerCallback(name,callback,wait_for=wait_for)
-        self.__callbacks.append(new_callback)
+        with self.__callback_lock:
+            self.__callbacks.append(new_callback)
         return new_callback
 
     def run(self):
@@ -490,9 +554,12 @@ class SimpleScheduler(threading.Thread):
                     updated_groups.append(group_name)
             # Update the list of groups
             self.__active_groups = updated_groups
-            # Handle callbacks
-            updated_callback_list = []
-            for callback in self.__callbacks:
+            # Handle callbacks (working from a snapshot, as the
+            # callbacks themselves may add new callbacks)
+            with self.__callback_lock:
+                callbacks = list(self.__callbacks)
+            invoked_callbacks = []
+            for callback in callbacks:
                 logging.debug("Checking %s" % callback.callback_name)
                 logging.debug("Waiting_for: %s" % callback.waiting_for)
                 invoke_callback = True
@@ -509,9 +576,11 @@ class SimpleScheduler(threading.Thread):
                 if invoke_callback:
                     logging.debug("Invoking callback '%s'" % callback.callback_name)
                     callback.invoke(tuple(callback_jobs),self)
-                else:
-                    updated_callback_list.append(callback)
-            self.__callbacks = updated_callback_list
+                    invoked_callbacks.append(callback)
+            with self.__callback_lock:
+                self.__callbacks = [callback
+                                    for callback in self.__callbacks
+                                    if callback not in invoked_callbacks]
             # Add submitted jobs to the waiting list
             while not self.__submitted.empty():
                 job = self.__submitted.get()
@@ -528,6 +597,12 @@ class SimpleScheduler(threading.Thread):
                     # Check if job is waiting for another job to finish
                     for name in job.waiting_for:
                         ok_to_run = (ok_to_run and name in self.__finished_names)
+                    # Check if the job's runner is at capacity
+                    if ok_to_run and job.runner in self.__runner_limits:
+                        n_running = len([j for j in self.__running
+                                         if j.runner is job.runner])
+                        if n_running >= self.__runner_limits[job.runner]:
+                            ok_to_run = False
                 if ok_to_run:
                     # Start the job running
                     try:
@@ -729,10 +804,18 @@ class SchedulerJob(Job):
     SchedulerJob instances should normally be returned by a
     call to the 'submit' method of a SimpleScheduler object.
 
+    If 'resource_usage' is set then when the job is started
+    the command is written to a wrapper script which also
+    records the resources used (see the 'resource_usage'
+    option of 'Command.make_wrapper_script'), and the script
+    is run instead. The script is written to the log
+    directory (or to the working directory if no log
+    directory is set).
+
     """
 
     def __init__(self,runner,args,job_number=None,name=None,working_dir=None,
-                 log_dir=None,wait_for=[]):
+                 log_dir=None,wait_for=[],resource_usage=False):
         """Create a new SchedulerJob instance
 
         """
@@ -749,6 +832,9 @@ class SchedulerJob(Job):
             working_dir = os.path.abspath(working_dir)
         Job.__init__(self,runner,name,working_dir,args[0],args[1:])
         self._restarts = 0
+        self._resource_usage = None
+        self._wrap_resource_usage = resource_usage
+        self._wrapper_script = None
 
     @property 
     def name(self):
@@ -794,6 +880,29 @@ class SchedulerJob(Job):
         """
         return self.exit_status
 
+    @property
+    def resource_usage(self):
+        """Return the resources used by the job
+
+        The resource usage is extracted from the job's log
+        file, and is only available for completed jobs which
+        ran a wrapper script that records it (e.g. jobs from
+        a scheduler with 'resource_usage' turned on, or scripts
+        generated by 'PipelineCommand.make_wrapper_script').
+
+        Returns:
+          Dictionary with keys 'wall_time', 'user_time',
+          'sys_time' and 'cpu_time' (in seconds) and 'peak_rss'
+          (in Kb, or None), or None if the resource usage is
+          not available.
+        """
+        if self._resource_usage is None and self.completed:
+            log_file = getattr(self,'log',None)
+            if log_file is not None and not os.path.isabs(log_file):
+                log_file = os.path.join(self.working_dir,log_file)
+            self._resource_usage = parse_resource_usage(log_file)
+        return self._resource_usage
+
     def start(self):
         """Start the job running
 
@@ -803,6 +912,8 @@ class SchedulerJob(Job):
           Id for job
 
         """
+        if self._wrap_resource_usage and self._wrapper_script is None:
+            self._make_wrapper_script()
         if self.log_dir is not None:
             runner_log_dir = self.runner.log_dir
             self.runner.set_log_dir(self.log_dir)
@@ -811,6 +922,32 @@ class SchedulerJob(Job):
             self.runner.set_log_dir(runner_log_dir)
         return job_id
 
+    def _make_wrapper_script(self):
+        """Internal: run the command via a resource usage wrapper
+
+        Writes the command to a wrapper script which also
+        records the resources it uses, and replaces the job's
+        script and arguments so that the wrapper is run
+        instead.
+        """
+        scripts_dir = self.log_dir
+        if scripts_dir is None:
+            scripts_dir = self.working_dir
+        # Quote the arguments so that the wrapped command line
+        # behaves the same as running the command directly
+        cmd = Command(*[pipes.quote(str(arg))
+                        for arg in ([self.script,] + self.args)])
+        script_file = os.path.join(
+            scripts_dir,
+            "%s.%s.sh" % (str(self.name).replace(os.sep,'_'),
+                          uuid.uuid4()))
+        cmd.make_wrapper_script(shell="/bin/bash",
+                                filen=script_file,
+                                resource_usage=True)
+        self._wrapper_script = script_file
+        self.script = '/bin/bash'
+        self.args = [script_file]
+
     def wait(self,poll_interval=5,timeout=None):
         """Wait for the job to complete
 
@@ -895,7 +1032,7 @@ class SchedulerJob(Job):
         """Return string representation of the job command line
 
         """
-        return ' '.join([str(x) for x in ([self.script,] + self.args)])
+        return self.command
 
 class SchedulerCallback:
     """Class providing an interface to scheduled callbacks
@@ -947,6 +1084,11 @@ class SchedulerReporter:
     job_end           Job finishes        as 'job_scheduled'
     group_added       Group is created    group_name, group_id, time_stamp
     group_end         Group completes     as 'group_added'
+    group_resources   Group completes     as 'group_added', plus
+                                          n_jobs, wall_time, cpu_time,
+                                          peak_rss (only reported if
+                                          resource usage is available
+                                          for the group's jobs)
     scheduler_status  Need status         n_running, n_waiting, n_finished
 
     An example template string for a job could be:
@@ -957,13 +1099,31 @@ class SchedulerReporter:
     customise reporting of the standard scheduler operations when
     used in an application.
 
+    Optionally the reporter can also write a structured event
+    stream to a file, consisting of one JSON object per line for
+    each job_scheduled, job_start, job_end, group_added and
+    group_end operation. Each event has the keys 'event' (the
+    operation name) and 'time' (seconds since the epoch), plus:
+
+    - for jobs: 'job_number', 'job_name', 'job_id', 'runner'
+      and (for 'job_end' only) 'exit_status' and
+      'resource_usage'
+    - for groups: 'group_id' and 'group_name' (plus
+      'resource_usage' for 'group_end')
+
+    The event stream can be read back using the
+    'read_scheduler_events' function and summarised using the
+    SchedulerEventSummary class.
+
     """
-    def __init__(self,fp=sys.stdout,**args):
+    def __init__(self,fp=sys.stdout,event_log=None,**args):
         """Create new SchedulerReporter instance
 
         Arguments
           fp: optional, if provided then must be a file-like
               object opened for writing (defaults to stdout)
+          event_log: optional, if provided then must be the path
+              to a file which events will be appended to
           args: optional keyword-value pairs, where 'value'
               defines a template for the name provided by
               'keyword'
@@ -975,9 +1135,12 @@ class SchedulerReporter:
                                 'group_added',
                                 'group_start',
                                 'group_end',
+                                'group_resources',
                                 'scheduler_status']
         self.__templates = {}
         self.__fp = fp
+        self.__event_log = event_log
+        self.__event_lock = threading.Lock()
         for name in args:
             self.set_template(name,args[name])
 
@@ -1027,6 +1190,34 @@ class SchedulerReporter:
                  'group_id'   : group.group_id,
                  'time_stamp' : date_and_time() }
 
+    def _job_event(self,job):
+        """Return dictionary of event data derived from job instance
+
+        Arguments:
+          job: SchedulerJob instance
+
+        Returns:
+          Dictionary containing appropriate keywords
+
+        """
+        return { 'job_number' : job.job_number,
+                 'job_name'   : job.job_name,
+                 'job_id'     : job.job_id,
+                 'runner'     : job.runner.__class__.__name__ }
+
+    def _group_event(self,group):
+        """Return dictionary of event data derived from group instance
+
+        Arguments:
+          group: SchedulerGroup instance
+
+        Returns:
+          Dictionary containing appropriate keywords
+
+        """
+        return { 'group_id'   : group.group_id,
+                 'group_name' : group.group_name }
+
     def scheduler_status(self,sched):
         """Write report string for scheduler status
 
@@ -1044,6 +1235,7 @@ class SchedulerReporter:
 
         """
         self._report('job_scheduled',**self._job_dict(job))
+        self._log_event('job_scheduled',**self._job_event(job))
 
     def job_start(self,job):
         """Write report string when a job starts
@@ -1053,6 +1245,7 @@ class SchedulerReporter:
 
         """
         self._report('job_start',**self._job_dict(job))
+        self._log_event('job_start',**self._job_event(job))
 
     def job_end(self,job):
         """Write report string when a job ends
@@ -1062,6 +1255,9 @@ class SchedulerReporter:
 
         """
         self._report('job_end',**self._job_dict(job))
+        self._log_event('job_end',exit_status=job.exit_code,
+                        resource_usage=job.resource_usage,
+                        **self._job_event(job))
 
     def group_added(self,group):
         """Write report string when a group is added
@@ -1071,6 +1267,7 @@ class SchedulerReporter:
 
         """
         self._report('group_added',**self._group_dict(group))
+        self._log_event('group_added',**self._group_event(group))
 
     def group_end(self,group):
         """Write report string when a group ends
@@ -1080,6 +1277,18 @@ class SchedulerReporter:
 
         """
         self._report('group_end',**self._group_dict(group))
+        usage = summarise_resource_usage(group.jobs)
+        if usage['n_jobs']:
+            args = self._group_dict(group)
+            args['n_jobs'] = usage['n_jobs']
+            args['wall_time'] = format_duration(usage['max_wall_time'])
+            args['cpu_time'] = format_duration(usage['total_cpu_time'])
+            args['peak_rss'] = ("%.1fM" % (usage['max_peak_rss']/1024.0)
+                                if usage['max_peak_rss'] is not None
+                                else '?')
+            self._report('group_resources',**args)
+        self._log_event('group_end',resource_usage=usage,
+                        **self._group_event(group))
 
     def set_template(self,name,template):
         """Associate a template string with an operation
@@ -1121,6 +1330,159 @@ class SchedulerReporter:
             logging.debug("SchedulerReporter: exception '%s' (ignored)" % ex)
             return
 
+    def _log_event(self,event,**args):
+        """Append an event to the event log
+
+        Internal function that should not be called directly.
+        Does nothing if no event log was specified when the
+        SchedulerReporter instance was created; errors writing
+        to the log are reported but otherwise ignored.
+
+        Arguments:
+          event: operation name e.g. 'job_start'
+          args: keyword-value pairs with the event data
+
+        """
+        if self.__event_log is None:
+            return
+        args['event'] = event
+        args['time'] = time.time()
+        try:
+            with self.__event_lock:
+                with open(self.__event_log,'a') as fp:
+                    fp.write("%s\n" % json.dumps(args,sort_keys=True))
+        except (IOError,TypeError,ValueError),ex:
+            logging.warning("SchedulerReporter: failed to write event "
+                            "to %s: %s (ignored)" % (self.__event_log,ex))
+
+class SchedulerEventSummary:
+    """Class to summarise events from a scheduler event log
+
+    Events (i.e. dictionaries read from the event log written
+    by a SchedulerReporter) are added via the 'update' method,
+    and the summary is available via the properties:
+
+    - n_scheduled: total number of jobs scheduled
+    - n_waiting: number of jobs waiting to start (i.e. the
+      queue depth)
+    - n_running: number of jobs currently running
+    - n_finished: number of jobs which have finished
+    - n_failed: number of finished jobs with a non-zero
+      exit status
+    - throughput: jobs finished per minute
+    - eta: estimated number of seconds to finish the jobs
+      scheduled so far
+
+    Example usage:
+
+    >>> summary = SchedulerEventSummary()
+    >>> for event in read_scheduler_events('events.ndjson')[0]:
+    ...    summary.update(event)
+    >>> print summary.report()
+
+    """
+    def __init__(self):
+        """Create a new SchedulerEventSummary instance
+
+        """
+        self.n_scheduled = 0
+        self.n_started = 0
+        self.n_finished = 0
+        self.n_failed = 0
+        self.start_time = None
+        self.last_time = None
+
+    def update(self,event):
+        """Update the summary with data from an event
+
+        Arguments:
+          event: dictionary with the event data
+
+        """
+        name = event.get('event')
+        timestamp = event.get('time')
+        if timestamp is not None:
+            if self.start_time is None:
+                self.start_time = timestamp
+            self.last_time = timestamp
+        if name == 'job_scheduled':
+            self.n_scheduled += 1
+        elif name == 'job_start':
+            self.n_started += 1
+        elif name == 'job_end':
+            self.n_finished += 1
+            if event.get('exit_status'):
+                self.n_failed += 1
+
+    @property
+    def n_waiting(self):
+        return max(self.n_scheduled - self.n_started,0)
+
+    @property
+    def n_running(self):
+        return max(self.n_started - self.n_finished,0)
+
+    def throughput(self,now=None):
+        """Return the number of jobs finished per minute
+
+        Arguments:
+          now: optional, time (in seconds since the epoch)
+            to measure up to (defaults to time of the most
+            recent event)
+
+        Returns:
+          Float: jobs per minute, or None if this can't
+            be determined.
+
+        """
+        if now is None:
+            now = self.last_time
+        if self.start_time is None or now is None or \
+           now <= self.start_time:
+            return None
+        return self.n_finished*60.0/(now - self.start_time)
+
+    def eta(self,now=None):
+        """Return estimated time to finish the scheduled jobs
+
+        Arguments:
+          now: optional, time (in seconds since the epoch)
+            to measure up to (defaults to time of the most
+            recent event)
+
+        Returns:
+          Float: estimated number of seconds remaining, or
+            None if this can't be determined.
+
+        """
+        remaining = self.n_scheduled - self.n_finished
+        if remaining <= 0:
+            return 0.0
+        throughput = self.throughput(now=now)
+        if not throughput:
+            return None
+        return remaining*60.0/throughput
+
+    def report(self,now=None):
+        """Return a one-line report of the summary
+
+        Arguments:
+          now: optional, time (in seconds since the epoch)
+            to measure up to (defaults to time of the most
+            recent event)
+
+        """
+        throughput = self.throughput(now=now)
+        eta = self.eta(now=now)
+        return "%d running, %d waiting, %d finished (%d failed); " \
+            "%s jobs/min; ETA %s" % \
+            (self.n_running,
+             self.n_waiting,
+             self.n_finished,
+             self.n_failed,
+             ("%.2f" % throughput if throughput is not None else '?'),
+             (format_duration(eta) if eta is not None else '?'))
+
 #######################################################################
 # Functions
 #######################################################################
@@ -1134,18 +1496,98 @@ def date_and_time(epoch=None):
     else:
         return time.asctime()
 
-def default_scheduler_reporter():
+def format_duration(seconds):
+    """Return a duration in seconds formatted as HH:MM:SS
+
+    """
+    seconds = int(round(seconds))
+    return "%02d:%02d:%02d" % (seconds/3600,(seconds%3600)/60,seconds%60)
+
+def read_scheduler_events(event_log,offset=0):
+    """Read events from a scheduler event log
+
+    Reads the events written by a SchedulerReporter from
+    the file, starting at the specified offset (so that the
+    file can be 'tailed' by passing the offset returned from
+    the previous call). Incomplete or invalid lines are
+    skipped.
+
+    Arguments:
+      event_log: path to the event log file
+      offset: optional, byte offset to start reading from
+        (default: 0 i.e. start of the file)
+
+    Returns:
+      Tuple: (events,offset) where 'events' is a list of
+        event dictionaries and 'offset' is the offset to
+        use for the next read.
+
+    """
+    events = []
+    with open(event_log,'r') as fp:
+        fp.seek(offset)
+        while True:
+            line = fp.readline()
+            if not line.endswith('\n'):
+                # End of file (or a partially written line
+                # which will be picked up by the next read)
+                break
+            offset = fp.tell()
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                logging.debug("Skipping bad event line: %s" % line)
+    return (events,offset)
+
+def summarise_resource_usage(jobs):
+    """Summarise the resources used by a set of jobs
+
+    Arguments:
+      jobs: list of SchedulerJob instances
+
+    Returns:
+      Dictionary with keys 'n_jobs' (number of jobs with
+      resource usage data), 'total_cpu_time' and
+      'max_wall_time' (in seconds) and 'max_peak_rss' (in
+      Kb, or None if not available).
+
+    """
+    summary = { 'n_jobs': 0,
+                'total_cpu_time': 0.0,
+                'max_wall_time': 0.0,
+                'max_peak_rss': None }
+    for job in jobs:
+        usage = job.resource_usage
+        if usage is None:
+            continue
+        summary['n_jobs'] += 1
+        summary['total_cpu_time'] += usage['cpu_time']
+        summary['max_wall_time'] = max(summary['max_wall_time'],
+                                       usage['wall_time'])
+        if usage['peak_rss'] is not None:
+            if summary['max_peak_rss'] is None or \
+               usage['peak_rss'] > summary['max_peak_rss']:
+                summary['max_peak_rss'] = usage['peak_rss']
+    return summary
+
+def default_scheduler_reporter(event_log=None):
     """Return a default SchedulerReporter object
 
+    Arguments:
+      event_log: optional, path to a file to write the
+        structured event stream to
+
     """
     return SchedulerReporter(
+        event_log=event_log,
         scheduler_status="%(time_stamp)s: %(n_running)d running, %(n_waiting)d waiting, %(n_finished)d finished",
         job_scheduled="Job scheduled: #%(job_number)d: \"%(job_name)s\" (%(time_stamp)s)",
         job_start="Job started: #%(job_number)d (%(job_id)s): \"%(job_name)s\" (%(time_stamp)s)",
         job_end="Job completed: #%(job_number)d (%(job_id)s): \"%(job_name)s\" (%(time_stamp)s)",
 
         group_added="Group has been added: #%(group_id)d: \"%(group_name)s\" (%(time_stamp)s)",
-        group_end="Group completed: #%(group_id)d: \"%(group_name)s\" (%(time_stamp)s)"
+        group_end="Group completed: #%(group_id)d: \"%(group_name)s\" (%(time_stamp)s)",
+        group_resources="Group resources: #%(group_id)d: \"%(group_name)s\": %(n_jobs)d jobs, max wall time %(wall_time)s, total CPU time %(cpu_time)s, max peak RSS %(peak_rss)s"
     )
 
 #######################################################################
@@ -440,7 +440,8 @@ def run_cellranger_count(fastq_dir,
     )
     sched_reporter = SchedulerReporter()
     sched = SimpleScheduler(max_concurrent=max_jobs,
-                            reporter=sched_reporter)
+                            reporter=sched_reporter,
+                            resource_usage=True)
     sched.start()
 
     # Make a log directory
@@ -0,0 +1,109 @@
+#######################################################################
+# Unit tests for qc/fastqc.py
+#######################################################################
+
+import unittest
+import os
+import tempfile
+import shutil
+import zipfile
+
+from auto_process_ngs.mockqcdata import FASTQC_0_11_3
+from auto_process_ngs.qc.fastqc import FastqcData
+
+class TestFastqcData(unittest.TestCase):
+    def setUp(self):
+        # Create a temporary working dir
+        self.wd = tempfile.mkdtemp(suffix='.test_FastqcData')
+        # Create a FastQC output dir with fastqc_data.txt
+        self.fastqc_dir = os.path.join(self.wd,'PJB_S1_R1_001_fastqc')
+        os.mkdir(self.fastqc_dir)
+        self.fastqc_data_txt = os.path.join(self.fastqc_dir,
+                                            'fastqc_data.txt')
+        # NB only use the first copy of the data from the mock
+        # file contents
+        fastqc_data = FASTQC_0_11_3['fastqc_data.txt'] % \
+                      { 'fastq': 'PJB_S1_R1_001.fastq' }
+        fastqc_data = '##FastQC' + fastqc_data.split('##FastQC')[1]
+        with open(self.fastqc_data_txt,'w') as fp:
+            fp.write(fastqc_data)
+    def tearDown(self):
+        # Remove temporary working dir
+        if os.path.isdir(self.wd):
+            shutil.rmtree(self.wd)
+    def _make_zip_and_remove_dir(self):
+        # Zip the FastQC output dir and then remove it
+        zip_file = self.fastqc_dir + '.zip'
+        with zipfile.ZipFile(zip_file,'w') as z:
+            z.write(self.fastqc_data_txt,
+                    arcname='PJB_S1_R1_001_fastqc/fastqc_data.txt')
+        shutil.rmtree(self.fastqc_dir)
+        return zip_file
+    def test_fastqcdata(self):
+        """FastqcData: read data from fastqc_data.txt
+        """
+        fqc = FastqcData(self.fastqc_data_txt)
+        self.assertEqual(fqc.version,'0.11.3')
+        self.assertEqual(fqc.path,self.fastqc_data_txt)
+        self.assertEqual(fqc.zip,None)
+        self.assertEqual(fqc.modules[0:2],['Basic Statistics',
+                                           'Per base sequence quality'])
+        self.assertEqual(fqc.module_status('Basic Statistics'),'pass')
+        self.assertEqual(fqc.module_status('Per base sequence quality'),
+                         'fail')
+        self.assertEqual(fqc.module_status('Not a module'),None)
+        self.assertEqual(fqc.data('Not a module'),None)
+    def test_fastqcdata_basic_statistics(self):
+        """FastqcData: access 'Basic Statistics' data
+        """
+        fqc = FastqcData(self.fastqc_data_txt)
+        self.assertEqual(fqc.basic_statistics('Filename'),
+                         'PJB_S1_R1_001.fastq')
+        self.assertEqual(fqc.basic_statistics('Total Sequences'),'10')
+        self.assertEqual(fqc.basic_statistics('%GC'),'51')
+        self.assertRaises(KeyError,fqc.basic_statistics,'Not a measure')
+        self.assertEqual(fqc.basic_statistics(),
+                         { 'Filename': 'PJB_S1_R1_001.fastq',
+                           'File type': 'Conventional base calls',
+                           'Encoding': 'Sanger / Illumina 1.9',
+                           'Total Sequences': '10',
+                           'Sequences flagged as poor quality': '0',
+                           'Sequence length': '250',
+                           '%GC': '51', })
+    def test_fastqcdata_data(self):
+        """FastqcData: access raw data lines for a module
+        """
+        fqc = FastqcData(self.fastqc_data_txt)
+        data = fqc.data('Per base sequence quality')
+        self.assertEqual(data[0],"#Base\tMean\tMedian\tLower Quartile\t"
+                         "Upper Quartile\t10th Percentile\t90th Percentile")
+        self.assertEqual(data[1],"1\t27.6\t0.0\t0.0\t0.0\t0.0\t0.0")
+    def test_fastqcdata_columns(self):
+        """FastqcData: access typed columns for a module
+        """
+        fqc = FastqcData(self.fastqc_data_txt)
+        columns = fqc.columns('Per base sequence quality')
+        self.assertEqual(columns.keys(),['Base','Mean','Median',
+                                         'Lower Quartile','Upper Quartile',
+                                         '10th Percentile',
+                                         '90th Percentile'])
+        self.assertEqual(columns['Base'][0:10],
+                         [1,2,3,4,5,6,7,8,9,'10-14'])
+        self.assertEqual(columns['Mean'][0:3],[27.6,25.6,22.0])
+        self.assertEqual(fqc.columns('Not a module'),None)
+    def test_fastqcdata_from_zip(self):
+        """FastqcData: read data from _fastqc.zip when dir is missing
+        """
+        zip_file = self._make_zip_and_remove_dir()
+        fqc = FastqcData(self.fastqc_data_txt)
+        self.assertEqual(fqc.version,'0.11.3')
+        self.assertEqual(fqc.zip,zip_file)
+        self.assertEqual(fqc.module_status('Basic Statistics'),'pass')
+        self.assertEqual(fqc.basic_statistics('Total Sequences'),'10')
+        self.assertEqual(fqc.columns('Per base sequence quality')['Mean'][0],
+                         27.6)
+    def test_fastqcdata_missing_file(self):
+        """FastqcData: raise IOError if data file and zip are missing
+        """
+        shutil.rmtree(self.fastqc_dir)
+        self.assertRaises(IOError,FastqcData,self.fastqc_data_txt)
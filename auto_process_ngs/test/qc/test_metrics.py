@@ -0,0 +1,92 @@
+#######################################################################
+# Unit tests for qc/metrics.py
+#######################################################################
+
+import unittest
+import os
+import tempfile
+import shutil
+from cStringIO import StringIO
+
+from auto_process_ngs.mock import MockAnalysisProject
+from auto_process_ngs.mockqc import MockQCOutputs
+from auto_process_ngs.utils import AnalysisProject
+from auto_process_ngs.qc.metrics import QCMetrics
+
+class TestQCMetrics(unittest.TestCase):
+    def setUp(self):
+        # Temporary working dir
+        self.wd = tempfile.mkdtemp(suffix='.test_QCMetrics')
+    def tearDown(self):
+        # Remove temporary working dir
+        if os.path.isdir(self.wd):
+            shutil.rmtree(self.wd)
+    def _make_analysis_project(self,name,fastq_names,screens=True):
+        # Create a mock Analysis Project directory
+        # with QC outputs
+        analysis_dir = MockAnalysisProject(name,fastq_names)
+        analysis_dir.create(top_dir=self.wd)
+        qc_dir = os.path.join(self.wd,name,'qc')
+        os.mkdir(qc_dir)
+        for fq in fastq_names:
+            MockQCOutputs.fastqc_v0_11_2(fq,qc_dir)
+            if screens:
+                for screen in ('model_organisms',
+                               'other_organisms',
+                               'rRNA'):
+                    MockQCOutputs.fastq_screen_v0_9_2(fq,qc_dir,screen)
+        return AnalysisProject(name,os.path.join(self.wd,name))
+    def test_qcmetrics(self):
+        """QCMetrics: collect metrics for multiple projects
+        """
+        projects = [
+            self._make_analysis_project('PJB',
+                                        ('PJB1_S1_R1_001.fastq.gz',
+                                         'PJB1_S1_R2_001.fastq.gz',
+                                         'PJB1_S1_I1_001.fastq.gz',)),
+            self._make_analysis_project('AB',
+                                        ('AB1_S2_R1_001.fastq.gz',)),
+        ]
+        metrics = QCMetrics(projects)
+        self.assertEqual(len(metrics.raw),3)
+        header = metrics.raw.header()
+        self.assertEqual(header[0:6],['Project','Sample','Fastq',
+                                      'Reads','%GC','Sequence_length'])
+        self.assertTrue('Per base sequence quality' in header)
+        self.assertTrue('model_organisms:hg19' in header)
+        self.assertTrue('rRNA:no_hits' in header)
+        line = metrics.raw[0]
+        self.assertEqual(line['Project'],'PJB')
+        self.assertEqual(line['Sample'],'PJB1')
+        self.assertEqual(line['Fastq'],'PJB1_S1_R1_001.fastq.gz')
+        self.assertEqual(line['Reads'],10)
+        self.assertEqual(line['Per base sequence quality'],'FAIL')
+        self.assertEqual(line['model_organisms:hg19'],0.82)
+        self.assertEqual(line['rRNA:no_hits'],98.92)
+        self.assertEqual(metrics.raw[2]['Project'],'AB')
+    def test_qcmetrics_missing_screens(self):
+        """QCMetrics: handle missing fastq_screen outputs
+        """
+        projects = [
+            self._make_analysis_project('PJB',
+                                        ('PJB1_S1_R1_001.fastq.gz',),
+                                        screens=False),
+        ]
+        metrics = QCMetrics(projects)
+        self.assertEqual(len(metrics.raw),1)
+        self.assertEqual(metrics.raw[0]['Reads'],10)
+        self.assertFalse('rRNA:no_hits' in metrics.raw.header())
+    def test_qcmetrics_write(self):
+        """QCMetrics: write metrics as tab-delimited table
+        """
+        projects = [
+            self._make_analysis_project('PJB',
+                                        ('PJB1_S1_R1_001.fastq.gz',)),
+        ]
+        fp = StringIO()
+        QCMetrics(projects).write(fp=fp)
+        lines = fp.getvalue().split('\n')
+        self.assertTrue(lines[0].startswith(
+            "#Project\tSample\tFastq\tReads\t%GC\tSequence_length\t"))
+        self.assertTrue(lines[1].startswith(
+            "PJB\tPJB1\tPJB1_S1_R1_001.fastq.gz\t10\t51\t250\t"))
@@ -4,6 +4,10 @@
 from auto_process_ngs.applications import *
 import unittest
 import cStringIO
+import os
+import shutil
+import tempfile
+import subprocess
 
 class TestCommand(unittest.TestCase):
 
@@ -83,6 +87,101 @@ class TestCommand(unittest.TestCase):
         cmd.make_wrapper_script(fp=fp)
         self.assertEqual(fp.getvalue(),"echo hello")
 
+    def test_make_wrapper_script_resource_usage(self):
+        """Check 'make_wrapper_script' records resource usage
+        """
+        cmd = Command('echo','hello')
+        self.assertEqual(cmd.make_wrapper_script(shell="/bin/bash",
+                                                 resource_usage=True),
+                         "#!/bin/bash\n%s" %
+                         resource_usage_wrapper("echo hello"))
+        # Run the script and check the usage is recorded
+        wd = tempfile.mkdtemp(suffix='.test_make_wrapper_script')
+        try:
+            script = os.path.join(wd,'wrapper.sh')
+            log_file = os.path.join(wd,'wrapper.log')
+            Command('sh','-c',"'exit 3'").make_wrapper_script(
+                filen=script,
+                shell="/bin/bash",
+                resource_usage=True)
+            with open(log_file,'w') as fp:
+                status = subprocess.call(['/bin/bash',script],stdout=fp)
+            self.assertEqual(status,3)
+            usage = parse_resource_usage(log_file)
+            self.assertNotEqual(usage,None)
+            self.assertTrue(usage['wall_time'] >= 0.0)
+            self.assertEqual(usage['cpu_time'],
+                             usage['user_time']+usage['sys_time'])
+        finally:
+            shutil.rmtree(wd)
+
+    def test_make_wrapper_script_resource_usage_cpu_time(self):
+        """Check 'make_wrapper_script' records CPU time used by command
+        """
+        wd = tempfile.mkdtemp(suffix='.test_make_wrapper_script')
+        try:
+            script = os.path.join(wd,'wrapper.sh')
+            log_file = os.path.join(wd,'wrapper.log')
+            # Busy loop to use some CPU time
+            Command('sh','-c',
+                    "'i=0; while [ $i -lt 200000 ]; do i=$((i+1)); done'"
+            ).make_wrapper_script(filen=script,
+                                  shell="/bin/bash",
+                                  resource_usage=True)
+            with open(log_file,'w') as fp:
+                status = subprocess.call(['/bin/bash',script],stdout=fp)
+            self.assertEqual(status,0)
+            usage = parse_resource_usage(log_file)
+            self.assertNotEqual(usage,None)
+            self.assertTrue(usage['cpu_time'] > 0.0)
+        finally:
+            shutil.rmtree(wd)
+
+class TestParseResourceUsage(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp(suffix='.test_parse_resource_usage')
+        self.log_file = os.path.join(self.wd,'job.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+
+    def test_parse_resource_usage_gnu_time(self):
+        """Extract resource usage recorded using GNU time
+        """
+        with open(self.log_file,'w') as fp:
+            fp.write("hello\n"
+                     "#### RESOURCES wall=12.50 user=10.25 sys=1.25 "
+                     "maxrss=20480\n"
+                     "#### EXIT_CODE 0\n")
+        self.assertEqual(parse_resource_usage(self.log_file),
+                         { 'wall_time': 12.5,
+                           'user_time': 10.25,
+                           'sys_time': 1.25,
+                           'cpu_time': 11.5,
+                           'peak_rss': 20480 })
+
+    def test_parse_resource_usage_shell_times(self):
+        """Extract resource usage recorded using shell 'times'
+        """
+        with open(self.log_file,'w') as fp:
+            fp.write("#### RESOURCES wall=75 user=1m2.500s sys=0m0.500s\n")
+        self.assertEqual(parse_resource_usage(self.log_file),
+                         { 'wall_time': 75.0,
+                           'user_time': 62.5,
+                           'sys_time': 0.5,
+                           'cpu_time': 63.0,
+                           'peak_rss': None })
+
+    def test_parse_resource_usage_missing(self):
+        """Return None when resource usage is not available
+        """
+        self.assertEqual(parse_resource_usage(self.log_file),None)
+        self.assertEqual(parse_resource_usage(None),None)
+        with open(self.log_file,'w') as fp:
+            fp.write("hello\n")
+        self.assertEqual(parse_resource_usage(self.log_file),None)
+
 class TestBcl2Fastq(unittest.TestCase):
 
     def test_configure_bcl_to_fastq(self):
@@ -691,3 +691,40 @@ Comments\t1% PhiX spike in
         ap = AutoProcess(mockdir.dirn)
         self.assertRaises(Exception,
                           ap.import_project,self.new_project_dir)
+
+class TestAutoProcessUpdateChecksumManifest(unittest.TestCase):
+    """Tests for AutoProcess.update_checksum_manifest
+
+    """
+    def setUp(self):
+        self.dirn = tempfile.mkdtemp(
+            suffix='TestAutoProcessUpdateChecksumManifest')
+
+    def tearDown(self):
+        # Remove the temporary test directory
+        shutil.rmtree(self.dirn)
+
+    def test_update_checksum_manifest(self):
+        """AutoProcess.update_checksum_manifest records Fastq checksums
+        """
+        # Make an auto-process directory
+        mockdir = MockAnalysisDirFactory.bcl2fastq2(
+            '160621_M00879_0087_000000000-AGEW9',
+            'miseq',
+            top_dir=self.dirn)
+        mockdir.create()
+        ap = AutoProcess(mockdir.dirn)
+        manifest = ap.update_checksum_manifest(nthreads=2)
+        self.assertTrue(os.path.exists(os.path.join(mockdir.dirn,
+                                                    'checksums.manifest')))
+        paths = manifest.paths()
+        self.assertTrue(len(paths) > 0)
+        self.assertTrue(filter(lambda p: p.startswith('bcl2fastq/'),paths))
+        for project in ap.get_analysis_projects_from_dirs():
+            for fq in project.fastqs:
+                self.assertTrue(fq in manifest)
+        # Remove a Fastq and update again
+        fq = os.path.join(mockdir.dirn,paths[0])
+        os.remove(fq)
+        manifest = ap.update_checksum_manifest()
+        self.assertEqual(manifest.paths(),paths[1:])
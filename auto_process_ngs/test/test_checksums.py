@@ -0,0 +1,353 @@
+#######################################################################
+# Tests for checksums.py module
+#######################################################################
+
+import unittest
+import os
+import tempfile
+import shutil
+import hashlib
+from auto_process_ngs.checksums import *
+
+class TestMd5sum(unittest.TestCase):
+    """
+    Tests for the md5sum function
+    """
+    def setUp(self):
+        # Temporary working dir
+        self.wd = tempfile.mkdtemp(suffix='.test_md5sum')
+    def tearDown(self):
+        # Remove temporary working dir
+        if os.path.isdir(self.wd):
+            shutil.rmtree(self.wd)
+    def test_md5sum(self):
+        """md5sum: compute MD5 checksum of file
+        """
+        filen = os.path.join(self.wd,'test.txt')
+        with open(filen,'w') as fp:
+            fp.write("hello\n"*1000)
+        self.assertEqual(md5sum(filen),
+                         hashlib.md5("hello\n"*1000).hexdigest())
+        self.assertEqual(md5sum(filen,block_size=7),
+                         hashlib.md5("hello\n"*1000).hexdigest())
+
+class TestChecksumReader(unittest.TestCase):
+    """
+    Tests for the ChecksumReader class
+    """
+    def test_checksum_reader(self):
+        """ChecksumReader: compute MD5 checksum of data read
+        """
+        from cStringIO import StringIO
+        reader = ChecksumReader(StringIO("hello\n"*1000))
+        data = ''
+        while True:
+            buf = reader.read(7)
+            if not buf:
+                break
+            data += buf
+        self.assertEqual(data,"hello\n"*1000)
+        self.assertEqual(reader.hexdigest(),
+                         hashlib.md5("hello\n"*1000).hexdigest())
+
+class TestCopyWithMd5sum(unittest.TestCase):
+    """
+    Tests for the copy_with_md5sum function
+    """
+    def setUp(self):
+        # Temporary working dir
+        self.wd = tempfile.mkdtemp(suffix='.test_copy_with_md5sum')
+    def tearDown(self):
+        # Remove temporary working dir
+        if os.path.isdir(self.wd):
+            shutil.rmtree(self.wd)
+    def test_copy_with_md5sum(self):
+        """copy_with_md5sum: copy file and compute MD5 checksum
+        """
+        filen = os.path.join(self.wd,'test.txt')
+        with open(filen,'w') as fp:
+            fp.write("hello\n"*1000)
+        # Copy to a file
+        copy_file = os.path.join(self.wd,'copy.txt')
+        self.assertEqual(copy_with_md5sum(filen,copy_file,block_size=7),
+                         hashlib.md5("hello\n"*1000).hexdigest())
+        self.assertEqual(open(copy_file).read(),"hello\n"*1000)
+        # Copy to a directory
+        copy_dir = os.path.join(self.wd,'copy')
+        os.mkdir(copy_dir)
+        self.assertEqual(copy_with_md5sum(filen,copy_dir),
+                         hashlib.md5("hello\n"*1000).hexdigest())
+        self.assertEqual(open(os.path.join(copy_dir,'test.txt')).read(),
+                         "hello\n"*1000)
+
+class TestSampledChecksum(unittest.TestCase):
+    """
+    Tests for the sampled_checksum function
+    """
+    def setUp(self):
+        # Temporary working dir
+        self.wd = tempfile.mkdtemp(suffix='.test_sampled_checksum')
+    def tearDown(self):
+        # Remove temporary working dir
+        if os.path.isdir(self.wd):
+            shutil.rmtree(self.wd)
+    def _make_file(self,name,data):
+        filen = os.path.join(self.wd,name)
+        with open(filen,'wb') as fp:
+            fp.write(data)
+        return filen
+    def test_sampled_checksum(self):
+        """sampled_checksum: detect differences in sampled blocks
+        """
+        data = 'A'*1000
+        f1 = self._make_file('f1',data)
+        f2 = self._make_file('f2',data)
+        f3 = self._make_file('f3','B'+data[1:])
+        f4 = self._make_file('f4',data[:-1]+'B')
+        for f in (f1,f2,f3,f4):
+            self.assertEqual(len(sampled_checksum(f,nblocks=4,
+                                                  block_size=10)),32)
+        self.assertEqual(sampled_checksum(f1,nblocks=4,block_size=10),
+                         sampled_checksum(f2,nblocks=4,block_size=10))
+        self.assertNotEqual(sampled_checksum(f1,nblocks=4,block_size=10),
+                            sampled_checksum(f3,nblocks=4,block_size=10))
+        self.assertNotEqual(sampled_checksum(f1,nblocks=4,block_size=10),
+                            sampled_checksum(f4,nblocks=4,block_size=10))
+    def test_sampled_checksum_small_file(self):
+        """sampled_checksum: read small files in full
+        """
+        f1 = self._make_file('f1','hello')
+        f2 = self._make_file('f2','hellp')
+        self.assertNotEqual(sampled_checksum(f1),sampled_checksum(f2))
+
+class TestReadMd5sumFile(unittest.TestCase):
+    """
+    Tests for the read_md5sum_file function
+    """
+    def setUp(self):
+        # Temporary working dir
+        self.wd = tempfile.mkdtemp(suffix='.test_read_md5sum_file')
+    def tearDown(self):
+        # Remove temporary working dir
+        if os.path.isdir(self.wd):
+            shutil.rmtree(self.wd)
+    def test_read_md5sum_file(self):
+        """read_md5sum_file: read checksums from md5sum file
+        """
+        md5sum_file = os.path.join(self.wd,'test.md5')
+        with open(md5sum_file,'w') as fp:
+            fp.write("""d41d8cd98f00b204e9800998ecf8427e  a/file1.txt
+0f723ae7f9bf07744445e93ac5595156 *./file 2.txt
+""")
+        self.assertEqual(read_md5sum_file(md5sum_file),
+                         { 'a/file1.txt':
+                           'd41d8cd98f00b204e9800998ecf8427e',
+                           'file 2.txt':
+                           '0f723ae7f9bf07744445e93ac5595156' })
+
+class TestCompareFiles(unittest.TestCase):
+    """
+    Tests for the compare_files function
+    """
+    def setUp(self):
+        # Temporary working dir
+        self.wd = tempfile.mkdtemp(suffix='.test_compare_files')
+        # Reference and copy dirs
+        self.ref = os.path.join(self.wd,'ref')
+        self.cpy = os.path.join(self.wd,'cpy')
+        os.mkdir(self.ref)
+        os.mkdir(self.cpy)
+    def tearDown(self):
+        # Remove temporary working dir
+        if os.path.isdir(self.wd):
+            shutil.rmtree(self.wd)
+    def _make_pair(self,name,ref_data,cpy_data):
+        for dirn,data in ((self.ref,ref_data),(self.cpy,cpy_data)):
+            with open(os.path.join(dirn,name),'w') as fp:
+                fp.write(data)
+        return (name,os.path.join(self.ref,name),os.path.join(self.cpy,name))
+    def test_compare_files(self):
+        """compare_files: compare reference and copy files
+        """
+        pairs = [self._make_pair('same','hello','hello'),
+                 self._make_pair('differ','hello','hellp'),
+                 self._make_pair('size_differs','hello','hello!'),
+                 ('missing_copy',os.path.join(self.ref,'same'),
+                  os.path.join(self.cpy,'missing')),
+                 ('missing_ref',os.path.join(self.ref,'missing'),
+                  os.path.join(self.cpy,'same')),]
+        expected = [('same',CHECKSUM_OK),
+                    ('differ',CHECKSUM_FAILED),
+                    ('size_differs',CHECKSUM_FAILED),
+                    ('missing_copy',CHECKSUM_FAILED),
+                    ('missing_ref',UNREADABLE_REFERENCE),]
+        self.assertEqual(list(compare_files(pairs)),expected)
+        self.assertEqual(list(compare_files(pairs,nthreads=3)),expected)
+    def test_compare_files_quick(self):
+        """compare_files: compare files in 'quick' mode
+        """
+        pairs = [self._make_pair('same','hello','hello'),
+                 self._make_pair('differ','hello','hellp'),]
+        # Set the same timestamps on reference and copy
+        for name,ref,cpy in pairs:
+            os.utime(ref,(1000000000,1000000000))
+            os.utime(cpy,(1000000000,1000000000))
+        self.assertEqual(list(compare_files(pairs,quick=True)),
+                         [('same',CHECKSUM_OK),
+                          ('differ',CHECKSUM_FAILED)])
+    def test_compare_files_reference_checksums(self):
+        """compare_files: use pre-computed checksums for references
+        """
+        pairs = [self._make_pair('same','hello','hello'),]
+        # Correct checksum
+        checksums = { 'same': hashlib.md5('hello').hexdigest() }
+        self.assertEqual(list(compare_files(pairs,
+                                            reference_checksums=checksums)),
+                         [('same',CHECKSUM_OK)])
+        # Wrong checksum
+        checksums = { 'same': hashlib.md5('hellp').hexdigest() }
+        self.assertEqual(list(compare_files(pairs,
+                                            reference_checksums=checksums)),
+                         [('same',CHECKSUM_FAILED)])
+        # Reference must still exist (sizes are compared)
+        os.remove(pairs[0][1])
+        self.assertEqual(list(compare_files(pairs,
+                                            reference_checksums=checksums)),
+                         [('same',UNREADABLE_REFERENCE)])
+
+class TestChecksumManifest(unittest.TestCase):
+    """
+    Tests for the ChecksumManifest class
+    """
+    def setUp(self):
+        # Temporary working dir
+        self.wd = tempfile.mkdtemp(suffix='.test_ChecksumManifest')
+        # Example files
+        os.mkdir(os.path.join(self.wd,'sub'))
+        self.files = []
+        for name,data in (('hello.txt',"hello\n"),
+                          ('sub/goodbye.txt',"goodbye\n"*100),):
+            filen = os.path.join(self.wd,name)
+            with open(filen,'w') as fp:
+                fp.write(data)
+            self.files.append(filen)
+    def tearDown(self):
+        # Remove temporary working dir
+        if os.path.isdir(self.wd):
+            shutil.rmtree(self.wd)
+    def test_checksum_manifest_update_and_save(self):
+        """ChecksumManifest: compute, save and reload checksums
+        """
+        manifest = ChecksumManifest(self.wd)
+        self.assertEqual(len(manifest),0)
+        self.assertEqual(manifest.update(self.files,nthreads=2),2)
+        self.assertTrue(manifest.modified)
+        manifest.save()
+        self.assertFalse(manifest.modified)
+        self.assertTrue(os.path.exists(os.path.join(self.wd,
+                                                    CHECKSUM_MANIFEST)))
+        # Reload
+        manifest = ChecksumManifest(self.wd)
+        self.assertEqual(manifest.paths(),['hello.txt','sub/goodbye.txt'])
+        self.assertTrue(self.files[1] in manifest)
+        self.assertEqual(manifest.checksums(),
+                         { 'hello.txt':
+                           hashlib.md5("hello\n").hexdigest(),
+                           'sub/goodbye.txt':
+                           hashlib.md5("goodbye\n"*100).hexdigest() })
+        # Nothing to recompute
+        self.assertEqual(manifest.update(self.files),0)
+        self.assertFalse(manifest.modified)
+    def test_checksum_manifest_changed_file(self):
+        """ChecksumManifest: recompute checksum for changed file
+        """
+        manifest = ChecksumManifest(self.wd)
+        manifest.update(self.files)
+        with open(self.files[0],'w') as fp:
+            fp.write("hello again\n")
+        self.assertEqual(manifest.lookup(self.files[0]),None)
+        self.assertEqual(manifest.checksums().keys(),['sub/goodbye.txt'])
+        self.assertEqual(manifest.md5sum(self.files[0]),
+                         hashlib.md5("hello again\n").hexdigest())
+        self.assertEqual(manifest.lookup('hello.txt'),
+                         hashlib.md5("hello again\n").hexdigest())
+    def test_checksum_manifest_trusts_unchanged_entries(self):
+        """ChecksumManifest: trust entries with matching stat signatures
+        """
+        st = os.stat(self.files[0])
+        with open(os.path.join(self.wd,CHECKSUM_MANIFEST),'w') as fp:
+            fp.write("%s\n" % CHECKSUM_MANIFEST_HEADER)
+            fp.write("hello.txt\t%d\t%d\t%s\n" % (st.st_size,
+                                                  int(st.st_mtime),
+                                                  '0'*32))
+        manifest = ChecksumManifest(self.wd)
+        self.assertEqual(manifest.md5sum(self.files[0]),'0'*32)
+        self.assertEqual(manifest.update(self.files),1)
+        self.assertEqual(manifest.md5sum('hello.txt'),'0'*32)
+    def test_checksum_manifest_hard_links(self):
+        """ChecksumManifest: reuse checksums for hard linked files
+        """
+        link = os.path.join(self.wd,'hello.lnk')
+        os.link(self.files[0],link)
+        manifest = ChecksumManifest(self.wd)
+        manifest.update(self.files)
+        self.assertEqual(manifest.update([link]),0)
+        self.assertEqual(manifest.lookup(link),
+                         hashlib.md5("hello\n").hexdigest())
+    def test_checksum_manifest_prune(self):
+        """ChecksumManifest: remove entries for missing files
+        """
+        manifest = ChecksumManifest(self.wd)
+        manifest.update(self.files)
+        manifest.save()
+        os.remove(self.files[0])
+        self.assertEqual(manifest.prune(),1)
+        self.assertEqual(manifest.paths(),['sub/goodbye.txt'])
+        self.assertTrue(manifest.modified)
+    def test_checksum_manifest_file_outside_base_dir(self):
+        """ChecksumManifest: don't store files outside base dir
+        """
+        manifest = ChecksumManifest(os.path.join(self.wd,'sub'))
+        self.assertEqual(manifest.md5sum(self.files[0]),
+                         hashlib.md5("hello\n").hexdigest())
+        self.assertEqual(len(manifest),0)
+    def test_checksum_manifest_write_md5sum_file(self):
+        """ChecksumManifest: write checksums in 'md5sum' format
+        """
+        manifest = ChecksumManifest(self.wd)
+        manifest.update(self.files)
+        md5sum_file = os.path.join(self.wd,'test.md5')
+        manifest.write_md5sum_file(md5sum_file)
+        self.assertEqual(read_md5sum_file(md5sum_file),
+                         manifest.checksums())
+
+class TestLoadReferenceChecksums(unittest.TestCase):
+    """
+    Tests for the load_reference_checksums function
+    """
+    def setUp(self):
+        # Temporary working dir
+        self.wd = tempfile.mkdtemp(suffix='.test_load_ref_checksums')
+        self.filen = os.path.join(self.wd,'hello.txt')
+        with open(self.filen,'w') as fp:
+            fp.write("hello\n")
+    def tearDown(self):
+        # Remove temporary working dir
+        if os.path.isdir(self.wd):
+            shutil.rmtree(self.wd)
+    def test_load_reference_checksums_manifest(self):
+        """load_reference_checksums: read checksum manifest
+        """
+        manifest = ChecksumManifest(self.wd)
+        manifest.update([self.filen])
+        manifest.save()
+        self.assertEqual(load_reference_checksums(manifest.manifest_file),
+                         { 'hello.txt': hashlib.md5("hello\n").hexdigest() })
+    def test_load_reference_checksums_md5sum_file(self):
+        """load_reference_checksums: read 'md5sum' format file
+        """
+        md5sum_file = os.path.join(self.wd,'test.md5')
+        with open(md5sum_file,'w') as fp:
+            fp.write("%s  hello.txt\n" % ('0'*32))
+        self.assertEqual(load_reference_checksums(md5sum_file),
+                         { 'hello.txt': '0'*32 })
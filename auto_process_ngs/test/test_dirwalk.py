@@ -0,0 +1,249 @@
+#######################################################################
+# Tests for dirwalk.py module
+#######################################################################
+
+import unittest
+import os
+import tempfile
+import shutil
+from auto_process_ngs.dirwalk import *
+
+class DirwalkTestCase(unittest.TestCase):
+    """
+    Base class for dirwalk tests
+    """
+    def setUp(self):
+        # Temporary working dir
+        self.wd = tempfile.mkdtemp(suffix='.test_dirwalk')
+        # Example directory tree
+        self.dirs = [self.wd]
+        self.files = []
+        for d in ('sub1','sub1/deep','sub2'):
+            d = os.path.join(self.wd,d)
+            os.mkdir(d)
+            self.dirs.append(d)
+        for f,size in (('a.txt',100),
+                       ('sub1/b.txt',2000),
+                       ('sub1/deep/c.txt',5),
+                       ('sub2/d.txt',0)):
+            f = os.path.join(self.wd,f)
+            with open(f,'w') as fp:
+                fp.write('x'*size)
+            self.files.append(f)
+        # Link to a directory (shouldn't be followed)
+        self.link = os.path.join(self.wd,'sub3')
+        os.symlink('sub1',self.link)
+    def tearDown(self):
+        # Remove temporary working dir
+        if os.path.isdir(self.wd):
+            shutil.rmtree(self.wd)
+    def _expected_usage(self,include_top=True):
+        # Sum the lstat values for all items in the tree
+        items = self.dirs[:] + self.files + [self.link]
+        if not include_top:
+            items.remove(self.wd)
+        return (sum([os.lstat(f).st_size for f in items]),
+                sum([os.lstat(f).st_blocks for f in items]))
+
+class TestScanDir(DirwalkTestCase):
+    """
+    Tests for the scan_dir function
+    """
+    def test_scan_dir(self):
+        """scan_dir: list directory entries with lstat results
+        """
+        entries = sorted(scan_dir(self.wd))
+        self.assertEqual([e[0] for e in entries],
+                         ['a.txt','sub1','sub2','sub3'])
+        self.assertEqual(entries[0][1],os.path.join(self.wd,'a.txt'))
+        self.assertEqual(entries[0][2].st_size,100)
+        self.assertEqual(entries[3][2].st_size,os.lstat(self.link).st_size)
+    def test_scan_dir_missing_dir(self):
+        """scan_dir: return empty list for missing directory
+        """
+        self.assertEqual(scan_dir(os.path.join(self.wd,'missing')),[])
+
+class TestWalkTree(DirwalkTestCase):
+    """
+    Tests for the walk_tree function
+    """
+    def test_walk_tree(self):
+        """walk_tree: visit each directory once
+        """
+        dirs = [d for d,entries in walk_tree(self.wd)]
+        self.assertEqual(sorted(dirs),sorted(self.dirs))
+    def test_walk_tree_multiple_threads(self):
+        """walk_tree: visit each directory once using multiple threads
+        """
+        dirs = []
+        files = []
+        for d,entries in walk_tree(self.wd,nthreads=4):
+            # Parent should have been visited first
+            if d != self.wd:
+                self.assertTrue(os.path.dirname(d) in dirs)
+            dirs.append(d)
+            files.extend([path for name,path,st in entries
+                          if os.path.isfile(path)])
+        self.assertEqual(sorted(dirs),sorted(self.dirs))
+        self.assertEqual(sorted(files),sorted(self.files))
+
+class TestGetDiskUsage(DirwalkTestCase):
+    """
+    Tests for the get_disk_usage function
+    """
+    def test_get_disk_usage(self):
+        """get_disk_usage: collect sizes and blocks for directory
+        """
+        apparent_size,blocks = self._expected_usage()
+        for nthreads in (1,4):
+            usage = get_disk_usage(self.wd,nthreads=nthreads)
+            self.assertEqual(usage.apparent_size,apparent_size)
+            self.assertEqual(usage.blocks,blocks)
+            self.assertEqual(usage.size,blocks*512)
+            self.assertEqual(usage.nfiles,5)
+            self.assertEqual(usage.ndirs,4)
+            self.assertEqual(usage.uids,set([os.getuid()]))
+    def test_get_disk_usage_exclude_top(self):
+        """get_disk_usage: exclude top-level directory from totals
+        """
+        apparent_size,blocks = self._expected_usage(include_top=False)
+        usage = get_disk_usage(self.wd,include_top=False)
+        self.assertEqual(usage.apparent_size,apparent_size)
+        self.assertEqual(usage.blocks,blocks)
+    def test_get_disk_usage_file(self):
+        """get_disk_usage: get usage for a single file
+        """
+        usage = get_disk_usage(self.files[1])
+        self.assertEqual(usage.apparent_size,2000)
+        self.assertEqual(usage.nfiles,1)
+        self.assertEqual(usage.ndirs,0)
+
+    def test_get_disk_usage_linked_top_level_dir(self):
+        """get_disk_usage: follow link to top-level directory
+        """
+        link_dir = tempfile.mkdtemp()
+        try:
+            link = os.path.join(link_dir,'link')
+            os.symlink(self.wd,link)
+            apparent_size,blocks = self._expected_usage()
+            usage = get_disk_usage(link)
+            self.assertEqual(usage.apparent_size,apparent_size)
+            self.assertEqual(usage.blocks,blocks)
+            self.assertEqual(usage.nfiles,5)
+            self.assertEqual(usage.ndirs,4)
+        finally:
+            shutil.rmtree(link_dir)
+
+class TestWalkUsage(DirwalkTestCase):
+    """
+    Tests for the walk_usage function
+    """
+    def test_walk_usage(self):
+        """walk_usage: collect usage for each directory
+        """
+        usage = dict([(d,u) for d,st,u in walk_usage(self.wd)])
+        self.assertEqual(sorted(usage.keys()),sorted(self.dirs))
+        self.assertEqual(usage[os.path.join(self.wd,'sub1')].nfiles,1)
+        self.assertEqual(usage[os.path.join(self.wd,'sub1')].ndirs,1)
+        self.assertEqual(usage[os.path.join(self.wd,'sub1')].apparent_size,
+                         2000 + os.lstat(os.path.join(self.wd,
+                                                      'sub1','deep')).st_size)
+    def test_walk_usage_classify(self):
+        """walk_usage: collect usage for categories
+        """
+        classify = lambda name: (['txt'] if name.endswith('.txt') else [])
+        total = DiskUsage()
+        for d,st,u in walk_usage(self.wd,classify=classify,nthreads=2):
+            total.merge(u)
+        self.assertEqual(total.categories,{ 'txt': 2105 })
+
+class TestUsageIndex(DirwalkTestCase):
+    """
+    Tests for the UsageIndex class
+    """
+    def setUp(self):
+        DirwalkTestCase.setUp(self)
+        # Separate dir for the index file
+        self.index_dir = tempfile.mkdtemp(suffix='.test_UsageIndex')
+        self.index_file = os.path.join(self.index_dir,'usage.db')
+    def tearDown(self):
+        DirwalkTestCase.tearDown(self)
+        if os.path.isdir(self.index_dir):
+            shutil.rmtree(self.index_dir)
+    def test_usage_index(self):
+        """UsageIndex: store and reuse usage for unchanged directories
+        """
+        index_file = self.index_file
+        apparent_size,blocks = self._expected_usage()
+        # Build the index
+        index = UsageIndex(index_file)
+        usage = get_disk_usage(self.wd,index=index)
+        self.assertEqual(usage.apparent_size,apparent_size)
+        self.assertEqual(len(index),4)
+        index.save()
+        # Reload the index and fake the stored value for an
+        # unchanged directory
+        index = UsageIndex(index_file)
+        self.assertEqual(len(index),4)
+        deep = os.path.join(self.wd,'sub1','deep')
+        stored,subdirs = index.lookup(deep,os.lstat(deep))
+        self.assertEqual(stored.apparent_size,5)
+        self.assertEqual(subdirs,[])
+        stored.apparent_size = 1000005
+        usage = get_disk_usage(self.wd,index=index)
+        self.assertEqual(usage.apparent_size,apparent_size+1000000)
+        # Refresh ignores stored values
+        usage = get_disk_usage(self.wd,index=index,refresh=True)
+        self.assertEqual(usage.apparent_size,apparent_size)
+    def test_usage_index_changed_directory(self):
+        """UsageIndex: ignore stored usage for changed directories
+        """
+        index = UsageIndex(self.index_file)
+        get_disk_usage(self.wd,index=index)
+        index.save()
+        sub2 = os.path.join(self.wd,'sub2')
+        self.assertNotEqual(index.lookup(sub2,os.lstat(sub2)),None)
+        with open(os.path.join(sub2,'e.txt'),'w') as fp:
+            fp.write('x'*1000)
+        os.utime(sub2,(0,0))
+        self.assertEqual(index.lookup(sub2,os.lstat(sub2)),None)
+        self.assertEqual(get_disk_usage(sub2,index=index).nfiles,2)
+    def test_usage_index_prune(self):
+        """UsageIndex: remove entries for missing directories
+        """
+        index = UsageIndex(self.index_file)
+        get_disk_usage(self.wd,index=index)
+        index.save()
+        shutil.rmtree(os.path.join(self.wd,'sub1'))
+        get_disk_usage(self.wd,index=index)
+        self.assertEqual(len(index),2)
+        index.save()
+        self.assertEqual(len(UsageIndex(self.index_file)),2)
+    def test_usage_index_different_scheme(self):
+        """UsageIndex: discard entries created with a different scheme
+        """
+        index_file = self.index_file
+        index = UsageIndex(index_file,scheme='one')
+        get_disk_usage(self.wd,index=index)
+        index.save()
+        self.assertEqual(len(UsageIndex(index_file,scheme='one')),4)
+        self.assertEqual(len(UsageIndex(index_file,scheme='two')),0)
+
+class TestDiskUsage(unittest.TestCase):
+    """
+    Tests for the DiskUsage class
+    """
+    def test_disk_usage_merge(self):
+        """DiskUsage: merge totals from another instance
+        """
+        usage1 = DiskUsage()
+        usage1.add(os.lstat(__file__))
+        usage2 = DiskUsage()
+        usage2.add(os.lstat(os.path.dirname(__file__)))
+        usage1.merge(usage2)
+        self.assertEqual(usage1.nfiles,1)
+        self.assertEqual(usage1.ndirs,1)
+        self.assertEqual(usage1.apparent_size,
+                         os.lstat(__file__).st_size +
+                         os.lstat(os.path.dirname(__file__)).st_size)
+        self.assertEqual(usage1.users,[get_user_name(os.getuid())])
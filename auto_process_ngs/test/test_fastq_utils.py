@@ -6,9 +6,14 @@ import unittest
 import os
 import tempfile
 import shutil
+import gzip
 from auto_process_ngs.fastq_utils import assign_barcodes_single_end
+from auto_process_ngs.fastq_utils import check_gzip_member
+from auto_process_ngs.fastq_utils import concat_fastqs
+from auto_process_ngs.fastq_utils import fastq_header_key
 from auto_process_ngs.fastq_utils import get_read_number
 from auto_process_ngs.fastq_utils import pair_fastqs
+from auto_process_ngs.fastq_utils import sample_fastq
 
 fastq_r1 = """@MISEQ:34:000000000-A7PHP:1:1101:12552:1774 1:N:0:TAAGGCGA
 TTTACAACTAGCTTCTCTTTTTCTT
@@ -78,6 +83,34 @@ class TestAssignBarcodesSingleEnd(unittest.TestCase):
         self.assertEqual(nreads,5)
         self.assertEqual(open(self.fastq_out,'r').read(),
                          fastq_r1_out)
+    def test_assign_barcodes_single_end_gzipped(self):
+        """assign_barcodes_single_end: handle gzipped input and output
+        """
+        fastq_in = self.fastq_in + '.gz'
+        fp = gzip.GzipFile(fastq_in,'wb')
+        fp.write(fastq_r1)
+        fp.close()
+        fastq_out = self.fastq_out + '.gz'
+        nreads = assign_barcodes_single_end(fastq_in,fastq_out)
+        self.assertEqual(nreads,5)
+        self.assertEqual(gzip.GzipFile(fastq_out,'rb').read(),
+                         fastq_r1_out)
+    def test_assign_barcodes_single_end_older_illumina(self):
+        """assign_barcodes_single_end: handle pre-1.8 Illumina headers
+        """
+        with open(self.fastq_in,'w') as fp:
+            fp.write("@HWUSI-EAS100R:6:73:941:1973#0/1\n"
+                     "TTTACAACTAGCTTC\n"
+                     "+\n"
+                     ">AA?131@C1FCGGG\n")
+        nreads = assign_barcodes_single_end(self.fastq_in,
+                                            self.fastq_out)
+        self.assertEqual(nreads,1)
+        self.assertEqual(open(self.fastq_out,'r').read(),
+                         "@HWUSI-EAS100R:6:73:941:1973#TTTAC/1\n"
+                         "AACTAGCTTC\n"
+                         "+\n"
+                         "31@C1FCGGG\n")
 
 # pair_fastqs
 fastq1_r1 = """@MISEQ:34:000000000-A7PHP:1:1101:12552:1774 1:N:0:TAAGGCGA
@@ -187,6 +220,56 @@ class TestPairFastqs(unittest.TestCase):
                   self.empty_r2]
         self.assertEqual(pair_fastqs(fastqs),
                          ([],[self.empty_r1,self.empty_r2]))
+    def test_pair_fastqs_gzipped(self):
+        """pair_fastqs: pair up gzipped FASTQs
+        """
+        fastqs = []
+        for fq,data in ((self.fastq1_r2,fastq1_r2),
+                        (self.fastq1_r1,fastq1_r1)):
+            fastq = fq + '.gz'
+            fp = gzip.GzipFile(fastq,'wb')
+            fp.write(data)
+            fp.close()
+            fastqs.append(fastq)
+        self.assertEqual(pair_fastqs(fastqs),
+                         ([(self.fastq1_r1+'.gz',self.fastq1_r2+'.gz')],
+                          []))
+    def test_pair_fastqs_multiple_threads(self):
+        """pair_fastqs: pair up a set of FASTQs using multiple threads
+        """
+        fastqs = [self.fastq2_r2,
+                  self.fastq1_r1,
+                  self.fastq2_r1,
+                  self.fastq1_r2,]
+        self.assertEqual(pair_fastqs(fastqs,nthreads=2),
+                         ([(self.fastq1_r1,self.fastq1_r2),
+                           (self.fastq2_r1,self.fastq2_r2)],
+                         []))
+
+# fastq_header_key
+class TestFastqHeaderKey(unittest.TestCase):
+    """
+    Tests for the fastq_header_key function
+    """
+    def test_fastq_header_key_illumina18(self):
+        """fastq_header_key: handle Illumina 1.8+ headers
+        """
+        self.assertEqual(fastq_header_key(
+            "@MISEQ:34:000000000-A7PHP:1:1101:12552:1774 2:N:0:TAAGGCGA\n"),
+                         ("MISEQ:34:000000000-A7PHP:1:1101:12552:1774",'2'))
+    def test_fastq_header_key_older_illumina(self):
+        """fastq_header_key: handle pre-1.8 Illumina headers
+        """
+        self.assertEqual(fastq_header_key(
+            "@HWUSI-EAS100R:6:73:941:1973#0/1\n"),
+                         ("HWUSI-EAS100R:6:73:941:1973#0",'1'))
+    def test_fastq_header_key_bad_header(self):
+        """fastq_header_key: return None for unrecognised headers
+        """
+        self.assertEqual(fastq_header_key(""),None)
+        self.assertEqual(fastq_header_key(None),None)
+        self.assertEqual(fastq_header_key("@read1\n"),None)
+        self.assertEqual(fastq_header_key("@A:B:C 1:N:0:ACGT\n"),None)
 
 # get_read_number
 class TestGetReadNumber(unittest.TestCase):
@@ -215,3 +298,158 @@ class TestGetReadNumber(unittest.TestCase):
         """get_read_number: check read number for R2 Fastq file
         """
         self.assertEqual(get_read_number(self.fastq_r2),2)
+
+# sample_fastq
+class TestSampleFastq(unittest.TestCase):
+    """
+    Tests for the sample_fastq function
+    """
+    def setUp(self):
+        # Temporary working dir
+        self.wd = tempfile.mkdtemp(suffix='.test_sample_fastq')
+        # Test file
+        self.fastq_in = os.path.join(self.wd,'test.fq')
+        with open(self.fastq_in,'w') as fp:
+            fp.write(fastq_r1)
+        # Split test data into records
+        lines = fastq_r1.split('\n')
+        self.records = ['\n'.join(lines[i:i+4])+'\n'
+                        for i in range(0,len(lines)-1,4)]
+    def tearDown(self):
+        # Remove temporary working dir
+        if os.path.isdir(self.wd):
+            shutil.rmtree(self.wd)
+    def test_sample_fastq(self):
+        """sample_fastq: sample subset of reads preserving order
+        """
+        fastq_out = os.path.join(self.wd,'out.fq')
+        self.assertEqual(sample_fastq(self.fastq_in,fastq_out,3,seed=1),3)
+        with open(fastq_out,'r') as fp:
+            data = fp.read()
+        lines = data.split('\n')
+        sampled = ['\n'.join(lines[i:i+4])+'\n'
+                   for i in range(0,len(lines)-1,4)]
+        self.assertEqual(len(sampled),3)
+        for r in sampled:
+            self.assertTrue(r in self.records)
+        self.assertEqual(sampled,sorted(sampled,
+                                        key=lambda r:
+                                        self.records.index(r)))
+    def test_sample_fastq_all_reads(self):
+        """sample_fastq: output all reads if subset exceeds total
+        """
+        fastq_out = os.path.join(self.wd,'out.fq')
+        self.assertEqual(sample_fastq(self.fastq_in,fastq_out,10),5)
+        with open(fastq_out,'r') as fp:
+            self.assertEqual(fp.read(),fastq_r1)
+    def test_sample_fastq_gzipped(self):
+        """sample_fastq: handle gzipped input and output
+        """
+        fastq_in = os.path.join(self.wd,'test.fq.gz')
+        with gzip.GzipFile(fastq_in,'wb') as fp:
+            fp.write(fastq_r1)
+        fastq_out = os.path.join(self.wd,'out.fq.gz')
+        self.assertEqual(sample_fastq(fastq_in,fastq_out,10),5)
+        with gzip.GzipFile(fastq_out,'rb') as fp:
+            self.assertEqual(fp.read(),fastq_r1)
+
+class TestConcatFastqs(unittest.TestCase):
+    """
+    Tests for the concat_fastqs function
+    """
+    def setUp(self):
+        # Temporary working dir
+        self.wd = tempfile.mkdtemp(suffix='.test_concat_fastqs')
+        # Split test data into two gzipped files
+        lines = fastq_r1.split('\n')
+        self.data1 = '\n'.join(lines[:8])+'\n'
+        self.data2 = '\n'.join(lines[8:])
+        self.fastqs = []
+        for i,data in enumerate((self.data1,self.data2)):
+            fastq = os.path.join(self.wd,'test%d.fastq.gz' % (i+1))
+            fp = gzip.GzipFile(fastq,'wb')
+            fp.write(data)
+            fp.close()
+            self.fastqs.append(fastq)
+    def tearDown(self):
+        # Remove temporary working dir
+        if os.path.isdir(self.wd):
+            shutil.rmtree(self.wd)
+    def test_concat_gzipped_fastqs(self):
+        """concat_fastqs: join gzipped Fastqs as gzip members
+        """
+        fastq_out = os.path.join(self.wd,'out.fastq.gz')
+        concat_fastqs(self.fastqs,fastq_out)
+        # Output is the compressed inputs joined together
+        compressed = ''.join([open(fq,'rb').read() for fq in self.fastqs])
+        self.assertEqual(open(fastq_out,'rb').read(),compressed)
+        # Output decompresses to the concatenated reads
+        self.assertEqual(gzip.GzipFile(fastq_out,'rb').read(),
+                         self.data1+self.data2)
+    def test_concat_fastqs_output_exists(self):
+        """concat_fastqs: raise OSError if output already exists
+        """
+        fastq_out = os.path.join(self.wd,'out.fastq.gz')
+        open(fastq_out,'w').close()
+        self.assertRaises(OSError,concat_fastqs,self.fastqs,fastq_out)
+    def test_concat_mixed_fastqs_to_gzipped(self):
+        """concat_fastqs: join gzipped and uncompressed Fastqs into gzipped output
+        """
+        fastq2 = os.path.join(self.wd,'test2.fastq')
+        with open(fastq2,'w') as fp:
+            fp.write(self.data2)
+        fastq_out = os.path.join(self.wd,'out.fastq.gz')
+        concat_fastqs([self.fastqs[0],fastq2],fastq_out)
+        self.assertEqual(gzip.GzipFile(fastq_out,'rb').read(),
+                         self.data1+self.data2)
+        self.assertFalse(os.path.exists(fastq_out+'.part'))
+    def test_concat_gzipped_fastqs_to_uncompressed(self):
+        """concat_fastqs: join gzipped Fastqs into uncompressed output
+        """
+        fastq_out = os.path.join(self.wd,'out.fastq')
+        concat_fastqs(self.fastqs,fastq_out)
+        self.assertEqual(open(fastq_out,'r').read(),
+                         self.data1+self.data2)
+    def test_concat_fastqs_bad_gzip(self):
+        """concat_fastqs: raise IOError for truncated gzipped input
+        """
+        with open(self.fastqs[1],'wb') as fp:
+            fp.write('\x1f\x8b\x08')
+        fastq_out = os.path.join(self.wd,'out.fastq.gz')
+        self.assertRaises(IOError,concat_fastqs,self.fastqs,fastq_out)
+        self.assertFalse(os.path.exists(fastq_out))
+        self.assertFalse(os.path.exists(fastq_out+'.part'))
+
+class TestCheckGzipMember(unittest.TestCase):
+    """
+    Tests for the check_gzip_member function
+    """
+    def setUp(self):
+        # Temporary working dir
+        self.wd = tempfile.mkdtemp(suffix='.test_check_gzip_member')
+    def tearDown(self):
+        # Remove temporary working dir
+        if os.path.isdir(self.wd):
+            shutil.rmtree(self.wd)
+    def test_check_gzip_member(self):
+        """check_gzip_member: accept valid gzipped file
+        """
+        fastq = os.path.join(self.wd,'test.fastq.gz')
+        fp = gzip.GzipFile(fastq,'wb')
+        fp.write(fastq_r1)
+        fp.close()
+        self.assertEqual(check_gzip_member(fastq),None)
+    def test_check_gzip_member_truncated(self):
+        """check_gzip_member: raise IOError for truncated gzipped file
+        """
+        fastq = os.path.join(self.wd,'test.fastq.gz')
+        with open(fastq,'wb') as fp:
+            fp.write('\x1f\x8b\x08\x00')
+        self.assertRaises(IOError,check_gzip_member,fastq)
+    def test_check_gzip_member_not_gzipped(self):
+        """check_gzip_member: raise IOError for non-gzipped file
+        """
+        fastq = os.path.join(self.wd,'test.fastq.gz')
+        with open(fastq,'w') as fp:
+            fp.write(fastq_r1)
+        self.assertRaises(IOError,check_gzip_member,fastq)
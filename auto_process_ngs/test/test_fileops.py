@@ -8,6 +8,7 @@ import tempfile
 import shutil
 import pwd
 import grp
+import hashlib
 from auto_process_ngs.utils import ZipArchive
 from auto_process_ngs.fileops import *
 
@@ -174,3 +175,207 @@ class TestUnzip(unittest.TestCase):
         self.assertEqual(open(out_file).read(),
                          "This is a test file")
 
+
+class TestFileOpsSession(unittest.TestCase):
+    """Tests for the FileOpsSession class (using local system)
+    """
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.test_dir,'src')
+        os.mkdir(self.src_dir)
+        self.pwd = os.getcwd()
+    def tearDown(self):
+        os.chdir(self.pwd)
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+    def _make_file(self,name,content):
+        # Make a file in the source directory
+        filen = os.path.join(self.src_dir,name)
+        with open(filen,'w') as fp:
+            fp.write(content)
+        return filen
+    def test_session_mkdir_and_copy(self):
+        """fileops.FileOpsSession: make directories and copy files
+        """
+        test_file1 = self._make_file('test1.txt',"This is test file 1")
+        test_file2 = self._make_file('test2.txt',"This is test file 2")
+        out_dir = os.path.join(self.test_dir,'out')
+        sub_dir = os.path.join(out_dir,'sub')
+        session = FileOpsSession(self.test_dir)
+        self.assertFalse(session.is_remote)
+        session.mkdir(out_dir)
+        session.mkdir(sub_dir)
+        session.copy(test_file1,out_dir)
+        session.copy(test_file2,os.path.join(sub_dir,'renamed.txt'))
+        self.assertEqual(session.pending,4)
+        # Nothing happens until the operations are run
+        self.assertFalse(os.path.exists(out_dir))
+        session.run()
+        self.assertEqual(session.pending,0)
+        session.close()
+        self.assertTrue(os.path.isdir(sub_dir))
+        self.assertEqual(open(os.path.join(out_dir,'test1.txt')).read(),
+                         "This is test file 1")
+        self.assertEqual(open(os.path.join(sub_dir,'renamed.txt')).read(),
+                         "This is test file 2")
+    def test_session_copy_relative_destination(self):
+        """fileops.FileOpsSession: copy file to relative destination
+        """
+        test_file = self._make_file('test.txt',"This is a test file")
+        os.chdir(self.test_dir)
+        with FileOpsSession(self.test_dir) as session:
+            session.mkdir('out')
+            session.copy(test_file,'out')
+        self.assertEqual(open(os.path.join(self.test_dir,
+                                           'out','test.txt')).read(),
+                         "This is a test file")
+    def test_session_copy_and_unzip(self):
+        """fileops.FileOpsSession: copy and unzip a ZIP archive
+        """
+        test_file = self._make_file('test.txt',"This is a test file")
+        zip_file = os.path.join(self.test_dir,'test.zip')
+        z = ZipArchive(zip_file,
+                       contents=(test_file,),
+                       relpath=self.src_dir,
+                       prefix='files')
+        z.close()
+        out_dir = os.path.join(self.test_dir,'out')
+        with FileOpsSession(self.test_dir) as session:
+            session.mkdir(out_dir)
+            session.copy(zip_file,out_dir)
+            session.unzip(os.path.join(out_dir,'test.zip'),out_dir)
+        self.assertTrue(os.path.isfile(os.path.join(out_dir,'test.zip')))
+        out_file = os.path.join(out_dir,'files','test.txt')
+        self.assertTrue(os.path.isfile(out_file))
+        self.assertEqual(open(out_file).read(),"This is a test file")
+    def test_session_set_group(self):
+        """fileops.FileOpsSession: set group ownership on a directory
+        """
+        # Get a list of groups
+        current_user = pwd.getpwuid(os.getuid()).pw_name
+        groups = [g.gr_gid for g in grp.getgrall()
+                  if current_user in g.gr_mem]
+        if len(groups) < 2:
+            raise unittest.SkipTest("user '%s' must be in at least "
+                                    "two groups" % current_user)
+        test_file = self._make_file('test.txt',"This is a test file")
+        gid = os.stat(test_file).st_gid
+        new_gid = [g for g in groups if g != gid][0]
+        with FileOpsSession(self.test_dir) as session:
+            session.set_group(grp.getgrgid(new_gid).gr_name,self.src_dir)
+        self.assertEqual(os.stat(self.src_dir).st_gid,new_gid)
+        self.assertEqual(os.stat(test_file).st_gid,new_gid)
+    def test_session_failed_operation_raises_exception(self):
+        """fileops.FileOpsSession: raise exception if operation fails
+        """
+        session = FileOpsSession(self.test_dir)
+        session.unzip(os.path.join(self.test_dir,'missing.zip'),
+                      self.test_dir)
+        self.assertRaises(Exception,session.run)
+        self.assertEqual(session.pending,0)
+    def test_session_rejects_path_on_other_system(self):
+        """fileops.FileOpsSession: reject paths on a different system
+        """
+        session = FileOpsSession('user@remote.host:/data')
+        self.assertTrue(session.is_remote)
+        self.assertRaises(Exception,
+                          session.mkdir,
+                          'user@other.host:/data/new_dir')
+        session.mkdir('user@remote.host:/data/new_dir')
+        session.mkdir('/data/new_dir2')
+        self.assertEqual(session.pending,2)
+        session.close()
+    def test_session_copy_and_check_md5sums(self):
+        """fileops.FileOpsSession: checksum copies and check with md5sum
+        """
+        test_file1 = self._make_file('test1.txt',"This is test file 1")
+        test_file2 = self._make_file('test2.txt',"This is test file 2")
+        out_dir = os.path.join(self.test_dir,'out')
+        session = FileOpsSession(self.test_dir)
+        session.mkdir(out_dir)
+        session.copy(test_file1,out_dir)
+        session.copy(test_file2,out_dir)
+        session.run()
+        md5sums = session.md5sums
+        self.assertEqual(md5sums[test_file1],
+                         hashlib.md5("This is test file 1").hexdigest())
+        self.assertEqual(md5sums[test_file2],
+                         hashlib.md5("This is test file 2").hexdigest())
+        # Check the copies using md5sum
+        md5file = os.path.join(self.test_dir,'test.chksums')
+        with open(md5file,'w') as fp:
+            for f in (test_file1,test_file2):
+                fp.write("%s  %s\n" % (md5sums[f],os.path.basename(f)))
+        session.copy(md5file,out_dir)
+        session.check_md5sums(os.path.join(out_dir,'test.chksums'))
+        session.run()
+        # Check fails if a copy is corrupted
+        with open(os.path.join(out_dir,'test2.txt'),'w') as fp:
+            fp.write("This is corrupted")
+        session.check_md5sums(os.path.join(out_dir,'test.chksums'))
+        self.assertRaises(Exception,session.run)
+        session.close()
+    def test_session_fetch(self):
+        """fileops.FileOpsSession: fetch a copy of a file
+        """
+        test_file = self._make_file('test.txt',"This is a test file\n")
+        local_file = os.path.join(self.test_dir,'fetched.txt')
+        session = FileOpsSession(self.test_dir)
+        self.assertTrue(session.fetch(test_file,local_file))
+        self.assertEqual(open(local_file).read(),"This is a test file\n")
+        self.assertFalse(session.fetch(os.path.join(self.src_dir,'missing'),
+                                       os.path.join(self.test_dir,'missing')))
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir,'missing')))
+        session.close()
+
+class TestSyncDirFunction(unittest.TestCase):
+    """Tests for the 'sync_dir' function
+    """
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.test_dir,'src')
+        os.mkdir(self.src_dir)
+        os.mkdir(os.path.join(self.src_dir,'sub'))
+        for f in ('test1.txt','sub/test2.txt'):
+            with open(os.path.join(self.src_dir,f),'w') as fp:
+                fp.write("This is %s" % f)
+        self.dest_dir = os.path.join(self.test_dir,'dest')
+    def tearDown(self):
+        if os.path.exists(self.test_dir):
+            shutil.rmtree(self.test_dir)
+    def test_sync_dir(self):
+        """fileops.sync_dir: copy directory contents
+        """
+        copied = sync_dir(self.src_dir,self.dest_dir)
+        self.assertEqual(copied,['sub/test2.txt','test1.txt'])
+        for f in ('test1.txt','sub/test2.txt'):
+            self.assertEqual(open(os.path.join(self.dest_dir,f)).read(),
+                             "This is %s" % f)
+        self.assertTrue(os.path.isfile(os.path.join(self.dest_dir,
+                                                    SYNC_CHECKSUMS)))
+    def test_sync_dir_only_copies_changed_files(self):
+        """fileops.sync_dir: only copy new and changed files
+        """
+        sync_dir(self.src_dir,self.dest_dir)
+        # Update one file and add another
+        with open(os.path.join(self.src_dir,'test1.txt'),'w') as fp:
+            fp.write("This is an updated file")
+        with open(os.path.join(self.src_dir,'sub','test3.txt'),'w') as fp:
+            fp.write("This is a new file")
+        # Modify copy of the unchanged file so we can tell
+        # if it's overwritten
+        with open(os.path.join(self.dest_dir,'sub','test2.txt'),'w') as fp:
+            fp.write("Not overwritten")
+        copied = sync_dir(self.src_dir,self.dest_dir)
+        self.assertEqual(copied,['sub/test3.txt','test1.txt'])
+        self.assertEqual(open(os.path.join(self.dest_dir,
+                                           'test1.txt')).read(),
+                         "This is an updated file")
+        self.assertEqual(open(os.path.join(self.dest_dir,
+                                           'sub','test3.txt')).read(),
+                         "This is a new file")
+        self.assertEqual(open(os.path.join(self.dest_dir,
+                                           'sub','test2.txt')).read(),
+                         "Not overwritten")
+        # Nothing to copy if there are no changes
+        self.assertEqual(sync_dir(self.src_dir,self.dest_dir),[])
@@ -11,6 +11,7 @@ import platform
 import getpass
 from auto_process_ngs.simple_scheduler import SimpleScheduler
 from auto_process_ngs.applications import Command
+from auto_process_ngs.applications import resource_usage_wrapper
 from auto_process_ngs.pipeliner import Pipeline
 from auto_process_ngs.pipeliner import PipelineTask
 from auto_process_ngs.pipeliner import PipelineCommand
@@ -508,11 +509,12 @@ class TestPipelineCommand(unittest.TestCase):
                          "echo \"#### HOSTNAME $HOSTNAME\"\n"
                          "echo \"#### USER $USER\"\n"
                          "echo \"#### START $(date)\"\n"
-                         "echo hello there\n"
+                         "%s\n"
                          "exit_code=$?\n"
                          "echo \"#### END $(date)\"\n"
                          "echo \"#### EXIT_CODE $exit_code\"\n"
-                         "exit $exit_code")
+                         "exit $exit_code" %
+                         resource_usage_wrapper("echo hello there"))
 
 class TestPipelineCommandWrapper(unittest.TestCase):
 
@@ -19,6 +19,8 @@ class TestSettings(unittest.TestCase):
         # General settings
         self.assertTrue(isinstance(s.general.default_runner,SimpleJobRunner))
         self.assertEqual(s.general.max_concurrent_jobs,12)
+        self.assertEqual(s.general.scheduler_event_log,True)
+        self.assertEqual(s.general.checksum_threads,4)
         self.assertEqual(s.modulefiles.make_fastqs,None)
         self.assertEqual(s.modulefiles.run_qc,None)
         # Bcl2fastq
@@ -9,6 +9,7 @@ import time
 import logging
 import tempfile
 import shutil
+import threading
 from bcftbx.JobRunner import BaseJobRunner
 from bcftbx.JobRunner import SimpleJobRunner
 from auto_process_ngs.simple_scheduler import *
@@ -224,6 +225,36 @@ class TestSimpleScheduler(unittest.TestCase):
         self.assertTrue(sched.is_empty())
         sched.stop()
 
+    def test_simple_scheduler_run_multiple_jobs_with_runner_limit(self):
+        """Run several jobs with limit on concurrent jobs for a runner
+
+        """
+        limited_runner = MockJobRunner()
+        sched = SimpleScheduler(runner=MockJobRunner(),poll_interval=0.01)
+        sched.set_runner_limit(limited_runner,1)
+        sched.start()
+        job_1 = sched.submit(['sleep','10'],runner=limited_runner)
+        job_2 = sched.submit(['sleep','20'],runner=limited_runner)
+        job_3 = sched.submit(['sleep','30'])
+        # Wait for scheduler to catch up
+        time.sleep(0.1)
+        self.assertEqual(sched.n_waiting,1)
+        self.assertEqual(sched.n_running,2)
+        self.assertEqual(job_2.job_id,None)
+        # Finish job on limited runner, wait for scheduler to catch up
+        job_1.terminate()
+        time.sleep(0.1)
+        self.assertEqual(sched.n_waiting,0)
+        self.assertEqual(sched.n_running,2)
+        self.assertNotEqual(job_2.job_id,None)
+        # Finish remaining jobs, wait for scheduler to catch up
+        job_2.terminate()
+        job_3.terminate()
+        time.sleep(0.1)
+        self.assertEqual(sched.n_finished,3)
+        self.assertTrue(sched.is_empty())
+        sched.stop()
+
     def test_simple_scheduler_run_dependent_jobs(self):
         """Run several jobs with one dependent on another
 
@@ -566,6 +597,35 @@ class TestSimpleScheduler(unittest.TestCase):
         self.assertTrue(sched.is_empty())
         sched.stop()
 
+    def test_scheduler_not_empty_while_callback_pending(self):
+        """Scheduler isn't empty until ready callbacks are invoked
+
+        """
+        sched = SimpleScheduler(runner=MockJobRunner(),poll_interval=0.01)
+        sched.start()
+        # Add a job with a callback which blocks until
+        # released
+        release = threading.Event()
+        def blocking_callback(name,jobs,sched):
+            release.wait()
+        job = sched.submit(['sleep','50'],callbacks=(blocking_callback,))
+        # Wait for scheduler to catch up
+        time.sleep(0.1)
+        self.assertEqual(sched.n_pending_callbacks,0)
+        self.assertFalse(sched.is_empty())
+        # Finish job, wait for scheduler to catch up
+        job.terminate()
+        time.sleep(0.1)
+        self.assertEqual(sched.n_running,0)
+        self.assertEqual(sched.n_pending_callbacks,1)
+        self.assertFalse(sched.is_empty())
+        # Release the callback
+        release.set()
+        time.sleep(0.1)
+        self.assertEqual(sched.n_pending_callbacks,0)
+        self.assertTrue(sched.is_empty())
+        sched.stop()
+
     def test_set_job_working_dir(self):
         """Explicitly specify working directory for a job
 
@@ -610,6 +670,33 @@ class TestSimpleScheduler(unittest.TestCase):
         self.assertTrue(sched.is_empty())
         sched.stop()
 
+    def test_job_resource_usage(self):
+        """Record resource usage for jobs run via the scheduler
+
+        """
+        log_dir = tempfile.mkdtemp(suffix='.test_job_resource_usage')
+        try:
+            sched = SimpleScheduler(
+                runner=SimpleJobRunner(join_logs=True),
+                poll_interval=0.01,
+                resource_usage=True)
+            sched.start()
+            job = sched.submit(['echo','hello there'],log_dir=log_dir)
+            job.wait(poll_interval=0.1)
+            sched.stop()
+            # Command line reported for the job is unchanged
+            self.assertEqual(str(job),"echo hello there")
+            # Job ran via a wrapper script in the log dir
+            self.assertEqual(job.script,'/bin/bash')
+            self.assertEqual(os.path.dirname(job.args[0]),log_dir)
+            self.assertEqual(job.exit_code,0)
+            # Output and resource usage are in the log
+            with open(job.log,'r') as fp:
+                self.assertEqual(fp.readline(),"hello there\n")
+            self.assertNotEqual(job.resource_usage,None)
+        finally:
+            shutil.rmtree(log_dir)
+
     def test_set_group_log_dir(self):
         """Explicitly specify log directory for a group
 
@@ -970,3 +1057,139 @@ class TestSchedulerReporter(unittest.TestCase):
         job.terminate()
         reporter.group_end(group)
         self.assertEqual('Group completed: #1: "test"\n',fp.getvalue())
+
+    def test_scheduler_reporter_event_log(self):
+        """SchedulerReporter writes events to event log
+        """
+        wd = tempfile.mkdtemp(suffix='.test_scheduler_reporter')
+        try:
+            event_log = os.path.join(wd,'events.ndjson')
+            fp = cStringIO.StringIO()
+            reporter = SchedulerReporter(fp=fp,event_log=event_log)
+            job = SchedulerJob(MockJobRunner(),['sleep','50'],
+                               job_number=2,name='test',wait_for=[])
+            reporter.job_scheduled(job)
+            job.start()
+            reporter.job_start(job)
+            job.terminate()
+            reporter.job_end(job)
+            # No templates so nothing written to stream
+            self.assertEqual('',fp.getvalue())
+            # Events written to event log
+            events,offset = read_scheduler_events(event_log)
+            self.assertEqual([e['event'] for e in events],
+                             ['job_scheduled','job_start','job_end'])
+            self.assertEqual(events[1]['job_name'],'test')
+            self.assertEqual(events[1]['job_number'],2)
+            self.assertEqual(events[1]['job_id'],'1')
+            self.assertEqual(events[1]['runner'],'MockJobRunner')
+            self.assertTrue('exit_status' in events[2])
+            self.assertTrue(isinstance(events[0]['time'],float))
+            self.assertEqual(offset,os.path.getsize(event_log))
+        finally:
+            shutil.rmtree(wd)
+
+class TestReadSchedulerEvents(unittest.TestCase):
+    """Unit tests for read_scheduler_events function
+
+    """
+    def setUp(self):
+        self.wd = tempfile.mkdtemp(suffix='.test_read_scheduler_events')
+        self.event_log = os.path.join(self.wd,'events.ndjson')
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+
+    def test_read_scheduler_events_tail(self):
+        """read_scheduler_events reads new events from offset
+        """
+        with open(self.event_log,'w') as fp:
+            fp.write('{"event": "job_scheduled", "time": 1.0}\n')
+        events,offset = read_scheduler_events(self.event_log)
+        self.assertEqual(len(events),1)
+        with open(self.event_log,'a') as fp:
+            fp.write('{"event": "job_start", "time": 2.0}\n')
+        events,offset = read_scheduler_events(self.event_log,offset)
+        self.assertEqual(events,[{'event':'job_start','time':2.0}])
+
+    def test_read_scheduler_events_partial_line(self):
+        """read_scheduler_events ignores partially written lines
+        """
+        with open(self.event_log,'w') as fp:
+            fp.write('{"event": "job_scheduled", "time": 1.0}\n'
+                     'not json\n'
+                     '{"event": "job_st')
+        events,offset = read_scheduler_events(self.event_log)
+        self.assertEqual(len(events),1)
+        with open(self.event_log,'a') as fp:
+            fp.write('art", "time": 2.0}\n')
+        events,offset = read_scheduler_events(self.event_log,offset)
+        self.assertEqual(events,[{'event':'job_start','time':2.0}])
+
+class TestSchedulerEventSummary(unittest.TestCase):
+    """Unit tests for SchedulerEventSummary class
+
+    """
+    def test_scheduler_event_summary(self):
+        """SchedulerEventSummary summarises job events
+        """
+        summary = SchedulerEventSummary()
+        for event in ({'event':'job_scheduled','time':0.0},
+                      {'event':'job_scheduled','time':0.0},
+                      {'event':'job_scheduled','time':0.0},
+                      {'event':'job_start','time':10.0},
+                      {'event':'job_start','time':10.0},
+                      {'event':'job_end','time':30.0,'exit_status':0},
+                      {'event':'job_end','time':60.0,'exit_status':1},):
+            summary.update(event)
+        self.assertEqual(summary.n_scheduled,3)
+        self.assertEqual(summary.n_waiting,1)
+        self.assertEqual(summary.n_running,0)
+        self.assertEqual(summary.n_finished,2)
+        self.assertEqual(summary.n_failed,1)
+        self.assertEqual(summary.throughput(),2.0)
+        self.assertEqual(summary.eta(),30.0)
+        self.assertEqual(summary.report(),
+                         "0 running, 1 waiting, 2 finished (1 failed); "
+                         "2.00 jobs/min; ETA 00:00:30")
+
+    def test_scheduler_event_summary_no_events(self):
+        """SchedulerEventSummary handles no events
+        """
+        summary = SchedulerEventSummary()
+        self.assertEqual(summary.throughput(),None)
+        self.assertEqual(summary.eta(),0.0)
+        self.assertEqual(summary.report(),
+                         "0 running, 0 waiting, 0 finished (0 failed); "
+                         "? jobs/min; ETA 00:00:00")
+
+class TestSummariseResourceUsage(unittest.TestCase):
+    """Unit tests for summarise_resource_usage function
+
+    """
+    def test_summarise_resource_usage(self):
+        """summarise_resource_usage summarises usage for jobs
+        """
+        class MockJob(object):
+            def __init__(self,usage):
+                self.resource_usage = usage
+        jobs = [MockJob({ 'wall_time': 10.0,
+                          'cpu_time': 8.0,
+                          'peak_rss': None }),
+                MockJob(None),
+                MockJob({ 'wall_time': 30.0,
+                          'cpu_time': 25.5,
+                          'peak_rss': 2048 }),]
+        self.assertEqual(summarise_resource_usage(jobs),
+                         { 'n_jobs': 2,
+                           'total_cpu_time': 33.5,
+                           'max_wall_time': 30.0,
+                           'max_peak_rss': 2048 })
+
+    def test_summarise_resource_usage_no_data(self):
+        """summarise_resource_usage handles jobs with no usage data
+        """
+        self.assertEqual(summarise_resource_usage([]),
+                         { 'n_jobs': 0,
+                           'total_cpu_time': 0.0,
+                           'max_wall_time': 0.0,
+                           'max_peak_rss': None })
@@ -288,6 +288,31 @@ class TestAnalysisFastq(unittest.TestCase):
         self.assertFalse(fq.is_index_read)
         self.assertEqual(str(fq),'NH1_ChIP-seq_Gli1_ACAGTG_L003_R2_001')
 
+class TestFastqNameAttrs(unittest.TestCase):
+
+    def test_fastq_name_attrs(self):
+        """FastqNameAttrs: store attributes
+        """
+        attrs = FastqNameAttrs('NH1',sample_number=4,lane_number=3,
+                               read_number=2,set_number=1)
+        self.assertEqual(attrs.sample_name,'NH1')
+        self.assertEqual(attrs.sample_number,4)
+        self.assertEqual(attrs.barcode_sequence,None)
+        self.assertEqual(attrs.lane_number,3)
+        self.assertEqual(attrs.read_number,2)
+        self.assertEqual(attrs.set_number,1)
+        self.assertFalse(attrs.is_index_read)
+        self.assertEqual(attrs.delimiter,'_')
+
+    def test_fastq_name_attrs_are_immutable(self):
+        """FastqNameAttrs: attributes can't be changed or added
+        """
+        attrs = FastqNameAttrs('NH1')
+        self.assertRaises(AttributeError,setattr,attrs,'sample_name','NH2')
+        self.assertRaises(AttributeError,setattr,attrs,'extra','value')
+        self.assertRaises(AttributeError,delattr,attrs,'sample_name')
+        self.assertEqual(attrs.sample_name,'NH1')
+
 class TestAnalysisDir(unittest.TestCase):
     """Tests for the AnalysisDir class
 
@@ -353,6 +378,63 @@ class TestAnalysisDir(unittest.TestCase):
         self.assertEqual(analysis_dir.n_projects,2)
         self.assertTrue(analysis_dir.paired_end)
 
+    def test_get_projects_with_pattern(self):
+        """Check AnalysisDir.get_projects with a pattern
+        """
+        mockdir = MockAnalysisDirFactory.bcl2fastq2(
+            '160621_M00879_0087_000000000-AGEW9',
+            'miseq',
+            top_dir=self.dirn)
+        mockdir.create()
+        analysis_dir = AnalysisDir(mockdir.dirn)
+        projects = analysis_dir.get_projects('CD*')
+        self.assertEqual([p.name for p in projects],['CDE'])
+        self.assertEqual([s.name for s in projects[0].samples],
+                         ['CDE3','CDE4'])
+        self.assertEqual([p.name for p in
+                          analysis_dir.get_projects('undetermined')],
+                         ['undetermined'])
+        self.assertEqual(analysis_dir.get_projects('XYZ'),[])
+        # Full scan reuses the already examined subdirectories
+        self.assertEqual(analysis_dir.n_projects,2)
+        self.assertTrue(projects[0] in analysis_dir.projects)
+
+    def test_list_projects(self):
+        """Check AnalysisDir.list_projects returns lazy projects
+        """
+        mockdir = MockAnalysisDirFactory.bcl2fastq2(
+            '160621_M00879_0087_000000000-AGEW9',
+            'miseq',
+            top_dir=self.dirn)
+        mockdir.create()
+        analysis_dir = AnalysisDir(mockdir.dirn)
+        projects = analysis_dir.list_projects()
+        self.assertEqual([p.name for p in projects],['AB','CDE'])
+        self.assertEqual([p.name for p in analysis_dir.list_projects('AB')],
+                         ['AB'])
+        # Projects are only populated on access
+        project = projects[0]
+        self.assertFalse('samples' in project.__dict__)
+        self.assertEqual([s.name for s in project.samples],['AB1','AB2'])
+        self.assertEqual(project.fastq_dir,
+                         os.path.join(project.dirn,'fastqs'))
+
+    def test_undetermined_without_scan(self):
+        """Check AnalysisDir.undetermined only examines 'undetermined'
+        """
+        mockdir = MockAnalysisDirFactory.bcl2fastq2(
+            '160621_M00879_0087_000000000-AGEW9',
+            'miseq',
+            top_dir=self.dirn)
+        mockdir.create()
+        analysis_dir = AnalysisDir(mockdir.dirn)
+        self.assertEqual(analysis_dir.undetermined.name,'undetermined')
+        self.assertEqual(analysis_dir._subdirs.keys(),['undetermined'])
+        # Full scan returns the same project
+        self.assertEqual(analysis_dir.n_projects,2)
+        self.assertTrue(analysis_dir.undetermined is
+                        analysis_dir._subdirs['undetermined'][1])
+
 class TestAnalysisProject(unittest.TestCase):
     """Tests for the AnalysisProject class
 
@@ -819,6 +901,44 @@ class TestAnalysisProject(unittest.TestCase):
         self.assertRaises(Exception,
                           project.use_fastq_dir,'fastqs.non_existant')
 
+    def test_lazy_analysis_project(self):
+        """Check AnalysisProject only populates lazy project on access
+        """
+        self.make_mock_project_dir(
+            'PJB',
+            ('PJB1-A_ACAGTG_L001_R1_001.fastq.gz',
+             'PJB1-B_ACAGTG_L002_R1_001.fastq.gz',))
+        dirn = os.path.join(self.dirn,'PJB')
+        project = AnalysisProject('PJB',dirn,user='Peter Briggs',lazy=True)
+        self.assertEqual(project.info.primary_fastq_dir,'fastqs')
+        self.assertEqual(project.info.user,'Peter Briggs')
+        self.assertFalse('samples' in project.__dict__)
+        self.assertEqual(project.fastq_dirs,['fastqs',])
+        self.assertEqual(project.samples[0].name,'PJB1-A')
+        self.assertEqual(project.samples[1].name,'PJB1-B')
+        self.assertEqual(project.qc_dir,os.path.join(project.dirn,'qc'))
+        self.assertEqual(project.info.user,'Peter Briggs')
+
+    def test_get_sample(self):
+        """Check AnalysisProject.get_sample returns the matching sample
+        """
+        self.make_mock_project_dir(
+            'PJB',
+            ('PJB1-B_ACAGTG_L002_R1_001.fastq.gz',
+             'PJB1-A_ACAGTG_L001_R1_001.fastq.gz',
+             'PJB1-A_ACAGTG_L001_R2_001.fastq.gz',))
+        dirn = os.path.join(self.dirn,'PJB')
+        project = AnalysisProject('PJB',dirn)
+        self.assertEqual([s.name for s in project.samples],
+                         ['PJB1-A','PJB1-B'])
+        self.assertEqual(project.get_sample('PJB1-B').name,'PJB1-B')
+        self.assertEqual(len(project.get_sample('PJB1-A').fastq),2)
+        self.assertRaises(KeyError,project.get_sample,'PJB1-C')
+        # Samples added directly to the list should also be found
+        sample = AnalysisSample('PJB1-C')
+        project.samples.append(sample)
+        self.assertEqual(project.get_sample('PJB1-C'),sample)
+
 class TestAnalysisSample(unittest.TestCase):
     """Tests for the AnalysisSample class
 
@@ -1068,6 +1188,76 @@ class TestMetadataDict(unittest.TestCase):
         self.assertEqual(metadata.valediction,'goodbye')
         self.assertEqual(metadata.chit_chat,'stuff')
 
+    def test_modified_flag(self):
+        """Check metadata tracks whether data have been modified
+        """
+        self.metadata_file = tempfile.mkstemp()[1]
+        metadata = MetadataDict(attributes={'salutation':'Salutation',
+                                            'valediction': 'Valediction'})
+        self.assertFalse(metadata.modified)
+        metadata['salutation'] = 'hello'
+        self.assertTrue(metadata.modified)
+        metadata.save(self.metadata_file)
+        self.assertFalse(metadata.modified)
+        metadata['salutation'] = 'hello'
+        self.assertFalse(metadata.modified)
+        metadata.load(self.metadata_file)
+        self.assertFalse(metadata.modified)
+
+    def test_unmodified_data_not_saved(self):
+        """Check unmodified metadata isn't rewritten to file
+        """
+        self.metadata_file = tempfile.mkstemp()[1]
+        with open(self.metadata_file,'w') as fp:
+            fp.write("Salutation\thello\n")
+        metadata = MetadataDict(attributes={'salutation':'Salutation',
+                                            'valediction': 'Valediction'},
+                                filen=self.metadata_file)
+        # Change the file behind the metadata object
+        with open(self.metadata_file,'w') as fp:
+            fp.write("Salutation\thi\n")
+        # Saving unmodified data shouldn't rewrite the file
+        metadata.save()
+        self.assertEqual(open(self.metadata_file,'rU').read(),
+                         "Salutation\thi\n")
+        # Unless it's forced
+        metadata.save(force=True)
+        self.assertEqual(open(self.metadata_file,'rU').read(),
+                         "Salutation\thello\nValediction\t.\n")
+
+    def test_batch_updates(self):
+        """Check saves are deferred until the end of a batch
+        """
+        self.metadata_file = tempfile.mkstemp()[1]
+        metadata = MetadataDict(attributes={'salutation':'Salutation',
+                                            'valediction': 'Valediction'})
+        with metadata.batch_updates():
+            metadata['salutation'] = 'hello'
+            metadata.save(self.metadata_file)
+            self.assertEqual(open(self.metadata_file,'rU').read(),"")
+            metadata['valediction'] = 'goodbye'
+            metadata.save(self.metadata_file)
+            self.assertEqual(open(self.metadata_file,'rU').read(),"")
+        self.assertEqual(open(self.metadata_file,'rU').read(),
+                         "Salutation\thello\nValediction\tgoodbye\n")
+        self.assertFalse(metadata.modified)
+
+    def test_batch_updates_discarded_on_exception(self):
+        """Check deferred saves are discarded if batch fails
+        """
+        self.metadata_file = tempfile.mkstemp()[1]
+        metadata = MetadataDict(attributes={'salutation':'Salutation',
+                                            'valediction': 'Valediction'})
+        try:
+            with metadata.batch_updates():
+                metadata['salutation'] = 'hello'
+                metadata.save(self.metadata_file)
+                raise Exception("Failed")
+        except Exception:
+            pass
+        self.assertEqual(open(self.metadata_file,'rU').read(),"")
+        self.assertTrue(metadata.modified)
+
 class TestAnalysisDirParameters(unittest.TestCase):
     """Tests for the AnalysisDirParameters class
 
@@ -1287,6 +1477,105 @@ class TestProjectMetadataFile(unittest.TestCase):
         self.assertEqual(project[4],"Yeast")
         self.assertEqual(project[5],"Marley")
 
+class TestLinkPlanner(unittest.TestCase):
+    """Tests for the LinkPlanner class
+
+    """
+    def setUp(self):
+        # Create a temporary working dir
+        self.wd = tempfile.mkdtemp(suffix='.test_LinkPlanner')
+        # Make source files and target dir
+        self.src_dir = os.path.join(self.wd,'src')
+        self.dest_dir = os.path.join(self.wd,'dest')
+        os.mkdir(self.src_dir)
+        os.mkdir(self.dest_dir)
+        self.sources = []
+        for name in ('PJB1_S1_R1_001.fastq.gz',
+                     'PJB1_S1_R2_001.fastq.gz',
+                     'PJB2_S2_R1_001.fastq.gz',
+                     'PJB2_S2_R2_001.fastq.gz',):
+            src = os.path.join(self.src_dir,name)
+            with open(src,'w') as fp:
+                fp.write("%s\n" % name)
+            self.sources.append(src)
+
+    def tearDown(self):
+        # Remove temporary working dir
+        if os.path.isdir(self.wd):
+            shutil.rmtree(self.wd)
+
+    def _make_planner(self,symlink=False):
+        planner = LinkPlanner(symlink=symlink)
+        for src in self.sources:
+            planner.add(src,os.path.join(self.dest_dir,
+                                         os.path.basename(src)))
+        return planner
+
+    def test_make_hard_links(self):
+        """LinkPlanner: make hard links
+        """
+        planner = self._make_planner()
+        self.assertEqual([op[2] for op in planner.plan()],['link']*4)
+        self.assertEqual(planner.execute(nthreads=2),0)
+        for src in self.sources:
+            target = os.path.join(self.dest_dir,os.path.basename(src))
+            self.assertFalse(os.path.islink(target))
+            self.assertTrue(os.path.samefile(src,target))
+        self.assertEqual(planner.summary(),
+                         "created 4, skipped 0, conflicts 0, failed 0")
+
+    def test_make_symlinks(self):
+        """LinkPlanner: make relative symbolic links
+        """
+        planner = self._make_planner(symlink=True)
+        self.assertEqual(planner.execute(nthreads=2),0)
+        for src in self.sources:
+            target = os.path.join(self.dest_dir,os.path.basename(src))
+            self.assertTrue(os.path.islink(target))
+            self.assertEqual(os.readlink(target),
+                             os.path.join('..','src',os.path.basename(src)))
+
+    def test_skip_existing_links_and_flag_conflicts(self):
+        """LinkPlanner: skip identical links and flag conflicts
+        """
+        os.link(self.sources[0],
+                os.path.join(self.dest_dir,
+                             os.path.basename(self.sources[0])))
+        with open(os.path.join(self.dest_dir,
+                               os.path.basename(self.sources[1])),
+                  'w') as fp:
+            fp.write("Different file\n")
+        planner = self._make_planner()
+        self.assertEqual([op[2] for op in planner.plan()],
+                         ['skip','conflict','link','link'])
+        self.assertEqual(planner.execute(),0)
+        self.assertEqual(planner.summary(),
+                         "created 2, skipped 1, conflicts 1, failed 0")
+        # Conflicting file is left unchanged
+        self.assertEqual(open(os.path.join(
+            self.dest_dir,os.path.basename(self.sources[1])),'rU').read(),
+                         "Different file\n")
+
+    def test_dry_run(self):
+        """LinkPlanner: dry run doesn't make links
+        """
+        planner = self._make_planner()
+        self.assertEqual(planner.execute(dry_run=True),0)
+        self.assertEqual(os.listdir(self.dest_dir),[])
+
+    def test_report_failures(self):
+        """LinkPlanner: report number of links which failed
+        """
+        planner = LinkPlanner()
+        planner.add(os.path.join(self.src_dir,'missing.fastq.gz'),
+                    os.path.join(self.dest_dir,'missing.fastq.gz'))
+        planner.add(self.sources[0],
+                    os.path.join(self.dest_dir,
+                                 os.path.basename(self.sources[0])))
+        self.assertEqual(planner.execute(),1)
+        self.assertEqual(planner.summary(),
+                         "created 1, skipped 0, conflicts 0, failed 1")
+
 class TestZipArchive(unittest.TestCase):
     """
     Tests for the ZipArchive class
@@ -1460,6 +1749,155 @@ class TestOutputFiles(unittest.TestCase):
         out.open('test2',append=True)
         self.assertEqual(len(out),1)
 
+class TestAtomicWrite(unittest.TestCase):
+
+    def setUp(self):
+        # Create a temporary working dir
+        self.wd = tempfile.mkdtemp(suffix='.test_atomic_write')
+
+    def tearDown(self):
+        # Remove temporary working dir
+        if os.path.isdir(self.wd):
+            shutil.rmtree(self.wd)
+
+    def test_atomic_write(self):
+        """atomic_write: write new file
+        """
+        filen = os.path.join(self.wd,'test.txt')
+        with atomic_write(filen) as fp:
+            fp.write("hello\n")
+        self.assertEqual(open(filen,'rU').read(),"hello\n")
+        self.assertEqual(os.listdir(self.wd),['test.txt'])
+
+    def test_atomic_write_preserves_permissions(self):
+        """atomic_write: preserve permissions of existing file
+        """
+        filen = os.path.join(self.wd,'test.txt')
+        with open(filen,'w') as fp:
+            fp.write("hello\n")
+        os.chmod(filen,0640)
+        with atomic_write(filen) as fp:
+            fp.write("goodbye\n")
+        self.assertEqual(open(filen,'rU').read(),"goodbye\n")
+        self.assertEqual(os.stat(filen).st_mode & 0777,0640)
+
+    def test_atomic_write_leaves_file_unchanged_on_failure(self):
+        """atomic_write: leave existing file unchanged on failure
+        """
+        filen = os.path.join(self.wd,'test.txt')
+        with open(filen,'w') as fp:
+            fp.write("hello\n")
+        try:
+            with atomic_write(filen) as fp:
+                fp.write("goodbye\n")
+                raise Exception("Failed")
+        except Exception:
+            pass
+        self.assertEqual(open(filen,'rU').read(),"hello\n")
+        self.assertEqual(os.listdir(self.wd),['test.txt'])
+
+class TestLruCache(unittest.TestCase):
+
+    def test_lru_cache(self):
+        """lru_cache: cache results of function calls
+        """
+        calls = []
+        @lru_cache(maxsize=2)
+        def square(x):
+            calls.append(x)
+            return x*x
+        self.assertEqual(square(2),4)
+        self.assertEqual(square(2),4)
+        self.assertEqual(calls,[2])
+        self.assertEqual(square.cache_info(),(1,1,2,1))
+
+    def test_lru_cache_discards_least_recently_used(self):
+        """lru_cache: discard least recently used result when full
+        """
+        calls = []
+        @lru_cache(maxsize=2)
+        def square(x):
+            calls.append(x)
+            return x*x
+        square(1)
+        square(2)
+        square(1)
+        square(3)
+        self.assertEqual(square.cache_info()[3],2)
+        square(1)
+        self.assertEqual(calls,[1,2,3])
+        square(2)
+        self.assertEqual(calls,[1,2,3,2])
+
+    def test_lru_cache_clear(self):
+        """lru_cache: clear the cache
+        """
+        @lru_cache(maxsize=2)
+        def square(x):
+            return x*x
+        square(2)
+        square.cache_clear()
+        self.assertEqual(square.cache_info(),(0,0,2,0))
+
+    def test_lru_cache_doesnt_cache_exceptions(self):
+        """lru_cache: exceptions aren't cached
+        """
+        calls = []
+        @lru_cache(maxsize=2)
+        def fail(x):
+            calls.append(x)
+            raise ValueError(x)
+        self.assertRaises(ValueError,fail,1)
+        self.assertRaises(ValueError,fail,1)
+        self.assertEqual(calls,[1,1])
+
+    def test_lru_cache_bad_maxsize(self):
+        """lru_cache: raise ValueError if maxsize is less than 1
+        """
+        self.assertRaises(ValueError,lru_cache,0)
+
+class TestParseFastqName(unittest.TestCase):
+
+    def test_parse_fastq_name(self):
+        """parse_fastq_name: parse Illumina-style name
+        """
+        attrs = parse_fastq_name('NH1_ChIP-seq_Gli1_ACAGTG-GTTCAC_L003_R2_001')
+        self.assertEqual(attrs.sample_name,'NH1_ChIP-seq_Gli1')
+        self.assertEqual(attrs.sample_number,None)
+        self.assertEqual(attrs.barcode_sequence,'ACAGTG-GTTCAC')
+        self.assertEqual(attrs.lane_number,3)
+        self.assertEqual(attrs.read_number,2)
+        self.assertEqual(attrs.set_number,1)
+        self.assertFalse(attrs.is_index_read)
+        self.assertEqual(attrs.delimiter,'_')
+
+    def test_parse_fastq_name_non_standard(self):
+        """parse_fastq_name: parse non-standard dot-separated name
+        """
+        attrs = parse_fastq_name('NH1_ChIP-seq.ACAGTG.r2')
+        self.assertEqual(attrs.sample_name,'NH1_ChIP-seq')
+        self.assertEqual(attrs.barcode_sequence,'ACAGTG')
+        self.assertEqual(attrs.read_number,2)
+        self.assertEqual(attrs.delimiter,'.')
+
+    def test_parse_fastq_name_is_cached(self):
+        """parse_fastq_name: repeated calls return the same instance
+        """
+        attrs = parse_fastq_name('ES_exp1_S4_L003_I1_001')
+        self.assertTrue(parse_fastq_name('ES_exp1_S4_L003_I1_001') is attrs)
+        self.assertEqual(attrs.sample_number,4)
+        self.assertTrue(attrs.is_index_read)
+
+    def test_analysis_fastq_attributes_are_independent(self):
+        """parse_fastq_name: changing AnalysisFastq doesn't affect cache
+        """
+        fq1 = AnalysisFastq('/data/PJB1_S1_R1_001.fastq.gz')
+        fq1.read_number = 2
+        fq2 = AnalysisFastq('/data/PJB1_S1_R1_001.fastq.gz')
+        self.assertEqual(fq2.read_number,1)
+        self.assertEqual(str(fq1),'PJB1_S1_R2_001')
+        self.assertEqual(str(fq2),'PJB1_S1_R1_001')
+
 class TestBasesMaskIsPairedEnd(unittest.TestCase):
     """Tests for the bases_mask_is_paired_end function
 
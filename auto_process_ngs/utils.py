@@ -22,6 +22,7 @@ Classes:
 
 - BaseFastqAttrs
 - AnalysisFastq:
+- FastqNameAttrs:
 - AnalysisDir:
 - AnalysisProject:
 - AnalysisSample:
@@ -32,9 +33,13 @@ Classes:
 - ProjectMetadataFile:
 - ZipArchive:
 - OutputFiles:
+- LinkPlanner:
 
 Functions:
 
+- lru_cache:
+- parse_fastq_name:
+- atomic_write:
 - bases_mask_is_paired_end:
 - split_user_host_dir:
 - get_numbered_subdir:
@@ -57,7 +62,12 @@ import logging
 import zipfile
 import pydoc
 import tempfile
+import threading
 import operator
+import stat
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 import applications
 import bcftbx.IlluminaData as IlluminaData
 import bcftbx.TabFile as TabFile
@@ -76,6 +86,16 @@ from pkg_resources import parse_version
 # Module specific logger
 logger = logging.getLogger(__name__)
 
+#######################################################################
+# Constants
+#######################################################################
+
+# Maximum number of parsed Fastq names to cache
+FASTQ_NAME_CACHE_SIZE = 10000
+
+# Characters allowed in barcode sequences
+_BARCODE_SEQUENCE_CHARS = frozenset('ACGTN-')
+
 #######################################################################
 # Classes
 #######################################################################
@@ -212,107 +232,18 @@ class AnalysisFastq(BaseFastqAttrs):
 
         """
         BaseFastqAttrs.__init__(self,fastq)
-        # Base name for sample (no leading path or extension)
-        fastq_base = self.basename
-        # Determine if it's a non-standard (dot-separated) name
-        #
-        # These are names of the form e.g.
-        # NH1.2.r2
-        # or
-        # NH1_ChIP-seq.ACAGTG.r2
-        if fastq_base.count('.') > 0:
-            self.delimiter = '.'
-            fields = fastq_base.split('.')
-            field = fields[-1]
-            if len(field) == 2 and field.startswith('r'):
-                # Read number
-                self.read_number = int(field[1])
-                fields = fields[:-1]
-                field = fields[-1]
-            if len(fields) > 1:
-                # Barcode sequence
-                is_tag = True
-                for f in field.split('-'):
-                    for c in f:
-                        is_tag = is_tag and c in 'ACGTN'
-                if is_tag:
-                    self.barcode_sequence = field
-                    fields = fields[:-1]
-                    field = fields[-1]
-            # Remaining fields are the sample name
-            self.sample_name = '.'.join(fields)
-            assert(self.sample_name != '')
-            return
-        # Some form of Illumina-derived name
-        #
-        # Full Illumina-style names are e.g.
-        # NH1_ChIP-seq_Gli1_ACAGTG_L001_R1_001
-        # or
-        # NH1_ChIP-seq_Gli1_S4_L003_R2_001
-        #
-        # We have shorter name formats where redundant parts are
-        # omitted, the patterns are:
-        # NAME          e.g. NH1_ChIP-seq_Gli1
-        # NAME+LANE     e.g. NH1_ChIP-seq_Gli1_L001
-        # NAME+TAG      e.g. NH1_ChIP-seq_Gli1_ACAGTG
-        # NAME+TAG+LANE e.g. NH1_ChIP-seq_Gli1_ACAGTG_L001
-        #
-        # Also read number (i.e. R1 or R2) is appended but only for
-        # paired end samples
-        #
-        # The set number is never included, except for full names
-        fields = fastq_base.split('_')
-        self.delimiter = '_'
-        # Deal with set number first e.g. 001
-        field = fields[-1]
-        ##logger.debug("Test for set number %s" % field)
-        if len(field) == 3 and field.isdigit():
-            self.set_number = int(field)
-            fields = fields[:-1]
-        # Deal with trailing read number e.g. R1
-        field = fields[-1]
-        ##logger.debug("Test for read number %s" % field)
-        if len(field) == 2:
-            if field.startswith('R'):
-                self.read_number = int(field[1])
-                fields = fields[:-1]
-            elif field.startswith('I'):
-                self.read_number = int(field[1])
-                self.is_index_read = True
-                fields = fields[:-1]
-        # Deal with trailing lane number e.g. L001
-        field = fields[-1]
-        ##logger.debug("Test for lane number %s" % field)
-        if len(field) == 4 and field.startswith('L') and field[1:].isdigit():
-            self.lane_number = int(field[1:])
-            fields = fields[:-1]
-        # Deal with trailing index tag e.g. ATTGCT or ATTGCT-CCTAAG
-        field = fields[-1]
-        ##logger.debug("Test for barcode sequence %s" % field)
-        if len(fields) > 1:
-            # This mustn't be the last field: if it is then it's
-            # not the tag - it's the name
-            is_tag = True
-            for f in field.split('-'):
-                for c in f:
-                    is_tag = is_tag and c in 'ACGTN'
-            if is_tag:
-                self.barcode_sequence = field
-                fields = fields[:-1]
-                ##logger.debug("Identified barcode sequence as %s" % self.barcode_sequence)
-            else:
-                # Alternatively might be the sample number
-                if field.startswith('S'):
-                    try:
-                        if field[1:].isdigit():
-                            self.sample_number = int(field[1:])
-                            fields = fields[:-1]
-                    except IndexError:
-                        pass
-        # What's left is the name
-        ##logger.debug("Remaining fields: %s" % fields)
-        self.sample_name = '_'.join(fields)
-        assert(self.sample_name != '')
+        # Parse the base name (no leading path or extension)
+        # NB parsed names are cached, so repeated instances for
+        # the same Fastq only pay for the parsing once
+        attrs = parse_fastq_name(self.basename)
+        self.sample_name = attrs.sample_name
+        self.sample_number = attrs.sample_number
+        self.barcode_sequence = attrs.barcode_sequence
+        self.lane_number = attrs.lane_number
+        self.read_number = attrs.read_number
+        self.set_number = attrs.set_number
+        self.is_index_read = attrs.is_index_read
+        self.delimiter = attrs.delimiter
 
     def __repr__(self):
         """Implement __repr__ built-in
@@ -337,6 +268,59 @@ class AnalysisFastq(BaseFastqAttrs):
             fq.append("%03d" % self.set_number)
         return self.delimiter.join(fq)
 
+class FastqNameAttrs(object):
+    """
+    Immutable record of the attributes parsed from a Fastq name
+
+    Instances are produced by the 'parse_fastq_name' function
+    and are shared between all callers parsing the same name,
+    so the attributes cannot be modified once set.
+
+    Provides the following attributes:
+
+    sample_name:      name of the sample (leading part of the name)
+    sample_number:    integer (or None if no sample number)
+    barcode_sequence: barcode sequence (string or None)
+    lane_number:      integer (or None if no lane number)
+    read_number:      integer (or None if no read number)
+    set_number:       integer (or None if no set number)
+    is_index_read:    boolean (True if index read, False if not)
+    delimiter:        delimiter used in the name ('_' or '.')
+    """
+    __slots__ = ('sample_name',
+                 'sample_number',
+                 'barcode_sequence',
+                 'lane_number',
+                 'read_number',
+                 'set_number',
+                 'is_index_read',
+                 'delimiter',)
+    def __init__(self,sample_name,sample_number=None,
+                 barcode_sequence=None,lane_number=None,
+                 read_number=None,set_number=None,
+                 is_index_read=False,delimiter='_'):
+        """Create a new FastqNameAttrs instance
+        """
+        for attr,value in (('sample_name',sample_name),
+                           ('sample_number',sample_number),
+                           ('barcode_sequence',barcode_sequence),
+                           ('lane_number',lane_number),
+                           ('read_number',read_number),
+                           ('set_number',set_number),
+                           ('is_index_read',is_index_read),
+                           ('delimiter',delimiter)):
+            object.__setattr__(self,attr,value)
+    def __setattr__(self,attr,value):
+        raise AttributeError("Can't set attribute '%s' of %s" %
+                             (attr,self.__class__.__name__))
+    def __delattr__(self,attr):
+        raise AttributeError("Can't delete attribute '%s' of %s" %
+                             (attr,self.__class__.__name__))
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__,
+                           ','.join(["%s=%r" % (attr,getattr(self,attr))
+                                     for attr in self.__slots__]))
+
 class AnalysisDir:
     """Class describing an analysis directory
 
@@ -358,12 +342,15 @@ class AnalysisDir:
         # Store location
         self._analysis_dir = os.path.abspath(analysis_dir)
         self._name = os.path.basename(analysis_dir)
+        # Subdirectories are examined on demand
+        self._subdirs = {}
+        self._scanned = False
         self._bcl2fastq_dirs = []
         self._project_dirs = []
         self._extra_dirs = []
-        self.sequencing_data = []
-        self.projects = []
-        self.undetermined = None
+        self._sequencing_data = []
+        self._projects = []
+        self._undetermined = None
         # Metadata
         self.metadata = AnalysisDirMetadata()
         try:
@@ -409,46 +396,117 @@ class AnalysisDir:
             self.instrument_name,\
             self.instrument_run_number = IlluminaData.split_run_name(
                 self.run_name)
-        # Look for outputs from bclToFastq and analysis projects
-        logger.debug("Examining subdirectories of %s" % self._analysis_dir)
-        for dirn in bcf_utils.list_dirs(self._analysis_dir):
-            # Look for sequencing data
-            try:
-                data = IlluminaData.IlluminaData(self._analysis_dir,
-                                                 unaligned_dir=dirn)
-                logger.debug("- %s: sequencing data" % dirn)
-                self._bcl2fastq_dirs.append(dirn)
-                self.sequencing_data.append(data)
-                continue
-            except IlluminaData.IlluminaDataError:
-                pass
-            except Exception as ex:
-                logging.warning("Exception when attempting to load "
-                                "subdir '%s' as CASAVA/bcl2fastq output "
-                                "(ignored): %s" % (dirn,ex))
+
+    def _examine_subdir(self,dirn):
+        """Internal: determine the contents of a subdirectory
+
+        Results are cached so each subdirectory is only
+        examined once.
+
+        Arguments:
+          dirn: name of the subdirectory
+
+        Returns:
+          Tuple (type,data) where 'type' is one of
+          'sequencing_data','undetermined','project' or
+          'extra', and 'data' is the associated IlluminaData
+          or AnalysisProject instance (or None).
+        """
+        try:
+            return self._subdirs[dirn]
+        except KeyError:
+            pass
+        result = None
+        # Look for sequencing data
+        try:
+            data = IlluminaData.IlluminaData(self._analysis_dir,
+                                             unaligned_dir=dirn)
+            logger.debug("- %s: sequencing data" % dirn)
+            result = ('sequencing_data',data)
+        except IlluminaData.IlluminaDataError:
+            pass
+        except Exception as ex:
+            logging.warning("Exception when attempting to load "
+                            "subdir '%s' as CASAVA/bcl2fastq output "
+                            "(ignored): %s" % (dirn,ex))
+        if result is None:
             # Look for analysis data
             data = AnalysisProject(dirn,os.path.join(self._analysis_dir,dirn))
             if data.is_analysis_dir:
                 if dirn == 'undetermined':
                     logger.debug("- %s: undetermined indexes" % dirn)
-                    self.undetermined = data
+                    result = ('undetermined',data)
                 else:
                     # Check against projects.info, if possible
                     try:
                         if not self.projects_metadata.lookup('Project',dirn):
                             logger.debug("- %s: not in projects.info" % dirn)
-                            self._extra_dirs.append(dirn)
-                            continue
+                            result = ('extra',None)
                     except AttributeError:
                         pass
-                    logger.debug("- %s: project directory" % dirn)
-                    self._project_dirs.append(dirn)
-                    self.projects.append(data)
-                continue
+                    if result is None:
+                        logger.debug("- %s: project directory" % dirn)
+                        result = ('project',data)
             else:
                 # Unidentified contents
-                self._extra_dirs.append(dirn)
                 logger.debug("- %s: unknown" % dirn)
+                result = ('extra',None)
+        self._subdirs[dirn] = result
+        return result
+
+    def _scan_subdirs(self):
+        """Internal: examine all subdirectories (if not already done)
+        """
+        if self._scanned:
+            return
+        # Look for outputs from bclToFastq and analysis projects
+        logger.debug("Examining subdirectories of %s" % self._analysis_dir)
+        for dirn in bcf_utils.list_dirs(self._analysis_dir):
+            dir_type,data = self._examine_subdir(dirn)
+            if dir_type == 'sequencing_data':
+                self._bcl2fastq_dirs.append(dirn)
+                self._sequencing_data.append(data)
+            elif dir_type == 'undetermined':
+                self._undetermined = data
+            elif dir_type == 'project':
+                self._project_dirs.append(dirn)
+                self._projects.append(data)
+            else:
+                self._extra_dirs.append(dirn)
+        self._scanned = True
+
+    @property
+    def projects(self):
+        """Return list of AnalysisProjects in the analysis directory
+
+        """
+        self._scan_subdirs()
+        return self._projects
+
+    @property
+    def sequencing_data(self):
+        """Return list of IlluminaData objects for sequencing data
+
+        """
+        self._scan_subdirs()
+        return self._sequencing_data
+
+    @property
+    def undetermined(self):
+        """Return AnalysisProject for undetermined indexes (or None)
+
+        If the subdirectories haven't already been scanned
+        then only the 'undetermined' subdirectory is examined.
+        """
+        if not self._scanned:
+            if not os.path.isdir(os.path.join(self._analysis_dir,
+                                              'undetermined')):
+                return None
+            dir_type,data = self._examine_subdir('undetermined')
+            if dir_type == 'undetermined':
+                return data
+            return None
+        return self._undetermined
 
     @property
     def n_projects(self):
@@ -484,6 +542,20 @@ class AnalysisDir:
         project will also be included; otherwise it will be omitted.
 
         """
+        if pattern is not None and not self._scanned:
+            # Only examine the subdirectories which match
+            projects = []
+            undetermined = None
+            for dirn in fnmatch.filter(
+                    bcf_utils.list_dirs(self._analysis_dir),pattern):
+                dir_type,data = self._examine_subdir(dirn)
+                if dir_type == 'project':
+                    projects.append(data)
+                elif dir_type == 'undetermined':
+                    undetermined = data
+            if include_undetermined and undetermined:
+                projects.append(undetermined)
+            return projects
         projects = [p for p in self.projects]
         if include_undetermined and self.undetermined:
             projects.append(self.undetermined)
@@ -492,6 +564,48 @@ class AnalysisDir:
             projects = filter(lambda p: fnmatch.fnmatch(p.name,pattern),
                               projects)
         return projects
+
+    def list_projects(self,pattern=None):
+        """Return projects listed in the analysis directory metadata
+
+        This is a fast alternative to 'get_projects' which
+        doesn't examine the contents of the subdirectories:
+        the project names are read from the 'projects.info'
+        file, and the projects are returned as 'lazy'
+        AnalysisProject instances (so initially only the
+        metadata from their 'README.info' files are loaded).
+
+        If 'projects.info' couldn't be loaded then any
+        subdirectories with a 'README.info' file are assumed
+        to be projects.
+
+        Note that the 'undetermined' project is not included,
+        and projects whose directories don't exist are omitted.
+
+        Arguments:
+          pattern: optional, simple pattern used to select a
+            subset of projects by name
+
+        Returns:
+          List of AnalysisProject instances.
+        """
+        if self.projects_metadata is not None:
+            names = [line['Project'] for line in self.projects_metadata]
+        else:
+            names = [d for d in bcf_utils.list_dirs(self._analysis_dir)
+                     if d != 'undetermined' and
+                     os.path.isfile(os.path.join(self._analysis_dir,d,
+                                                 "README.info"))]
+        if pattern is not None:
+            names = fnmatch.filter(names,pattern)
+        projects = []
+        for name in names:
+            dirn = os.path.join(self._analysis_dir,name)
+            if not os.path.isdir(dirn):
+                logger.warning("Project '%s': directory not found" % name)
+                continue
+            projects.append(AnalysisProject(name,dirn,lazy=True))
+        return projects
         
 class AnalysisProject:
     """Class describing an analysis project
@@ -545,10 +659,24 @@ class AnalysisProject:
     the project directory (by default this is the 'fastqs' subdirectory
     of the project directory). It can be changed using the
     'set_primary_fastq_dir' method.
+
+    If the project is created with 'lazy=True' then only the
+    metadata in the 'info' property is loaded on creation; the
+    directory isn't scanned for fastq files until one of the
+    properties which depends on them (e.g. 'samples' or
+    'fastq_dirs') is first accessed.
     """
+    # Attributes which depend on the directory contents (and so
+    # trigger populating a 'lazy' project when first accessed)
+    _populated_attributes = ('fastq_dir',
+                             'fastq_dirs',
+                             'fastq_format',
+                             'samples',
+                             '_samples_by_name',
+                             '_qc_dir',)
     def __init__(self,name,dirn,user=None,PI=None,library_type=None,
                  organism=None,run=None,comments=None,platform=None,
-                 fastq_attrs=None,fastq_dir=None):
+                 fastq_attrs=None,fastq_dir=None,lazy=False):
         """Create a new AnalysisProject instance
 
         Arguments:
@@ -572,13 +700,12 @@ class AnalysisProject:
             holding the set of Fastq files to load; defaults to
             'fastq' (if present) or to the top-level of the project
             directory (if absent).
+          lazy: optional, if True then defer scanning the directory
+            for fastq files until the data is first needed (default
+            is to scan on creation).
         """
         self.name = name
         self.dirn = os.path.abspath(dirn)
-        self.fastq_dir = None
-        self.fastq_dirs = []
-        self.fastq_format = None
-        self.samples = []
         self.info = AnalysisProjectInfo()
         self.info_file = os.path.join(self.dirn,"README.info")
         # Function to use for getting Fastq information
@@ -586,23 +713,60 @@ class AnalysisProject:
             self.fastq_attrs = AnalysisFastq
         else:
             self.fastq_attrs = fastq_attrs
-        # Populate from the directory contents
-        self.populate(fastq_dir=fastq_dir)
+        # Metadata to (re)set after loading
+        self._info_updates = [(item,value) for item,value in
+                              (('run',run),
+                               ('user',user),
+                               ('PI',PI),
+                               ('library_type',library_type),
+                               ('organism',organism),
+                               ('platform',platform),
+                               ('comments',comments),)
+                              if value is not None]
+        if lazy:
+            # Only load the metadata for now
+            self._populated = False
+            self._lazy_fastq_dir = fastq_dir
+            if os.path.isfile(self.info_file):
+                self.info.load(self.info_file)
+        else:
+            # Populate from the directory contents
+            self._populate_from_dir(fastq_dir=fastq_dir)
         # (Re)set metadata
-        if run is not None:
-            self.info['run'] = run
-        if user is not None:
-            self.info['user'] = user
-        if PI is not None:
-            self.info['PI'] = PI
-        if library_type is not None:
-            self.info['library_type'] = library_type
-        if organism is not None:
-            self.info['organism'] = organism
-        if platform is not None:
-            self.info['platform'] = platform
-        if comments is not None:
-            self.info['comments'] = comments
+        self._update_info()
+
+    def __getattr__(self,attr):
+        """Implement __getattr__ built-in
+
+        Populates 'lazy' projects from the directory contents
+        on first access to attributes which depend on them.
+        """
+        if attr in AnalysisProject._populated_attributes and \
+           not self.__dict__.get('_populated',True):
+            logger.debug("%s: populating on access to '%s'" %
+                         (self.name,attr))
+            self._populate_from_dir(fastq_dir=self._lazy_fastq_dir)
+            self._update_info()
+            return getattr(self,attr)
+        raise AttributeError("%s instance has no attribute '%s'" %
+                             (self.__class__.__name__,attr))
+
+    def _populate_from_dir(self,fastq_dir=None):
+        """Internal: reset and populate from directory contents
+        """
+        self._populated = True
+        self.fastq_dir = None
+        self.fastq_dirs = []
+        self.fastq_format = None
+        self.samples = []
+        self._samples_by_name = {}
+        self.populate(fastq_dir=fastq_dir)
+
+    def _update_info(self):
+        """Internal: (re)set metadata supplied on creation
+        """
+        for item,value in self._info_updates:
+            self.info[item] = value
 
     def populate(self,fastq_dir=None):
         """Populate data structure from directory contents
@@ -615,15 +779,15 @@ class AnalysisProject:
         if os.path.isfile(self.info_file):
             self.info.load(self.info_file)
         # Identify possible fastq subdirectories
-        fastq_dirs = []
+        # NB each directory is only scanned once, and the
+        # results are reused when collecting the fastqs below
+        fastqs_in_dir = OrderedDict()
         for d in bcf_utils.list_dirs(self.dirn):
             fq_dir = os.path.join(self.dirn,d)
-            fastqs = self.find_fastqs(fq_dir)
-            if fastqs:
-                fastq_dirs.append(d)
+            fastqs_in_dir[d] = self.find_fastqs(fq_dir)
         # Also check top-level dir
-        if self.find_fastqs(self.dirn):
-            fastq_dirs.append('.')
+        fastqs_in_dir['.'] = self.find_fastqs(self.dirn)
+        fastq_dirs = [d for d in fastqs_in_dir if fastqs_in_dir[d]]
         self.fastq_dirs = fastq_dirs
         logger.debug("Possible fastq dirs: %s" %
                      ','.join(self.fastq_dirs))
@@ -647,19 +811,24 @@ class AnalysisProject:
         self.fastq_dir = os.path.normpath(
             os.path.join(self.dirn,fastq_dir))
         # Collect fastq files
-        fastqs = self.find_fastqs(self.fastq_dir)
+        try:
+            fastqs = fastqs_in_dir[os.path.normpath(fastq_dir)]
+        except KeyError:
+            fastqs = self.find_fastqs(self.fastq_dir)
         if fastqs:
             self.fastq_format = self.determine_fastq_format(fastqs[0])
         logger.debug("Assigning fastqs to samples...")
         self.samples = []
+        self._samples_by_name = {}
         for fq in fastqs:
             name = self.fastq_attrs(fq).sample_name
             try:
-                sample = self.get_sample(name)
+                sample = self._samples_by_name[name]
             except KeyError:
                 sample = AnalysisSample(name,
                                         fastq_attrs=self.fastq_attrs)
                 self.samples.append(sample)
+                self._samples_by_name[name] = sample
             sample.add_fastq(os.path.normpath(
                 os.path.join(self.fastq_dir,fq)))
         logger.debug("Listing samples and files:")
@@ -678,10 +847,12 @@ class AnalysisProject:
         Return list of Fastq files found in directory
         """
         logger.debug("Searching '%s' for fastqs" % dirn)
-        fastq_tuples = Pipeline.GetFastqGzFiles(dirn)
+        # List the directory once and share between searches
+        file_list = os.listdir(dirn)
+        fastq_tuples = Pipeline.GetFastqGzFiles(dirn,file_list=file_list)
         if not fastq_tuples:
             logger.debug("No fastq.gz files found")
-            fastq_tuples = Pipeline.GetFastqFiles(dirn)
+            fastq_tuples = Pipeline.GetFastqFiles(dirn,file_list=file_list)
             if not fastq_tuples:
                 logger.debug("No fastq files found")
         # Unpack tuples
@@ -829,7 +1000,8 @@ class AnalysisProject:
     def create_directory(self,illumina_project=None,fastqs=None,
                          fastq_dir=None,
                          short_fastq_names=False,
-                         link_to_fastqs=False):
+                         link_to_fastqs=False,
+                         nthreads=1,dry_run=False):
         """Create and populate analysis directory for an IlluminaProject
 
         Creates a new directory corresponding to the AnalysisProject
@@ -856,8 +1028,21 @@ class AnalysisProject:
             (default) then use the original fastq names
           link_to_fastqs: (optional) if True then make symbolic links to
             to the fastq files; if False (default) then make hard links
+          nthreads: (optional) number of threads to use when making
+            the links to the fastq files (default: 1)
+          dry_run: (optional) if True then only report the links
+            that would be made, without creating anything
     
         """
+        if dry_run:
+            # Report the links and stop
+            print "Project '%s': %s" % (self.name,self.dirn)
+            planner = self._plan_fastq_links(illumina_project,
+                                             fastqs,fastq_dir,
+                                             short_fastq_names,
+                                             link_to_fastqs)
+            planner.execute(dry_run=True)
+            return
         logger.debug("Creating analysis directory for project '%s'" % self.name)
         # Check for & create directory
         if os.path.exists(self.dirn):
@@ -879,33 +1064,15 @@ class AnalysisProject:
         fastq_dir = os.path.join(self.dirn,fastq_dir)
         bcf_utils.mkdir(fastq_dir,mode=0775)
         # Check for & create links to fastq files
-        if fastqs is None:
-            # Make a list of fastqs to import from the supplied
-            # IlluminaProject object
-            fastqs = []
-            if illumina_project is not None:
-                for sample in illumina_project.samples:
-                    for fastq in sample.fastq:
-                        fastqs.append(os.path.join(sample.dirn,fastq))
-        if short_fastq_names:
-            # Get mapping to (shortened) unique names
-            fastq_names = IlluminaData.get_unique_fastq_names(fastqs)
-        else:
-            # Use full names
-            fastq_names = {}
-            for fq in fastqs:
-                fastq_names[fq] = os.path.basename(fq)
-        for fastq in fastqs:
-            target_fq = os.path.join(fastq_dir,fastq_names[fastq])
-            if os.path.exists(target_fq):
-                logger.warning("Target '%s' already exists" % target_fq)
-            else:
-                if link_to_fastqs:
-                    logger.debug("Making symlink to %s" % fastq)
-                    bcf_utils.mklink(fastq,target_fq,relative=True)
-                else:
-                    logger.debug("Making hard link to %s" % fastq)
-                    os.link(fastq,target_fq)
+        planner = self._plan_fastq_links(illumina_project,
+                                         fastqs,fastq_dir,
+                                         short_fastq_names,
+                                         link_to_fastqs)
+        nfailed = planner.execute(nthreads=nthreads)
+        print "Linked fastqs for '%s': %s" % (self.name,planner.summary())
+        if nfailed:
+            raise Exception("Failed to make %d link%s to fastqs" %
+                            (nfailed,'s' if nfailed != 1 else ''))
         # Populate
         self.populate(fastq_dir=os.path.basename(fastq_dir))
         # Update metadata: primary fastq dir
@@ -928,6 +1095,39 @@ class AnalysisProject:
         # Save metadata
         self.info.save(self.info_file)
 
+    def _plan_fastq_links(self,illumina_project,fastqs,fastq_dir,
+                          short_fastq_names,link_to_fastqs):
+        """Internal: set up the links to fastq files for the project
+
+        Arguments are the same as for 'create_directory'.
+
+        Returns:
+          LinkPlanner instance with the links to the fastqs.
+        """
+        if fastq_dir is None:
+            fastq_dir = "fastqs"
+        fastq_dir = os.path.join(self.dirn,fastq_dir)
+        if fastqs is None:
+            # Make a list of fastqs to import from the supplied
+            # IlluminaProject object
+            fastqs = []
+            if illumina_project is not None:
+                for sample in illumina_project.samples:
+                    for fastq in sample.fastq:
+                        fastqs.append(os.path.join(sample.dirn,fastq))
+        if short_fastq_names:
+            # Get mapping to (shortened) unique names
+            fastq_names = IlluminaData.get_unique_fastq_names(fastqs)
+        else:
+            # Use full names
+            fastq_names = {}
+            for fq in fastqs:
+                fastq_names[fq] = os.path.basename(fq)
+        planner = LinkPlanner(symlink=link_to_fastqs,relative=True)
+        for fastq in fastqs:
+            planner.add(fastq,os.path.join(fastq_dir,fastq_names[fastq]))
+        return planner
+
     @property
     def exists(self):
         """Check if analysis project directory already exists
@@ -1113,8 +1313,19 @@ class AnalysisProject:
           KeyError exception if no match is found.
 
         """
+        # Look up in the index first
+        try:
+            sample = self._samples_by_name[name]
+            if sample.name == name:
+                return sample
+        except KeyError:
+            pass
+        # Fall back to searching the list (in case samples
+        # were added without updating the index)
         for sample in self.samples:
-            if sample.name == name: return sample
+            if sample.name == name:
+                self._samples_by_name[name] = sample
+                return sample
         raise KeyError, "No matching sample for '%s'" % name
 
     def get_samples(self,pattern):
@@ -1316,6 +1527,19 @@ class MetadataDict(bcf_utils.AttributeDictionary):
     are automatically converted back to the Python equivalents
     on reload.
 
+    Saving only rewrites the file if the data have been modified
+    since they were last loaded or saved (see the 'modified'
+    property), and the file is replaced atomically (so readers
+    never see a partially written file).
+
+    Multiple updates can be batched so that the file is only
+    written once:
+    >>> with metadata.batch_updates():
+    ...     metadata['salutation'] = 'hi'
+    ...     metadata.save()
+    ...     metadata['valediction'] = 'bye'
+    ...     metadata.save()
+
     """
 
     def __init__(self,attributes=dict(),order=None,filen=None):
@@ -1336,6 +1560,10 @@ class MetadataDict(bcf_utils.AttributeDictionary):
         """
         bcf_utils.AttributeDictionary.__init__(self)
         self.__filen = filen
+        # Track modifications and batched saves
+        self.__modified = False
+        self.__batch_level = 0
+        self.__pending_saves = []
         # Set up empty metadata attributes
         self.__attributes = attributes
         for key in self.__attributes:
@@ -1364,13 +1592,52 @@ class MetadataDict(bcf_utils.AttributeDictionary):
             if extra_keys:
                 extra_keys.sort()
                 self.__key_order.extend(extra_keys)
+        # Freshly created or loaded data is unmodified
+        self.__modified = False
 
     def __setitem__(self,key,value):
         if key in self.__attributes:
+            if key not in self or self[key] != value:
+                self.__modified = True
             bcf_utils.AttributeDictionary.__setitem__(self,key,value)
         else:
             raise AttributeError,"Key '%s' not defined" % key
 
+    @property
+    def modified(self):
+        """
+        Return True if data have changed since last load or save
+
+        """
+        return self.__modified
+
+    @contextmanager
+    def batch_updates(self):
+        """
+        Context manager which defers saving until the end of a block
+
+        Calls to 'save' inside the block are recorded and
+        only performed once, when the outermost block exits
+        (so multiple updates result in a single write). If
+        the block raises an exception then the deferred
+        saves are discarded.
+
+        """
+        self.__batch_level += 1
+        try:
+            yield self
+        except:
+            self.__batch_level -= 1
+            if not self.__batch_level:
+                self.__pending_saves = []
+            raise
+        self.__batch_level -= 1
+        if not self.__batch_level:
+            pending_saves = self.__pending_saves
+            self.__pending_saves = []
+            for filen in pending_saves:
+                self.save(filen)
+
     def __iter__(self):
         return iter(self.__key_order)
 
@@ -1424,22 +1691,45 @@ class MetadataDict(bcf_utils.AttributeDictionary):
                         self[attr] = value
             except IndexError:
                 logger.warning("Bad line in %s: %s" % (filen,line))
+        self.__modified = False
 
-    def save(self,filen=None):
+    def save(self,filen=None,force=False):
         """Save metadata to tab-delimited file
 
         Writes key-value paires to a tab-delimited file.
         The data can be recovered using the 'load' method.
  
         Note that if the specified file already exists then
-        it will be overwritten.
+        it will be overwritten (atomically). However if the
+        file is the one the data were loaded from (or last
+        saved to) and the data haven't been modified since
+        then the file is not rewritten, unless 'force' is
+        specified.
+
+        If called inside a 'batch_updates' block then the
+        save is deferred until the end of the block.
 
         Arguments:
           filen: name of the tab-delimited file with key-value
             pairs; if None then the file specified when the
             object was instantiated will be used instead.
+          force: if True then write the file even if the
+            data are unmodified (default is False).
 
         """
+        if filen is None:
+            filen = self.__filen
+        if self.__batch_level:
+            # Defer until end of batch
+            if filen not in self.__pending_saves:
+                self.__pending_saves.append(filen)
+            return
+        if not (force or self.__modified) and \
+           filen is not None and \
+           filen == self.__filen and \
+           os.path.exists(filen):
+            logger.debug("%s: unmodified, not saving" % filen)
+            return
         metadata = TabFile.TabFile()
         for key in self.__key_order:
             # Retrieve value and convert to appropriate
@@ -1456,9 +1746,13 @@ class MetadataDict(bcf_utils.AttributeDictionary):
             # Store in the file
             metadata.append(data=(attr,value))
         # Write the file
-        if filen is not None:
-            self.__filen = filen
-        metadata.write(self.__filen)
+        self.__filen = filen
+        if self.__filen is None:
+            metadata.write(self.__filen)
+        else:
+            with atomic_write(self.__filen) as fp:
+                metadata.write(fp=fp)
+        self.__modified = False
 
     def null_items(self):
         """
@@ -1937,6 +2231,184 @@ class OutputFiles:
     def __len__(self):
         return len(self._fp.keys())
 
+class LinkPlanner(object):
+    """
+    Class for planning and making sets of hard or symbolic links
+
+    Collects the links to be made, determines up front which
+    operations are actually needed (skipping targets which
+    already link to their source, and flagging targets which
+    exist but point elsewhere), then makes the links using a
+    pool of threads.
+
+    Existing targets are found by listing each target
+    directory once, rather than checking each target
+    individually.
+
+    Example usage:
+
+    >>> planner = LinkPlanner(symlink=True)
+    >>> planner.add('/data/PJB1_S1_R1_001.fastq.gz',
+    ...             '/analysis/PJB/fastqs/PJB1_S1_R1_001.fastq.gz')
+    >>> planner.execute(nthreads=4)
+    >>> print planner.summary()
+
+    Each planned operation is a tuple of (source,target,action)
+    where 'action' is one of:
+
+    - 'link': the link will be made
+    - 'skip': an identical link already exists
+    - 'conflict': a different file already exists at the target
+    """
+    def __init__(self,symlink=False,relative=True):
+        """
+        Create a new LinkPlanner instance
+
+        Arguments:
+          symlink (bool): if True then make symbolic links,
+            otherwise make hard links (the default)
+          relative (bool): if True (the default) then symbolic
+            links are made relative to the target directory
+        """
+        self._symlink = symlink
+        self._relative = relative
+        self._links = []
+        self._operations = None
+        self._results = OrderedDict((('created',0),
+                                     ('skipped',0),
+                                     ('conflicts',0),
+                                     ('failed',0)))
+
+    def add(self,source,target):
+        """
+        Add a link to be made
+
+        Arguments:
+          source (str): path to the file to link to
+          target (str): path of the link to make
+        """
+        self._links.append((source,target))
+        self._operations = None
+
+    def plan(self):
+        """
+        Determine the operations needed to make the links
+
+        Returns:
+          List: list of (source,target,action) tuples
+        """
+        if self._operations is not None:
+            return self._operations
+        # List the contents of each target directory once
+        dir_contents = {}
+        for source,target in self._links:
+            dirn = os.path.dirname(target)
+            if dirn not in dir_contents:
+                try:
+                    dir_contents[dirn] = set(os.listdir(dirn))
+                except OSError:
+                    dir_contents[dirn] = set()
+        # Determine the action for each link
+        self._operations = []
+        for source,target in self._links:
+            if os.path.basename(target) not in \
+               dir_contents[os.path.dirname(target)]:
+                action = 'link'
+            elif self._is_same_link(source,target):
+                action = 'skip'
+            else:
+                action = 'conflict'
+            self._operations.append((source,target,action))
+        return self._operations
+
+    def _is_same_link(self,source,target):
+        """
+        Internal: check if existing target already links to source
+        """
+        try:
+            if self._symlink:
+                return os.path.islink(target) and \
+                    os.path.realpath(target) == os.path.realpath(source)
+            else:
+                return os.path.samefile(source,target)
+        except OSError:
+            return False
+
+    def _make_link(self,operation):
+        """
+        Internal: make a single link
+
+        Returns:
+          Tuple: (target,error) where 'error' is None if the
+            link was made successfully.
+        """
+        source,target,action = operation
+        try:
+            if self._symlink:
+                bcf_utils.mklink(source,target,relative=self._relative)
+            else:
+                os.link(source,target)
+            return (target,None)
+        except Exception as ex:
+            return (target,ex)
+
+    def execute(self,nthreads=1,dry_run=False):
+        """
+        Make the planned links
+
+        Arguments:
+          nthreads (int): number of threads to use for
+            making the links (default: 1)
+          dry_run (bool): if True then report the planned
+            operations without making any links
+
+        Returns:
+          Integer: number of links which failed.
+        """
+        operations = self.plan()
+        for source,target,action in operations:
+            if action == 'skip':
+                logger.debug("%s: already linked, skipping" % target)
+                self._results['skipped'] += 1
+            elif action == 'conflict':
+                logger.warning("Target '%s' already exists" % target)
+                self._results['conflicts'] += 1
+            elif dry_run:
+                print "%s %s -> %s" % (('symlink' if self._symlink
+                                        else 'link'),
+                                       target,source)
+        to_link = [op for op in operations if op[2] == 'link']
+        if dry_run or not to_link:
+            return 0
+        logger.debug("Making %d link%s using %d thread%s" %
+                     (len(to_link),'s' if len(to_link) != 1 else '',
+                      nthreads,'s' if nthreads != 1 else ''))
+        if nthreads > 1:
+            pool = ThreadPool(nthreads)
+            results = pool.map(self._make_link,to_link)
+            pool.close()
+            pool.join()
+        else:
+            results = map(self._make_link,to_link)
+        for target,error in results:
+            if error is None:
+                self._results['created'] += 1
+            else:
+                logger.error("Failed to link '%s': %s" % (target,error))
+                self._results['failed'] += 1
+        return self._results['failed']
+
+    def summary(self):
+        """
+        Return a summary of the outcomes of making the links
+
+        Returns:
+          String: summary text e.g. 'created 10, skipped 2,
+            conflicts 0, failed 0'
+        """
+        return ', '.join(["%s %d" % (outcome,self._results[outcome])
+                          for outcome in self._results])
+
 class ZipArchive(object):
     """
     Utility class for creating .zip archive files
@@ -2022,6 +2494,241 @@ class ZipArchive(object):
 # Functions
 #######################################################################
 
+def lru_cache(maxsize=1024):
+    """
+    Decorator which caches the most recent results of a function
+
+    Implements a bounded 'least recently used' (LRU) cache for
+    functions whose (positional) arguments are hashable: when
+    the cache is full the least recently used result is
+    discarded to make room for the new one. Exceptions raised
+    by the function are not cached.
+
+    The decorated function also provides 'cache_info' (returns
+    a tuple of hits, misses, maxsize and current size) and
+    'cache_clear' (empties the cache and resets the counts)
+    methods.
+
+    Example usage:
+
+    >>> @lru_cache(maxsize=100)
+    ... def parse(name):
+    ...    ...
+
+    Arguments:
+      maxsize (int): maximum number of results to keep
+        in the cache (must be a positive integer)
+    """
+    if maxsize < 1:
+        raise ValueError("lru_cache: maxsize must be at least 1")
+    def decorator(f):
+        cache = OrderedDict()
+        stats = { 'hits': 0, 'misses': 0 }
+        lock = threading.Lock()
+        def wrapper(*args):
+            with lock:
+                try:
+                    result = cache.pop(args)
+                    stats['hits'] += 1
+                    cache[args] = result
+                    return result
+                except KeyError:
+                    stats['misses'] += 1
+            result = f(*args)
+            with lock:
+                cache[args] = result
+                while len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return result
+        def cache_info():
+            return (stats['hits'],stats['misses'],maxsize,len(cache))
+        def cache_clear():
+            with lock:
+                cache.clear()
+                stats['hits'] = 0
+                stats['misses'] = 0
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
+        wrapper.__name__ = f.__name__
+        wrapper.__doc__ = f.__doc__
+        return wrapper
+    return decorator
+
+@lru_cache(maxsize=FASTQ_NAME_CACHE_SIZE)
+def parse_fastq_name(fastq_base):
+    """
+    Parse a Fastq base name into its component attributes
+
+    Handles all the name formats described for the
+    AnalysisFastq class. Results are cached (see the
+    'lru_cache' decorator) so repeated calls for the same
+    name return the same FastqNameAttrs instance.
+
+    Arguments:
+      fastq_base (str): Fastq name without leading path or
+        NGS file extensions (e.g.
+        'NH1_ChIP-seq_Gli1_ACAGTG_L001_R1_001')
+
+    Returns:
+      FastqNameAttrs: immutable record with the attributes
+        extracted from the name.
+    """
+    sample_number = None
+    barcode_sequence = None
+    lane_number = None
+    read_number = None
+    set_number = None
+    is_index_read = False
+    # Determine if it's a non-standard (dot-separated) name
+    #
+    # These are names of the form e.g.
+    # NH1.2.r2
+    # or
+    # NH1_ChIP-seq.ACAGTG.r2
+    if '.' in fastq_base:
+        fields = fastq_base.split('.')
+        field = fields[-1]
+        if len(field) == 2 and field.startswith('r'):
+            # Read number
+            read_number = int(field[1])
+            fields = fields[:-1]
+            field = fields[-1]
+        if len(fields) > 1:
+            # Barcode sequence
+            if _is_barcode_sequence(field):
+                barcode_sequence = field
+                fields = fields[:-1]
+                field = fields[-1]
+        # Remaining fields are the sample name
+        sample_name = '.'.join(fields)
+        assert(sample_name != '')
+        return FastqNameAttrs(sample_name,
+                              barcode_sequence=barcode_sequence,
+                              read_number=read_number,
+                              delimiter='.')
+    # Some form of Illumina-derived name
+    #
+    # Full Illumina-style names are e.g.
+    # NH1_ChIP-seq_Gli1_ACAGTG_L001_R1_001
+    # or
+    # NH1_ChIP-seq_Gli1_S4_L003_R2_001
+    #
+    # We have shorter name formats where redundant parts are
+    # omitted, the patterns are:
+    # NAME          e.g. NH1_ChIP-seq_Gli1
+    # NAME+LANE     e.g. NH1_ChIP-seq_Gli1_L001
+    # NAME+TAG      e.g. NH1_ChIP-seq_Gli1_ACAGTG
+    # NAME+TAG+LANE e.g. NH1_ChIP-seq_Gli1_ACAGTG_L001
+    #
+    # Also read number (i.e. R1 or R2) is appended but only for
+    # paired end samples
+    #
+    # The set number is never included, except for full names
+    fields = fastq_base.split('_')
+    # Deal with set number first e.g. 001
+    field = fields[-1]
+    if len(field) == 3 and field.isdigit():
+        set_number = int(field)
+        fields = fields[:-1]
+    # Deal with trailing read number e.g. R1
+    field = fields[-1]
+    if len(field) == 2:
+        if field.startswith('R'):
+            read_number = int(field[1])
+            fields = fields[:-1]
+        elif field.startswith('I'):
+            read_number = int(field[1])
+            is_index_read = True
+            fields = fields[:-1]
+    # Deal with trailing lane number e.g. L001
+    field = fields[-1]
+    if len(field) == 4 and field.startswith('L') and field[1:].isdigit():
+        lane_number = int(field[1:])
+        fields = fields[:-1]
+    # Deal with trailing index tag e.g. ATTGCT or ATTGCT-CCTAAG
+    field = fields[-1]
+    if len(fields) > 1:
+        # This mustn't be the last field: if it is then it's
+        # not the tag - it's the name
+        if _is_barcode_sequence(field):
+            barcode_sequence = field
+            fields = fields[:-1]
+        elif field.startswith('S') and field[1:].isdigit():
+            # Alternatively might be the sample number
+            sample_number = int(field[1:])
+            fields = fields[:-1]
+    # What's left is the name
+    sample_name = '_'.join(fields)
+    assert(sample_name != '')
+    return FastqNameAttrs(sample_name,
+                          sample_number=sample_number,
+                          barcode_sequence=barcode_sequence,
+                          lane_number=lane_number,
+                          read_number=read_number,
+                          set_number=set_number,
+                          is_index_read=is_index_read,
+                          delimiter='_')
+
+def _is_barcode_sequence(s):
+    """
+    Internal: check if string looks like a barcode sequence
+
+    Returns True if the string consists only of the
+    characters 'ACGTN' (with '-' separating the
+    components of a dual index), False otherwise.
+    """
+    return _BARCODE_SEQUENCE_CHARS.issuperset(s)
+
+@contextmanager
+def atomic_write(filen):
+    """
+    Context manager for atomically writing to a file
+
+    Yields a file object open for writing to a temporary
+    file in the same directory as the target file. When
+    the block completes the data are flushed and synced
+    to disk, and the temporary file is renamed to the
+    target (so the target is never left partially
+    written). If the block raises an exception then the
+    temporary file is removed and the target is left
+    unchanged.
+
+    The permissions of an existing target file are
+    preserved (otherwise the default permissions for
+    new files are used).
+
+    Example usage:
+
+    >>> with atomic_write('metadata.info') as fp:
+    ...    fp.write("Run\t170901_M00879_0087\n")
+
+    Arguments:
+      filen (str): path of the file to write
+    """
+    filen = os.path.abspath(filen)
+    # Permissions for the final file
+    try:
+        mode = stat.S_IMODE(os.stat(filen).st_mode)
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0666 & ~umask
+    fd,tmp_filen = tempfile.mkstemp(
+        dir=os.path.dirname(filen),
+        prefix=".%s." % os.path.basename(filen),
+        suffix=".tmp")
+    try:
+        with os.fdopen(fd,'w') as fp:
+            yield fp
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.chmod(tmp_filen,mode)
+        os.rename(tmp_filen,filen)
+    except:
+        if os.path.exists(tmp_filen):
+            os.remove(tmp_filen)
+        raise
+
 def bases_mask_is_paired_end(bases_mask):
     # Determine if run is paired end based on bases mask string
     non_index_reads = []
@@ -18,7 +18,7 @@
 # Module metadata
 #######################################################################
 
-__version__ = '0.1.10'
+__version__ = '0.1.11'
 
 #######################################################################
 # Import modules that this module depends on
@@ -40,8 +40,23 @@ import time
 
 class DataArchiver:
     # Class to handle archiving and verification
-
-    def __init__(self,archive_dir,new_group=None,log_dir=None):
+    #
+    # Each data directory is copied as a set of 'streams': one
+    # for the top level of the directory (which also creates
+    # the destination directory) and one for each of the
+    # first-level subdirectories. The streams are run
+    # concurrently (up to 'max_streams' at a time across all
+    # data directories), and each subtree is verified as soon
+    # as its copy has finished.
+    #
+    # Completed copy and verify operations are recorded in a
+    # checkpoint file next to the destination directory, so
+    # that an interrupted archiving run can be resumed without
+    # repeating them; the checkpoint is removed once all
+    # operations have completed successfully.
+
+    def __init__(self,archive_dir,new_group=None,log_dir=None,max_streams=4,
+                 bwlimit=None):
         # Top-level archive dir
         self._archive_dir = archive_dir
         # List of data directories
@@ -49,8 +64,15 @@ class DataArchiver:
         # Other options
         self._new_group = new_group
         self._log_dir = log_dir
-        # Set up runner(s)
+        self._max_streams = max(1,max_streams)
+        self._bwlimit = bwlimit
+        # Checkpointed operations, indexed by job name
+        self._checkpoint_ops = {}
+        # Set up runner(s) (copy operations have a dedicated
+        # runner, so their concurrency can be limited separately)
         self._runner = JobRunner.SimpleJobRunner(join_logs=True,log_dir=log_dir)
+        self._copy_runner = JobRunner.SimpleJobRunner(join_logs=True,
+                                                      log_dir=log_dir)
         # Set up a custom reporter for the scheduler
         reporter = simple_scheduler.SchedulerReporter(
             job_start="%(time_stamp)s: started operation '%(job_name)s'",
@@ -58,16 +80,24 @@ class DataArchiver:
             group_added="*** Setting up operations for %(group_name)s ***",
             group_end="*** Completed operations for %(group_name)s ***"
         )
-        # Set up and start scheduler
-        self._sched = simple_scheduler.SimpleScheduler(runner=self._runner,
-                                                       reporter=reporter,
-                                                       max_concurrent=4)
+        # Set up and start scheduler (allowing verification
+        # to run alongside the copy streams)
+        self._sched = simple_scheduler.SimpleScheduler(
+            runner=self._runner,
+            reporter=reporter,
+            max_concurrent=2*self._max_streams,
+            resource_usage=True)
+        self._sched.set_runner_limit(self._copy_runner,self._max_streams)
         self._sched.start()
 
     def add_data_dir(self,dirn):
         data_dir = bcf_utils.AttributeDictionary()
         data_dir['name'] = os.path.basename(dirn)
         data_dir['dirn'] = os.path.abspath(dirn)
+        data_dir['streams'] = [None] + list_stream_subdirs(dirn)
+        data_dir['checkpoint'] = ArchiveCheckpoint(
+            get_checkpoint_file(get_archive_dir(self._archive_dir,dirn),
+                                data_dir.name))
         data_dir['result'] = bcf_utils.AttributeDictionary(completed=1,
                                                            copy_status=None,
                                                            group_status=None,
@@ -80,6 +110,18 @@ class DataArchiver:
             raise Exception,"data_manager.py not found"
         # Set up archive jobs
         for data_dir in self._data_dirs:
+            # Check if everything was already done according
+            # to the checkpoint
+            if self._new_group is None and \
+               not [stream for stream in data_dir.streams
+                    for operation in ('copy','verify')
+                    if not data_dir.checkpoint.is_done(operation,stream)]:
+                print "All operations already completed for %s" % \
+                    data_dir.dirn
+                for op_status in ('copy_status','verify_status','completed'):
+                    data_dir.result[op_status] = 0
+                data_dir.checkpoint.remove()
+                continue
             # Make a containing group
             group = self._sched.group(data_dir.name,
                                       callbacks=(self.archiving_complete,))
@@ -103,7 +145,7 @@ class DataArchiver:
             # Make a containing group
             group = self._sched.group(data_dir.name,
                                       callbacks=(self.archiving_complete,))
-            self.schedule_verify(data_dir)
+            self.schedule_verify(data_dir,use_checkpoint=False)
             group.close()
         # Wait for all jobs to complete
         self._sched.wait()
@@ -115,12 +157,33 @@ class DataArchiver:
         archive_to = get_archive_dir(self._archive_dir,data_dir.dirn)
         # Fetch the group to contain this operation
         group = self._sched.lookup(data_dir.name)
-        # Set up copy operation
-        copy_name = "copy.%s" % data_dir.name
-        # Look for previous copy operation - these should run one at a time
-        wait_for = [j.name for j in self._sched.find("copy.*")]
-        job = group.add(['data_manager.py','--copy-to=%s' % archive_to,data_dir.dirn],
-                        name=copy_name,wait_for=wait_for)
+        # Set up a copy operation for each stream
+        top_level_copy = None
+        for stream in data_dir.streams:
+            copy_name = get_job_name("copy",data_dir.name,stream)
+            if data_dir.checkpoint.is_done("copy",stream):
+                print "Copy of %s already completed, skipping" % \
+                    get_stream_path(data_dir.dirn,stream)
+                self.update_status(data_dir,'copy_status',0)
+                continue
+            wait_for = []
+            # Subdirectories need the destination to exist
+            if top_level_copy is not None:
+                wait_for.append(top_level_copy)
+            if stream is None:
+                src = data_dir.dirn + os.sep
+                dest = os.path.join(archive_to,data_dir.name)
+            else:
+                src = os.path.join(data_dir.dirn,stream)
+                dest = os.path.join(archive_to,data_dir.name)
+            job = group.add(rsync_stream_command(src,dest,
+                                                 recursive=(stream is not None),
+                                                 bwlimit=self._bwlimit),
+                            runner=self._copy_runner,
+                            name=copy_name,wait_for=wait_for)
+            self.schedule_checkpoint(data_dir,"copy",stream,copy_name)
+            if stream is None:
+                top_level_copy = copy_name
 
     def schedule_group_reset(self,data_dir):
         print "Setting up group name reset on copy of %s in %s" % (data_dir.dirn,
@@ -129,11 +192,12 @@ class DataArchiver:
         # Fetch the group to contain this operation
         group = self._sched.lookup(data_dir.name)
         # Schedule group name reset
-        # Look for previous copy operation
+        # Look for previous copy operations
         wait_for = []
-        copy_name = "copy.%s" % data_dir.name
-        if self._sched.lookup(copy_name) is not None:
-            wait_for.append(copy_name)
+        for stream in data_dir.streams:
+            copy_name = get_job_name("copy",data_dir.name,stream)
+            if self._sched.lookup(copy_name) is not None:
+                wait_for.append(copy_name)
         # Set up group change operation
         set_group_name="set_group.%s" % data_dir.name
         job = group.add(['data_manager.py','--set-group=%s' % self._new_group,
@@ -145,21 +209,55 @@ class DataArchiver:
                          os.path.join(archive_to,data_dir.name)],
                         name=check_group_name,wait_for=(set_group_name,))
 
-    def schedule_verify(self,data_dir):
+    def schedule_verify(self,data_dir,use_checkpoint=True):
         print "Setting up checks on copy of %s in %s" % (data_dir.dirn,self._archive_dir)
         archive_to = get_archive_dir(self._archive_dir,data_dir.dirn)
         # Fetch the group to contain this operation
         group = self._sched.lookup(data_dir.name)
-        # Look for previous copy operation
-        wait_for = []
-        copy_name = "copy.%s" % data_dir.name
-        if self._sched.lookup(copy_name) is not None:
-            wait_for.append(copy_name)
-        # Set up verify operation
-        verify_name = "verify.%s" % data_dir.name
-        job = group.add(['data_manager.py','--verify=%s' % data_dir.dirn,
-                         os.path.join(archive_to,data_dir.name)],
-                        name=verify_name,wait_for=wait_for)
+        # Set up a verify operation for each stream
+        for stream in data_dir.streams:
+            if use_checkpoint and data_dir.checkpoint.is_done("verify",stream):
+                print "Verification of %s already completed, skipping" % \
+                    get_stream_path(data_dir.dirn,stream)
+                self.update_status(data_dir,'verify_status',0)
+                continue
+            # Look for previous copy operation
+            wait_for = []
+            copy_name = get_job_name("copy",data_dir.name,stream)
+            if self._sched.lookup(copy_name) is not None:
+                wait_for.append(copy_name)
+            # Set up verify operation
+            verify_name = get_job_name("verify",data_dir.name,stream)
+            verify = ['data_manager.py']
+            if stream is None:
+                verify.append('--top-level-only')
+            verify.extend(['--verify=%s' % get_stream_path(data_dir.dirn,stream),
+                           get_stream_path(os.path.join(archive_to,data_dir.name),
+                                           stream)])
+            job = group.add(verify,name=verify_name,wait_for=wait_for)
+            if use_checkpoint:
+                self.schedule_checkpoint(data_dir,"verify",stream,verify_name)
+
+    def schedule_checkpoint(self,data_dir,operation,stream,job_name):
+        # Record the operation in the checkpoint file when the
+        # job completes successfully
+        self._checkpoint_ops[job_name] = (data_dir,operation,stream)
+        self._sched.callback("checkpoint.%s" % job_name,
+                             self.checkpoint_complete,
+                             wait_for=(job_name,))
+
+    def checkpoint_complete(self,name,jobs,sched):
+        # Callback handler for completion of checkpointed operations
+        for job in jobs:
+            data_dir,operation,stream = self._checkpoint_ops[job.job_name]
+            if get_job_status(job) == 0:
+                data_dir.checkpoint.record(operation,stream)
+
+    def update_status(self,data_dir,op_status,status):
+        # Update the status for an operation on a data dir
+        # (non-zero statuses from other streams are kept)
+        if not data_dir.result[op_status]:
+            data_dir.result[op_status] = status
 
     def report_job_complete(self,name,jobs,sched):
         # Generic report completion of scheduled job(s)
@@ -185,34 +283,22 @@ class DataArchiver:
             logging.debug("\t%s" % job.job_name)
             if job.job_name.startswith("copy."):
                 # Check copy operation
-                fp = open(job.log,'rU')
-                for line in fp:
-                    if line.startswith("Copy completed with status "):
-                        data_dir.result['copy_status'] = int(line.split()[-1])
-                        logging.debug("\tCopy status:\t%s" % data_dir.result.copy_status)
-                        break
-                    ##print line.strip()
-                fp.close()
+                self.update_status(data_dir,'copy_status',get_job_status(job))
+                logging.debug("\tCopy status:\t%s" % data_dir.result.copy_status)
             elif job.job_name.startswith("check_group."):
                 # Check group setting operation
-                fp = open(job.log,'rU')
-                for line in fp:
-                    if line.startswith("Group/permissions check completed with status "):
-                        data_dir.result['group_status'] = int(line.split()[-1])
-                        logging.debug("\tGroup check:\t%s" % data_dir.result.group_status)
-                        break
-                    ##print line.strip()
-                fp.close()
+                self.update_status(data_dir,'group_status',get_job_status(job))
+                logging.debug("\tGroup check:\t%s" % data_dir.result.group_status)
             elif job.job_name.startswith("verify."):
                 # Check verification operation
-                fp = open(job.log,'rU')
-                for line in fp:
-                    if line.startswith("Verification completed with status "):
-                        data_dir.result['verify_status'] = int(line.split()[-1])
-                        logging.debug("\tVerify status:\t%s" % data_dir.result.verify_status)
-                        break
-                    ##print line.strip()
-                fp.close()
+                self.update_status(data_dir,'verify_status',get_job_status(job))
+                logging.debug("\tVerify status:\t%s" % data_dir.result.verify_status)
+        # Remove the checkpoint once everything has succeeded
+        if not [op_status for op_status in ('copy_status',
+                                            'group_status',
+                                            'verify_status')
+                if data_dir.result[op_status]]:
+            data_dir.checkpoint.remove()
 
     def result(self,data_dir):
         # Fetch the results for the specified data dir
@@ -269,10 +355,125 @@ class DataArchiver:
         for data_dir in self._data_dirs:
             self.status_for(data_dir,fp) != 0
 
+class ArchiveCheckpoint:
+    """Record of the completed operations for an archiving run
+
+    The checkpoint file has one line for each completed
+    operation, of the form 'OPERATION<TAB>STREAM' (where
+    the stream is the name of a subdirectory, or '.' for
+    the top level of the data directory).
+
+    Once the checkpoint has been removed any further
+    operations are not recorded (so that callbacks for
+    operations which complete at the same time as the
+    archiving can't recreate the file).
+
+    """
+    def __init__(self,checkpoint_file):
+        self._checkpoint_file = checkpoint_file
+        self._done = set()
+        self._removed = False
+        if os.path.exists(checkpoint_file):
+            with open(checkpoint_file,'r') as fp:
+                for line in fp:
+                    try:
+                        operation,stream = line.rstrip('\n').split('\t')
+                        self._done.add((operation,stream))
+                    except ValueError:
+                        pass
+
+    @property
+    def checkpoint_file(self):
+        return self._checkpoint_file
+
+    def is_done(self,operation,stream=None):
+        # Check if operation has been recorded for stream
+        return (operation,get_stream_name(stream)) in self._done
+
+    def record(self,operation,stream=None):
+        # Record that operation has completed for stream
+        stream = get_stream_name(stream)
+        if self._removed or (operation,stream) in self._done:
+            return
+        with open(self._checkpoint_file,'a') as fp:
+            fp.write("%s\t%s\n" % (operation,stream))
+            fp.flush()
+            os.fsync(fp.fileno())
+        self._done.add((operation,stream))
+
+    def remove(self):
+        # Remove the checkpoint file
+        if os.path.exists(self._checkpoint_file):
+            os.remove(self._checkpoint_file)
+        self._done = set()
+        self._removed = True
+
 #######################################################################
 # Functions
 #######################################################################
 
+def list_stream_subdirs(dirn):
+    # Return sorted list of the names of the subdirectories of
+    # dirn that will be copied as separate streams (links to
+    # directories are copied as links with the top level)
+    return sorted([d for d in os.listdir(dirn)
+                   if os.path.isdir(os.path.join(dirn,d)) and
+                   not os.path.islink(os.path.join(dirn,d))])
+
+def get_stream_name(stream):
+    # Return the name used for a stream ('.' for the top level)
+    if stream is None:
+        return '.'
+    return stream
+
+def get_stream_path(dirn,stream):
+    # Return the path for a stream within dirn
+    if stream is None:
+        return dirn
+    return os.path.join(dirn,stream)
+
+def get_job_name(operation,name,stream):
+    # Return the job name for an operation on a stream
+    if stream is None:
+        return "%s.%s" % (operation,name)
+    return "%s.%s.%s" % (operation,name,stream)
+
+def get_checkpoint_file(archive_to,name):
+    # Return path for the checkpoint file for a data dir
+    return os.path.join(archive_to,".%s.archive_checkpoint" % name)
+
+def get_job_status(job):
+    # Return the status for a completed job
+    #
+    # For data_manager.py operations the status is taken from
+    # the job log; otherwise the job exit code is used
+    prefixes = ("Copy completed with status ",
+                "Group/permissions check completed with status ",
+                "Verification completed with status ",)
+    try:
+        with open(job.log,'rU') as fp:
+            for line in fp:
+                for prefix in prefixes:
+                    if line.startswith(prefix):
+                        return int(line.split()[-1])
+    except (IOError,TypeError):
+        pass
+    return job.exit_code
+
+def rsync_stream_command(src,dest,recursive=True,bwlimit=None):
+    # Return rsync command to copy a stream
+    #
+    # Uses the same options as DataDir.copy in data_manager.py,
+    # plus --partial so interrupted transfers of large files can
+    # be resumed; if recursive is False then only the top level
+    # of src is copied (subdirectories are created empty)
+    rsync_options = '-rplotDE' if recursive else '-dplotDE'
+    rsync = ['rsync',rsync_options,'--partial','--chmod=u+rwX,g+rwX,o-w']
+    if bwlimit is not None:
+        rsync.append('--bwlimit=%s' % bwlimit)
+    rsync.extend([src,dest])
+    return rsync
+
 def extract_year_and_platform(dirname):
     # Given directory path return the year and platform
     # if found and return as a tuple (year,platform)
@@ -509,6 +710,112 @@ class TestDataArchiver(unittest.TestCase):
         self.assertEqual(status,0)
         self.assertEqual(archiver.status,0)
 
+    def test_archive_single_data_dir_leaves_no_checkpoint(self):
+        """DataArchiver removes checkpoint after successful archiving
+
+        """
+        checkpoint_file = get_checkpoint_file(
+            self.archive_dir,os.path.basename(self.data_dir))
+        archiver = DataArchiver(self.archive_dir,log_dir=self.log_dir)
+        archiver.add_data_dir(self.data_dir)
+        status = archiver.archive_dirs()
+        self.assertEqual(status,0)
+        self.assertFalse(os.path.exists(checkpoint_file))
+
+    def test_archive_data_dir_resume_from_checkpoint(self):
+        """DataArchiver resumes interrupted archiving from checkpoint
+
+        """
+        # Make a partial copy with one subdirectory missing
+        dest_dir = os.path.join(self.archive_dir,os.path.basename(self.data_dir))
+        archiver = DataArchiver(self.archive_dir,log_dir=self.log_dir)
+        archiver.add_data_dir(self.data_dir)
+        status = archiver.archive_dirs()
+        self.assertEqual(status,0)
+        TestUtils.remove_dir(os.path.join(dest_dir,'countries'))
+        # Also remove a top-level file (which shouldn't be
+        # restored as the top level is in the checkpoint)
+        os.remove(os.path.join(dest_dir,'hello'))
+        # Write a checkpoint recording all the other streams
+        checkpoint = ArchiveCheckpoint(get_checkpoint_file(
+            self.archive_dir,os.path.basename(self.data_dir)))
+        for stream in [None] + list_stream_subdirs(self.data_dir):
+            if stream != 'countries':
+                checkpoint.record('copy',stream)
+                checkpoint.record('verify',stream)
+        self.assertTrue(os.path.exists(checkpoint.checkpoint_file))
+        # Run the archiver again
+        archiver = DataArchiver(self.archive_dir,log_dir=self.log_dir)
+        archiver.add_data_dir(self.data_dir)
+        status = archiver.archive_dirs()
+        # Check the missing stream was restored
+        self.check_directory_contents(os.path.join(self.data_dir,'countries'),
+                                      os.path.join(dest_dir,'countries'))
+        self.assertFalse(os.path.exists(os.path.join(dest_dir,'hello')))
+        # Check the status and that the checkpoint was removed
+        self.assertEqual(archiver.result(self.data_dir).copy_status,0)
+        self.assertEqual(archiver.result(self.data_dir).verify_status,0)
+        self.assertEqual(status,0)
+        self.assertFalse(os.path.exists(checkpoint.checkpoint_file))
+
+    def test_archive_data_dir_all_done_in_checkpoint(self):
+        """DataArchiver skips data directory completed in checkpoint
+
+        """
+        dest_dir = os.path.join(self.archive_dir,os.path.basename(self.data_dir))
+        archiver = DataArchiver(self.archive_dir,log_dir=self.log_dir)
+        archiver.add_data_dir(self.data_dir)
+        self.assertEqual(archiver.archive_dirs(),0)
+        # Remove a file from the copy and record all operations
+        # as done (so the file shouldn't be restored)
+        os.remove(os.path.join(dest_dir,'hello'))
+        checkpoint = ArchiveCheckpoint(get_checkpoint_file(
+            self.archive_dir,os.path.basename(self.data_dir)))
+        for stream in [None] + list_stream_subdirs(self.data_dir):
+            checkpoint.record('copy',stream)
+            checkpoint.record('verify',stream)
+        # Run the archiver again
+        archiver = DataArchiver(self.archive_dir,log_dir=self.log_dir)
+        archiver.add_data_dir(self.data_dir)
+        status = archiver.archive_dirs()
+        self.assertFalse(os.path.exists(os.path.join(dest_dir,'hello')))
+        self.assertEqual(archiver.result(self.data_dir).completed,0)
+        self.assertEqual(status,0)
+        self.assertFalse(os.path.exists(checkpoint.checkpoint_file))
+
+class TestArchiveCheckpoint(unittest.TestCase):
+    """Tests for ArchiveCheckpoint class
+    """
+    def setUp(self):
+        self.wd = TestUtils.make_dir()
+        self.checkpoint_file = os.path.join(self.wd,'.data.archive_checkpoint')
+
+    def tearDown(self):
+        TestUtils.remove_dir(self.wd)
+
+    def test_archive_checkpoint(self):
+        """ArchiveCheckpoint records and reloads completed operations
+        """
+        checkpoint = ArchiveCheckpoint(self.checkpoint_file)
+        self.assertFalse(checkpoint.is_done('copy'))
+        checkpoint.record('copy')
+        checkpoint.record('copy','subdir')
+        self.assertTrue(checkpoint.is_done('copy'))
+        self.assertTrue(checkpoint.is_done('copy','subdir'))
+        self.assertFalse(checkpoint.is_done('verify','subdir'))
+        # Reload from file
+        checkpoint = ArchiveCheckpoint(self.checkpoint_file)
+        self.assertTrue(checkpoint.is_done('copy'))
+        self.assertTrue(checkpoint.is_done('copy','subdir'))
+        self.assertFalse(checkpoint.is_done('verify','subdir'))
+        # Remove
+        checkpoint.remove()
+        self.assertFalse(os.path.exists(self.checkpoint_file))
+        self.assertFalse(checkpoint.is_done('copy'))
+        # Operations aren't recorded after removal
+        checkpoint.record('verify')
+        self.assertFalse(os.path.exists(self.checkpoint_file))
+
 class TestExtractYearAndPlatformFunction(unittest.TestCase):
     """Tests for extract_year_and_platform() function
     """
@@ -565,6 +872,14 @@ if __name__ == "__main__":
                  help="only run MD5 checksums and link checks, don't run copy")
     p.add_option("--no-checks",action='store_true',dest="no_checks",default=False,
                  help="only copy, don't run MD5 checksums or link checks")
+    p.add_option("--streams",action='store',dest='max_streams',type='int',
+                 default=4,
+                 help="maximum number of concurrent copy streams (default: 4); "
+                 "each data directory is copied as one stream for the top level "
+                 "plus one for each subdirectory")
+    p.add_option("--bwlimit",action='store',dest='bwlimit',default=None,
+                 help="limit the I/O bandwidth of each copy stream to BWLIMIT "
+                 "KBytes per second (passed to rsync)")
     p.add_option("--report",action='store',dest="report_file",default=None,
                  help="write final report to REPORT_FILE (otherwise write to stdout)")
     p.add_option("--debug",action='store_true',dest='debug',
@@ -605,7 +920,9 @@ if __name__ == "__main__":
         sys.exit()
 
     # Construct, populate and run archiver
-    archiver = DataArchiver(archive_dir,new_group=new_group,log_dir=log_dir)
+    archiver = DataArchiver(archive_dir,new_group=new_group,log_dir=log_dir,
+                            max_streams=options.max_streams,
+                            bwlimit=options.bwlimit)
     for data_dir in data_dirs:
         archiver.add_data_dir(data_dir)
     if not options.only_checks:
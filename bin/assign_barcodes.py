@@ -24,7 +24,12 @@ if __name__ == '__main__':
     p.add_option('-n',action='store',dest='n',type='int',default=5,
                  help="remove first N bases from each read and assign "
                  "these as barcode index sequence (default: 5)")
+    p.add_option('-t','--threads',action='store',dest='nthreads',
+                 type='int',default=1,
+                 help="number of threads to use when compressing "
+                 "gzipped output (requires 'pigz'; default: 1)")
     opts,args = p.parse_args()
     if len(args) != 2:
         p.error('Need to specify input and output files')
-    assign_barcodes_single_end(args[0],args[1],opts.n)
+    assign_barcodes_single_end(args[0],args[1],opts.n,
+                               nthreads=opts.nthreads)
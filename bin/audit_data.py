@@ -32,9 +32,31 @@ import logging
 import optparse
 import sys
 import os
+import re
 import time
 import data_manager
 import simple_xls
+from auto_process_ngs.dirwalk import walk_usage
+from auto_process_ngs.dirwalk import DiskUsage
+from auto_process_ngs.dirwalk import UsageIndex
+
+#######################################################################
+# Constants
+#######################################################################
+
+# Categories used to classify disk usage, as tuples of
+# (attribute,regex) where the regex is matched against the
+# name of each file and directory
+DISK_USAGE_CATEGORIES = (
+    ('du_fastqs',re.compile(r'.*\.fastq$')),
+    ('du_fastqgzs',re.compile(r'.*\.fastq\.gz$')),
+    ('du_solid',re.compile(r'.*\.(csfasta|qual)$')),
+    ('du_bams',re.compile(r'.*\.bam$')),
+    ('du_sams',re.compile(r'.*\.sam$')),
+    ('du_compressed_bams',re.compile(r'.*\.bam\.(gz|bz2)$')),
+    ('du_compressed_sams',re.compile(r'.*\.sam\.(gz|bz2)$')),
+    ('du_beds',re.compile(r'.*\.bed$')),
+)
 
 #######################################################################
 # Classes
@@ -57,7 +79,7 @@ class SeqDataSizes:
         self.du_fastqs = None
         self.du_fastqgzs = None
         self.du_solid = None
-        self.du_bam = None
+        self.du_bams = None
         self.du_compressed_bams = None
         self.du_sams = None
         self.du_compressed_sams = None
@@ -65,6 +87,7 @@ class SeqDataSizes:
         self.is_subdir = is_subdir
         self.include_subdirs = include_subdirs
         self.subdirs = []
+        self._usage = None
         if not is_subdir and include_subdirs:
             for d in bcf_utils.list_dirs(self.dirn):
                 self.subdirs.append(SeqDataSizes(d,os.path.join(self.dirn,d),
@@ -111,23 +134,81 @@ class SeqDataSizes:
 
     @property
     def users(self):
+        """Return list of user names owning files in the directory
+
+        If 'get_disk_usage' has already been invoked then the
+        owners recorded when collecting the usage are returned,
+        otherwise the directory is walked to find them.
+
         """
+        if self._usage is None:
+            return data_manager.DataDir(self.dirn).users
+        return self._usage.users
+
+    def set_disk_usage(self,usage):
+        """Set the disk usage totals from a DiskUsage instance
+
+        Arguments:
+          usage: DiskUsage instance with the categories
+            from DISK_USAGE_CATEGORIES
+
         """
-        return data_manager.DataDir(self.dirn).users
-
-    def get_disk_usage(self):
-        d = data_manager.DataDir(self.dirn)
-        self.du_total = d.get_size()
-        self.du_fastqs = d.get_size(pattern='.*\.fastq$')
-        self.du_fastqgzs = d.get_size(pattern='.*\.fastq.gz$')
-        self.du_solid = d.get_size(pattern='.*\.(csfasta|qual)$')
-        self.du_bams = d.get_size(pattern='.*\.bam$')
-        self.du_sams = d.get_size(pattern='.*\.sam$')
-        self.du_compressed_bams = d.get_size(pattern='.*\.bam\.(gz|bz2)$')
-        self.du_compressed_sams = d.get_size(pattern='.*\.sam\.(gz|bz2)$')
-        self.du_beds = d.get_size(pattern='.*\.bed$')
+        self.du_total = usage.apparent_size
+        for attr,pattern in DISK_USAGE_CATEGORIES:
+            setattr(self,attr,usage.categories.get(attr,0))
+        self._usage = usage
+
+    def get_disk_usage(self,nthreads=1,index=None,refresh=False):
+        """Collect the disk usage for the directory and subdirectories
+
+        The directory is walked once, with each file and
+        directory being classified into all the categories
+        at the same time and its owner recorded. Usage for
+        the first-level subdirectories is accumulated from
+        the same walk.
+
+        Arguments:
+          nthreads: number of threads to use for walking
+            the directory tree (default: 1)
+          index: optional, UsageIndex instance with stored
+            usage for unchanged directories (updated with the
+            usage for any other directories)
+          refresh: if True then ignore stored usage in the
+            index and rescan all directories
+
+        """
+        top_dir = os.path.abspath(self.dirn)
+        subdirs = dict([(subdir.name,subdir) for subdir in self.subdirs])
+        usage = DiskUsage()
+        subdir_usage = dict()
+        for dirn,st,dir_usage in walk_usage(self.dirn,
+                                            nthreads=nthreads,
+                                            classify=classify_name,
+                                            index=index,
+                                            refresh=refresh):
+            usage.merge(dir_usage)
+            if dirn == top_dir:
+                # Add the top-level directory itself
+                usage.add(st,classify_name(os.path.basename(dirn)))
+                continue
+            # Also add to the first-level subdirectory (NB parent
+            # directories are always walked before their contents)
+            name = os.path.relpath(dirn,top_dir).split(os.sep)[0]
+            if name not in subdirs:
+                continue
+            if name not in subdir_usage:
+                subdir_usage[name] = DiskUsage()
+                subdir_usage[name].add(st,classify_name(name))
+            subdir_usage[name].merge(dir_usage)
+        self.set_disk_usage(usage)
         for subdir in self.subdirs:
-            subdir.get_disk_usage()
+            if subdir.name in subdir_usage:
+                subdir.set_disk_usage(subdir_usage[subdir.name])
+            else:
+                # Not walked (e.g. link to a directory elsewhere)
+                subdir.get_disk_usage(nthreads=nthreads,
+                                      index=index,
+                                      refresh=refresh)
 
     def dataline(self,formatter):
         if not self.is_subdir:
@@ -201,6 +282,16 @@ class UsageFormatter:
 # Functions
 #######################################################################
 
+def classify_name(name):
+    """Return the disk usage categories that a file name belongs to
+
+    Returns a list of the attributes from DISK_USAGE_CATEGORIES
+    with patterns that match 'name'.
+
+    """
+    return [attr for attr,pattern in DISK_USAGE_CATEGORIES
+            if pattern.match(name)]
+
 def get_seqdir_dataline(seqdir,formatter):
     if not seqdir.is_subdir:
         dataline = [seqdir.year,
@@ -302,6 +393,15 @@ if __name__ == "__main__":
     p.add_option("--include-subdirs",action='store_true',dest='include_subdirs',default=False,
                  help="also collect and report disk usage information for first level of "
                  "subdirectories in each data directory")
+    p.add_option("--threads",action='store',dest='nthreads',type='int',default=1,
+                 help="number of threads to use when walking directories (default: 1)")
+    p.add_option("--index",action='store',dest='index_file',default=None,
+                 help="store per-directory usage in the SQLite database INDEX_FILE "
+                 "and reuse it for directories which haven't changed since the "
+                 "last audit")
+    p.add_option("--refresh",action='store_true',dest='refresh',default=False,
+                 help="with --index, ignore stored usage and rescan all "
+                 "directories")
     p.add_option("--plot",action='store',dest='plot_file',default=None,
                  help="plot a stacked barchart of the usage and output as a PNG to PLOT_FILE")
     p.add_option("--debug",action='store_true',dest='debug',
@@ -352,6 +452,12 @@ if __name__ == "__main__":
             if platform not in platforms.list_platforms():
                 p.error("Unknown platform '%s' supplied to --platform option" % platform)
 
+    # Usage index
+    if options.index_file is not None:
+        index = UsageIndex(options.index_file,scheme='audit_data')
+    else:
+        index = None
+
     # Report before starting
     print "Years:\t%s" % ','.join([str(x) for x in years])
     print "Platforms:\t%s" % ','.join(platform_list)
@@ -379,8 +485,12 @@ if __name__ == "__main__":
                     else:
                         seqdir = SeqDataSizes(run,run_dir,year=year,platform=platform,
                                               include_subdirs=options.include_subdirs)
-                        seqdir.get_disk_usage()
+                        seqdir.get_disk_usage(nthreads=options.nthreads,
+                                              index=index,
+                                              refresh=options.refresh)
                         seqdirs.append(seqdir)
+    if index is not None:
+        index.save()
 
     # Calculate totals for each year
     usage = dict()
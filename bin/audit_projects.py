@@ -18,12 +18,14 @@ import os
 import sys
 import bcftbx.utils as utils
 from auto_process_ngs.utils import AnalysisDir
+from auto_process_ngs.dirwalk import get_disk_usage
+from auto_process_ngs.dirwalk import UsageIndex
 
 #######################################################################
 # Functions
 #######################################################################
 
-def get_size(f):
+def get_size(f,nthreads=1,index=None,refresh=False):
     """
     Return size (in bytes) for file or directory
     
@@ -31,9 +33,9 @@ def get_size(f):
     number of blocks * 512.
 
     """
-    return get_blocks(f)*512
+    return get_blocks(f,nthreads=nthreads,index=index,refresh=refresh)*512
 
-def get_blocks(f):
+def get_blocks(f,nthreads=1,index=None,refresh=False):
     """
     Return number of 512-byte blocks for file or directory
     
@@ -41,18 +43,16 @@ def get_blocks(f):
     os.lstat() function.
 
     For a directory, returns the sum of all 'st_blocks' values
-    for the directory contents (recursing into subdirectories
-    as required).
+    for the directory and its contents (collected in a single
+    walk of the directory tree using 'nthreads' threads).
+
+    If a UsageIndex is supplied then stored values are used
+    for directories which haven't changed since they were
+    indexed (unless 'refresh' is True).
 
     """
-    blocks = os.lstat(f).st_blocks
-    if not os.path.isfile(f):
-        for dirpath,dirnames,filenames in os.walk(f):
-            for d in dirnames:
-                blocks += os.lstat(os.path.join(dirpath,d)).st_blocks
-            for f in filenames:
-                blocks += os.lstat(os.path.join(dirpath,f)).st_blocks
-    return blocks
+    return get_disk_usage(f,nthreads=nthreads,index=index,
+                          refresh=refresh).blocks
 
 #######################################################################
 # Main program
@@ -71,7 +71,22 @@ if __name__ == "__main__":
                  "patterns)")
     p.add_option("--unassigned",action='store_true',dest="unassigned",default=False,
                  help="List data for projects where PI is not assigned")
+    p.add_option("--threads",action='store',dest="nthreads",type='int',default=1,
+                 help="Number of threads to use when walking directories "
+                 "(default: 1)")
+    p.add_option("--index",action='store',dest="index_file",default=None,
+                 help="Store per-directory usage in the SQLite database "
+                 "INDEX_FILE and reuse it for directories which haven't "
+                 "changed since the last audit")
+    p.add_option("--refresh",action='store_true',dest="refresh",default=False,
+                 help="With --index, ignore stored usage and rescan all "
+                 "directories")
     opts,args = p.parse_args()
+    # Usage index
+    if opts.index_file is not None:
+        index = UsageIndex(opts.index_file,scheme='audit_projects')
+    else:
+        index = None
     # Collect data
     audit_data = {}
     unassigned = []
@@ -82,10 +97,15 @@ if __name__ == "__main__":
             #print "Examining %s" % dirn
             try:
                 run = AnalysisDir(dirn)
-                for p in run.get_projects():
-                    if p.name == "undetermined":
-                        undetermined.append((p,get_size(p.dirn)))
-                        continue
+                # Undetermined reads
+                if run.undetermined is not None:
+                    p = run.undetermined
+                    undetermined.append(
+                        (p,get_size(p.dirn,nthreads=opts.nthreads,
+                                    index=index,refresh=opts.refresh)))
+                # NB projects are only populated from their directory
+                # contents if their data are needed
+                for p in run.list_projects():
                     pi = p.info.PI
                     if pi is None:
                         # PI is not assigned
@@ -100,7 +120,8 @@ if __name__ == "__main__":
                     if pi not in audit_data:
                         audit_data[pi] = []
                     # Acquire size of data
-                    size = get_size(p.dirn)
+                    size = get_size(p.dirn,nthreads=opts.nthreads,
+                                    index=index,refresh=opts.refresh)
                     if p.fastqs_are_symlinks:
                         # Actual fastq files are outside the project
                         # and need to be explicitly added
@@ -119,6 +140,8 @@ if __name__ == "__main__":
             except Exception,ex:
                 print "Failed to load as run: %s" % ex
                 pass
+    if index is not None:
+        index.save()
     # Sort into order by disk usage
     pi_list = audit_data.keys()
     pi_list = sorted(pi_list,key=lambda x: sum([y[1] for y in audit_data[x]]),
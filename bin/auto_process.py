@@ -43,6 +43,7 @@ Additional commands are available:
     clone
     samplesheet
     analyse_barcodes
+    qc_metrics
     merge_fastq_dirs
     update_fastq_stats
     import_project
@@ -486,6 +487,11 @@ def add_setup_analysis_dirs_command(cmdparser):
                  dest='link_to_fastqs',default=False,
                  help="create symbolic links to original fastqs from project directory "
                  "(default is to make hard links)")
+    p.add_option('-t','--threads',action='store',dest="nthreads",
+                 type='int',default=1,
+                 help="number of threads to use when making links to fastqs "
+                 "(default: 1)")
+    add_dry_run_option(p)
     add_debug_option(p)
 
 def add_run_qc_command(cmdparser):
@@ -543,6 +549,32 @@ def add_run_qc_command(cmdparser):
                           "to turn on decompression)")
     p.add_option_group(deprecated)
 
+def add_qc_metrics_command(cmdparser):
+    """Create a parser for the 'qc_metrics' command
+    """
+    p = cmdparser.add_command('qc_metrics',help="Export QC metrics as a table",
+                              usage="%prog qc_metrics [OPTIONS] [ANALYSIS_DIR]",
+                              description="Collect QC metrics (numbers of reads, "
+                              "%GC, FastQC module statuses and fastq_screen "
+                              "results) for all Fastqs in projects in "
+                              "ANALYSIS_DIR, and write to a single tab-delimited "
+                              "file.")
+    p.add_option('--projects',action='store',
+                 dest='project_pattern',default=None,
+                 help="simple wildcard-based pattern specifying a subset of "
+                 "projects to collect the QC metrics for.")
+    p.add_option('--qc_dir',action='store',dest='qc_dir',default=None,
+                 help="explicitly specify QC output directory (nb if "
+                 "supplied then the same QC_DIR will be used for each "
+                 "project. Non-absolute paths are assumed to be relative to "
+                 "the project directory). Default: the default QC directory "
+                 "for each project")
+    p.add_option('-o','--output',action='store',dest='out_file',default=None,
+                 help="file name for output table (default: "
+                 "'qc_metrics.tsv' in ANALYSIS_DIR)")
+    add_nprocessors_option(p,1)
+    add_debug_option(p)
+
 def add_publish_qc_command(cmdparser):
     """Create a parser for the 'publish_qc' command
     """
@@ -576,6 +608,27 @@ def add_publish_qc_command(cmdparser):
                  "if verification has failed")
     add_debug_option(p)
 
+def add_monitor_command(cmdparser):
+    """Create a parser for the 'monitor' command
+    """
+    p = cmdparser.add_command('monitor',help="Monitor running jobs",
+                              usage="%prog monitor [OPTIONS] [ANALYSIS_DIR]",
+                              description="Follow the scheduler event log "
+                              "for ANALYSIS_DIR and report the numbers of "
+                              "running, waiting and finished jobs, the "
+                              "throughput and the estimated time to "
+                              "completion.")
+    p.add_option('--event-log',action='store',dest='event_log',default=None,
+                 help="event log file to follow (default: most recently "
+                 "updated event log in the log directory)")
+    p.add_option('--interval',action='store',dest='interval',type='int',
+                 default=5,
+                 help="number of seconds between status updates "
+                 "(default: 5)")
+    p.add_option('--once',action='store_true',dest='once',default=False,
+                 help="report the current status and exit")
+    add_debug_option(p)
+
 def add_archive_command(cmdparser):
     """Create a parser for the 'archive' command
     """
@@ -787,6 +840,8 @@ if __name__ == "__main__":
     add_make_fastqs_command(p)
     add_setup_analysis_dirs_command(p)
     add_run_qc_command(p)
+    add_qc_metrics_command(p)
+    add_monitor_command(p)
     add_publish_qc_command(p)
     add_archive_command(p)
     add_report_command(p)
@@ -896,7 +951,7 @@ if __name__ == "__main__":
         else:
             analysis_dir = os.getcwd()
         # Turn off allow save for specific commands
-        if cmd in ('params','metadata','report'):
+        if cmd in ('params','metadata','report','qc_metrics','monitor'):
             allow_save = False
         # Run the specified stage
         d = AutoProcess(analysis_dir,allow_save_params=allow_save)
@@ -993,7 +1048,9 @@ if __name__ == "__main__":
                                   options.ignore_missing_metadata,
                                   undetermined_project=options.undetermined,
                                   short_fastq_names=options.short_fastq_names,
-                                  link_to_fastqs=options.link_to_fastqs)
+                                  link_to_fastqs=options.link_to_fastqs,
+                                  nthreads=options.nthreads,
+                                  dry_run=options.dry_run)
         elif cmd == 'run_qc':
             # Do the make_fastqs step
             retcode = d.run_qc(projects=options.project_pattern,
@@ -1006,6 +1063,17 @@ if __name__ == "__main__":
                                report_html=options.html_file,
                                runner=options.runner)
             sys.exit(retcode)
+        elif cmd == 'qc_metrics':
+            retcode = d.qc_metrics(projects=options.project_pattern,
+                                   qc_dir=options.qc_dir,
+                                   out_file=options.out_file,
+                                   nprocessors=options.nprocessors)
+            sys.exit(retcode)
+        elif cmd == 'monitor':
+            retcode = d.monitor(event_log=options.event_log,
+                                poll_interval=options.interval,
+                                once=options.once)
+            sys.exit(retcode)
         elif cmd == 'samplesheet':
             # Sample sheet operations
             if options.edit:
@@ -8,13 +8,17 @@ concat_fastqs.py
 
 Concatenate a list of fastq files.
 
+Gzipped inputs are joined directly into a gzipped output
+without decompressing; other inputs are compressed or
+decompressed as required to match the output.
+
 """
 
 import optparse
 import os
 import sys
 import logging
-from bcftbx.utils import concatenate_fastq_files
+from auto_process_ngs.fastq_utils import concat_fastqs
 import auto_process_ngs
 
 __version__ = auto_process_ngs.get_version()
@@ -43,8 +47,7 @@ if __name__ == "__main__":
             sys.exit(1)
     # Run the concatenation
     try:
-        concatenate_fastq_files(fastq_out,fastqs,
-                                verbose=opts.verbose)
+        concat_fastqs(fastqs,fastq_out,verbose=opts.verbose)
     except Exception as ex:
         logging.critical("Failed with exception: %s" % ex)
         sys.exit(1)
@@ -31,7 +31,8 @@ import optparse
 import logging
 import subprocess
 import bcf_utils
-import Md5sum
+from auto_process_ngs import checksums
+from auto_process_ngs import dirwalk
 
 #######################################################################
 # Classes
@@ -52,7 +53,8 @@ class DataDir:
         """
         """
         return self.__data_dir
-    def get_size(self,pattern=None,block_size=1,human_readable=False):
+    def get_size(self,pattern=None,block_size=1,human_readable=False,
+                 nthreads=1):
         """Return the total size of some or all files
 
         By default this returns the total size of the data dir
@@ -79,14 +81,21 @@ class DataDir:
             'block_size' bytes (default is 1)
           human_readable: report size in appropriate units,
             with unit identifier appended e.g. 1G
+          nthreads: number of threads to use for walking the
+            directory (default: 1; only used if no pattern is
+            supplied)
 
         Returns
           Total size for specified files/dirs in request units.
 
         """
-        size = 0
-        for f in self.walk(pattern=pattern):
-            size += os.lstat(f).st_size
+        if pattern is None:
+            size = dirwalk.get_disk_usage(self.dir,
+                                          nthreads=nthreads).apparent_size
+        else:
+            size = 0
+            for f in self.walk(pattern=pattern):
+                size += os.lstat(f).st_size
         #return int(float(size)/1024)
         if human_readable:
             # Format into human-readable format
@@ -95,7 +104,7 @@ class DataDir:
             # Return number of blocks, rounded
             # up or down to nearest integer
             return int(round(float(size)/float(block_size)))
-    def walk(self,include_dirs=True,pattern=None):
+    def walk(self,include_dirs=True,pattern=None,recursive=True):
         """Traverse the directory, subdirectories and files
         
         Arguments:
@@ -105,6 +114,9 @@ class DataDir:
             pattern which restricts the set of yielded files and
             directories to a subset of those which match the
             pattern
+          recursive: if False then don't descend into the
+            subdirectories (default is to traverse the whole
+            tree)
         
         """
         if pattern is not None:
@@ -122,6 +134,8 @@ class DataDir:
                 f1 = os.path.join(dirpath,f)
                 if pattern is None or matcher.match(f1):
                     yield f1
+            if not recursive:
+                break
     def copy(self,target,dry_run=False,verbose=False):
         """Create a copy of dir using rsync
 
@@ -209,16 +223,36 @@ class DataDir:
         user names which own files and/or directories within it.
 
         """
-        users = []
-        for f in self.walk():
-            user = str(bcf_utils.PathInfo(f).user)
-            if user not in users:
-                users.append(user)
-        users.sort()
-        return users
-    def verify(self,dirn):
+        return dirwalk.get_disk_usage(self.dir).users
+    def verify(self,dirn,nthreads=1,quick=False,manifest=None,
+               recursive=True):
         """Verify another data directory using this one as a reference
 
+        Files present in both directories are compared using
+        MD5 sums; the comparisons are performed using multiple
+        threads if 'nthreads' is greater than 1 (see
+        'checksums.compare_files').
+
+        Arguments:
+          dirn: path to the directory to verify
+          nthreads: optional, number of threads to use for
+            comparing files (default: 1)
+          quick: optional, if True then files with the same size
+            and modification time are compared using checksums
+            of sampled blocks rather than full MD5 sums
+          manifest: optional, path to a checksum manifest or
+            an 'md5sum'-format file with pre-computed MD5 sums
+            for the reference files (paths relative to the
+            reference directory); files listed in the manifest
+            are not read from the reference. If not supplied
+            then the checksum manifest in the reference
+            directory is used, if present (only entries whose
+            size and timestamp still match the file are used)
+          recursive: optional, if False then only check the
+            files, links and subdirectories at the top level
+            of the reference directory (default is to check
+            the whole tree)
+
         Returns
           Counter object.
 
@@ -233,8 +267,18 @@ class DataDir:
         result.add_quantity("types_differ","Copy types differ from reference")
         result.add_quantity("missing","Missing from copy")
         result.add_quantity("unreadable_ref","Unreadable reference")
+        # Load pre-computed checksums
+        reference_checksums = None
+        if manifest is None:
+            manifest = os.path.join(self.dir,checksums.CHECKSUM_MANIFEST)
+            if not os.path.exists(manifest):
+                manifest = None
+        if manifest is not None:
+            reference_checksums = checksums.load_reference_checksums(
+                manifest,base_dir=self.dir)
         # Walk the reference directory and check against copy
-        for f in self.walk():
+        file_pairs = []
+        for f in self.walk(recursive=recursive):
             f = bcf_utils.PathInfo(f).relpath(self.dir)
             ref = bcf_utils.PathInfo(f,basedir=self.dir)
             cpy = bcf_utils.PathInfo(f,basedir=data_dir.dir)
@@ -251,14 +295,10 @@ class DataDir:
                     print "TYPE DIFFERS (NOT FILE): %s" % ref.relpath(self.dir)
                     result.incr('types_differ')
                 else:
-                    # Compare MD5sums
-                    if Md5sum.Md5Checker.md5cmp_files(ref.path,cpy.path) == \
-                       Md5sum.Md5Checker.MD5_OK:
-                        print "MD5 OK: %s" % ref.relpath(self.dir)
-                        result.incr('ok')
-                    else:
-                        print "MD5 FAILED: %s" % ref.relpath(self.dir)
-                        result.incr('md5_failed')
+                    # Compare MD5sums later
+                    file_pairs.append((ref.relpath(self.dir),
+                                       ref.path,
+                                       cpy.path))
             elif ref.is_link:
                 # Check copy is the same type
                 if not cpy.is_link:
@@ -281,6 +321,21 @@ class DataDir:
                 else:
                     print "DIR OK: %s" % ref.relpath(self.dir)
                     result.incr('ok')
+        # Compare MD5sums for files
+        for f,outcome in checksums.compare_files(
+                file_pairs,
+                nthreads=nthreads,
+                quick=quick,
+                reference_checksums=reference_checksums):
+            if outcome == checksums.CHECKSUM_OK:
+                print "MD5 OK: %s" % f
+                result.incr('ok')
+            elif outcome == checksums.UNREADABLE_REFERENCE:
+                print "UNREADABLE REFERENCE: %s" % f
+                result.incr('unreadable_ref')
+            else:
+                print "MD5 FAILED: %s" % f
+                result.incr('md5_failed')
         # Finished
         return result
     def diff(self,dirn):
@@ -418,17 +473,12 @@ class Counter(bcf_utils.AttributeDictionary):
 # Functions
 #######################################################################
 
-def get_size(f):
-    if os.path.isfile(f):
-        return float(os.lstat(f).st_size)/1024
-    else:
-        size = 0
-        for dirpath,dirnames,filenames in os.walk(f):
-            for d in dirnames:
-                size += get_size(os.path.join(dirpath,d))
-            for f in filenames:
-                size += get_size(os.path.join(dirpath,f))
-        return size
+def get_size(f,nthreads=1):
+    """Return the size of a file, or of the contents of a directory, in Kb
+
+    """
+    usage = dirwalk.get_disk_usage(f,nthreads=nthreads,include_top=False)
+    return float(usage.apparent_size)/1024
 
 # http://stackoverflow.com/questions/6798097/find-regex-in-python-or-how-to-find-files-whose-whole-name-path-name
 def find(dirn,regex):
@@ -883,6 +933,84 @@ class TestDataDirVerify(unittest.TestCase):
         self.assertEqual(result.missing,4)
         self.assertEqual(result.unreadable_ref,0)
         self.assertEqual(result.ok+result.missing,result.total())
+    def test_verify_md5sums_differ_multiple_threads(self):
+        """DataDir.verify() confirms different MD5 sums using multiple threads
+
+        """
+        # Change content of file in copy
+        open(self.example_dir.path("icelandic/takk_fyrir"),'w').write("Thanking you")
+        # Do the verification
+        ref_dir = DataDir(self.ref)
+        result = ref_dir.verify(self.wd,nthreads=4)
+        self.assertTrue(result.total() > 0)
+        self.assertEqual(result.md5_failed,1)
+        self.assertEqual(result.md5_failed+result.ok,result.total())
+    def test_verify_quick(self):
+        """DataDir.verify() in quick mode confirms exact match for exact copy
+
+        """
+        ref_dir = DataDir(self.ref)
+        result = ref_dir.verify(self.wd,quick=True)
+        self.assertTrue(result.total() > 0)
+        self.assertEqual(result.ok,result.total())
+    def test_verify_with_manifest(self):
+        """DataDir.verify() uses MD5 sums from manifest for reference
+
+        """
+        # Make a manifest with a 'wrong' checksum for one file
+        manifest = os.path.join(os.path.dirname(self.ref),
+                                "%s.md5" % os.path.basename(self.ref))
+        with open(manifest,'w') as fp:
+            fp.write("%s  hello\n" % ('0'*32))
+        try:
+            ref_dir = DataDir(self.ref)
+            result = ref_dir.verify(self.wd,manifest=manifest)
+        finally:
+            os.remove(manifest)
+        self.assertTrue(result.total() > 0)
+        self.assertEqual(result.md5_failed,1)
+        self.assertEqual(result.md5_failed+result.ok,result.total())
+    def test_verify_with_checksum_manifest(self):
+        """DataDir.verify() uses checksum manifest in reference dir
+
+        """
+        # Make a manifest with a 'wrong' checksum for one file
+        # and a stale entry (which should be ignored) for another
+        manifest = os.path.join(self.ref,checksums.CHECKSUM_MANIFEST)
+        hello = os.path.join(self.ref,'hello')
+        goodbye = os.path.join(self.ref,'goodbye')
+        with open(manifest,'w') as fp:
+            fp.write("%s\n" % checksums.CHECKSUM_MANIFEST_HEADER)
+            fp.write("hello\t%d\t%d\t%s\n" %
+                     (os.path.getsize(hello),
+                      int(os.path.getmtime(hello)),
+                      '0'*32))
+            fp.write("goodbye\t%d\t%d\t%s\n" %
+                     (os.path.getsize(goodbye)+1,
+                      int(os.path.getmtime(goodbye)),
+                      '0'*32))
+        try:
+            ref_dir = DataDir(self.ref)
+            result = ref_dir.verify(self.wd)
+        finally:
+            os.remove(manifest)
+        self.assertTrue(result.total() > 0)
+        self.assertEqual(result.md5_failed,1)
+    def test_verify_top_level_only(self):
+        """DataDir.verify() only checks top level if not recursive
+
+        """
+        # Remove a file from a subdirectory of the copy
+        os.remove(self.example_dir.path("countries/spain"))
+        # Do the verification
+        ref_dir = DataDir(self.ref)
+        result = ref_dir.verify(self.wd,recursive=False)
+        self.assertTrue(result.total() > 0)
+        self.assertEqual(result.ok,result.total())
+        self.assertEqual(result.missing,0)
+        # Check that full verification finds the missing file
+        result = ref_dir.verify(self.wd)
+        self.assertEqual(result.missing,1)
 
 class TestDataDirDiff(unittest.TestCase):
     """Tests for the DataDir class 'diff' functionality
@@ -1104,6 +1232,29 @@ if __name__ == "__main__":
                      'common files, link targets for common links, and any files '
                      'or directories missing from DATA_DIR which are present in '
                      'REF_DIR')
+    group.add_option('--threads',action='store',dest='nthreads',type='int',
+                     default=1,
+                     help='number of threads to use when comparing files '
+                     'with --verify, or walking DATA_DIR with --info '
+                     '(default: 1)')
+    group.add_option('--quick',action='store_true',dest='quick',
+                     default=False,
+                     help='with --verify, compare files with the same size '
+                     'and timestamp using checksums of sampled blocks rather '
+                     'than full MD5 sums')
+    group.add_option('--manifest',action='store',dest='manifest',
+                     default=None,
+                     help='with --verify, read pre-computed MD5 sums for '
+                     'files in REF_DIR from MANIFEST (either a checksum '
+                     'manifest or in md5sum format, with paths relative '
+                     'to REF_DIR) instead of reading the reference files '
+                     '(default: use %s in REF_DIR, if present)' %
+                     checksums.CHECKSUM_MANIFEST)
+    group.add_option('--top-level-only',action='store_true',
+                     dest='top_level_only',default=False,
+                     help='with --verify, only check the items at the top '
+                     'level of REF_DIR (i.e. don\'t descend into the '
+                     'subdirectories)')
     group.add_option('--diff',action='store',dest='diff_dir',default=None,
                      help='check whether DATA_DIR contains files, directories and '
                      'symlinks in DIFF_DIR. Only lists missing items, not whether '
@@ -1143,7 +1294,7 @@ if __name__ == "__main__":
     # Get information
     if options.info:
         print "Gathering information about %s" % data_dir.dir
-        data_dir_size = data_dir.get_size()
+        data_dir_size = data_dir.get_size(nthreads=options.nthreads)
         print "Size: %fK (%s)" % (float(data_dir_size)/1024,
                                   bcf_utils.format_file_size(data_dir_size))
 
@@ -1176,7 +1327,11 @@ if __name__ == "__main__":
     if options.ref_dir is not None:
         print "Verifying %s against reference directory %s" % (data_dir.dir,
                                                                options.ref_dir)
-        result = DataDir(options.ref_dir).verify(data_dir.dir)
+        result = DataDir(options.ref_dir).verify(data_dir.dir,
+                                                 nthreads=options.nthreads,
+                                                 quick=options.quick,
+                                                 manifest=options.manifest,
+                                                 recursive=not options.top_level_only)
         # Print report
         result.report()
         status = 0 if result.total() == result.ok else 1
@@ -1235,7 +1390,8 @@ if __name__ == "__main__":
             print "Found %d temporary/hidden data items:" % len(temporary)
             for filen in temporary:
                 print "\t%s (%s)" % (os.path.relpath(filen,data_dir.dir),
-                                     bcf_utils.format_file_size(get_size(filen)))
+                                     bcf_utils.format_file_size(
+                                         get_size(filen)*1024))
         else:
             print "No temporary or hidden files found"
 
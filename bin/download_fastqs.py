@@ -20,10 +20,14 @@ Utility to download Fastq files from web server.
 
 import optparse
 import tempfile
+import urllib2
 from urllib2 import urlopen
 import re
 import sys
 import os
+import time
+import threading
+from multiprocessing.pool import ThreadPool
 try:
     import hashlib
 except ImportError:
@@ -36,41 +40,478 @@ except ImportError:
 
 BLOCKSIZE = 1024*1024
 
+# Default number of concurrent downloads
+NDOWNLOADS = 4
+
+# Extension for partially downloaded files
+PARTIAL_EXT = '.part'
+
+#######################################################################
+# Classes
+#######################################################################
+
+class DownloadProgress(object):
+    """Report progress for a batch of downloads
+
+    Keeps track of the number of files and bytes downloaded
+    across all downloads (which can be running in different
+    threads), and writes a one-line progress report to the
+    output stream (by default stdout) at most every 'interval'
+    seconds.
+
+    """
+    def __init__(self,nfiles,interval=1.0,fp=None):
+        self.nfiles = nfiles
+        self.nfiles_done = 0
+        self.nbytes = 0
+        self._interval = interval
+        self._fp = fp if fp is not None else sys.stdout
+        self._start = time.time()
+        self._last_report = 0
+        self._lock = threading.Lock()
+    def update(self,nbytes=0,file_done=False):
+        # Add to the totals and report (if due)
+        with self._lock:
+            self.nbytes += nbytes
+            if file_done:
+                self.nfiles_done += 1
+            now = time.time()
+            if file_done or now - self._last_report >= self._interval:
+                self._last_report = now
+                self._fp.write("\r%s" % self.status())
+                self._fp.flush()
+    def status(self):
+        # Return the progress report
+        elapsed = max(time.time() - self._start,0.001)
+        return "%d/%d files  %s downloaded  %s/s " % \
+            (self.nfiles_done,
+             self.nfiles,
+             format_size(self.nbytes),
+             format_size(self.nbytes/elapsed))
+    def finish(self):
+        # Write final report
+        with self._lock:
+            self._fp.write("\r%s\n" % self.status())
+            self._fp.flush()
+
 #######################################################################
 # Functions
 #######################################################################
 
-def download_file(url,dest):
-    # See http://stackoverflow.com/a/22776/579925
-    u = urlopen(url)
-    f = open(dest,'wb')
-    meta = u.info()
-    file_size = int(meta.getheaders("Content-Length")[0])
-    print "Downloading: %s Bytes: %s" % (dest, file_size)
-    file_size_dl = 0
-    block_sz = 8192
-    while True:
-        buffer = u.read(block_sz)
-        if not buffer:
-            break
-        file_size_dl += len(buffer)
-        f.write(buffer)
-        status = r"%10d  [%3.2f%%]" % (file_size_dl, file_size_dl * 100. / file_size)
-        status = status + chr(8)*(len(status)+1)
-        print status,
-    f.close()
+def download_file(url,dest,block_size=BLOCKSIZE,progress=None,resume=True):
+    """Download a file and return its MD5 checksum
 
-def check_md5sum(filen,md5):
+    The data are written to a temporary file 'DEST.part',
+    which is renamed to 'dest' once the download has
+    completed; the checksum is computed as the data are
+    received. If the server closes the connection before
+    all the data have been received (based on the size
+    given by the 'Content-Length' or 'Content-Range'
+    headers) then the partial file is kept and an
+    exception is raised.
+
+    If 'resume' is True and a partial file is already
+    present from an interrupted download then an HTTP
+    'Range' request is used to fetch only the remaining
+    data (if the server doesn't support ranges then the
+    whole file is downloaded again).
+
+    Arguments:
+      url: URL of the file to download
+      dest: path to write the downloaded file to
+      block_size: size of blocks to read the data in
+      progress: optional DownloadProgress instance to
+        update with the number of bytes downloaded
+      resume: if True (default) then resume partial
+        downloads
+
+    Returns:
+      MD5 checksum of the downloaded file as a hex digest.
+
+    """
+    partial = dest + PARTIAL_EXT
+    chksum = new_md5()
+    offset = 0
+    if resume and os.path.exists(partial):
+        # Checksum the data already downloaded
+        offset = os.path.getsize(partial)
+        with open(partial,'rb') as fp:
+            for block in iter(lambda: fp.read(block_size),''):
+                chksum.update(block)
+    request = urllib2.Request(url)
+    if offset:
+        request.add_header('Range','bytes=%d-' % offset)
+    try:
+        u = urlopen(request)
+    except urllib2.HTTPError as ex:
+        if ex.code == 416 and offset:
+            # Nothing left to download
+            os.rename(partial,dest)
+            return chksum.hexdigest()
+        raise
+    try:
+        if offset and u.getcode() != 206:
+            # Server doesn't support ranges: start again
+            offset = 0
+            chksum = new_md5()
+        # Get the expected total size of the file
+        expected_size = get_expected_size(u.info(),offset)
+        nbytes = offset
+        with open(partial,'ab' if offset else 'wb') as fp:
+            while True:
+                block = u.read(block_size)
+                if not block:
+                    break
+                chksum.update(block)
+                fp.write(block)
+                nbytes += len(block)
+                if progress is not None:
+                    progress.update(len(block))
+    finally:
+        u.close()
+    # NB httplib doesn't raise an exception if the connection
+    # is closed early, so check that all the data arrived
+    if expected_size is not None and nbytes != expected_size:
+        raise Exception("Incomplete download of %s: received %d of "
+                        "%d bytes" % (url,nbytes,expected_size))
+    os.rename(partial,dest)
+    return chksum.hexdigest()
+
+def get_expected_size(headers,offset=0):
+    """Return the expected total size of a downloaded file
+
+    The size is taken from the 'Content-Range' header if
+    present (i.e. for a response to a 'Range' request),
+    otherwise from the 'Content-Length' header plus the
+    offset that the download started from.
+
+    Arguments:
+      headers: headers from the HTTP response (e.g. from
+        the 'info' method of the object returned by
+        'urlopen')
+      offset: number of bytes already downloaded before
+        the request
+
+    Returns:
+      Expected size in bytes, or None if it can't be
+      determined from the headers.
+
+    """
+    content_range = headers.get('Content-Range')
+    if content_range:
+        m = re.match(r'^bytes \d+-\d+/(\d+)$',content_range.strip())
+        if m:
+            return int(m.group(1))
+    content_length = headers.get('Content-Length')
+    if content_length:
+        try:
+            return offset + int(content_length)
+        except ValueError:
+            pass
+    return None
+
+def download_files(url,chksums,ndownloads=NDOWNLOADS,block_size=BLOCKSIZE,
+                   progress=True):
+    """Download files in parallel and verify their MD5 checksums
+
+    Files are downloaded from 'url' into the current
+    directory; files which already exist are not downloaded
+    again (but are still checked). Partial downloads are
+    resumed (see 'download_file').
+
+    Arguments:
+      url: base URL to download the files from
+      chksums: dictionary mapping file names to their
+        MD5 checksums
+      ndownloads: number of files to download concurrently
+      block_size: size of blocks to read the data in
+      progress: if True (default) then report progress
+        for the whole batch
+
+    Returns:
+      List of (filename,status) tuples in the same order
+      as the sorted file names, where 'status' is 'OK',
+      'FAILED' (checksum mismatch) or an error message.
+
+    """
+    file_list = sorted(chksums.keys())
+    if progress:
+        progress = DownloadProgress(len(file_list))
+    else:
+        progress = None
+    def download(f):
+        try:
+            if os.path.exists(f):
+                chksum = md5sum(f,block_size=block_size)
+            else:
+                chksum = download_file(os.path.join(url,f),f,
+                                       block_size=block_size,
+                                       progress=progress)
+            status = ('OK' if chksum == chksums[f] else 'FAILED')
+        except Exception as ex:
+            status = "ERROR %s" % ex
+        if progress is not None:
+            progress.update(file_done=True)
+        return (f,status)
+    pool = ThreadPool(max(1,ndownloads))
+    try:
+        results = pool.map(download,file_list)
+    finally:
+        pool.close()
+        pool.join()
+    if progress is not None:
+        progress.finish()
+    return results
+
+def new_md5():
+    # Return a new MD5 checksum object
     try:
-        c = hashlib.md5()
+        return hashlib.md5()
     except NameError:
-        c = md5.new()
-    f = open(filen,'rb')
-    for block in iter(lambda: f.read(BLOCKSIZE),''):
-        c.update(block)
-    c = c.digest()
-    chksum = ("%02x"*len(c)) % tuple(map(ord,c))
-    return (chksum == md5)
+        return md5.new()
+
+def md5sum(filen,block_size=BLOCKSIZE):
+    # Return MD5 checksum for a file as a hex digest
+    c = new_md5()
+    with open(filen,'rb') as f:
+        for block in iter(lambda: f.read(block_size),''):
+            c.update(block)
+    return c.hexdigest()
+
+def check_md5sum(filen,md5):
+    return (md5sum(filen) == md5)
+
+def format_size(nbytes):
+    # Return human-readable file size
+    for units in ('B','K','M','G'):
+        if nbytes < 1024:
+            break
+        nbytes /= 1024.0
+    else:
+        units = 'T'
+    if units == 'B':
+        return "%d%s" % (nbytes,units)
+    return "%.1f%s" % (nbytes,units)
+
+#######################################################################
+# Tests
+#######################################################################
+
+import unittest
+import shutil
+import BaseHTTPServer
+
+class MockHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Serves files from the server's 'root' directory, with
+    # support for 'Range: bytes=N-' requests (unless the
+    # server's 'ranges' attribute is False); the headers of
+    # each request are recorded in the server's 'requests'.
+    # If the server's 'truncate' attribute is set then the
+    # connection is closed after sending that many bytes
+    # (but the headers still give the full size)
+    def do_GET(self):
+        self.server.requests.append((self.path,dict(self.headers)))
+        filen = os.path.join(self.server.root,self.path.lstrip('/'))
+        if not os.path.isfile(filen):
+            self.send_error(404)
+            return
+        data = open(filen,'rb').read()
+        offset = None
+        if self.server.ranges and 'range' in self.headers:
+            offset = int(re.match(r'bytes=(\d+)-',
+                                  self.headers['range']).group(1))
+            if offset >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range','bytes %d-%d/%d' %
+                             (offset,len(data)-1,len(data)))
+            data = data[offset:]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length',str(len(data)))
+        self.end_headers()
+        if self.server.truncate is not None:
+            data = data[:self.server.truncate]
+        self.wfile.write(data)
+    def log_message(self,format,*args):
+        pass
+
+class MockHTTPServer(object):
+    # Local HTTP server run in a separate thread
+    def __init__(self,root,ranges=True,truncate=None):
+        self.httpd = BaseHTTPServer.HTTPServer(('127.0.0.1',0),
+                                               MockHTTPRequestHandler)
+        self.httpd.root = root
+        self.httpd.ranges = ranges
+        self.httpd.truncate = truncate
+        self.httpd.requests = []
+        self.url = "http://127.0.0.1:%d" % self.httpd.server_port
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+    @property
+    def requests(self):
+        return self.httpd.requests
+    def set_truncate(self,truncate):
+        self.httpd.truncate = truncate
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class TestDownloadFile(unittest.TestCase):
+    """Tests for download_file() function
+    """
+    def setUp(self):
+        self.wd = tempfile.mkdtemp()
+        self.root = os.path.join(self.wd,'server')
+        os.mkdir(self.root)
+        self.data = ''.join([chr(i%256) for i in xrange(100000)])
+        with open(os.path.join(self.root,'test.fastq.gz'),'wb') as fp:
+            fp.write(self.data)
+        self.dest = os.path.join(self.wd,'test.fastq.gz')
+        self.server = None
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+        shutil.rmtree(self.wd)
+    def test_download_file(self):
+        """download_file: download file and return checksum
+        """
+        self.server = MockHTTPServer(self.root)
+        chksum = download_file(self.server.url + '/test.fastq.gz',
+                               self.dest,block_size=4096)
+        self.assertEqual(chksum,hashlib.md5(self.data).hexdigest())
+        self.assertEqual(open(self.dest,'rb').read(),self.data)
+        self.assertFalse(os.path.exists(self.dest + PARTIAL_EXT))
+    def test_download_file_resume(self):
+        """download_file: resume partial download using Range request
+        """
+        with open(self.dest + PARTIAL_EXT,'wb') as fp:
+            fp.write(self.data[:30000])
+        self.server = MockHTTPServer(self.root)
+        chksum = download_file(self.server.url + '/test.fastq.gz',
+                               self.dest,block_size=4096)
+        self.assertEqual(self.server.requests[0][1]['range'],'bytes=30000-')
+        self.assertEqual(chksum,hashlib.md5(self.data).hexdigest())
+        self.assertEqual(open(self.dest,'rb').read(),self.data)
+        self.assertFalse(os.path.exists(self.dest + PARTIAL_EXT))
+    def test_download_file_resume_complete_file(self):
+        """download_file: resume partial download with no data missing
+        """
+        with open(self.dest + PARTIAL_EXT,'wb') as fp:
+            fp.write(self.data)
+        self.server = MockHTTPServer(self.root)
+        chksum = download_file(self.server.url + '/test.fastq.gz',
+                               self.dest)
+        self.assertEqual(chksum,hashlib.md5(self.data).hexdigest())
+        self.assertEqual(open(self.dest,'rb').read(),self.data)
+    def test_download_file_resume_without_range_support(self):
+        """download_file: restart download if server ignores Range
+        """
+        with open(self.dest + PARTIAL_EXT,'wb') as fp:
+            fp.write("not the right data")
+        self.server = MockHTTPServer(self.root,ranges=False)
+        chksum = download_file(self.server.url + '/test.fastq.gz',
+                               self.dest,block_size=4096)
+        self.assertEqual(chksum,hashlib.md5(self.data).hexdigest())
+        self.assertEqual(open(self.dest,'rb').read(),self.data)
+
+    def test_download_file_connection_closed_early(self):
+        """download_file: keep partial file if connection closes early
+        """
+        self.server = MockHTTPServer(self.root,truncate=30000)
+        self.assertRaises(Exception,
+                          download_file,
+                          self.server.url + '/test.fastq.gz',
+                          self.dest,block_size=4096)
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertEqual(open(self.dest + PARTIAL_EXT,'rb').read(),
+                         self.data[:30000])
+        # Download is resumed on the next attempt
+        self.server.set_truncate(None)
+        chksum = download_file(self.server.url + '/test.fastq.gz',
+                               self.dest,block_size=4096)
+        self.assertEqual(self.server.requests[1][1]['range'],'bytes=30000-')
+        self.assertEqual(chksum,hashlib.md5(self.data).hexdigest())
+        self.assertEqual(open(self.dest,'rb').read(),self.data)
+        self.assertFalse(os.path.exists(self.dest + PARTIAL_EXT))
+
+class TestGetExpectedSize(unittest.TestCase):
+    """Tests for get_expected_size() function
+    """
+    def test_get_expected_size_content_length(self):
+        """get_expected_size: size from Content-Length
+        """
+        self.assertEqual(get_expected_size({'Content-Length':'100000'}),
+                         100000)
+        self.assertEqual(get_expected_size({'Content-Length':'70000'},
+                                           offset=30000),100000)
+    def test_get_expected_size_content_range(self):
+        """get_expected_size: size from Content-Range
+        """
+        self.assertEqual(get_expected_size(
+            {'Content-Length':'70000',
+             'Content-Range':'bytes 30000-99999/100000'},
+            offset=30000),100000)
+    def test_get_expected_size_no_headers(self):
+        """get_expected_size: no size if headers are missing
+        """
+        self.assertEqual(get_expected_size({}),None)
+
+class TestDownloadFiles(unittest.TestCase):
+    """Tests for download_files() function
+    """
+    def setUp(self):
+        self.wd = tempfile.mkdtemp()
+        self.root = os.path.join(self.wd,'server')
+        os.mkdir(self.root)
+        self.chksums = dict()
+        for i in xrange(5):
+            filen = "test%d.fastq.gz" % i
+            data = "file %d\n" % i * 1000
+            with open(os.path.join(self.root,filen),'wb') as fp:
+                fp.write(data)
+            self.chksums[filen] = hashlib.md5(data).hexdigest()
+        self.dest_dir = os.path.join(self.wd,'dest')
+        os.mkdir(self.dest_dir)
+        self.pwd = os.getcwd()
+        os.chdir(self.dest_dir)
+        self.server = MockHTTPServer(self.root)
+    def tearDown(self):
+        self.server.stop()
+        os.chdir(self.pwd)
+        shutil.rmtree(self.wd)
+    def test_download_files(self):
+        """download_files: download and verify multiple files
+        """
+        # Make an existing file (shouldn't be downloaded)
+        shutil.copy(os.path.join(self.root,'test0.fastq.gz'),self.dest_dir)
+        # Corrupt the checksum for one file
+        self.chksums['test1.fastq.gz'] = '0'*32
+        results = download_files(self.server.url,self.chksums,
+                                 ndownloads=3,progress=False)
+        self.assertEqual(results,[('test0.fastq.gz','OK'),
+                                  ('test1.fastq.gz','FAILED'),
+                                  ('test2.fastq.gz','OK'),
+                                  ('test3.fastq.gz','OK'),
+                                  ('test4.fastq.gz','OK')])
+        self.assertEqual(sorted([r[0] for r in self.server.requests]),
+                         ['/test1.fastq.gz',
+                          '/test2.fastq.gz',
+                          '/test3.fastq.gz',
+                          '/test4.fastq.gz'])
+        for f in self.chksums:
+            self.assertEqual(open(f,'rb').read(),
+                             open(os.path.join(self.root,f),'rb').read())
+    def test_download_files_missing_file(self):
+        """download_files: report error for missing file
+        """
+        self.chksums['missing.fastq.gz'] = '0'*32
+        results = dict(download_files(self.server.url,self.chksums,
+                                      progress=False))
+        self.assertTrue(results['missing.fastq.gz'].startswith('ERROR'))
+        self.assertEqual(results['test0.fastq.gz'],'OK')
 
 #######################################################################
 # Main program
@@ -82,6 +523,14 @@ if __name__ == "__main__":
                               "URL into current directory (or directory DIR, if "
                               "specified), and verify the downloaded files against "
                               "the checksum file.")
+    p.add_option('-n','--ndownloads',action='store',dest='ndownloads',
+                 type='int',default=NDOWNLOADS,
+                 help="number of files to download concurrently "
+                 "(default: %d)" % NDOWNLOADS)
+    p.add_option('--blocksize',action='store',dest='blocksize',
+                 type='int',default=BLOCKSIZE,
+                 help="size of blocks (in bytes) to read data in "
+                 "(default: %d)" % BLOCKSIZE)
     options,args = p.parse_args()
     if not len(args):
         p.error("Supply a URL to download Fastqs from, and an option target d")
@@ -113,32 +562,30 @@ if __name__ == "__main__":
     chksum_file = chksum_file.group(0)
     # Download chksum file
     print "Fetching %s" % chksum_file
-    download_file(os.path.join(url,chksum_file),chksum_file)
+    download_file(os.path.join(url,chksum_file),chksum_file,resume=False)
     # Get file list and checksums
     chksums = dict()
     with open(chksum_file,'r') as fp:
         for line in fp:
             chksum,filen = line.strip('\n').split()
             chksums[filen] = chksum
-    file_list = chksums.keys()
-    file_list.sort()
-    # Flag for checking MD5 sums
-    checksum_errors = False
     # Download the files
-    print "Downloading %d files" % len(file_list)
-    for f in file_list:
-        if os.path.exists(f):
-            print "%s: file exists, skipping download" % f
-        else:
-            download_file(os.path.join(url,f),f)
-        if check_md5sum(f,chksums[f]):
+    print "Downloading %d files" % len(chksums)
+    checksum_errors = False
+    for f,status in download_files(url,chksums,
+                                   ndownloads=options.ndownloads,
+                                   block_size=options.blocksize):
+        if status == 'OK':
             print "%s: checksum OK" % f
-        else:
+        elif status == 'FAILED':
             print "%s: checksum FAILED" % f
             checksum_errors = True
+        else:
+            print "%s: %s" % (f,status)
+            checksum_errors = True
     if checksum_errors:
-        sys.stderr.write("ERROR one or more checksums failed, see above\n")
+        sys.stderr.write("ERROR one or more downloads or checksums failed, "
+                         "see above\n")
         sys.exit(1)
     else:
         print "All checksums verified ok"
-
@@ -32,10 +32,12 @@ import shutil
 import tempfile
 import zipfile
 import fnmatch
+from multiprocessing.pool import ThreadPool
 import bcftbx.utils as bcf_utils
 import bcftbx.Md5sum as md5sum
 import auto_process_ngs.utils as utils
-import auto_process_ngs.applications as applications
+import auto_process_ngs.checksums as checksums
+import auto_process_ngs.fileops as fileops
 from auto_process_ngs import get_version
 
 #######################################################################
@@ -74,7 +76,8 @@ def get_fastqs(project,pattern=None):
                 target = fq
             yield (sample.name,fq,target)
 
-def write_checksums(project,pattern=None,filen=None,relative=True):
+def write_checksums(project,pattern=None,filen=None,relative=True,
+                    manifest=None):
     """Write MD5 checksums for fastq files with an AnalysisProject
 
     Arguments:
@@ -87,10 +90,14 @@ def write_checksums(project,pattern=None,filen=None,relative=True):
       relative: if True (default) then fastq file names
         will be the basename; otherwise they will be the
         full paths.
+      manifest: optional, ChecksumManifest instance; if
+        supplied then checksums are taken from the manifest
+        where the entries are still valid (and the manifest
+        is updated with any new checksums)
 
     """
     if filen:
-        fp = open(md5file,'w')
+        fp = open(filen,'w')
     else:
         fp = sys.stdout
     for sample_name,fastq,fq in get_fastqs(project,pattern=pattern):
@@ -98,55 +105,163 @@ def write_checksums(project,pattern=None,filen=None,relative=True):
             name = os.path.basename(fq)
         else:
             name = fq
-        fp.write("%s  %s\n" % (md5sum.md5sum(fq),name))
+        if manifest is not None:
+            chksum = manifest.md5sum(fq)
+        else:
+            chksum = md5sum.md5sum(fq)
+        fp.write("%s  %s\n" % (chksum,name))
     if filen:
         fp.close()
 
-def copy_to_dest(f,dirn,chksum=None):
-    """Copy a file to a local or remote destination
+def load_checksum_manifest(dirn):
+    """Load the checksum manifest for an analysis directory
+
+    Arguments:
+      dirn: path to the analysis directory
+
+    Returns:
+      ChecksumManifest instance, or None if the analysis
+      directory doesn't have a checksum manifest.
+
+    """
+    manifest_file = os.path.join(dirn,checksums.CHECKSUM_MANIFEST)
+    if not os.path.exists(manifest_file):
+        return None
+    return checksums.ChecksumManifest(dirn,manifest_file)
+
+def save_checksum_manifest(manifest):
+    """Save a checksum manifest if it has been updated
+
+    Failure to save (e.g. because the analysis directory
+    isn't writable) is reported but otherwise ignored.
+
+    Arguments:
+      manifest: ChecksumManifest instance (or None)
+
+    """
+    if manifest is None or not manifest.modified:
+        return
+    try:
+        manifest.save()
+    except (IOError,OSError) as ex:
+        sys.stderr.write("WARNING failed to update checksum manifest "
+                         "%s: %s\n" % (manifest.manifest_file,ex))
+
+def copy_fastqs(fastqs,dirn,md5file,nthreads=1,manifest=None,
+                verify=False):
+    """Copy files to a local or remote destination with checksums
 
-    Raises an exception if the copy operation fails.
+    The MD5 checksums of the files are computed while they
+    are being copied, and are written to 'md5file' (with
+    the file names being the basenames of the files) which
+    is also copied to the destination.
 
-    If 'chksum' argument is supplied then the MD5 sum of
-    the copy is also verified against this and an
-    exception is raised if this fails to match.
+    For a local destination up to 'nthreads' files are
+    copied concurrently. The data are only read once, so
+    by default the copies are not read back; if 'verify'
+    is True then each copy is also checked against the
+    checksum of the original as soon as it completes.
+
+    For a remote destination all the files are sent in a
+    single stream over one connection (see the
+    'fileops.FileOpsSession' class), and then all the copies
+    are checked together by running 'md5sum -c' on the remote
+    system.
+
+    Raises an exception if any of the copy operations or
+    checksum verifications fail.
 
     Arguments:
-      f: file to copy (must be local)
+      fastqs: list of files to copy (must be local)
       dirn: target directory, either local or of the form
         "[user@]host:dir"
-      chksum: (optional) MD5 sum of the original file
-        to match against the copy
-    
+      md5file: path to the (local) checksum file to write
+      nthreads: (optional) number of files to copy
+        concurrently to a local destination (default: 1)
+      manifest: (optional) ChecksumManifest instance; if
+        supplied then the checksums computed while copying
+        are also checked against any valid checksums in the
+        manifest (to detect files which were changed or read
+        incorrectly)
+      verify: (optional) if True then also read back each
+        copy to a local destination and check its checksum
+        (default: False)
+
+    Returns:
+      Dictionary mapping the file basenames to checksums.
+
     """
-    if not os.path.exists(f):
-        raise Exception("File %s doesn't exist" % f)
-    user,host,dest = utils.split_user_host_dir(dirn)
-    remote = (host is not None)
-    if not remote:
-        # Local copy
-        shutil.copy(f,dirn)
-        if chksum is not None:
-            if md5sum.md5sum(f) != chksum:
-                raise Exception("MD5 checksum failed for copy of %s" % f)
-    else:
-        # Remote copy
-        try:
-            scp = applications.general.scp(user,host,f,dest)
-            print "Running %s" % scp
-            scp.run_subprocess()
-            # Run md5sum -c on the remote system
-            if chksum is not None:
-                md5sum_check = applications.general.ssh_command(
-                    user,host,
-                    ('echo',
-                     '"%s  %s"' % (chksum,
-                                   os.path.join(dest,os.path.basename(f))),
-                    '|','md5sum','-c'))
-                print "Running %s" % md5sum_check
-                md5sum_check.run_subprocess()
-        except Exception, ex:
-            raise Exception("Failed to copy %s to %s: %s" % (f,dirn,ex))
+    for fq in fastqs:
+        if not os.path.exists(fq):
+            raise Exception("File %s doesn't exist" % fq)
+    dest = fileops.Location(dirn)
+    chksums = dict()
+    if dest.is_remote:
+        session = fileops.FileOpsSession(dirn)
+    try:
+        # Copy the files
+        if not dest.is_remote:
+            pool = ThreadPool(max(1,nthreads))
+            try:
+                for fq,chksum in pool.imap(_copy_with_checksum,
+                                           [(fq,dest.path,verify)
+                                            for fq in fastqs]):
+                    print "%s  %s" % (chksum,fq)
+                    chksums[fq] = chksum
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for fq in fastqs:
+                session.copy(fq,dest.path)
+            session.run()
+            for fq in fastqs:
+                chksums[fq] = session.md5sums[os.path.abspath(fq)]
+        # Check against the manifest
+        if manifest is not None:
+            for fq in fastqs:
+                chksum = manifest.lookup(fq)
+                if chksum is not None and chksum != chksums[fq]:
+                    raise Exception("MD5 checksum for %s doesn't match "
+                                    "checksum manifest" % fq)
+        # Write and copy the checksum file
+        with open(md5file,'w') as fp:
+            for fq in fastqs:
+                fp.write("%s  %s\n" % (chksums[fq],os.path.basename(fq)))
+        if not dest.is_remote:
+            shutil.copy(md5file,dest.path)
+        else:
+            # Verify all the remote copies
+            session.copy(md5file,dest.path)
+            session.check_md5sums(os.path.join(dest.path,
+                                               os.path.basename(md5file)))
+            session.run()
+    finally:
+        if dest.is_remote:
+            session.close()
+    return dict([(os.path.basename(fq),chksums[fq]) for fq in fastqs])
+
+def _copy_with_checksum(task):
+    """Internal: copy file and return its checksum
+
+    The checksum is computed while the data are copied.
+
+    Arguments:
+      task: tuple of (src,dirn,verify) where 'src' is the
+        file to copy, 'dirn' is the local target directory,
+        and if 'verify' is True then the copy is read back
+        and checked against the checksum of the original
+
+    Returns:
+      Tuple of (src,chksum).
+
+    """
+    src,dirn,verify = task
+    chksum = checksums.copy_with_md5sum(src,dirn)
+    if verify and \
+       checksums.md5sum(os.path.join(dirn,os.path.basename(src))) != chksum:
+        raise Exception("MD5 checksum failed for copy of %s" % src)
+    return (src,chksum)
 
 #######################################################################
 # Main program
@@ -168,6 +283,16 @@ if __name__ == "__main__":
     p.add_option('--fastq_dir',action='store',dest='fastq_dir',default=None,
                  help="explicitly specify subdirectory of DIR with "
                  "Fastq files to run the QC on.")
+    p.add_option('--threads',action='store',dest='nthreads',type='int',
+                 default=4,
+                 help="number of files to copy concurrently with the "
+                 "'copy' command, for a local DEST (default: 4)")
+    p.add_option('--verify',action='store_true',dest='verify',
+                 default=False,
+                 help="with the 'copy' command, also read back each "
+                 "copy to a local DEST and check its MD5 checksum "
+                 "(copies to a remote DEST are always checked on "
+                 "the remote system)")
     options,args = p.parse_args()
     # Get analysis dir
     try:
@@ -177,6 +302,7 @@ if __name__ == "__main__":
         p.error("Need to supply the path to an analysis dir")
         sys.exit(1)
     analysis_dir = utils.AnalysisDir(dirn)
+    manifest = load_checksum_manifest(dirn)
     # Get specified project
     try:
         project_name = args[1]
@@ -266,30 +392,20 @@ if __name__ == "__main__":
         except IndexError:
             p.error("Need to supply a destination for 'copy' command")
             sys.exit(1)
-        # Make a temporary MD5 file
+        # Copy fastqs and checksums
+        fastqs = [fq for sample_name,fastq,fq in
+                  get_fastqs(project,pattern=options.pattern)]
+        print "Copying %d fastqs to %s" % (len(fastqs),dest)
         tmp = tempfile.mkdtemp()
         try:
             md5file = os.path.join(tmp,"%s.chksums" % project.name)
-            sys.stdout.write("Creating checksum file %s..." % md5file)
-            write_checksums(project,pattern=options.pattern,filen=md5file)
-            print "done"
-            print("Copying to %s" % dest)
-            copy_to_dest(md5file,dest)
-            # Load checksums into dictionary
-            chksums = dict()
-            with open(md5file,'r') as fp:
-                for line in fp:
-                    chksum,filen = line.strip('\n').split()
-                    chksums[filen] = chksum
+            copy_fastqs(fastqs,dest,md5file,nthreads=options.nthreads,
+                        manifest=manifest,verify=options.verify)
+        except Exception as ex:
+            sys.stderr.write("FAILED %s\n" % ex)
+            sys.exit(1)
         finally:
             shutil.rmtree(tmp)
-        # Copy fastqs
-        nfastqs = sum(1 for _ in get_fastqs(project,pattern=options.pattern))
-        i = 0
-        for sample_name,fastq,fq in get_fastqs(project,pattern=options.pattern):
-            i += 1
-            print "(% 2d/% 2d) %s" % (i,nfastqs,fq)
-            copy_to_dest(fq,dest,chksums[os.path.basename(fq)])
     elif cmd == 'md5':
         # Generate MD5 checksums
         md5file = "%s.chksums" % project.name
@@ -297,7 +413,9 @@ if __name__ == "__main__":
             sys.stderr.write("ERROR checksum file '%s' already exists\n" % md5file)
             sys.exit(1)
         sys.stdout.write("Creating checksum file %s..." % md5file)
-        write_checksums(project,pattern=options.pattern,filen=md5file)
+        write_checksums(project,pattern=options.pattern,filen=md5file,
+                        manifest=manifest)
+        save_checksum_manifest(manifest)
         print "done"
     elif cmd == 'zip':
         # Create a zip file
@@ -315,7 +433,8 @@ if __name__ == "__main__":
         try:
             md5file = os.path.join(tmp,"%s.chksums" % project.name)
             sys.stdout.write("Creating checksum file %s..." % md5file)
-            write_checksums(project,filen=md5file)
+            write_checksums(project,filen=md5file,manifest=manifest)
+            save_checksum_manifest(manifest)
             print "done"
             print("Adding to %s" % zip_file)
             zz.write(md5file,arcname=os.path.basename(md5file))
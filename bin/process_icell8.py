@@ -232,13 +232,12 @@ class ConcatFastqs(PipelineCommand):
     Concatenate reads from multiple Fastqs into a single file
 
     Given a list of Fastq files, combines them into a single
-    Fastq using the 'cat' utility.
+    Fastq using the 'concat_fastqs.py' utility.
 
-    If the output FASTQ names end with .gz then they will be
-    automatically compressed with gzip after concatenation.
+    If the output FASTQ names end with .gz then the data will
+    be compressed as they are written to the output.
 
-    FASTQs cannot be gzipped, and must all be same read number
-    (i.e. R1 or R2).
+    FASTQs must all be same read number (i.e. R1 or R2).
     """
     def init(self,fastqs,concat_dir,fastq_out):
         """
@@ -255,17 +254,9 @@ class ConcatFastqs(PipelineCommand):
         self._concat_dir = os.path.abspath(concat_dir)
         self._fastq_out = fastq_out
     def cmd(self):
-        compress = self._fastq_out.endswith('.gz')
-        if compress:
-            fastq_out = '.'.join(self._fastq_out.split('.')[:-1])
-        else:
-            fastq_out = self._fastq_out
-        fastq_out = os.path.join(self._concat_dir,fastq_out)
-        cmd = Command('cat')
+        cmd = Command('concat_fastqs.py')
         cmd.add_args(*self._fastqs)
-        cmd.add_args('>',fastq_out)
-        if compress:
-            cmd.add_args('&&','gzip',fastq_out)
+        cmd.add_args(os.path.join(self._concat_dir,self._fastq_out))
         return cmd
 
 class TrimFastqPair(PipelineCommand):
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#
+#     reportqc.py: verify QC and generate report for a project
+#     Copyright (C) University of Manchester 2017 Peter Briggs
+#
+#########################################################################
+#
+# reportqc.py
+#
+#########################################################################
+
+"""
+Verifies the QC outputs for an analysis project and generates the
+QC report
+"""
+
+#######################################################################
+# Imports
+#######################################################################
+
+import sys
+import os
+import argparse
+import logging
+from auto_process_ngs.utils import AnalysisProject
+import auto_process_ngs
+
+# Module-specific logger
+logger = logging.getLogger(__name__)
+
+# Versions and settings
+__version__ = auto_process_ngs.get_version()
+
+#######################################################################
+# Main program
+#######################################################################
+
+if __name__ == "__main__":
+    # Make a command line parser
+    p = argparse.ArgumentParser(
+        description="Verify the QC outputs for an analysis project "
+        "and generate the QC report. Exits with a non-zero status "
+        "if the QC couldn't be verified or the report couldn't be "
+        "generated.")
+    p.add_argument('--version', action='version',
+                   version=("%%(prog)s %s" % __version__))
+    p.add_argument("project_dir",metavar="DIR",
+                   help="analysis project directory to report "
+                   "the QC for")
+    p.add_argument('--qc_dir',metavar='QC_DIR',
+                   action='store',dest='qc_dir',default=None,
+                   help="explicitly specify QC output directory. "
+                   "NB if a relative path is supplied then it's assumed "
+                   "to be a subdirectory of DIR (default: <DIR>/qc)")
+    p.add_argument('--fastq_dir',metavar='SUBDIR',
+                   action='store',dest='fastq_dir',default=None,
+                   help="explicitly specify subdirectory of DIR with "
+                   "Fastq files (default: Fastq dir associated with "
+                   "QC_DIR)")
+    p.add_argument('-f','--filename',metavar='NAME',action='store',
+                   dest='filename',default=None,
+                   help="file name for output QC report (default: "
+                   "<DIR>/<QC_DIR>_report.html)")
+    p.add_argument('-t','--title',metavar='TITLE',action='store',
+                   dest='title',default=None,
+                   help="title for the QC report")
+    p.add_argument('--multiqc',metavar='NAME',action='store',
+                   dest='multiqc',default=None,
+                   help="also check that MultiQC report NAME exists "
+                   "(NB if a relative path is supplied then it's "
+                   "assumed to be relative to DIR)")
+
+    # Parse the command line
+    args = p.parse_args()
+
+    # Load the project
+    project_dir = os.path.abspath(args.project_dir)
+    project_name = os.path.basename(project_dir)
+    project = AnalysisProject(project_name,project_dir)
+
+    # Set up QC and Fastq dirs
+    if args.qc_dir is not None:
+        project.use_qc_dir(args.qc_dir)
+    qc_dir = project.qc_dir
+    fastq_dir = args.fastq_dir
+    if fastq_dir is None:
+        fastq_dir = project.qc_info(qc_dir).fastq_dir
+    project.use_fastq_dir(fastq_dir)
+    print "QC output dir: %s" % qc_dir
+    print "Fastq dir    : %s" % project.fastq_dir
+
+    # Output file name
+    if args.filename is None:
+        out_file = '%s_report.html' % os.path.basename(qc_dir)
+    else:
+        out_file = args.filename
+    if not os.path.isabs(out_file):
+        out_file = os.path.join(project.dirn,out_file)
+
+    # Verify the QC and generate the report
+    status = 0
+    if not project.verify_qc(qc_dir=qc_dir):
+        logger.error("%s: QC couldn't be verified" % project.name)
+        status = 1
+    else:
+        print "QC okay, generating report for %s" % project.name
+        if project.qc_report(qc_dir=qc_dir,
+                             title=args.title,
+                             report_html=out_file) is None:
+            logger.error("%s: failed to generate QC report" %
+                         project.name)
+            status = 1
+        else:
+            print "QC report: %s" % out_file
+
+    # Check the MultiQC report
+    if args.multiqc is not None:
+        multiqc_report = args.multiqc
+        if not os.path.isabs(multiqc_report):
+            multiqc_report = os.path.join(project.dirn,multiqc_report)
+        if not os.path.exists(multiqc_report):
+            logger.error("%s: missing MultiQC report" % project.name)
+            status = 1
+    sys.exit(status)
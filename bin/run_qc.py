@@ -191,7 +191,8 @@ if __name__ == "__main__":
     announce("Running QC")
     max_jobs = __settings.general.max_concurrent_jobs
     sched = SimpleScheduler(runner=qc_runner,
-                            max_concurrent=max_jobs)
+                            max_concurrent=max_jobs,
+                            resource_usage=True)
     sched.start()
     for sample in samples:
         print "Checking/setting up for sample '%s'" % sample.name
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+#
+#     sample_fastq.py: randomly sample a subset of reads from a fastq
+#     Copyright (C) University of Manchester 2017 Peter Briggs
+#
+"""
+sample_fastq.py
+
+Randomly sample a subset of reads from a fastq file.
+
+"""
+
+import optparse
+import os
+import sys
+import logging
+from auto_process_ngs.fastq_utils import sample_fastq
+import auto_process_ngs
+
+__version__ = auto_process_ngs.get_version()
+
+if __name__ == "__main__":
+    # Handle command line
+    p = optparse.OptionParser(
+        usage="%prog [OPTIONS] FASTQ FASTQ_OUT",
+        description="Randomly sample a subset of reads from the input "
+        "Fastq file and write them to a new file FASTQ_OUT (which will "
+        "be gzipped if the name ends with '.gz').",
+        version=__version__)
+    p.add_option('-n','--subset',
+                 action="store",dest="subset",type='int',
+                 default=100000,
+                 help="number of reads to sample (default: 100000)")
+    p.add_option('--seed',
+                 action="store",dest="seed",type='int',
+                 default=None,
+                 help="seed for the random number generator (for "
+                 "reproducible sampling)")
+    opts,args = p.parse_args()
+    # Sort out inputs
+    if len(args) != 2:
+        p.error("Need to supply input fastq and output name")
+    fastq,fastq_out = args
+    # Check input exists
+    if not os.path.exists(fastq):
+        logging.critical("Input file '%s' not found" % fastq)
+        sys.exit(1)
+    # Do the sampling
+    try:
+        nreads = sample_fastq(fastq,fastq_out,opts.subset,seed=opts.seed)
+        print "Sampled %d reads from %s into %s" % (nreads,fastq,fastq_out)
+    except Exception as ex:
+        logging.critical("Failed with exception: %s" % ex)
+        sys.exit(1)